@@ -0,0 +1,256 @@
+"""准入控制 - 限制同时发往服务商的请求数，排队请求按客户端轮转公平出队"""
+
+from __future__ import annotations
+
+import asyncio
+import math
+import threading
+import time
+from collections import OrderedDict, deque
+from typing import Callable, Deque, Dict, Optional, Union
+
+from metrics import BucketCounts
+
+# config.json 中 "admission" 段的默认值
+DEFAULT_SETTINGS = {
+    'enabled': False,
+    'max_concurrent': 8,      # 全局同时进行的上游请求数
+    'per_client': 2,          # 单个客户端同时进行的上游请求数
+    'max_queue': 64,          # 等待队列长度上限
+    'max_wait_seconds': 30,   # 预计或实际等待超过该时间时直接返回 503
+}
+
+WAIT_BUCKETS_MS = (10, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000)
+DEPTH_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100)
+HOLD_EWMA_ALPHA = 0.2
+
+
+class AdmissionRejected(Exception):
+    """请求未获准入（队列已满或等待超时），retry_after 为建议的重试秒数"""
+
+    def __init__(self, message: str, retry_after: int) -> None:
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class _Waiter:
+    def __init__(self, client: str, max_wait: float, on_grant: Optional[Callable[[], None]] = None) -> None:
+        self.client = client
+        self.max_wait = max_wait
+        self.on_grant = on_grant  # 放行时在持锁状态下调用，异步等待者用它唤醒事件循环
+        self.event = threading.Event()
+        self.granted = False
+        self.enqueued_at = time.monotonic()
+
+
+class Ticket:
+    """一次准入许可；release() 可重复调用"""
+
+    def __init__(self, controller: Optional["AdmissionController"], client: str) -> None:
+        self._controller = controller
+        self.client = client
+        self.acquired_at = time.monotonic()
+        self.released = False
+
+    def release(self) -> None:
+        if self._controller is not None:
+            self._controller._release(self)
+
+    def __enter__(self) -> "Ticket":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.release()
+
+
+class AdmissionController:
+    """全局上限 + 单客户端上限 + 有界等待队列"""
+
+    def __init__(self, settings: Optional[dict] = None) -> None:
+        self._lock = threading.Lock()
+        self._active_total = 0
+        self._active: Dict[str, int] = {}
+        self._queues: "OrderedDict[str, Deque[_Waiter]]" = OrderedDict()
+        self._queued = 0
+        self._hold_ewma: Optional[float] = None
+        self.admitted = 0
+        self.rejected_queue_full = 0
+        self.rejected_deadline = 0
+        self.timed_out = 0
+        self.abandoned = 0
+        self.wait_ms = BucketCounts(WAIT_BUCKETS_MS)
+        self.queue_depth = BucketCounts(DEPTH_BUCKETS)
+        self.settings = dict(DEFAULT_SETTINGS)
+        self.configure(settings)
+
+    def configure(self, settings: Optional[dict] = None) -> None:
+        merged = dict(DEFAULT_SETTINGS)
+        merged.update({k: v for k, v in (settings or {}).items() if k in DEFAULT_SETTINGS})
+        with self._lock:
+            self.settings = merged
+            # 上限调大时立即放行排队的请求
+            self._dispatch_locked()
+
+    def _estimated_wait_locked(self) -> Optional[float]:
+        """按平均占用时长估计新请求的等待秒数；还没有样本时返回 None"""
+        if self._hold_ewma is None:
+            return None
+        return (self._queued + 1) * self._hold_ewma / max(int(self.settings['max_concurrent']), 1)
+
+    def _retry_after_locked(self) -> int:
+        estimate = self._estimated_wait_locked()
+        if estimate is None:
+            estimate = float(self.settings['max_wait_seconds'])
+        return max(1, math.ceil(estimate))
+
+    def _can_admit_locked(self, client: str) -> bool:
+        return (
+            self._active_total < int(self.settings['max_concurrent'])
+            and self._active.get(client, 0) < int(self.settings['per_client'])
+            and client not in self._queues  # 不插队到同一客户端已排队的请求前面
+        )
+
+    def _grant_locked(self, client: str) -> None:
+        self._active_total += 1
+        self._active[client] = self._active.get(client, 0) + 1
+        self.admitted += 1
+
+    def acquire(self, client: str) -> Ticket:
+        """获取准入许可，必要时排队等待；无法在期限内获得时抛出 AdmissionRejected"""
+        waiter = self._enqueue(client)
+        if isinstance(waiter, Ticket):
+            return waiter
+        waiter.event.wait(waiter.max_wait)
+        return self._finish_wait(waiter)
+
+    async def acquire_async(self, client: str) -> Ticket:
+        """acquire 的协程版本：排队时不占用线程；任务被取消（如客户端断开）时退出队列"""
+        loop = asyncio.get_running_loop()
+        granted = loop.create_future()
+
+        def on_grant() -> None:
+            loop.call_soon_threadsafe(lambda: granted.done() or granted.set_result(None))
+
+        waiter = self._enqueue(client, on_grant)
+        if isinstance(waiter, Ticket):
+            return waiter
+        try:
+            await asyncio.wait({granted}, timeout=waiter.max_wait)
+        except asyncio.CancelledError:
+            self._abandon(waiter)
+            raise
+        return self._finish_wait(waiter)
+
+    def _enqueue(self, client: str, on_grant: Optional[Callable[[], None]] = None) -> Union[Ticket, _Waiter]:
+        """能立即放行时返回许可，否则加入排队并返回等待者；队列已满或预计等待过长时抛出 AdmissionRejected"""
+        with self._lock:
+            if not self.settings['enabled']:
+                return Ticket(None, client)
+            if self._can_admit_locked(client):
+                self._grant_locked(client)
+                self.wait_ms.observe(0.0)
+                return Ticket(self, client)
+
+            max_wait = float(self.settings['max_wait_seconds'])
+            if self._queued >= int(self.settings['max_queue']):
+                self.rejected_queue_full += 1
+                raise AdmissionRejected("服务繁忙：等待队列已满", self._retry_after_locked())
+            estimate = self._estimated_wait_locked()
+            if estimate is not None and estimate > max_wait:
+                self.rejected_deadline += 1
+                raise AdmissionRejected("服务繁忙：预计等待时间过长", self._retry_after_locked())
+
+            self.queue_depth.observe(self._queued)
+            waiter = _Waiter(client, max_wait, on_grant)
+            queue = self._queues.get(client)
+            if queue is None:
+                queue = self._queues[client] = deque()
+            queue.append(waiter)
+            self._queued += 1
+            return waiter
+
+    def _remove_waiter_locked(self, waiter: _Waiter) -> None:
+        queue = self._queues[waiter.client]
+        queue.remove(waiter)
+        if not queue:
+            del self._queues[waiter.client]
+        self._queued -= 1
+
+    def _finish_wait(self, waiter: _Waiter) -> Ticket:
+        """等待结束：已放行则返回许可，否则退出队列并抛出 AdmissionRejected"""
+        with self._lock:
+            if not waiter.granted:
+                self._remove_waiter_locked(waiter)
+                self.timed_out += 1
+                raise AdmissionRejected("服务繁忙：排队超时", self._retry_after_locked())
+        return Ticket(self, waiter.client)
+
+    def _abandon(self, waiter: _Waiter) -> None:
+        """客户端在排队时离开：退出队列；恰好已被放行时立即归还名额"""
+        with self._lock:
+            self.abandoned += 1
+            if waiter.granted:
+                self._free_locked(waiter.client)
+            else:
+                self._remove_waiter_locked(waiter)
+
+    def _release(self, ticket: Ticket) -> None:
+        with self._lock:
+            if ticket.released:
+                return
+            ticket.released = True
+            held = time.monotonic() - ticket.acquired_at
+            self._hold_ewma = held if self._hold_ewma is None else (
+                (1 - HOLD_EWMA_ALPHA) * self._hold_ewma + HOLD_EWMA_ALPHA * held
+            )
+            self._free_locked(ticket.client)
+
+    def _free_locked(self, client: str) -> None:
+        self._active_total -= 1
+        remaining = self._active.get(client, 1) - 1
+        if remaining > 0:
+            self._active[client] = remaining
+        else:
+            self._active.pop(client, None)
+        self._dispatch_locked()
+
+    def _dispatch_locked(self) -> None:
+        """有空位时按客户端轮转放行：每放行一个客户端就把它移到队尾"""
+        # 关闭准入控制时放行所有排队的请求
+        enabled = self.settings['enabled']
+        per_client = int(self.settings['per_client'])
+        while self._queues and (not enabled or self._active_total < int(self.settings['max_concurrent'])):
+            client = next((c for c in self._queues if not enabled or self._active.get(c, 0) < per_client), None)
+            if client is None:
+                break
+            queue = self._queues[client]
+            waiter = queue.popleft()
+            if queue:
+                self._queues.move_to_end(client)
+            else:
+                del self._queues[client]
+            self._queued -= 1
+            self._grant_locked(client)
+            self.wait_ms.observe((time.monotonic() - waiter.enqueued_at) * 1000)
+            waiter.granted = True
+            waiter.event.set()
+            if waiter.on_grant is not None:
+                waiter.on_grant()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'settings': dict(self.settings),
+                'active': self._active_total,
+                'active_by_client': dict(self._active),
+                'queued': self._queued,
+                'queued_by_client': {client: len(queue) for client, queue in self._queues.items()},
+                'admitted': self.admitted,
+                'rejected_queue_full': self.rejected_queue_full,
+                'rejected_deadline': self.rejected_deadline,
+                'timed_out': self.timed_out,
+                'abandoned': self.abandoned,
+                'avg_hold_seconds': round(self._hold_ewma, 3) if self._hold_ewma is not None else None,
+                'wait_ms': self.wait_ms.snapshot(),
+                'queue_depth': self.queue_depth.snapshot(),
+            }
@@ -151,6 +151,16 @@ window.showAISettingsPanel = function() {
                     <div class="setting-hint">控制回复的随机性（0=确定性，2=最随机）</div>
                 </div>
                 
+                <div class="setting-item">
+                    <label>
+                        <span class="setting-label">候选回复数</span>
+                        <span class="setting-value" id="candidates-value">${config.candidates || 1}</span>
+                    </label>
+                    <input type="range" id="candidates" min="1" max="4" step="1" value="${config.candidates || 1}" 
+                           oninput="updateSetting('candidates', parseInt(this.value), 'candidates-value')">
+                    <div class="setting-hint">一次请求同时生成多个回复，可左右切换选择（大于1时按倍数消耗额度）</div>
+                </div>
+                
                 <div class="setting-item">
                     <label>
                         <span class="setting-label">Top P</span>
@@ -391,6 +401,7 @@ window.resetToDefaults = function() {
         config.frontend_max_history = 65536;
         config.frontend_max_response = 10000;
         config.top_p = 1.0;
+        config.candidates = 1;
         config.top_k = 0;
         config.frequency_penalty = 0;
         config.presence_penalty = 0;
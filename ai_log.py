@@ -0,0 +1,407 @@
+"""AI 请求日志 - 只追加的 JSONL 分段日志，由后台线程批量写入并按大小轮转
+
+请求线程只负责把日志序列化后放入有界队列，不再读写整个日志文件；
+"最新的在最上面"由读取端（iter_entries）倒序读取实现。
+
+每个分段旁边有一个 .idx 索引文件，每条日志对应一条定长记录（偏移、长度、时间、错误标记、ID、模型、端点），
+查询时从索引末尾倒序读取，只有按 ID 读取单条日志时才读取完整的请求/响应体。
+
+请求中的对话消息按内容哈希保存在 blobs/ 中，日志只记录已保存的历史前缀的哈希和本轮新增的消息，
+长对话每轮写入的日志量不再随历史长度增长；读取单条日志时再还原完整请求。
+"""
+
+from __future__ import annotations
+
+import atexit
+import json
+import os
+import queue
+import re
+import struct
+import threading
+import time
+import uuid
+from typing import Callable, Iterator, List, Optional, Tuple
+
+from blob_store import BlobStore
+
+# config.json 中 "ai_log" 段的默认值
+DEFAULT_SETTINGS = {
+    'segment_bytes': 4 * 1024 * 1024,  # 单个分段文件达到该大小后轮转
+    'max_segments': 20,                # 最多保留的分段数，超出时删除最早的
+    'max_queue': 1000,                 # 等待写入的日志条数上限，队列满时丢弃新日志
+    'batch_size': 100,                 # 每批最多写入的条数
+    'flush_interval': 0.5,             # 后台线程每批等待的最长秒数
+    'text_log': False,                 # 同时输出易读格式到控制台和 logs/ai_chat.log（在写入线程中还原完整消息，调试时开启）
+    'dedup_messages': True,            # 对话消息按内容哈希去重保存
+    'dedup_min_bytes': 128,            # 短于该字节数的消息直接写在日志中
+}
+
+SEGMENT_PATTERN = re.compile(r'^ai_requests-(\d{6})\.jsonl$')
+
+# 索引记录：偏移、长度、时间戳、标记、ID（8 字节）、模型（48 字节）、端点（115 字节，过长时保留末尾），共 192 字节
+INDEX_RECORD = struct.Struct('<QIdB8s48s115s')
+FLAG_ERROR = 1
+INDEX_READ_BLOCK = 256  # 倒序读取索引时每次读取的记录数
+
+
+def segment_name(number: int) -> str:
+    return f"ai_requests-{number:06d}.jsonl"
+
+
+def index_path(segment_path: str) -> str:
+    return segment_path[:-len('.jsonl')] + '.idx'
+
+
+def _fit(text: str, size: int, keep_tail: bool = False) -> bytes:
+    data = text.encode('utf-8')
+    if len(data) <= size:
+        return data
+    return data[-size:] if keep_tail else data[:size]
+
+
+def _unfit(data: bytes) -> str:
+    return data.rstrip(b'\0').decode('utf-8', errors='ignore')
+
+
+def entry_meta(entry: dict, timestamp: float) -> tuple:
+    """索引记录中除偏移和长度以外的部分"""
+    request = entry.get('request')
+    model = request.get('model') if isinstance(request, dict) else None
+    return (
+        timestamp,
+        FLAG_ERROR if entry.get('error') else 0,
+        bytes.fromhex(entry['id']),
+        _fit(str(model or ''), 48),
+        _fit(str(entry.get('endpoint') or ''), 115, keep_tail=True),
+    )
+
+
+def unpack_record(raw: bytes) -> dict:
+    offset, length, timestamp, flags, entry_id, model, endpoint = INDEX_RECORD.unpack(raw)
+    return {
+        'id': entry_id.hex(),
+        'offset': offset,
+        'length': length,
+        'timestamp': timestamp,
+        'error': bool(flags & FLAG_ERROR),
+        'model': _unfit(model),
+        'endpoint': _unfit(endpoint),
+    }
+
+
+class AILogWriter:
+    """后台批量写入的分段日志
+
+    mirror(entry) 在后台线程中对每条日志调用一次，用于输出易读格式的文本日志；
+    entry 中按哈希保存的消息已还原为完整内容。
+    """
+
+    def __init__(self, log_dir: str, settings: Optional[dict] = None,
+                 mirror: Optional[Callable[[dict], None]] = None) -> None:
+        self.log_dir = log_dir
+        self.mirror = mirror
+        self._lock = threading.Lock()
+        self._index_lock = threading.Lock()
+        self._queue: "queue.Queue[tuple]" = queue.Queue()
+        self._thread: Optional[threading.Thread] = None
+        self._file = None
+        self._index_file = None
+        self._segment_number = 0
+        self._segment_size = 0
+        self.written = 0
+        self.dropped = 0
+        self.batches = 0
+        self.write_errors = 0
+        self.settings = dict(DEFAULT_SETTINGS)
+        self.configure(settings)
+        os.makedirs(log_dir, exist_ok=True)
+        self.blobs = BlobStore(os.path.join(log_dir, 'blobs'))
+        segments = self.segments()
+        self._segment_number = segments[-1][0] if segments else 1
+
+    def configure(self, settings: Optional[dict] = None) -> None:
+        merged = dict(DEFAULT_SETTINGS)
+        merged.update({k: v for k, v in (settings or {}).items() if k in DEFAULT_SETTINGS})
+        self.settings = merged
+
+    def segments(self) -> List[tuple]:
+        """按编号从旧到新返回 (编号, 路径)"""
+        found = []
+        for name in os.listdir(self.log_dir):
+            match = SEGMENT_PATTERN.match(name)
+            if match:
+                found.append((int(match.group(1)), os.path.join(self.log_dir, name)))
+        return sorted(found)
+
+    def submit(self, entry: dict) -> Optional[str]:
+        """序列化日志并放入写入队列，返回日志 ID；队列已满时丢弃并返回 None"""
+        entry = dict(entry, id=uuid.uuid4().hex[:16])
+        if self._queue.qsize() >= int(self.settings['max_queue']):
+            with self._lock:
+                self.dropped += 1
+            return None
+        new_blobs = []
+        request = entry.get('request')
+        if self.settings['dedup_messages'] and isinstance(request, dict) and isinstance(request.get('messages'), list):
+            messages, new_blobs = self.blobs.prepare(request['messages'], int(self.settings['dedup_min_bytes']))
+            entry['request'] = dict(request, messages=messages)
+        line = json.dumps(entry, ensure_ascii=False, default=str)
+        self._ensure_thread()
+        self._queue.put((line, entry_meta(entry, time.time()), new_blobs))
+        return entry['id']
+
+    def _ensure_thread(self) -> None:
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='ai-log-writer', daemon=True)
+                self._thread.start()
+
+    def _run(self) -> None:
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + float(self.settings['flush_interval'])
+            while len(batch) < int(self.settings['batch_size']):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            try:
+                self._write_batch(batch)
+            except Exception as exc:
+                with self._lock:
+                    self.write_errors += 1
+                print(f"[AI日志] 写入失败: {exc}")
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    def _write_batch(self, batch: List[tuple]) -> None:
+        if not batch:
+            return
+        # 先保存新消息，日志中的引用总能找到对应内容；保存成功后之后的请求才会引用它们
+        batch_blobs = [item for _line, _meta, new_blobs in batch for item in new_blobs]
+        try:
+            self.blobs.write(batch_blobs)
+        except Exception:
+            self.blobs.forget(key for key, _data in batch_blobs)
+            raise
+        self.blobs.remember(batch_blobs)
+        encoded = [line.encode('utf-8') for line, _meta, _blobs in batch]
+        data = b'\n'.join(encoded) + b'\n'
+        if self._file is None:
+            self._open_segment()
+        if self._segment_size and self._segment_size + len(data) > int(self.settings['segment_bytes']):
+            self._rotate()
+        records = []
+        offset = self._segment_size
+        for raw, (_line, meta, _blobs) in zip(encoded, batch):
+            records.append(INDEX_RECORD.pack(offset, len(raw), *meta))
+            offset += len(raw) + 1
+        # 先写数据再写索引，索引中的记录总是指向完整的行
+        self._file.write(data)
+        self._file.flush()
+        self._index_file.write(b''.join(records))
+        self._index_file.flush()
+        self._segment_size += len(data)
+        with self._lock:
+            self.written += len(batch)
+            self.batches += 1
+
+        if self.mirror is not None and self.settings['text_log']:
+            for line, _meta, _blobs in batch:
+                try:
+                    self.mirror(self.expand_entry(json.loads(line)))
+                except Exception as exc:
+                    print(f"[AI日志] 文本日志输出失败: {exc}")
+
+    def _open_segment(self) -> None:
+        path = os.path.join(self.log_dir, segment_name(self._segment_number))
+        with self._index_lock:
+            if os.path.exists(path):
+                # 上次异常退出或旧版本写入的分段先补齐索引
+                self._check_index(path)
+            self._file = open(path, 'ab')
+            self._index_file = open(index_path(path), 'ab')
+        self._segment_size = self._file.tell()
+
+    def _rotate(self) -> None:
+        self._file.close()
+        self._index_file.close()
+        self._segment_number += 1
+        self._open_segment()
+        segments = self.segments()
+        expired = segments[:max(0, len(segments) - int(self.settings['max_segments']))]
+        for _number, path in expired:
+            for stale_path in (path, index_path(path)):
+                try:
+                    os.remove(stale_path)
+                except OSError:
+                    pass
+        if expired:
+            self._collect_blobs()
+
+    def _collect_blobs(self) -> None:
+        """删除留存的日志分段都不再引用的消息"""
+        removed = self.blobs.collect(path for _number, path in self.segments())
+        if removed:
+            print(f"[AI日志] 已清理 {removed} 个不再被引用的消息对象")
+
+    def _check_index(self, path: str) -> None:
+        """索引缺失或与数据不一致时扫描分段重建（需持有 _index_lock）"""
+        idx_path = index_path(path)
+        data_size = os.path.getsize(path)
+        try:
+            idx_size = os.path.getsize(idx_path)
+        except OSError:
+            idx_size = -1
+        if idx_size == 0 and data_size == 0:
+            return
+        if idx_size > 0 and idx_size % INDEX_RECORD.size == 0:
+            with open(idx_path, 'rb') as f:
+                f.seek(idx_size - INDEX_RECORD.size)
+                last = unpack_record(f.read(INDEX_RECORD.size))
+            if last['offset'] + last['length'] + 1 == data_size:
+                return
+
+        records = []
+        offset = 0
+        with open(path, 'rb') as f:
+            for raw in f:
+                line = raw.rstrip(b'\n')
+                if raw.endswith(b'\n') and line:
+                    try:
+                        entry = json.loads(line)
+                        timestamp = time.mktime(time.strptime(entry['timestamp'][:19], '%Y-%m-%dT%H:%M:%S'))
+                        records.append(INDEX_RECORD.pack(offset, len(line), *entry_meta(entry, timestamp)))
+                    except (ValueError, KeyError, TypeError):
+                        pass
+                offset += len(raw)
+        temp_path = idx_path + '.tmp'
+        with open(temp_path, 'wb') as f:
+            f.write(b''.join(records))
+        os.replace(temp_path, idx_path)
+        print(f"[AI日志] 已重建索引 {os.path.basename(idx_path)}（{len(records)} 条）")
+
+    def _index_records(self, number: int, path: str) -> Iterator[dict]:
+        """倒序读取一个分段的索引记录"""
+        with self._index_lock:
+            # 正在写入的分段由写入线程维护索引，其余分段在读取前检查一次
+            if not (self._file is not None and number == self._segment_number):
+                try:
+                    self._check_index(path)
+                except OSError:
+                    return
+        try:
+            f = open(index_path(path), 'rb')
+        except OSError:
+            return
+        with f:
+            f.seek(0, os.SEEK_END)
+            count = f.tell() // INDEX_RECORD.size
+            while count > 0:
+                start = max(0, count - INDEX_READ_BLOCK)
+                f.seek(start * INDEX_RECORD.size)
+                block = f.read((count - start) * INDEX_RECORD.size)
+                for position in range(len(block) - INDEX_RECORD.size, -1, -INDEX_RECORD.size):
+                    yield unpack_record(block[position:position + INDEX_RECORD.size])
+                count = start
+
+    def iter_records(self) -> Iterator[Tuple[str, dict]]:
+        """从新到旧遍历 (分段路径, 索引记录)"""
+        for number, path in reversed(self.segments()):
+            for record in self._index_records(number, path):
+                yield path, record
+
+    def query(self, since: Optional[float] = None, until: Optional[float] = None,
+              endpoint: Optional[str] = None, model: Optional[str] = None, errors_only: bool = False,
+              offset: int = 0, limit: int = 50) -> Tuple[List[dict], bool]:
+        """按条件从新到旧查询日志摘要，只读取索引；返回 (摘要列表, 是否还有更多)"""
+        results: List[dict] = []
+        skipped = 0
+        for _path, record in self.iter_records():
+            if since is not None and record['timestamp'] < since:
+                break
+            if until is not None and record['timestamp'] > until:
+                continue
+            if errors_only and not record['error']:
+                continue
+            if endpoint and endpoint not in record['endpoint']:
+                continue
+            if model and model != record['model']:
+                continue
+            if skipped < offset:
+                skipped += 1
+                continue
+            if len(results) >= limit:
+                return results, True
+            results.append(record)
+        return results, False
+
+    def get_entry(self, entry_id: str, expand: bool = True) -> Optional[dict]:
+        """按 ID 读取完整的日志（包括请求和响应体）；expand 为 True 时还原按哈希保存的消息"""
+        for path, record in self.iter_records():
+            if record['id'] == entry_id:
+                entry = self._read_entry(path, record)
+                if entry is not None and expand:
+                    self.expand_entry(entry)
+                return entry
+        return None
+
+    def expand_entry(self, entry: dict) -> dict:
+        request = entry.get('request')
+        if isinstance(request, dict) and isinstance(request.get('messages'), list):
+            request['messages'] = self.blobs.expand(request['messages'])
+        return entry
+
+    @staticmethod
+    def _read_entry(path: str, record: dict) -> Optional[dict]:
+        try:
+            with open(path, 'rb') as f:
+                f.seek(record['offset'])
+                return json.loads(f.read(record['length']))
+        except (OSError, ValueError):
+            return None
+
+    def flush(self) -> None:
+        """等待队列中的日志全部写入"""
+        if self._thread is not None and self._thread.is_alive():
+            self._queue.join()
+
+    def close(self) -> None:
+        self.flush()
+        if self._file is not None:
+            self._file.close()
+            self._index_file.close()
+            self._file = None
+            self._index_file = None
+
+    def iter_entries(self) -> Iterator[dict]:
+        """从新到旧遍历日志（只包含已写入磁盘的部分）"""
+        for path, record in self.iter_records():
+            entry = self._read_entry(path, record)
+            if entry is not None:
+                yield self.expand_entry(entry)
+
+    def stats(self) -> dict:
+        segments = self.segments()
+        with self._lock:
+            return {
+                'settings': dict(self.settings),
+                'queued': self._queue.qsize(),
+                'written': self.written,
+                'dropped': self.dropped,
+                'batches': self.batches,
+                'write_errors': self.write_errors,
+                'segments': len(segments),
+                'bytes': sum(os.path.getsize(path) for _number, path in segments),
+                'blobs': self.blobs.stats(),
+            }
+
+
+def register_shutdown(writer: AILogWriter) -> None:
+    """进程退出前写完队列中的日志"""
+    atexit.register(writer.close)
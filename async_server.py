@@ -0,0 +1,534 @@
+"""异步流式引擎 - 用单个事件循环承载大量并发 SSE 流
+
+用法:
+    pip install aiohttp uvicorn
+    python async_server.py            # 监听 0.0.0.0:5000
+
+流式的 /api/chat/completions 在事件循环中直接转发，准入排队也在事件循环中等待，不再占用线程；
+其余所有接口（包括非流式对话）原样交给 Flask 应用在线程池中处理，
+因此请求/响应格式与 log_ai_request 的记录方式和 server.py 完全一致。
+交给 Flask 的对话请求（非流式、多候选、续传）使用单独的线程池，长时间的流不会占满其他接口的线程。
+
+断线重连依赖 Flask 路径中的广播/重放缓冲区：带 Last-Event-ID 的续传请求总是交给 Flask，
+开启 stream_replay 时流式对话也全部交给 Flask。异步引擎转发的流不参与请求合并（single_flight）：
+相同的请求各自连接服务商，/api/singleflight/stats 中 stream_coalescing 为 false。
+"""
+
+from __future__ import annotations
+
+import asyncio
+import io
+import json
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+try:
+    import aiohttp
+    AIOHTTP_AVAILABLE = True
+except ImportError:
+    aiohttp = None  # type: ignore[assignment]
+    AIOHTTP_AVAILABLE = False
+    print("提示: 未安装 aiohttp，异步流式引擎不可用（pip install aiohttp uvicorn）")
+
+import admission
+import metrics
+import tracing
+import server
+import sse_stream
+import upstream_router
+
+CHAT_COMPLETIONS_PATH = '/api/chat/completions'
+WSGI_BUFFER_CHUNKS = 64  # 桥接 Flask 响应时最多缓存的数据块数，客户端读得慢时 Flask 线程等待
+_END_OF_BODY = object()
+
+
+class AsyncStreamingApp:
+    """ASGI 应用：流式对话走异步引擎，其余请求桥接到 Flask"""
+
+    def __init__(self, wsgi_app, max_workers: int = 32, chat_workers: int = 64) -> None:
+        self.wsgi_app = wsgi_app
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='flask')
+        self.chat_executor = ThreadPoolExecutor(max_workers=chat_workers, thread_name_prefix='flask-chat')
+        if AIOHTTP_AVAILABLE:
+            server.ASYNC_STREAMING = True
+        self._session: Optional["aiohttp.ClientSession"] = None
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self._lifespan(receive, send)
+            return
+        if scope['type'] != 'http':
+            return
+
+        body = await _read_body(receive)
+        if (AIOHTTP_AVAILABLE and scope['method'] == 'POST' and scope['path'] == CHAT_COMPLETIONS_PATH
+                and _header(scope, b'last-event-id') is None and not server.replay_store.enabled):
+            data = _parse_json_body(scope, body)
+            if data is not None and _wants_stream(data):
+                trace = server.tracer.start('chat_completions', force=_header(scope, b'x-trace') == b'1')
+                await self._stream_chat(data, receive, send, _client_id(scope), trace)
+                return
+        executor = self.chat_executor if scope['path'] == CHAT_COMPLETIONS_PATH else self.executor
+        await self._call_wsgi(scope, body, receive, send, executor)
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                if self._session is not None:
+                    await self._session.close()
+                self.executor.shutdown(wait=False)
+                self.chat_executor.shutdown(wait=False)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    def _get_session(self) -> "aiohttp.ClientSession":
+        """共享的异步连接池，参数取自 config.json 的 "upstream" 段"""
+        if self._session is None or self._session.closed:
+            settings = server.upstream.settings
+            connector = aiohttp.TCPConnector(
+                limit=int(settings['async_max_connections']),
+                force_close=not settings['keep_alive'],
+            )
+            timeout = aiohttp.ClientTimeout(
+                sock_connect=float(settings['connect_timeout']),
+                sock_read=float(settings['read_timeout']),
+            )
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=timeout,
+                read_bufsize=2 ** 20,
+            )
+        return self._session
+
+    async def _open_upstream(self, request_data: dict, headers: dict, attempted: Optional[list] = None):
+        """连接上游；所有上游都失败时按 server.retry 的策略退避后整体重试（仍在输出第一个字节之前）
+
+        attempted 不为 None 时依次追加尝试过的上游，失败时调用方据此记录实际请求的地址。
+        """
+        policy = server.retry
+        idempotent = policy.completions_idempotent
+        policy.begin()
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                response, target = await self._open_routed(request_data, headers, idempotent, attempted)
+            except Exception as exc:
+                delay = policy.next_delay(attempt, error=exc, idempotent=idempotent)
+                if delay is None:
+                    policy.finish(attempt, False)
+                    raise
+                reason = f"{type(exc).__name__}: {exc}"
+            else:
+                delay = policy.next_delay(attempt, status=response.status, headers=response.headers, idempotent=idempotent)
+                if delay is None:
+                    policy.finish(attempt, response.status < 400)
+                    return response, target
+                reason = f"HTTP {response.status}"
+                response.release()
+            print(f"[重试] 第 {attempt} 次请求失败（{reason}），{delay:.1f} 秒后重试")
+            await asyncio.sleep(delay)
+
+    async def _open_routed(self, request_data: dict, headers: dict, idempotent: bool,
+                           attempted: Optional[list] = None):
+        """按 server.router 的顺序连接上游，拿到响应头之前的连接错误、429、5xx 切换到下一个
+
+        与 UpstreamRouter.request 相同，非幂等请求只在连接失败和 429/503 时切换。
+        """
+        router = server.router
+        targets = router.candidates(request_data['model'])
+        if not targets:
+            raise ValueError("没有可用的上游（请检查 api_url 或 upstreams 配置）")
+        last_error: Optional[BaseException] = None
+        for attempt, target in enumerate(targets):
+            if attempt:
+                router.record_failover()
+            if attempted is not None:
+                attempted.append(target)
+            started = time.monotonic()
+            try:
+                response = await self._get_session().post(
+                    target.url('/chat/completions'), headers=target.headers(headers), json=request_data
+                )
+            except (aiohttp.ClientError, asyncio.TimeoutError) as exc:
+                router.record(target, False)
+                metrics.upstream_responses.labels(target.name, '/chat/completions', 'error').inc()
+                last_error = exc
+                print(f"[上游路由] {target.name} 请求失败: {exc}")
+                if not upstream_router.can_fail_over(idempotent, error=exc):
+                    raise
+                continue
+            metrics.upstream_responses.labels(target.name, '/chat/completions', response.status).inc()
+            if upstream_router.is_retryable_status(response.status):
+                router.record(target, False)
+                if attempt < len(targets) - 1 and upstream_router.can_fail_over(idempotent, status_code=response.status):
+                    print(f"[上游路由] {target.name} 返回 {response.status}，切换到下一个上游")
+                    response.release()
+                    continue
+                return response, target
+            router.record(target, True, time.monotonic() - started)
+            return response, target
+        raise last_error
+
+    async def _stream_chat(self, data: dict, receive, send, client_id: str, trace=tracing.NULL_TRACE) -> None:
+        """异步版本的流式对话转发，输出格式与 server.chat_completions 相同"""
+        loop = asyncio.get_running_loop()
+        original_request = data.copy()  # 保存原始请求用于日志记录
+        with trace.span('parse'):
+            request_data = server.build_chat_request(data)
+        trace.set('model', request_data['model'])
+        request_started = time.monotonic()
+        model = request_data['model']
+        metrics.chat_requests.labels(model, 'true').inc()
+        sent = metrics.bytes_proxied.labels(model)
+        headers = server.upstream_headers()
+        endpoint = server.default_completion_endpoint()
+        attempted = []  # 尝试过的上游，出错时记录最后一个
+        accumulated_content = []  # 累积响应内容用于日志
+        settings = server.stream_settings()
+        collector = None
+        started = False
+        pump_started = first_at = None
+
+        def content_parts():
+            return collector.content_parts() if collector else accumulated_content
+
+        async def send_chunk(body: bytes, more_body: bool = True) -> None:
+            # 与 Flask 一样，首个数据块到来时才发送响应头；之前出错则由服务器返回 500
+            nonlocal started, first_at
+            if not started:
+                started = True
+                metrics.time_to_first_token.labels(model).observe(time.monotonic() - request_started)
+                first_at = time.perf_counter()
+                trace.add('ttfb', first_at - pump_started, pump_started)
+                response_headers = [(b'content-type', b'text/event-stream')]
+                if trace.sampled:
+                    response_headers.append((b'server-timing', trace.server_timing().encode('latin-1')))
+                    response_headers.append((b'x-trace-id', trace.trace_id.encode('ascii')))
+                await send({
+                    'type': 'http.response.start',
+                    'status': 200,
+                    'headers': response_headers,
+                })
+            sent.inc(len(body))
+            await send({'type': 'http.response.body', 'body': body, 'more_body': more_body})
+
+        async def pump() -> None:
+            nonlocal collector, endpoint, pump_started
+            pump_started = time.perf_counter()
+            try:
+                with trace.span('upstream'):
+                    response, target = await self._open_upstream(request_data, headers, attempted)
+            except Exception:
+                if attempted:
+                    endpoint = attempted[-1].url('/chat/completions')
+                raise
+            endpoint = target.url('/chat/completions')
+            async with response:
+                if settings['coalesce']:
+                    coalescer = sse_stream.DeltaCoalescer(settings['coalesce_window_ms'], settings['coalesce_max_bytes'])
+                    async for raw_line in response.content:
+                        line = raw_line.rstrip(b'\r\n')
+                        if line:
+                            line_str = line.decode('utf-8')
+                            if line_str.startswith('data: '):
+                                chunk_data = sse_stream.parse_stream_line(line_str, accumulated_content)
+                                for frame in coalescer.feed(line_str, chunk_data):
+                                    await send_chunk(frame.encode('utf-8'))
+                    for frame in coalescer.flush():
+                        await send_chunk(frame.encode('utf-8'))
+                elif settings['passthrough']:
+                    # 透传模式：原样转发到达的字节块，结束后再解析内容
+                    collector = sse_stream.SSEContentCollector()
+                    async for chunk in response.content.iter_any():
+                        await send_chunk(chunk)
+                        collector.feed(chunk)
+                else:
+                    async for raw_line in response.content:
+                        line = raw_line.rstrip(b'\r\n')
+                        if line:
+                            line_str = line.decode('utf-8')
+                            if line_str.startswith('data: '):
+                                await send_chunk((line_str + '\n\n').encode('utf-8'))
+                                sse_stream.accumulate_stream_line(line_str, accumulated_content)
+
+        # 客户端断开时 uvicorn 不会让 send 报错，需要单独监听 http.disconnect
+        disconnect_task = asyncio.ensure_future(_wait_for_disconnect(receive))
+        # 准入控制可能需要排队：在事件循环中等待，不占用线程；排队期间客户端断开则退出队列
+        admission_task = asyncio.ensure_future(server.admission_controller.acquire_async(client_id))
+        with trace.span('admission'):
+            await asyncio.wait({admission_task, disconnect_task}, return_when=asyncio.FIRST_COMPLETED)
+        if not admission_task.done():
+            admission_task.cancel()
+            try:
+                (await admission_task).release()  # 取消之前恰好获准入
+            except (asyncio.CancelledError, admission.AdmissionRejected):
+                pass
+            trace.set('cancelled', True)
+            trace.finish()
+            return
+        try:
+            ticket = admission_task.result()
+        except admission.AdmissionRejected as exc:
+            disconnect_task.cancel()
+            trace.finish(503)
+            await _send_json(send, 503, {'error': str(exc)}, [(b'retry-after', str(exc.retry_after).encode('ascii'))])
+            return
+
+        pump_task = asyncio.ensure_future(pump())
+        active = metrics.active_streams.labels(model)
+        active.inc()
+        try:
+            await asyncio.wait({pump_task, disconnect_task}, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            disconnect_task.cancel()
+            active.dec()
+            if first_at is not None:
+                trace.add('stream', time.perf_counter() - first_at, first_at)
+            if pump_task.done():
+                ticket.release()
+
+        if not pump_task.done():
+            # 用户中止：取消任务会退出 async with，立即关闭上游响应并释放连接
+            pump_task.cancel()
+            try:
+                await pump_task
+            except asyncio.CancelledError:
+                pass
+            finally:
+                ticket.release()
+            server.log_cancelled_stream(endpoint, original_request, request_data, content_parts)
+            trace.set('cancelled', True)
+            trace.finish(200)
+            return
+
+        error = pump_task.exception()
+        if error is not None:
+            await loop.run_in_executor(
+                self.executor, lambda: server.log_ai_request(endpoint, original_request, error=error)
+            )
+            trace.finish(500)
+            if not started:
+                await _send_json(send, 500, {'error': str(error)})
+                return
+            # 已经发送了 200 响应头：在流中输出一帧 error，然后正常结束响应
+            frame = {'error': {'message': str(error)}, 'choices': [{'index': 0, 'delta': {}, 'finish_reason': 'error'}]}
+            await send_chunk(('data: ' + json.dumps(frame, ensure_ascii=False) + '\n\n').encode('utf-8'), more_body=False)
+            return
+
+        # 流式响应完成后记录（透传模式的内容解析也在线程池中完成，不占用事件循环）
+        def log_completion():
+            parts = content_parts()
+            sse_stream.stream_stats.record_completed(request_data['model'], len(parts))
+            metrics.record_stream_done(model, request_started, sum(map(len, parts)))
+            complete_response = server.build_stream_log_response(parts)
+            with trace.span('log'):
+                server.log_ai_request(endpoint, original_request, complete_response)
+
+        await loop.run_in_executor(self.executor, log_completion)
+        await send_chunk(b'', more_body=False)
+        trace.finish(200)
+
+    async def _call_wsgi(self, scope, body: bytes, receive, send, executor: ThreadPoolExecutor) -> None:
+        """在线程池 executor 中运行 Flask 应用并把结果转成 ASGI 消息
+
+        同一个请求的 WSGI 调用和响应迭代都放在同一个线程里完成，
+        这样 stream_with_context 推入的请求上下文可以在原线程弹出。
+        最多缓存 WSGI_BUFFER_CHUNKS 个数据块；客户端断开后 Flask 线程停止迭代并关闭响应，
+        交给 Flask 的流（如多候选）随之关闭上游连接。
+        迭代响应时出错：还没有发送响应头则返回 500，否则记录错误并结束响应。
+        """
+        loop = asyncio.get_running_loop()
+        environ = _build_environ(scope, body)
+        queue: asyncio.Queue = asyncio.Queue()
+        slots = threading.Semaphore(WSGI_BUFFER_CHUNKS)
+        disconnected = threading.Event()
+        response_start = {}
+        failure = {}
+
+        def start_response(status, headers, exc_info=None):
+            response_start['status'] = int(status.split(' ', 1)[0])
+            response_start['headers'] = [
+                (name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers
+            ]
+            return lambda data: None
+
+        def run_wsgi():
+            result = None
+            try:
+                result = self.wsgi_app(environ, start_response)
+                for chunk in result:
+                    if not chunk:
+                        continue
+                    # 缓存已满时等待事件循环发送，客户端断开则不再继续读取
+                    while not slots.acquire(timeout=0.5):
+                        if disconnected.is_set():
+                            break
+                    if disconnected.is_set():
+                        break
+                    loop.call_soon_threadsafe(queue.put_nowait, chunk)
+            except Exception as exc:
+                failure['error'] = exc
+                print(f"[异步引擎] {environ['PATH_INFO']} 的 Flask 响应出错: {exc}")
+            finally:
+                try:
+                    close = getattr(result, 'close', None)
+                    if close is not None:
+                        close()
+                finally:
+                    loop.call_soon_threadsafe(queue.put_nowait, _END_OF_BODY)
+
+        future = loop.run_in_executor(executor, run_wsgi)
+        disconnect_task = asyncio.ensure_future(_wait_for_disconnect(receive))
+        started = False
+        try:
+            while True:
+                get_task = asyncio.ensure_future(queue.get())
+                await asyncio.wait({get_task, disconnect_task}, return_when=asyncio.FIRST_COMPLETED)
+                if not get_task.done():
+                    # 客户端断开：通知 Flask 线程停止，等待它关闭响应
+                    get_task.cancel()
+                    disconnected.set()
+                    await future
+                    return
+                chunk = get_task.result()
+                if not started:
+                    started = True
+                    if 'status' not in response_start:
+                        # Flask 没有调用 start_response 就结束（或出错）：不能只发送响应体
+                        await future
+                        error = failure.get('error')
+                        await _send_json(send, 500, {'error': str(error) if error else "服务器内部错误"})
+                        return
+                    await send({
+                        'type': 'http.response.start',
+                        'status': response_start['status'],
+                        'headers': response_start['headers'],
+                    })
+                if chunk is _END_OF_BODY:
+                    break
+                await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+                slots.release()
+        finally:
+            disconnect_task.cancel()
+        await future
+        await send({'type': 'http.response.body', 'body': b'', 'more_body': False})
+
+
+async def _send_json(send, status: int, payload: dict, headers: Optional[list] = None) -> None:
+    """发送完整的 JSON 响应（与 Flask 路径的 jsonify 错误格式相同）"""
+    body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(b'content-type', b'application/json')] + (headers or []),
+    })
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def _wait_for_disconnect(receive) -> None:
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            return
+
+
+async def _read_body(receive) -> bytes:
+    chunks = []
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            break
+        chunks.append(message.get('body', b''))
+        if not message.get('more_body'):
+            break
+    return b''.join(chunks)
+
+
+def _parse_json_body(scope, body: bytes) -> Optional[dict]:
+    """仅在 Content-Type 为 JSON 且能解析时返回请求体，否则交给 Flask 给出原有的错误响应"""
+    content_type = b''
+    for name, value in scope['headers']:
+        if name == b'content-type':
+            content_type = value
+            break
+    if not content_type.split(b';')[0].strip().endswith(b'json'):
+        return None
+    try:
+        data = json.loads(body)
+    except ValueError:
+        return None
+    return data if isinstance(data, dict) else None
+
+
+def _header(scope, name: bytes) -> Optional[bytes]:
+    for header_name, value in scope.get('headers', []):
+        if header_name == name:
+            return value
+    return None
+
+
+def _client_id(scope) -> str:
+    """与 server.admission_client_id 相同：按来源地址"""
+    client = scope.get('client')
+    return client[0] if client else 'anonymous'
+
+
+def _wants_stream(data: dict) -> bool:
+    # 多候选请求需要同时转发多个上游流，交给 Flask 处理
+    return bool(data.get('stream', server.config.get('streaming', True))) and server.requested_candidates(data) == 1
+
+
+def _build_environ(scope, body: bytes) -> dict:
+    """由 ASGI scope 构造 WSGI environ"""
+    server_name, server_port = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+    path = scope.get('root_path', '') + scope['path']
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': '',
+        'PATH_INFO': path.encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': server_name,
+        'SERVER_PORT': str(server_port),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'REMOTE_ADDR': client[0],
+        'REMOTE_PORT': str(client[1]),
+        'CONTENT_LENGTH': str(len(body)),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False,
+    }
+    for raw_name, raw_value in scope['headers']:
+        name = raw_name.decode('latin-1').upper().replace('-', '_')
+        value = raw_value.decode('latin-1')
+        if name == 'CONTENT_TYPE':
+            environ['CONTENT_TYPE'] = value
+        elif name != 'CONTENT_LENGTH':
+            key = f"HTTP_{name}"
+            environ[key] = f"{environ[key]},{value}" if key in environ else value
+    return environ
+
+
+app = AsyncStreamingApp(server.app)
+
+
+if __name__ == '__main__':
+    try:
+        import uvicorn
+    except ImportError:
+        print("请先安装 uvicorn: pip install uvicorn aiohttp")
+        sys.exit(1)
+    print("异步服务器启动在 http://0.0.0.0:5000")
+    print("日志文件位置: logs/ai_requests/（JSONL），logs/ai_chat.log（文本）")
+    uvicorn.run(app, host='0.0.0.0', port=5000, log_level='info')
@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+对话搜索基准测试 - 生成随机的中英文对话，测量索引建立时间、内存占用和各类查询的延迟
+
+用法:
+    python bench_search.py                        # 默认 300 个对话 × 1000 条消息
+    python bench_search.py --chats 50 --messages 2000 --repeat 10
+"""
+
+import argparse
+import random
+import tempfile
+import time
+
+import chat_search
+import storage
+
+CJK_POOL = ('的一是在不了有和人这中大为上个国我以要他时来用们生到作地于出就分对成会可主发年动同工也能下过子说产种面而方后多定行学法所民得经'
+            '十三之进着等部度家电力里如水化高自二理起小物现实加量都两体制机当使点从业本去把性好应开它合还因由其些然前外天政四日那社义事平形')
+WORDS = ('hello', 'world', 'dragon', 'sword', 'magic', 'castle')
+RARE_PHRASE = '樱花飘落的季节'
+
+QUERIES = (
+    ('罕见短语', '樱花飘落'),
+    ('引号短语', f'"{RARE_PHRASE}"'),
+    ('常见双字', '的是'),
+    ('单个汉字', '经'),
+    ('最常见单字', '的'),
+    ('英文单词', 'dragon'),
+    ('英文多词', 'dragon magic'),
+    ('英文短语', '"hello world"'),
+    ('不存在', 'xyz'),
+)
+
+
+def generate(store, chats, messages):
+    random.seed(1)
+    total = 0
+    for number in range(chats):
+        month = number % 12 + 1
+        entries = []
+        for index in range(messages):
+            text = ''.join(random.choice(CJK_POOL) for _ in range(random.randint(40, 200)))
+            if random.random() < 0.2:
+                text += ' ' + ' '.join(random.sample(WORDS, 2))
+            if random.random() < 0.001:
+                text += RARE_PHRASE
+            entries.append({'name': 'x', 'is_user': index % 2 == 0, 'mes': text,
+                            'send_date': f'2024-{month:02d}-01T00:00:00'})
+        metadata = {'user_name': 'User', 'character_name': f'char{number % 10}',
+                    'create_date': f'2024-{month:02d}-01', 'chat_metadata': {'title': f'chat{number}'}}
+        store.chat(f'char{number % 10}', f'chat{number}').write_all(metadata, entries)
+        total += len(entries)
+    return total
+
+
+def main():
+    parser = argparse.ArgumentParser(description="对话全文搜索基准测试")
+    parser.add_argument('--chats', type=int, default=300, help='对话数量')
+    parser.add_argument('--messages', type=int, default=1000, help='每个对话的消息数')
+    parser.add_argument('--repeat', type=int, default=5, help='每个查询重复次数（取最快一次）')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as data_dir:
+        store = storage.open_storage(data_dir, backend='sqlite')
+        print("=" * 64)
+        total = generate(store, args.chats, args.messages)
+        print(f"对话搜索基准: {args.chats} 个对话, 共 {total} 条消息, 每个查询取 {args.repeat} 次中最快一次")
+        print("=" * 64)
+
+        index = chat_search.ChatSearchIndex(store)
+        started = time.perf_counter()
+        index.start()
+        while not index.stats()['ready']:
+            time.sleep(0.05)
+        stats = index.stats()
+        print(f"建立索引 {time.perf_counter() - started:.1f} 秒, 索引词 {stats['tokens']} 个, "
+              f"倒排表 {stats['postings_bytes'] / 2 ** 20:.1f} MB")
+        print("-" * 64)
+
+        slowest = 0.0
+        for label, query in QUERIES:
+            best = float('inf')
+            for _ in range(args.repeat):
+                started = time.perf_counter()
+                _results, matched, truncated = index.search(query)
+                best = min(best, time.perf_counter() - started)
+            slowest = max(slowest, best)
+            note = '（只检查最新的候选）' if truncated else ''
+            print(f"{label:<8} {query:<16} 匹配 {matched:>7} 条  {best * 1000:8.1f} ms{note}")
+
+        started = time.perf_counter()
+        _results, matched, _truncated = index.search('dragon', character='char3', date_from='2024-05', date_to='2024-06')
+        print(f"{'按角色和日期过滤':<8} {'dragon':<16} 匹配 {matched:>7} 条  {(time.perf_counter() - started) * 1000:8.1f} ms")
+        print("-" * 64)
+        print(f"最慢的查询: {slowest * 1000:.1f} ms")
+        store.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+SSE 转发基准测试 - 对比逐行转发、零解码透传与增量合并的单流 CPU 开销和写出次数
+
+用法:
+    python bench_sse.py                    # 默认 2000 个 token，每次网络读取到达 4 帧
+    python bench_sse.py --tokens 5000 --frames-per-read 1 --streams 20
+"""
+
+import argparse
+import io
+import json
+import time
+
+from requests.models import Response
+from urllib3.response import HTTPResponse
+
+import sse_stream
+
+
+class _ArrivalFile(io.RawIOBase):
+    """模拟网络到达：每次读取最多返回一个"网络包"的数据"""
+
+    def __init__(self, packets):
+        self._packets = list(packets)
+        self._current = b''
+
+    def readable(self):
+        return True
+
+    def _next(self, size):
+        if not self._current and self._packets:
+            self._current = self._packets.pop(0)
+        if size is None or size < 0:
+            size = len(self._current)
+        data, self._current = self._current[:size], self._current[size:]
+        return data
+
+    def read(self, size=-1):
+        return self._next(size)
+
+    def read1(self, size=-1):
+        return self._next(size)
+
+    def readinto(self, buffer):
+        data = self._next(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+
+def build_frames(tokens):
+    frames = []
+    for i in range(tokens):
+        chunk = {
+            "id": "chatcmpl-bench",
+            "object": "chat.completion.chunk",
+            "model": "bench-model",
+            "choices": [{"index": 0, "delta": {"content": f"字{i % 10}"}, "finish_reason": None}],
+        }
+        frames.append(b'data: ' + json.dumps(chunk, ensure_ascii=False).encode('utf-8') + b'\n\n')
+    frames.append(b'data: ' + json.dumps({
+        "id": "chatcmpl-bench", "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]
+    }).encode('utf-8') + b'\n\n')
+    frames.append(b'data: [DONE]\n\n')
+    return frames
+
+
+def make_response(frames, frames_per_read):
+    packets = [b''.join(frames[i:i + frames_per_read]) for i in range(0, len(frames), frames_per_read)]
+    response = Response()
+    response.status_code = 200
+    response.raw = HTTPResponse(body=_ArrivalFile(packets), preload_content=False, decode_content=True)
+    return response
+
+
+def run_lines(frames, frames_per_read):
+    accumulated = []
+    writes = 0
+    for _ in sse_stream.relay_lines(make_response(frames, frames_per_read), accumulated):
+        writes += 1
+    return writes, 0.0, "".join(accumulated)
+
+
+def run_passthrough(frames, frames_per_read):
+    collector = sse_stream.SSEContentCollector()
+    writes = 0
+    for _ in sse_stream.relay_passthrough(make_response(frames, frames_per_read), collector):
+        writes += 1
+    start = time.process_time()
+    content = "".join(collector.content_parts())
+    return writes, time.process_time() - start, content
+
+
+def run_coalesced(frames, frames_per_read):
+    accumulated = []
+    writes = 0
+    coalescer = sse_stream.DeltaCoalescer(window_ms=50, max_bytes=2048)
+    for _ in sse_stream.relay_coalesced(make_response(frames, frames_per_read), accumulated, coalescer):
+        writes += 1
+    return writes, 0.0, "".join(accumulated)
+
+
+def measure(func, frames, frames_per_read, streams):
+    hot_total = 0.0
+    sidecar_total = 0.0
+    writes = 0
+    content = ''
+    for _ in range(streams):
+        start = time.process_time()
+        writes, sidecar, content = func(frames, frames_per_read)
+        hot_total += time.process_time() - start - sidecar
+        sidecar_total += sidecar
+    return hot_total / streams * 1000, sidecar_total / streams * 1000, writes, content
+
+
+def main():
+    parser = argparse.ArgumentParser(description="SSE 转发模式 CPU 基准测试")
+    parser.add_argument('--tokens', type=int, default=2000, help='每个流的 token 帧数')
+    parser.add_argument('--frames-per-read', type=int, default=4, help='每次网络读取到达的帧数')
+    parser.add_argument('--streams', type=int, default=10, help='重复测量的流数量')
+    args = parser.parse_args()
+
+    frames = build_frames(args.tokens)
+    print("=" * 64)
+    print(f"SSE 转发基准: {args.tokens} 帧/流, 每次读取 {args.frames_per_read} 帧, {args.streams} 个流取平均")
+    print("=" * 64)
+
+    results = {}
+    modes = (('逐行转发', run_lines), ('零解码透传', run_passthrough), ('增量合并', run_coalesced))
+    for name, func in modes:
+        hot_ms, sidecar_ms, writes, content = measure(func, frames, args.frames_per_read, args.streams)
+        results[name] = (hot_ms, sidecar_ms, content)
+        print(f"{name:<8} 热路径 CPU {hot_ms:8.2f} ms/流  旁路解析 {sidecar_ms:7.2f} ms/流  写出次数 {writes}")
+
+    lines_hot, _, lines_content = results['逐行转发']
+    pass_hot, pass_sidecar, pass_content = results['零解码透传']
+    print("-" * 64)
+    print(f"热路径 CPU 降低: {lines_hot / pass_hot:.1f}x")
+    print(f"含旁路解析的总 CPU 降低: {lines_hot / (pass_hot + pass_sidecar):.1f}x")
+    print(f"日志内容一致: {'是' if lines_content == pass_content == results['增量合并'][2] else '否'}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,226 @@
+"""内容寻址存储 - 按哈希保存日志中的对话消息，相同的消息和相同的历史前缀只存一份
+
+两种对象都保存为 blobs/<前两位>/<哈希>.json：
+- 消息：一条对话消息，哈希为消息内容（规范化 JSON）的 SHA-256
+- 前缀节点：{"parent": 上一个前缀哈希, "message": 消息哈希}，表示"某段历史 + 一条消息"，
+  哈希由上一个前缀哈希和消息哈希计算，因此相同的历史前缀总是得到相同的哈希
+
+日志中的消息列表写成 [{"$prefix": 前缀哈希, "count": 条数}, 之后的消息...]，
+之后的消息中存储过的写成 {"$ref": 消息哈希}，新消息（本轮的增量）原样保留。
+"""
+
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from typing import Iterable, List, Optional, Set, Tuple
+
+REF_KEY = '$ref'
+PREFIX_KEY = '$prefix'
+REF_PATTERN = re.compile(rb'"\$(?:ref|prefix)": "([0-9a-f]{32})"')
+RECENT_SECONDS = 600      # 最近引用过的对象在清理时视为仍在使用（日志可能还在写入队列中）
+MAX_KNOWN = 100000        # 内存中记住的已存储哈希数量上限
+
+
+def blob_hash(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()[:32]
+
+
+def canonical(obj) -> bytes:
+    return json.dumps(obj, sort_keys=True, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+class BlobStore:
+    """prepare() 在请求线程中计算哈希并替换已存储的部分，write() 在日志写入线程中保存新对象
+
+    只有已经写入磁盘的对象才会被记为已存储，写入失败时后续日志不会引用不存在的对象。
+    """
+
+    def __init__(self, root: str) -> None:
+        self.root = root
+        self._lock = threading.Lock()
+        self._known: "OrderedDict[str, float]" = OrderedDict()  # 哈希 -> 最近一次引用的时间
+        self.stored = 0
+        self.collected = 0
+        os.makedirs(root, exist_ok=True)
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.root, key[:2], f"{key}.json")
+
+    def _has(self, key: str, now: float) -> bool:
+        with self._lock:
+            if key in self._known:
+                self._known[key] = now
+                self._known.move_to_end(key)
+                return True
+        if os.path.exists(self.path(key)):
+            # 重启后第一次遇到：磁盘上已有
+            self._remember([key], now)
+            return True
+        return False
+
+    def _remember(self, keys: Iterable[str], now: float) -> None:
+        with self._lock:
+            for key in keys:
+                self._known[key] = now
+                self._known.move_to_end(key)
+            while len(self._known) > MAX_KNOWN:
+                self._known.popitem(last=False)
+
+    def prepare(self, messages: list, min_bytes: int = 0) -> Tuple[list, List[Tuple[str, bytes]]]:
+        """返回 (写入日志的消息列表, 需要保存的新对象)"""
+        now = time.time()
+        encoded = [canonical(message) for message in messages]
+        message_hashes = [blob_hash(data) for data in encoded]
+        prefixes = []
+        parent = ''
+        for message_key in message_hashes:
+            parent = blob_hash(f"{parent}:{message_key}".encode('ascii'))
+            prefixes.append(parent)
+
+        # 已存储的前缀一定包含它之前的所有前缀，二分查找最长的已存储前缀
+        low, high = 0, len(prefixes)
+        while low < high:
+            middle = (low + high + 1) // 2
+            if self._has(prefixes[middle - 1], now):
+                low = middle
+            else:
+                high = middle - 1
+        known_count = low
+
+        stored_messages = []
+        if known_count:
+            stored_messages.append({PREFIX_KEY: prefixes[known_count - 1], 'count': known_count})
+        new_objects: List[Tuple[str, bytes]] = []
+        pending: Set[str] = set()
+        for index in range(known_count, len(messages)):
+            message_key = message_hashes[index]
+            if message_key in pending or self._has(message_key, now):
+                if len(encoded[index]) >= min_bytes:
+                    stored_messages.append({REF_KEY: message_key})
+                else:
+                    stored_messages.append(messages[index])
+            else:
+                stored_messages.append(messages[index])
+                new_objects.append((message_key, encoded[index]))
+                pending.add(message_key)
+            parent = prefixes[index - 1] if index else None
+            new_objects.append((prefixes[index], canonical({'parent': parent, 'message': message_key})))
+        return stored_messages, new_objects
+
+    def remember(self, new_objects: List[Tuple[str, bytes]]) -> None:
+        """write() 成功后在写入线程中调用，之后的请求即可引用这些对象"""
+        self._remember((key for key, _data in new_objects), time.time())
+
+    def forget(self, keys: Iterable[str]) -> None:
+        """写入失败时调用：这些对象不一定在磁盘上，之后遇到时重新检查"""
+        with self._lock:
+            for key in keys:
+                self._known.pop(key, None)
+
+    def write(self, new_objects: List[Tuple[str, bytes]]) -> None:
+        for key, data in new_objects:
+            path = self.path(key)
+            if os.path.exists(path):
+                continue
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            temp_path = f"{path}.tmp"
+            with open(temp_path, 'wb') as f:
+                f.write(data)
+            os.replace(temp_path, path)
+            self.stored += 1
+
+    def load(self, key: str) -> Optional[object]:
+        try:
+            with open(self.path(key), 'rb') as f:
+                return json.loads(f.read())
+        except (OSError, ValueError):
+            return None
+
+    def expand(self, messages: list) -> list:
+        """还原完整的消息列表；已被清理的对象保留引用并标记 missing"""
+        expanded = []
+        for message in messages:
+            if isinstance(message, dict) and PREFIX_KEY in message:
+                expanded.extend(self._expand_prefix(message[PREFIX_KEY], message.get('count', 0)))
+            elif isinstance(message, dict) and set(message) == {REF_KEY}:
+                loaded = self.load(message[REF_KEY])
+                expanded.append(loaded if loaded is not None else {REF_KEY: message[REF_KEY], 'missing': True})
+            else:
+                expanded.append(message)
+        return expanded
+
+    def _expand_prefix(self, key: str, count: int) -> list:
+        message_keys = []
+        while key:
+            node = self.load(key)
+            if node is None:
+                return [{PREFIX_KEY: key, 'count': count, 'missing': True}]
+            message_keys.append(node['message'])
+            key = node['parent']
+        expanded = []
+        for message_key in reversed(message_keys):
+            loaded = self.load(message_key)
+            expanded.append(loaded if loaded is not None else {REF_KEY: message_key, 'missing': True})
+        return expanded
+
+    def collect(self, log_paths: Iterable[str]) -> int:
+        """标记-清除：删除现存日志和最近的请求都不再引用的对象"""
+        started = time.time()
+        with self._lock:
+            roots = {key for key, referenced_at in self._known.items() if started - referenced_at < RECENT_SECONDS}
+        for path in log_paths:
+            try:
+                with open(path, 'rb') as f:
+                    roots.update(match.decode('ascii') for match in REF_PATTERN.findall(f.read()))
+            except OSError:
+                pass
+
+        marked: Set[str] = set()
+        for key in roots:
+            # 前缀节点沿 parent 向前标记，遇到已标记的节点即停止
+            while key and key not in marked:
+                marked.add(key)
+                node = self.load(key)
+                if not isinstance(node, dict) or 'parent' not in node:
+                    break
+                marked.add(node['message'])
+                key = node['parent']
+
+        removed = 0
+        for prefix in os.listdir(self.root):
+            directory = os.path.join(self.root, prefix)
+            if not os.path.isdir(directory):
+                continue
+            for name in os.listdir(directory):
+                key = name[:-len('.json')]
+                if key in marked:
+                    continue
+                path = os.path.join(directory, name)
+                try:
+                    # 刚写入、日志还没落盘的对象不删除
+                    if os.path.getmtime(path) < started - RECENT_SECONDS:
+                        os.remove(path)
+                        removed += 1
+                except OSError:
+                    pass
+        with self._lock:
+            for key in list(self._known):
+                if key not in marked and started - self._known[key] >= RECENT_SECONDS:
+                    del self._known[key]
+        self.collected += removed
+        return removed
+
+    def stats(self) -> dict:
+        with self._lock:
+            known = len(self._known)
+        return {
+            'stored': self.stored,
+            'collected': self.collected,
+            'known': known,
+        }
@@ -0,0 +1,203 @@
+"""对话目录索引 - 记录每个对话的名称、角色、标题、创建时间、消息数、修改时间、大小和预览
+
+/api/chats/list 只读取内存中的索引，不再打开每个对话文件。
+索引以日志形式保存在 data/chats/.catalog.jsonl（每行一次新增/更新或删除），启动时重放，
+再按文件的修改时间和大小与磁盘核对（只 stat，不读取内容），只重新读取变化过的对话。
+日志中过时的记录超过一定数量时整理为一份快照。
+"""
+
+from __future__ import annotations
+
+import json
+import os
+import threading
+from typing import Dict, List, Optional, Tuple
+
+from chat_store import ChatLog
+
+CATALOG_FILE = '.catalog.jsonl'
+PREVIEW_CHARS = 100
+SORT_KEYS = ('create_date', 'modified', 'title', 'message_count', 'size', 'name')
+
+
+class ChatCatalog:
+    def __init__(self, chats_dir: str) -> None:
+        self.chats_dir = chats_dir
+        self.journal_path = os.path.join(chats_dir, CATALOG_FILE)
+        self._lock = threading.RLock()
+        self._entries: Dict[str, dict] = {}
+        self._journal_lines = 0
+        self._ready = threading.Event()
+        self.reconciled = 0
+
+    # ---- 启动 ----
+
+    def start(self, reconcile: bool = True) -> None:
+        """读取日志，并在后台线程中与磁盘核对（核对完成前的查询会等待）
+
+        reconcile 为 False 时只读取日志（如迁移工具），之后的写入照常追加到日志。
+        """
+        self._load_journal()
+        if not reconcile:
+            self._ready.set()
+            return
+        threading.Thread(target=self._initial_reconcile, name='chat-catalog', daemon=True).start()
+
+    def _initial_reconcile(self) -> None:
+        try:
+            self.reconcile()
+        except Exception as exc:
+            print(f"[对话索引] 核对失败: {exc}")
+        finally:
+            self._ready.set()
+
+    def _load_journal(self) -> None:
+        entries: Dict[str, dict] = {}
+        lines = 0
+        try:
+            with open(self.journal_path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue  # 写入中断留下的半行
+                    lines += 1
+                    if record.get('op') == 'del':
+                        entries.pop(record['key'], None)
+                    else:
+                        entries[record['key']] = record['entry']
+        except OSError:
+            pass
+        with self._lock:
+            self._entries = entries
+            self._journal_lines = lines
+
+    def reconcile(self) -> int:
+        """按修改时间和大小核对磁盘上的对话文件，返回更新的条数"""
+        seen = set()
+        changed = 0
+        if os.path.isdir(self.chats_dir):
+            for char_entry in os.scandir(self.chats_dir):
+                if not char_entry.is_dir():
+                    continue
+                for file_entry in os.scandir(char_entry.path):
+                    if not file_entry.name.endswith('.jsonl') or not file_entry.is_file():
+                        continue
+                    key = f"{char_entry.name}/{file_entry.name[:-len('.jsonl')]}"
+                    seen.add(key)
+                    stat = file_entry.stat()
+                    current = self._entries.get(key)
+                    if current is None or current['mtime_ns'] != stat.st_mtime_ns or current['size'] != stat.st_size:
+                        if self._refresh_key(key, file_entry.path, stat):
+                            changed += 1
+        with self._lock:
+            for key in [key for key in self._entries if key not in seen]:
+                self._put(key, None)
+                changed += 1
+        self.reconciled += changed
+        return changed
+
+    # ---- 更新 ----
+
+    def key_for(self, path: str) -> str:
+        character = os.path.basename(os.path.dirname(path))
+        return f"{character}/{os.path.basename(path)[:-len('.jsonl')]}"
+
+    def refresh(self, path: str) -> Optional[dict]:
+        """对话文件被写入后调用：重新读取元数据、消息数和预览"""
+        try:
+            stat = os.stat(path)
+        except OSError:
+            self.remove(path)
+            return None
+        return self._refresh_key(self.key_for(path), path, stat)
+
+    def remove(self, path: str) -> None:
+        with self._lock:
+            if self.key_for(path) in self._entries:
+                self._put(self.key_for(path), None)
+
+    def rename(self, old_path: str, new_path: str) -> None:
+        self.remove(old_path)
+        self.refresh(new_path)
+
+    def _refresh_key(self, key: str, path: str, stat) -> Optional[dict]:
+        try:
+            chat_log = ChatLog(path)
+            metadata = chat_log.read_metadata()
+            message_count = chat_log.message_count()
+            first = chat_log.read_range(0, 1)
+        except (OSError, ValueError) as exc:
+            print(f"[对话索引] 无法读取 {path}: {exc}")
+            return None
+        character, name = key.split('/', 1)
+        entry = {
+            'name': name,
+            'character': character,
+            'create_date': metadata.get('create_date'),
+            'title': metadata.get('chat_metadata', {}).get('title'),
+            'message_count': message_count,
+            'modified': stat.st_mtime,
+            'size': stat.st_size,
+            'preview': (first[0].get('mes') or '')[:PREVIEW_CHARS] if first else '',
+            'mtime_ns': stat.st_mtime_ns,
+        }
+        with self._lock:
+            self._put(key, entry)
+        return entry
+
+    def _put(self, key: str, entry: Optional[dict]) -> None:
+        """更新内存中的索引并追加一行日志（调用方持有锁）"""
+        if entry is None:
+            self._entries.pop(key, None)
+            record = {'op': 'del', 'key': key}
+        else:
+            self._entries[key] = entry
+            record = {'op': 'put', 'key': key, 'entry': entry}
+        try:
+            os.makedirs(self.chats_dir, exist_ok=True)
+            with open(self.journal_path, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(record, ensure_ascii=False) + '\n')
+            self._journal_lines += 1
+        except OSError as exc:
+            print(f"[对话索引] 写入失败: {exc}")
+        self._maybe_compact()
+
+    def _maybe_compact(self) -> None:
+        if self._journal_lines <= 2 * len(self._entries) + 100:
+            return
+        temp_path = f"{self.journal_path}.tmp"
+        try:
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                for key, entry in self._entries.items():
+                    f.write(json.dumps({'op': 'put', 'key': key, 'entry': entry}, ensure_ascii=False) + '\n')
+            os.replace(temp_path, self.journal_path)
+            self._journal_lines = len(self._entries)
+        except OSError as exc:
+            print(f"[对话索引] 整理失败: {exc}")
+
+    # ---- 查询 ----
+
+    def list(self, character: Optional[str] = None, sort: str = 'create_date', descending: bool = True,
+             offset: int = 0, limit: Optional[int] = None) -> Tuple[List[dict], int]:
+        """返回 (当前页的对话, 符合条件的总数)"""
+        self._ready.wait()
+        if sort not in SORT_KEYS:
+            raise ValueError(f"sort 只能是 {', '.join(SORT_KEYS)}")
+        with self._lock:
+            entries = [entry for entry in self._entries.values()
+                       if character is None or entry['character'] == character]
+        empty = 0 if sort in ('message_count', 'size', 'modified') else ''
+        entries.sort(key=lambda entry: entry.get(sort) or empty, reverse=descending)
+        total = len(entries)
+        page = entries[offset:offset + limit] if limit is not None else entries[offset:]
+        return page, total
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'ready': self._ready.is_set(),
+                'chats': len(self._entries),
+                'journal_lines': self._journal_lines,
+                'reconciled': self.reconciled,
+            }
@@ -0,0 +1,431 @@
+"""对话全文搜索 - 对所有对话中消息的正文建立倒排索引
+
+中日韩文字按相邻两个字（bigram）切分，英文和数字按整词切分并转为小写。
+查询时先对各词的倒排表求交集得到候选消息，再在原文中确认每个词（或引号中的短语）确实出现，
+按 BM25 打分排序并截取摘要。只有一个汉字的查询词在原文中确认；查询只由单字组成时，
+候选取包含该字的索引词的倒排表的并集（只取各表末尾最新的部分）。
+候选从最新的消息开始检查，最多对 MAX_CANDIDATES 条打分，超出时结果标记为 truncated。
+
+索引只保存在内存中：启动时由后台线程通过存储层读取全部对话建立，之后由保存、追加、修改、删除接口增量更新。
+更新方法接收存储层的对话句柄（storage.chat() 的返回值），以句柄的 key（"角色/对话名"）区分对话。
+被替换或删除的消息先标记为失效，失效条数超过有效条数时重新整理倒排表。
+"""
+
+from __future__ import annotations
+
+import heapq
+import math
+import re
+import threading
+import time
+from array import array
+from bisect import bisect_left
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+CJK_CHARS = '\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff'
+TOKEN_PATTERN = re.compile(f'[{CJK_CHARS}]+|[0-9a-z_]+')
+CJK_PATTERN = re.compile(f'[{CJK_CHARS}]')
+QUERY_PATTERN = re.compile(r'"([^"]+)"|(\S+)')
+DATE_PATTERN = re.compile(r'\d{4}(-\d{2}(-\d{2}([T ]\d{2}(:\d{2}(:\d{2})?)?)?)?)?')
+
+SNIPPET_CHARS = 80
+COMPACT_MIN_DEAD = 10000
+BM25_K1 = 1.2
+BM25_B = 0.75
+BUILD_WAIT_SECONDS = 5  # 索引建立中时查询最多等待的时间
+MAX_CANDIDATES = 20000  # 单次查询最多打分的消息数（从最新的开始）
+
+
+def tokenize(text: str) -> List[str]:
+    """切分为索引词：连续的中日韩文字取每相邻两个字（前后都不是中日韩文字的单字取该字），英文数字取整词"""
+    tokens = []
+    for run in TOKEN_PATTERN.findall(text.lower()):
+        if len(run) > 1 and CJK_PATTERN.match(run):
+            tokens.extend(run[i:i + 2] for i in range(len(run) - 1))
+        else:
+            tokens.append(run)
+    return tokens
+
+
+def check_date(value: Optional[str], name: str) -> Optional[str]:
+    """校验日期过滤参数：ISO 格式的前缀，如 2024、2024-05、2024-05-01、2024-05-01T12:30；无效时抛出 ValueError"""
+    if not value:
+        return None
+    if not DATE_PATTERN.fullmatch(value):
+        raise ValueError(f"{name} 不是有效的日期: {value}")
+    padded = {4: '-01-01', 7: '-01'}.get(len(value), '')
+    try:
+        datetime.fromisoformat(value.replace(' ', 'T') + padded)
+    except ValueError:
+        raise ValueError(f"{name} 不是有效的日期: {value}") from None
+    return value
+
+
+def parse_query(query: str) -> List[str]:
+    """拆分查询：引号中的内容作为一个短语，其余按空白分隔；所有词都必须出现"""
+    terms = []
+    for phrase, word in QUERY_PATTERN.findall(query):
+        term = ' '.join((phrase or word).lower().split())
+        if term and term not in terms:
+            terms.append(term)
+    return terms
+
+
+class IndexNotReady(Exception):
+    """启动时的索引尚未建立完成"""
+
+    def __init__(self, indexed: int) -> None:
+        super().__init__(f"搜索索引正在建立（已索引 {indexed} 条消息），请稍后再试")
+        self.indexed = indexed
+
+
+def intersect(postings: List[array]) -> List[int]:
+    """有序倒排表求交集：从最短的表出发，在其余表中二分查找"""
+    postings = sorted(postings, key=len)
+    result = list(postings[0])
+    for other in postings[1:]:
+        matched = []
+        position = 0
+        for doc_id in result:
+            position = bisect_left(other, doc_id, position)
+            if position == len(other):
+                break
+            if other[position] == doc_id:
+                matched.append(doc_id)
+        result = matched
+        if not result:
+            break
+    return result
+
+
+class _Chat:
+    __slots__ = ('key', 'character', 'name', 'title', 'create_date', 'doc_ids')
+
+    def __init__(self, key: str) -> None:
+        self.key = key
+        self.character, self.name = key.split('/', 1)
+        self.title = None
+        self.create_date = ''
+        self.doc_ids: List[int] = []
+
+
+class ChatSearchIndex:
+    def __init__(self, storage) -> None:
+        self.storage = storage
+        self._lock = threading.RLock()
+        self._ready = threading.Event()
+        self._chats: Dict[str, _Chat] = {}
+        self._reset()
+        self.build_seconds = None
+
+    def _reset(self) -> None:
+        # 按消息编号（doc_id）存放的各列，失效的消息正文为 None；
+        # _lowered 为转为小写的正文，与原文相同时（中文通常如此）引用同一个对象，不额外占用内存
+        self._texts: List[Optional[str]] = []
+        self._lowered: List[Optional[str]] = []
+        self._doc_chat: List[_Chat] = []
+        self._doc_index: List[int] = []
+        self._doc_info: List[Tuple[str, Optional[str], str]] = []  # (role, name, send_date)
+        self._lengths = array('I')
+        self._postings: Dict[str, array] = {}
+        self._char_tokens: Dict[str, List[str]] = {}  # 单个汉字 -> 包含它的索引词，用于单字查询
+        self._total_length = 0
+        self._live = 0
+        self._dead = 0
+
+    # ---- 建立 ----
+
+    def start(self) -> None:
+        """在后台线程中读取全部对话建立索引（建立完成前的查询会等待）"""
+        threading.Thread(target=self._build, name='chat-search', daemon=True).start()
+
+    def _build(self) -> None:
+        started = time.perf_counter()
+        try:
+            for character, name in self.storage.iter_chats():
+                self.refresh(self.storage.chat(character, name))
+        except Exception as exc:
+            print(f"[对话搜索] 建立索引失败: {exc}")
+        finally:
+            self.build_seconds = round(time.perf_counter() - started, 3)
+            self._ready.set()
+        print(f"[对话搜索] 已索引 {self._live} 条消息，用时 {self.build_seconds} 秒")
+
+    # ---- 更新 ----
+
+    def refresh(self, chat_log) -> None:
+        """从存储中重新读取整个对话"""
+        try:
+            with chat_log.lock:
+                metadata = chat_log.read_metadata()
+                entries = chat_log.read_range(0, chat_log.message_count())
+                self.replace_chat(chat_log, metadata, entries)
+        except FileNotFoundError:
+            self.remove(chat_log)
+        except (OSError, ValueError) as exc:
+            print(f"[对话搜索] 无法读取 {chat_log.key}: {exc}")
+
+    def replace_chat(self, chat_log, metadata: dict, entries: List[dict]) -> None:
+        """整个对话被重写后调用（metadata 为 JSONL 第一行）"""
+        with self._lock:
+            key = chat_log.key
+            chat = self._chats.get(key)
+            if chat is None:
+                chat = self._chats[key] = _Chat(key)
+            for doc_id in chat.doc_ids:
+                self._kill(doc_id)
+            chat.title = (metadata.get('chat_metadata') or {}).get('title')
+            chat.create_date = metadata.get('create_date') or ''
+            chat.doc_ids = [self._add(chat, index, entry) for index, entry in enumerate(entries)]
+            self._maybe_compact()
+
+    def append(self, chat_log, start: int, entries: List[dict]) -> None:
+        """在对话末尾追加了从第 start 条开始的消息；与索引中的条数对不上时重新读取整个对话"""
+        with self._lock:
+            chat = self._chats.get(chat_log.key)
+            if chat is not None and len(chat.doc_ids) == start:
+                chat.doc_ids.extend(self._add(chat, start + i, entry) for i, entry in enumerate(entries))
+                return
+        self.refresh(chat_log)
+
+    def replace_message(self, chat_log, index: int, entry: dict) -> None:
+        with self._lock:
+            chat = self._chats.get(chat_log.key)
+            if chat is not None and 0 <= index < len(chat.doc_ids):
+                self._kill(chat.doc_ids[index])
+                chat.doc_ids[index] = self._add(chat, index, entry)
+                self._maybe_compact()
+                return
+        self.refresh(chat_log)
+
+    def remove_message(self, chat_log, index: int) -> None:
+        with self._lock:
+            chat = self._chats.get(chat_log.key)
+            if chat is not None and 0 <= index < len(chat.doc_ids):
+                self._kill(chat.doc_ids.pop(index))
+                for doc_id in chat.doc_ids[index:]:
+                    self._doc_index[doc_id] -= 1
+                self._maybe_compact()
+                return
+        self.refresh(chat_log)
+
+    def remove(self, chat_log) -> None:
+        with self._lock:
+            chat = self._chats.pop(chat_log.key, None)
+            if chat is not None:
+                for doc_id in chat.doc_ids:
+                    self._kill(doc_id)
+                self._maybe_compact()
+
+    def rename(self, old_key: str, new_key: str) -> None:
+        with self._lock:
+            chat = self._chats.pop(old_key, None)
+            if chat is None:
+                return
+            chat.key = new_key
+            chat.character, chat.name = chat.key.split('/', 1)
+            self._chats[chat.key] = chat
+
+    def _add(self, chat: _Chat, index: int, entry: dict) -> int:
+        text = entry.get('mes') or ''
+        lowered = text.lower()
+        tokens = tokenize(lowered)
+        doc_id = len(self._texts)
+        self._texts.append(text)
+        self._lowered.append(text if lowered == text else lowered)
+        self._doc_chat.append(chat)
+        self._doc_index.append(index)
+        self._doc_info.append(('user' if entry.get('is_user') else 'assistant',
+                               entry.get('name'), entry.get('send_date') or ''))
+        self._lengths.append(len(tokens))
+        postings_get = self._postings.get
+        for token in set(tokens):
+            postings = postings_get(token)
+            if postings is None:
+                postings = self._postings[token] = array('I')
+                if CJK_PATTERN.match(token):
+                    for char in set(token):
+                        self._char_tokens.setdefault(char, []).append(token)
+            postings.append(doc_id)
+        self._total_length += len(tokens)
+        self._live += 1
+        return doc_id
+
+    def _kill(self, doc_id: int) -> None:
+        if self._texts[doc_id] is None:
+            return
+        self._texts[doc_id] = None
+        self._lowered[doc_id] = None
+        self._total_length -= self._lengths[doc_id]
+        self._live -= 1
+        self._dead += 1
+
+    def _maybe_compact(self) -> None:
+        """失效的消息过多时按现有对话重新编号并重建倒排表"""
+        if self._dead < COMPACT_MIN_DEAD or self._dead <= self._live:
+            return
+        texts, doc_info = self._texts, self._doc_info
+        self._reset()
+        for chat in self._chats.values():
+            new_ids = []
+            for index, doc_id in enumerate(chat.doc_ids):
+                role, name, send_date = doc_info[doc_id]
+                entry = {'mes': texts[doc_id], 'is_user': role == 'user', 'name': name, 'send_date': send_date}
+                new_ids.append(self._add(chat, index, entry))
+            chat.doc_ids = new_ids
+
+    # ---- 查询 ----
+
+    def search(self, query: str, character: Optional[str] = None, date_from: Optional[str] = None,
+               date_to: Optional[str] = None, offset: int = 0,
+               limit: int = 20) -> Tuple[List[dict], int, bool]:
+        """返回 (当前页的结果, 匹配的消息总数, 是否只检查了最新的 MAX_CANDIDATES 条候选)
+
+        日期按 ISO 格式前缀比较，如 2024-05 或 2024-05-01；格式无效或查询为空时抛出 ValueError。
+        """
+        terms = parse_query(query)
+        if not terms:
+            raise ValueError("搜索内容不能为空")
+        date_from = check_date(date_from, 'date_from')
+        date_to = check_date(date_to, 'date_to')
+        if not self._ready.wait(BUILD_WAIT_SECONDS):
+            raise IndexNotReady(self._live)
+        with self._lock:
+            live = max(self._live, 1)
+            sources = []      # 每个来源是一个有序的 doc_id 列表，候选为它们的交集
+            char_groups = []  # 单字查询词：包含该字的各索引词的倒排表
+            idfs = []
+            verify = []       # 需要在原文中确认的词（只由一个索引词组成、且与之相同的词不需要）
+            for term in terms:
+                term_tokens = set(tokenize(term))
+                single_chars = [token for token in term_tokens if len(token) == 1 and CJK_PATTERN.match(token)]
+                term_tokens.difference_update(single_chars)
+                term_sources = []
+                for token in term_tokens:
+                    postings = self._postings.get(token)
+                    if postings is None:
+                        return [], 0, False
+                    term_sources.append(postings)
+                dfs = [len(source) for source in term_sources]
+                for char in single_chars:
+                    group = [self._postings[token] for token in self._char_tokens.get(char, ())]
+                    if not group:
+                        return [], 0, False
+                    char_groups.append(group)
+                    dfs.append(min(sum(map(len, group)), live))
+                sources.extend(term_sources)
+                df = min(dfs, default=live)
+                idfs.append(math.log(1 + (live - df + 0.5) / (df + 0.5)))
+                if term_tokens != {term}:
+                    verify.append(term)
+
+            cut = False  # 候选只取了倒排表末尾的部分
+            if sources:
+                candidates = intersect(sources)
+            elif char_groups:
+                # 只有单字：取并集最小的一个字，每个倒排表只需末尾最新的 MAX_CANDIDATES 条
+                group = min(char_groups, key=lambda postings: sum(map(len, postings)))
+                merged = set()
+                for postings in group:
+                    merged.update(postings[-MAX_CANDIDATES:])
+                    cut = cut or len(postings) > MAX_CANDIDATES
+                candidates = sorted(merged)
+            else:
+                candidates = range(len(self._texts))
+
+            average_length = self._total_length / live or 1.0
+            length_factor = BM25_K1 * BM25_B / average_length
+            base_norm = BM25_K1 * (1 - BM25_B)
+            weights = [(term, idf * (BM25_K1 + 1)) for term, idf in zip(terms, idfs)]
+            lowered_texts, lengths, doc_chat, doc_info = self._lowered, self._lengths, self._doc_chat, self._doc_info
+
+            scored = []
+            examined = 0
+            truncated = False
+            for doc_id in reversed(candidates):
+                lowered = lowered_texts[doc_id]
+                if lowered is None:
+                    continue
+                if character is not None and doc_chat[doc_id].character != character:
+                    continue
+                if date_from or date_to:
+                    date = doc_info[doc_id][2] or doc_chat[doc_id].create_date
+                    if date_from and date[:len(date_from)] < date_from:
+                        continue
+                    if date_to and date[:len(date_to)] > date_to:
+                        continue
+                if examined == MAX_CANDIDATES:
+                    truncated = True
+                    break
+                examined += 1
+                if verify and not all(term in lowered for term in verify):
+                    continue
+                norm = base_norm + length_factor * lengths[doc_id]
+                score = 0.0
+                for term, weight in weights:
+                    tf = lowered.count(term)
+                    score += weight * tf / (tf + norm)
+                scored.append((score, doc_id))
+
+            # 分数相同时较新写入的消息在前
+            page = heapq.nlargest(offset + limit, scored)[offset:]
+            results = [self._format(doc_id, score, terms) for score, doc_id in page]
+            return results, len(scored), truncated or cut
+
+    def _format(self, doc_id: int, score: float, terms: List[str]) -> dict:
+        chat = self._doc_chat[doc_id]
+        role, name, send_date = self._doc_info[doc_id]
+        snippet, highlights = make_snippet(self._texts[doc_id], terms)
+        return {
+            'character': chat.character,
+            'chat_name': chat.name,
+            'title': chat.title,
+            'index': self._doc_index[doc_id],
+            'role': role,
+            'name': name,
+            'send_date': send_date or None,
+            'score': round(score, 4),
+            'snippet': snippet,
+            'highlights': highlights,
+        }
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'ready': self._ready.is_set(),
+                'build_seconds': self.build_seconds,
+                'chats': len(self._chats),
+                'items': self._live,
+                'dead': self._dead,
+                'tokens': len(self._postings),
+                'postings_bytes': sum(posting.buffer_info()[1] * posting.itemsize
+                                      for posting in self._postings.values()),
+            }
+
+
+def make_snippet(text: str, terms: List[str]) -> Tuple[str, List[List[int]]]:
+    """截取第一个命中位置附近的文字，highlights 为摘要中各命中的 [起, 止) 位置"""
+    lowered = text.lower()
+    positions = [lowered.find(term) for term in terms]
+    first = min((position for position in positions if position >= 0), default=0)
+    start = max(first - SNIPPET_CHARS // 4, 0)
+    end = min(start + SNIPPET_CHARS, len(text))
+    start = max(end - SNIPPET_CHARS, 0)
+    prefix = '…' if start > 0 else ''
+    suffix = '…' if end < len(text) else ''
+
+    spans = []
+    window = lowered[start:end]
+    for term in terms:
+        position = window.find(term)
+        while position >= 0:
+            spans.append([position + len(prefix), position + len(prefix) + len(term)])
+            position = window.find(term, position + len(term))
+    merged = []
+    for span in sorted(spans):
+        if merged and span[0] <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], span[1])
+        else:
+            merged.append(span)
+    return prefix + text[start:end] + suffix, merged
@@ -0,0 +1,300 @@
+"""聊天记录文件 - SillyTavern 兼容的 JSONL（第一行元数据，之后每行一条消息）及其行偏移索引
+
+<对话>.jsonl.idx 记录每一行的起始偏移，用于：
+- 追加消息：只写入新增的行，不再重写整个文件
+- 修改/删除某条消息：新内容不长于原行时原地覆盖（用空格补齐，JSON 允许行尾空白）；
+  否则只重写该行之后的部分，修改最近的消息几乎没有开销
+- 按范围读取消息：定位到行偏移后只解析需要的行
+
+索引头部保存 JSONL 文件的大小和修改时间，文件被外部修改后自动重建。
+补齐用的空格累计超过文件的 1/4 时整理（compact）一次，这是唯一需要重写整个文件的情况。
+"""
+
+from __future__ import annotations
+
+import json
+import os
+import struct
+import threading
+from array import array
+from typing import Iterable, List, Optional, Tuple
+
+INDEX_SUFFIX = '.idx'
+INDEX_MAGIC = b'CHATIDX1'
+INDEX_HEADER = struct.Struct('<8sQqQ')  # 标识, JSONL 大小, JSONL 修改时间(ns), 补齐的空格字节数
+COMPACT_MIN_PADDING = 4096
+
+def window(total: int, offset: int = 0, limit: Optional[int] = None, tail: Optional[int] = None) -> Tuple[int, int]:
+    """把分页参数换算成消息序号范围 [start, stop)
+
+    tail=N 取最后 N 条；否则从 offset 开始取 limit 条，limit 为 None 时取到末尾。
+    start 不超过 total，可直接作为返回给前端的 offset。
+    """
+    if tail is not None:
+        return max(total - max(tail, 0), 0), total
+    start = min(max(offset, 0), total)
+    stop = total if limit is None else min(start + max(limit, 0), total)
+    return start, stop
+
+
+_locks_guard = threading.Lock()
+_locks = {}
+
+
+def path_lock(path: str) -> threading.RLock:
+    """同一个对话文件的所有读写共用一把锁"""
+    key = os.path.abspath(path)
+    with _locks_guard:
+        lock = _locks.get(key)
+        if lock is None:
+            lock = _locks[key] = threading.RLock()
+        return lock
+
+
+def encode_line(entry: dict, width: int = 0) -> bytes:
+    """序列化为一行；width 大于实际长度时在换行前用空格补齐"""
+    data = json.dumps(entry, ensure_ascii=False).encode('utf-8')
+    if width > len(data) + 1:
+        data += b' ' * (width - len(data) - 1)
+    return data + b'\n'
+
+
+def line_padding(line: bytes) -> int:
+    """行尾补齐的空格数（正常序列化的 JSON 不以空格结尾）"""
+    content = line.rstrip(b'\r\n')
+    return len(content) - len(content.rstrip(b' '))
+
+
+class ChatLog:
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.index_path = path + INDEX_SUFFIX
+        self.lock = path_lock(path)
+
+    def exists(self) -> bool:
+        return os.path.exists(self.path)
+
+    # ---- 索引 ----
+
+    def _scan_offsets(self) -> Tuple[array, int]:
+        """顺序读取整个文件重建行偏移，同时统计行尾补齐的空格"""
+        offsets = array('Q')
+        padding = 0
+        position = 0
+        with open(self.path, 'rb') as f:
+            for line in f:
+                offsets.append(position)
+                position += len(line)
+                padding += line_padding(line)
+        return offsets, padding
+
+    def _write_index(self, offsets: array, padding: int) -> None:
+        stat = os.stat(self.path)
+        temp_path = f"{self.index_path}.tmp"
+        with open(temp_path, 'wb') as f:
+            f.write(INDEX_HEADER.pack(INDEX_MAGIC, stat.st_size, stat.st_mtime_ns, padding))
+            offsets.tofile(f)
+        os.replace(temp_path, self.index_path)
+
+    def _update_index(self, offsets: array, padding: int, changed_from: int) -> None:
+        """只改写索引头部和 changed_from 之后的偏移"""
+        stat = os.stat(self.path)
+        try:
+            with open(self.index_path, 'r+b') as f:
+                f.write(INDEX_HEADER.pack(INDEX_MAGIC, stat.st_size, stat.st_mtime_ns, padding))
+                f.seek(INDEX_HEADER.size + changed_from * offsets.itemsize)
+                offsets[changed_from:].tofile(f)
+                f.truncate()
+        except OSError:
+            self._write_index(offsets, padding)
+
+    def load_index(self) -> Tuple[array, int]:
+        """返回 (每行的起始偏移, 补齐的空格字节数)；索引缺失或与文件不一致时重建"""
+        with self.lock:
+            stat = os.stat(self.path)
+            try:
+                with open(self.index_path, 'rb') as f:
+                    header = f.read(INDEX_HEADER.size)
+                    magic, size, mtime_ns, padding = INDEX_HEADER.unpack(header)
+                    if magic == INDEX_MAGIC and size == stat.st_size and mtime_ns == stat.st_mtime_ns:
+                        offsets = array('Q')
+                        offsets.frombytes(f.read())
+                        return offsets, padding
+            except (OSError, struct.error, ValueError):
+                pass
+            offsets, padding = self._scan_offsets()
+            self._write_index(offsets, padding)
+            return offsets, padding
+
+    def message_count(self) -> int:
+        """消息条数（不含第一行元数据）"""
+        offsets, _padding = self.load_index()
+        return max(len(offsets) - 1, 0)
+
+    # ---- 读取 ----
+
+    def read_metadata(self) -> dict:
+        with open(self.path, 'rb') as f:
+            line = f.readline()
+        data = json.loads(line) if line.strip() else {}
+        return data if 'user_name' in data else {}
+
+    def read_lines(self) -> List[dict]:
+        """读取所有行（包括元数据行；没有元数据的旧文件第一行就是消息）"""
+        with self.lock, open(self.path, 'rb') as f:
+            return [json.loads(line) for line in f if line.strip()]
+
+    def read_range(self, start: int, stop: int) -> List[dict]:
+        """读取第 start 到 stop-1 条消息（按消息序号，不含元数据）"""
+        with self.lock:
+            offsets, _padding = self.load_index()
+            count = len(offsets) - 1
+            start, stop = max(start, 0), min(stop, count)
+            if start >= stop:
+                return []
+            begin = offsets[start + 1]
+            end = offsets[stop + 1] if stop + 1 < len(offsets) else os.path.getsize(self.path)
+            with open(self.path, 'rb') as f:
+                f.seek(begin)
+                data = f.read(end - begin)
+        return [json.loads(line) for line in data.splitlines() if line.strip()]
+
+    # ---- 写入 ----
+
+    def write_all(self, metadata: dict, entries: Iterable[dict]) -> int:
+        """写入完整的对话（先写临时文件再替换，中途失败不会损坏原文件），返回消息条数"""
+        with self.lock:
+            directory = os.path.dirname(self.path)
+            os.makedirs(directory, exist_ok=True)
+            offsets = array('Q')
+            position = 0
+            temp_path = f"{self.path}.tmp"
+            with open(temp_path, 'wb') as f:
+                for entry in [metadata, *entries]:
+                    line = encode_line(entry)
+                    offsets.append(position)
+                    position += len(line)
+                    f.write(line)
+            os.replace(temp_path, self.path)
+            self._write_index(offsets, 0)
+            return len(offsets) - 1
+
+    def append(self, entries: List[dict], metadata: Optional[dict] = None,
+               expected_count: Optional[int] = None) -> int:
+        """在末尾追加消息；文件不存在时先写入 metadata。返回追加后的消息条数
+
+        expected_count 为调用方认为服务器上已有的条数，不一致时抛出 ChatConflict，
+        调用方应改为保存完整对话。
+        """
+        with self.lock:
+            if not self.exists():
+                if expected_count:
+                    raise ChatConflict(0)
+                return self.write_all(metadata or {}, entries)
+            offsets, padding = self.load_index()
+            count = len(offsets) - 1
+            if expected_count is not None and expected_count != count:
+                raise ChatConflict(count)
+            changed_from = len(offsets)
+            with open(self.path, 'r+b') as f:
+                f.seek(0, os.SEEK_END)
+                position = f.tell()
+                if position:
+                    f.seek(position - 1)
+                    if f.read(1) != b'\n':
+                        # 外部写入的文件末尾可能没有换行
+                        f.write(b'\n')
+                        position += 1
+                data = bytearray()
+                for entry in entries:
+                    offsets.append(position + len(data))
+                    data += encode_line(entry)
+                f.write(data)
+            self._update_index(offsets, padding, changed_from)
+            return len(offsets) - 1
+
+    def replace(self, index: int, entry: dict) -> None:
+        """修改第 index 条消息"""
+        with self.lock:
+            offsets, padding = self.load_index()
+            line_number = self._line_number(offsets, index)
+            begin = offsets[line_number]
+            end = offsets[line_number + 1] if line_number + 1 < len(offsets) else os.path.getsize(self.path)
+            line = encode_line(entry)
+            if len(line) <= end - begin:
+                # 原地覆盖：行长度不变，偏移索引无需改动
+                line = encode_line(entry, end - begin)
+                with open(self.path, 'r+b') as f:
+                    f.seek(begin)
+                    old_line = f.read(end - begin)
+                    f.seek(begin)
+                    f.write(line)
+                padding += line_padding(line) - line_padding(old_line)
+                self._update_index(offsets, max(padding, 0), len(offsets))
+            else:
+                self._rewrite_tail(offsets, padding, line_number, line)
+            self._maybe_compact()
+
+    def remove(self, index: int) -> None:
+        """删除第 index 条消息（重写其后的部分，删除最后一条只需截断）"""
+        with self.lock:
+            offsets, padding = self.load_index()
+            line_number = self._line_number(offsets, index)
+            self._rewrite_tail(offsets, padding, line_number, b'')
+
+    def _line_number(self, offsets: array, index: int) -> int:
+        count = len(offsets) - 1
+        if not 0 <= index < count:
+            raise IndexError(f"消息序号超出范围: {index}（共 {count} 条）")
+        return index + 1
+
+    def _rewrite_tail(self, offsets: array, padding: int, line_number: int, line: bytes) -> None:
+        """把第 line_number 行替换为 line（为空时删除该行），并移动其后的内容"""
+        begin = offsets[line_number]
+        with open(self.path, 'r+b') as f:
+            f.seek(begin)
+            rest = f.read()
+            old_length = (offsets[line_number + 1] - begin) if line_number + 1 < len(offsets) else len(rest)
+            f.seek(begin)
+            f.write(line)
+            f.write(rest[old_length:])
+            f.truncate()
+        padding = max(padding - line_padding(rest[:old_length]), 0)
+        shift = len(line) - old_length
+        new_offsets = offsets[:line_number + 1] if line else offsets[:line_number]
+        new_offsets.extend(offset + shift for offset in offsets[line_number + 1:])
+        self._update_index(new_offsets, padding, line_number)
+
+    def _maybe_compact(self) -> None:
+        _offsets, padding = self.load_index()
+        if padding >= COMPACT_MIN_PADDING and padding * 4 > os.path.getsize(self.path):
+            self.compact()
+
+    def compact(self) -> int:
+        """去掉行尾补齐的空格，重写整个文件，返回消息条数"""
+        with self.lock:
+            with open(self.path, 'rb') as f:
+                lines = [json.loads(line) for line in f if line.strip()]
+            if not lines:
+                return 0
+            return self.write_all(lines[0], lines[1:])
+
+    def rename(self, new_path: str) -> None:
+        with self.lock:
+            os.rename(self.path, new_path)
+            if os.path.exists(self.index_path):
+                os.replace(self.index_path, new_path + INDEX_SUFFIX)
+
+    def delete(self) -> None:
+        with self.lock:
+            os.remove(self.path)
+            if os.path.exists(self.index_path):
+                os.remove(self.index_path)
+
+
+class ChatConflict(Exception):
+    """追加时服务器上的消息条数与调用方预期不一致"""
+
+    def __init__(self, count: int) -> None:
+        super().__init__(f"服务器上已有 {count} 条消息")
+        self.count = count
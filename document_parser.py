@@ -7,7 +7,9 @@ import json
 import os
 import shutil
 import tempfile
+import threading
 import zipfile
+from collections import OrderedDict
 from pathlib import Path
 
 try:
@@ -214,9 +216,43 @@ class UniversalDocumentParser:
         'data': ['.csv', '.json']
     }
 
-    def __init__(self, max_file_size: int = 10 * 1024 * 1024) -> None:
+    def __init__(self, max_file_size: int = 10 * 1024 * 1024, cache_max_entries: int = 32,
+                 cache_max_chars: int = 20 * 1024 * 1024) -> None:
         self.max_file_size = max_file_size
-        self.cache = {}
+        # 解析结果按最近使用顺序缓存，超过条数或总字符数时淘汰最久未用的
+        self.cache = OrderedDict()
+        self.cache_max_entries = cache_max_entries
+        self.cache_max_chars = cache_max_chars
+        self.cache_chars = 0
+        self.cache_evictions = 0
+        self._cache_lock = threading.Lock()
+
+    def configure_cache(self, max_entries: int, max_chars: int) -> None:
+        """调整缓存上限，立即淘汰超出的部分"""
+        with self._cache_lock:
+            self.cache_max_entries = max_entries
+            self.cache_max_chars = max_chars
+            self._evict_locked()
+
+    @staticmethod
+    def _result_chars(result: dict) -> int:
+        return len(result.get('text') or '')
+
+    def _evict_locked(self) -> None:
+        while self.cache and (len(self.cache) > self.cache_max_entries or self.cache_chars > self.cache_max_chars):
+            _key, evicted = self.cache.popitem(last=False)
+            self.cache_chars -= self._result_chars(evicted)
+            self.cache_evictions += 1
+
+    def cache_stats(self) -> dict:
+        with self._cache_lock:
+            return {
+                'entries': len(self.cache),
+                'chars': self.cache_chars,
+                'max_entries': self.cache_max_entries,
+                'max_chars': self.cache_max_chars,
+                'evictions': self.cache_evictions,
+            }
 
     def get_file_hash(self, file_path: str) -> str:
         """使用 MD5 作为缓存键"""
@@ -243,8 +279,11 @@ class UniversalDocumentParser:
         cache_key = None
         if use_cache:
             cache_key = self.get_file_hash(file_path)
-            if cache_key in self.cache:
-                return self.cache[cache_key]
+            with self._cache_lock:
+                cached = self.cache.get(cache_key)
+                if cached is not None:
+                    self.cache.move_to_end(cache_key)
+                    return cached
 
         result = self._parse_document(file_path)
         result['file_info'] = {
@@ -254,7 +293,13 @@ class UniversalDocumentParser:
         }
 
         if use_cache and result.get('success') and cache_key:
-            self.cache[cache_key] = result
+            with self._cache_lock:
+                previous = self.cache.pop(cache_key, None)
+                if previous is not None:
+                    self.cache_chars -= self._result_chars(previous)
+                self.cache[cache_key] = result
+                self.cache_chars += self._result_chars(result)
+                self._evict_locked()
 
         return result
 
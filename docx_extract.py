@@ -12,9 +12,11 @@ import zipfile
 from pathlib import Path
 from typing import Dict, Iterable, List, Optional, Sequence, Tuple
 
-import requests
 import xml.etree.ElementTree as ET
 
+from retry_policy import get_policy
+from upstream_router import Upstream, get_router
+
 WORD_NS = "http://schemas.openxmlformats.org/wordprocessingml/2006/main"
 REL_NS = "http://schemas.openxmlformats.org/officeDocument/2006/relationships"
 DRAWING_NS = "http://schemas.openxmlformats.org/drawingml/2006/main"
@@ -208,14 +210,31 @@ def parse_response(data: Dict[str, object]) -> str:
     raise ValueError("Unable to find text content in response")
 
 
-def call_vision_api(api_base: str, api_path: str, payload: Dict[str, object], api_key: str) -> Dict[str, object]:
-    """调用视觉识图API"""
-    url = api_base.rstrip("/") + (api_path if api_path.startswith("/") else f"/{api_path}")
-    headers = {
-        "Authorization": f"Bearer {api_key}",
-        "Content-Type": "application/json",
-    }
-    response = requests.post(url, headers=headers, json=payload, timeout=(10, 60))
+def call_vision_api(
+    api_base: str,
+    api_path: str,
+    payload: Dict[str, object],
+    api_key: str,
+    on_retry=None,
+) -> Dict[str, object]:
+    """调用视觉识图API；识图地址失败时切换到 config.json 中支持该模型的其他上游，
+    限流（429）等可重试的错误按共享的重试策略退避后重试"""
+    api_path = api_path if api_path.startswith("/") else f"/{api_path}"
+    # 配置的上游地址已包含 /v1，把识图路径拆成 版本前缀 + 接口路径
+    prefix = ""
+    if api_path.startswith("/v1/"):
+        prefix, api_path = "/v1", api_path[3:]
+    primary = Upstream("vision", api_base.rstrip("/") + prefix, api_key)
+    policy = get_policy()
+
+    def send():
+        response, _target = get_router().post(
+            api_path, model=payload.get("model"), primary=primary, json=payload,
+            idempotent=policy.completions_idempotent,
+        )
+        return response
+
+    response = policy.call(send, idempotent=policy.completions_idempotent, on_retry=on_retry)
     response.raise_for_status()
     return response.json()
 
@@ -227,11 +246,12 @@ def describe_image(
     api_base: str,
     api_path: str,
     api_key: str,
+    on_retry=None,
 ) -> str:
     """识别单张图片并返回描述"""
     image_data_url = encode_image_to_data_url(image_path)
     payload = build_payload(model, prompt, image_data_url)
-    data = call_vision_api(api_base, api_path, payload, api_key)
+    data = call_vision_api(api_base, api_path, payload, api_key, on_retry)
     return parse_response(data)
 
 
@@ -299,7 +319,15 @@ def describe_images(
                 progress_callback(index, total, image_path.name, "processing", f"正在识别第 {index}/{total} 张图片")
 
             print(f"正在识别第 {index}/{total} 张图片 ({image_path.name})...")
-            description = describe_image(image_path, model, prompt, api_base, api_path, api_key)
+
+            def on_retry(attempt, delay, reason, index=index, image_path=image_path):
+                if progress_callback:
+                    progress_callback(
+                        index, total, image_path.name, "processing",
+                        f"第 {index}/{total} 张图片请求失败（{reason}），{delay:.0f} 秒后第 {attempt} 次重试"
+                    )
+
+            description = describe_image(image_path, model, prompt, api_base, api_path, api_key, on_retry)
             descriptions.append((placeholder, description))
 
             if progress_callback:
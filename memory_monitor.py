@@ -0,0 +1,163 @@
+"""内存统计 - 汇总进程内各缓存/状态结构的大小，并用 tracemalloc 对比两次快照找出增长最多的代码位置
+
+各结构通过 register() 登记一个探测函数，探测函数返回 {'items': 条数, 'bytes': 估算字节数, ...}。
+tracemalloc 只在管理员开启后才记录分配，平时没有额外开销。
+"""
+
+from __future__ import annotations
+
+import gc
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from typing import Callable, Dict, Optional
+
+# config.json 中 "memory" 段的默认值
+DEFAULT_SETTINGS = {
+    'context_window_max_messages': 200,           # 上下文窗口只保留最近的消息
+    'document_cache_max_entries': 32,             # 文档解析结果缓存条数
+    'document_cache_max_chars': 20 * 1024 * 1024, # 文档解析结果缓存的总字符数
+    'import_progress_max_entries': 50,            # 工具书导入进度保留条数
+    'tracemalloc_frames': 10,                     # 开启 tracemalloc 时每次分配记录的调用栈深度
+}
+
+DEEP_SIZEOF_LIMIT = 200000  # 估算大小时最多遍历的对象数
+
+
+def deep_sizeof(obj, limit: int = DEEP_SIZEOF_LIMIT) -> int:
+    """递归估算容器及其内容占用的字节数（同一对象只计一次，超过 limit 个对象后停止）"""
+    seen = set()
+    stack = [obj]
+    total = 0
+    while stack and len(seen) < limit:
+        item = stack.pop()
+        if id(item) in seen:
+            continue
+        seen.add(id(item))
+        total += sys.getsizeof(item)
+        if isinstance(item, dict):
+            stack.extend(item.keys())
+            stack.extend(item.values())
+        elif isinstance(item, (list, tuple, set, frozenset)):
+            stack.extend(item)
+    return total
+
+
+def process_rss() -> Optional[int]:
+    """当前进程的常驻内存（字节）；无法获取时返回 None"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        pass
+    try:
+        import resource
+        # macOS 上单位为字节，Linux 上为 KB；这里只在没有 /proc 时使用（峰值）
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == 'darwin' else peak * 1024
+    except (ImportError, AttributeError):
+        return None
+
+
+class MemoryMonitor:
+    def __init__(self, settings: Optional[dict] = None) -> None:
+        self._lock = threading.Lock()
+        self._probes: Dict[str, Callable[[], dict]] = {}
+        self._snapshot: Optional[tracemalloc.Snapshot] = None
+        self._snapshot_at: Optional[float] = None
+        self.settings = dict(DEFAULT_SETTINGS)
+        self.configure(settings)
+
+    def configure(self, settings: Optional[dict] = None) -> None:
+        merged = dict(DEFAULT_SETTINGS)
+        merged.update({k: v for k, v in (settings or {}).items() if k in DEFAULT_SETTINGS})
+        with self._lock:
+            self.settings = merged
+
+    def register(self, name: str, probe: Callable[[], dict]) -> None:
+        """登记一个结构；probe 在生成报告时调用"""
+        with self._lock:
+            self._probes[name] = probe
+
+    def report(self) -> dict:
+        with self._lock:
+            probes = list(self._probes.items())
+        structures = {}
+        for name, probe in probes:
+            try:
+                structures[name] = probe()
+            except Exception as exc:
+                structures[name] = {'error': str(exc)}
+        return {
+            'rss_bytes': process_rss(),
+            'gc_objects': len(gc.get_objects()),
+            'gc_counts': gc.get_count(),
+            'tracemalloc': self.tracing_status(),
+            'structures': structures,
+        }
+
+    def tracing_status(self) -> dict:
+        if not tracemalloc.is_tracing():
+            return {'tracing': False}
+        current, peak = tracemalloc.get_traced_memory()
+        return {
+            'tracing': True,
+            'frames': tracemalloc.get_traceback_limit(),
+            'traced_bytes': current,
+            'peak_bytes': peak,
+            'snapshot_at': self._snapshot_at,
+        }
+
+    def start_tracing(self, frames: Optional[int] = None) -> None:
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(int(frames or self.settings['tracemalloc_frames']))
+        with self._lock:
+            self._snapshot = None
+            self._snapshot_at = None
+
+    def stop_tracing(self) -> None:
+        with self._lock:
+            self._snapshot = None
+            self._snapshot_at = None
+        if tracemalloc.is_tracing():
+            tracemalloc.stop()
+
+    def snapshot(self, limit: int = 20, group_by: str = 'lineno') -> dict:
+        """拍摄快照；返回占用最多的位置，以及与上一次快照相比增长最多的位置
+
+        未开启 tracemalloc 时自动开启，此时只有本次之后的分配会被记录。
+        """
+        started = not tracemalloc.is_tracing()
+        if started:
+            self.start_tracing()
+        snapshot = tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+        ))
+        with self._lock:
+            previous, previous_at = self._snapshot, self._snapshot_at
+            self._snapshot, self._snapshot_at = snapshot, time.time()
+        result = {
+            'started_tracing': started,
+            'top': [self._format_stat(stat) for stat in snapshot.statistics(group_by)[:limit]],
+        }
+        if previous is not None:
+            result['since'] = previous_at
+            result['diff'] = [
+                self._format_stat(stat) for stat in snapshot.compare_to(previous, group_by)[:limit]
+            ]
+        return result
+
+    @staticmethod
+    def _format_stat(stat) -> dict:
+        formatted = {
+            'location': [f"{frame.filename}:{frame.lineno}" for frame in stat.traceback],
+            'size_bytes': stat.size,
+            'count': stat.count,
+        }
+        if hasattr(stat, 'size_diff'):
+            formatted['size_diff_bytes'] = stat.size_diff
+            formatted['count_diff'] = stat.count_diff
+        return formatted
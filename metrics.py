@@ -0,0 +1,292 @@
+"""运行指标 - Prometheus 文本格式的计数器、仪表和直方图
+
+热路径上只有一次按标签取子项的字典查找（已存在时不加全局锁）和一次子项内的加锁累加，
+没有其他分配。/metrics 接口调用 render() 输出全部指标。
+"""
+
+from __future__ import annotations
+
+import functools
+import threading
+import time
+from abc import ABC, abstractmethod
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+# config.json 中 "metrics" 段的默认值
+DEFAULT_SETTINGS = {
+    'public': False,  # 为 True 时 /metrics 不做管理员校验（供其他主机上的 Prometheus 抓取）
+}
+settings = dict(DEFAULT_SETTINGS)
+
+# 常用的直方图分桶
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+DURATION_BUCKETS = (0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+RATE_BUCKETS = (5, 10, 25, 50, 100, 200, 400, 800, 1600)
+
+
+def configure(new_settings: Optional[dict] = None) -> None:
+    """用 config.json 的 "metrics" 段更新设置"""
+    merged = dict(DEFAULT_SETTINGS)
+    merged.update({k: v for k, v in (new_settings or {}).items() if k in DEFAULT_SETTINGS})
+    settings.update(merged)
+
+
+class BucketCounts:
+    """累积直方图的计数部分（与 Prometheus 的 le 桶语义一致），不加锁，由调用方保证互斥"""
+
+    def __init__(self, buckets: Sequence[float]) -> None:
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[index] += 1
+                break
+        else:
+            self.counts[-1] += 1
+        self.sum += value
+        self.count += 1
+
+    def snapshot(self) -> dict:
+        cumulative = 0
+        buckets = {}
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            buckets[str(bound)] = cumulative
+        buckets['+Inf'] = self.count
+        return {'buckets': buckets, 'sum': round(self.sum, 3), 'count': self.count}
+
+
+def _escape(value: str) -> str:
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = '') -> str:
+    parts = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return '{' + ','.join(parts) + '}' if parts else ''
+
+
+def _format_number(value: float) -> str:
+    if value == int(value):
+        return str(int(value))
+    return repr(round(value, 6))
+
+
+class _CounterChild:
+    __slots__ = ('_lock', 'value')
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self.value = 0.0
+
+    def inc(self, amount: float = 1) -> None:
+        with self._lock:
+            self.value += amount
+
+
+class _GaugeChild(_CounterChild):
+    __slots__ = ()
+
+    def dec(self, amount: float = 1) -> None:
+        with self._lock:
+            self.value -= amount
+
+    def set(self, value: float) -> None:
+        self.value = value
+
+
+class _HistogramChild:
+    __slots__ = ('_lock', 'counts')
+
+    def __init__(self, buckets: Sequence[float]) -> None:
+        self._lock = threading.Lock()
+        self.counts = BucketCounts(buckets)
+
+    def observe(self, value: float) -> None:
+        with self._lock:
+            self.counts.observe(value)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return self.counts.snapshot()
+
+
+class _Metric(ABC):
+    kind = ''
+
+    def __init__(self, name: str, help_text: str, labels: Sequence[str] = ()) -> None:
+        self.name = name
+        self.help = help_text
+        self.label_names = tuple(labels)
+        self._children: Dict[Tuple[str, ...], object] = {}
+        self._lock = threading.Lock()
+
+    @abstractmethod
+    def _new_child(self):
+        """新建一个标签组合的子项"""
+
+    def labels(self, *values) -> object:
+        """按标签值取子项；已存在时只有一次字典查找"""
+        key = tuple(str(value) for value in values)
+        child = self._children.get(key)
+        if child is None:
+            with self._lock:
+                child = self._children.get(key)
+                if child is None:
+                    child = self._children[key] = self._new_child()
+        return child
+
+    def _items(self) -> List[Tuple[Tuple[str, ...], object]]:
+        with self._lock:
+            return list(self._children.items())
+
+    def render(self) -> Iterator[str]:
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} {self.kind}"
+        for values, child in self._items():
+            yield f"{self.name}{_format_labels(self.label_names, values)} {_format_number(child.value)}"
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def _new_child(self):
+        return _CounterChild()
+
+
+class Gauge(_Metric):
+    kind = 'gauge'
+
+    def _new_child(self):
+        return _GaugeChild()
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name: str, help_text: str, labels: Sequence[str] = (),
+                 buckets: Sequence[float] = LATENCY_BUCKETS) -> None:
+        super().__init__(name, help_text, labels)
+        self.buckets = tuple(buckets)
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+
+    def render(self) -> Iterator[str]:
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} {self.kind}"
+        for values, child in self._items():
+            snapshot = child.snapshot()
+            for bound, count in snapshot['buckets'].items():
+                le = 'le="+Inf"' if bound == '+Inf' else f'le="{bound}"'
+                yield f"{self.name}_bucket{_format_labels(self.label_names, values, le)} {count}"
+            labels = _format_labels(self.label_names, values)
+            yield f"{self.name}_sum{labels} {_format_number(snapshot['sum'])}"
+            yield f"{self.name}_count{labels} {snapshot['count']}"
+
+
+class Registry:
+    def __init__(self) -> None:
+        self._metrics: List[_Metric] = []
+        self._collectors: List[Callable[[], Iterator[str]]] = []
+
+    def register(self, metric: _Metric) -> _Metric:
+        self._metrics.append(metric)
+        return metric
+
+    def register_collector(self, collector: Callable[[], Iterator[str]]) -> None:
+        """注册在输出时才计算的指标（如准入控制的排队数），collector 返回文本格式的行"""
+        self._collectors.append(collector)
+
+    def render(self) -> str:
+        lines: List[str] = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        for collector in self._collectors:
+            try:
+                lines.extend(collector())
+            except Exception as exc:
+                lines.append(f"# collector error: {_escape(exc)}")
+        return '\n'.join(lines) + '\n'
+
+
+def gauge_lines(name: str, help_text: str, value: float, kind: str = 'gauge') -> List[str]:
+    """供 collector 使用：输出一个没有标签的指标"""
+    return [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}", f"{name} {_format_number(value)}"]
+
+
+registry = Registry()
+
+http_requests = registry.register(Counter(
+    'chat_proxy_http_requests_total', '本服务处理的 HTTP 请求数', ('endpoint', 'method', 'status')))
+http_duration = registry.register(Histogram(
+    'chat_proxy_http_request_duration_seconds', '请求处理时间（流式请求只计到开始返回）', ('endpoint',)))
+chat_requests = registry.register(Counter(
+    'chat_proxy_chat_requests_total', '对话请求数', ('model', 'stream')))
+upstream_responses = registry.register(Counter(
+    'chat_proxy_upstream_responses_total', '服务商返回的状态码（连接失败记为 error）', ('upstream', 'endpoint', 'status')))
+time_to_first_token = registry.register(Histogram(
+    'chat_proxy_time_to_first_token_seconds', '流式请求从收到到输出第一个数据块的时间', ('model',)))
+stream_duration = registry.register(Histogram(
+    'chat_proxy_stream_duration_seconds', '流式请求的总时长', ('model',), DURATION_BUCKETS))
+output_chars_per_second = registry.register(Histogram(
+    'chat_proxy_output_chars_per_second', '流式回复的输出速度（字符/秒）', ('model',), RATE_BUCKETS))
+bytes_proxied = registry.register(Counter(
+    'chat_proxy_stream_bytes_total', '转发给前端的流式数据量（字符串按字符数计）', ('model',)))
+active_streams = registry.register(Gauge(
+    'chat_proxy_active_streams', '正在进行的流式请求数', ('model',)))
+document_parse_duration = registry.register(Histogram(
+    'chat_proxy_document_parse_seconds', '文档解析耗时', ('format', 'status'), DURATION_BUCKETS))
+import_duration = registry.register(Histogram(
+    'chat_proxy_import_seconds', '工具书/世界书导入耗时', ('kind', 'status'), DURATION_BUCKETS))
+
+
+def track_stream(chunks, model: str, started: float) -> Iterator:
+    """包装流式输出：记录首个数据块时间、转发的数据量和进行中的流数量"""
+    active = active_streams.labels(model)
+    sent = bytes_proxied.labels(model)
+    active.inc()
+    try:
+        first = True
+        for chunk in chunks:
+            if first:
+                time_to_first_token.labels(model).observe(time.monotonic() - started)
+                first = False
+            sent.inc(len(chunk))
+            yield chunk
+    finally:
+        # 被关闭时同时关闭内层生成器，由其立即释放上游连接和准入许可
+        if hasattr(chunks, 'close'):
+            chunks.close()
+        active.dec()
+
+
+def record_stream_done(model: str, started: float, chars: int) -> None:
+    """流式请求正常结束时记录总时长和输出速度"""
+    duration = time.monotonic() - started
+    stream_duration.labels(model).observe(duration)
+    if duration > 0 and chars:
+        output_chars_per_second.labels(model).observe(chars / duration)
+
+
+def timed(histogram: Histogram, *label_values: str) -> Callable:
+    """装饰器：记录 Flask 视图函数的耗时，最后一个标签按返回的状态码取 success/error"""
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            started = time.monotonic()
+            status = 'error'
+            try:
+                result = view(*args, **kwargs)
+                code = result[1] if isinstance(result, tuple) and len(result) > 1 else getattr(result, 'status_code', 200)
+                status = 'success' if int(code) < 400 else 'error'
+                return result
+            finally:
+                histogram.labels(*label_values, status).observe(time.monotonic() - started)
+        return wrapper
+    return decorator
@@ -0,0 +1,152 @@
+"""模型列表缓存 - 按上游配置缓存 /models 结果，过期后先返回旧列表并在后台刷新"""
+
+from __future__ import annotations
+
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+from singleflight import SingleFlight
+
+# config.json 中 "model_cache" 段的默认值
+DEFAULT_SETTINGS = {
+    'enabled': True,
+    'ttl_seconds': 300,        # 在有效期内直接返回缓存
+    'stale_seconds': 86400,    # 过期后这段时间内先返回旧列表，同时在后台刷新
+}
+
+
+class _Entry:
+    def __init__(self, models: List[str], upstream: str) -> None:
+        self.models = models
+        self.upstream = upstream
+        self.fetched_at = time.time()
+        self.last_error: Optional[str] = None
+
+
+class ModelCatalog:
+    """线程安全的模型列表缓存
+
+    get() 返回 (模型列表, 状态)，状态为：
+    HIT（有效期内）、STALE（已过期，后台刷新中）、MISS（同步请求了服务商）、
+    FALLBACK（服务商请求失败，返回上一次成功的列表）。
+    同一上游同时只有一个请求在进行，并发调用者等待并共用其结果。
+    """
+
+    def __init__(self, settings: Optional[dict] = None) -> None:
+        self._lock = threading.Lock()
+        self._entries: Dict[str, _Entry] = {}
+        self._flights = SingleFlight()
+        self._refreshing = set()
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.fallbacks = 0
+        self.refresh_failures = 0
+        self.settings = dict(DEFAULT_SETTINGS)
+        self.configure(settings)
+
+    def configure(self, settings: Optional[dict] = None) -> None:
+        merged = dict(DEFAULT_SETTINGS)
+        merged.update({k: v for k, v in (settings or {}).items() if k in DEFAULT_SETTINGS})
+        with self._lock:
+            self.settings = merged
+
+    def get(self, key: str, fetch: Callable[[], Tuple[List[str], str]],
+            refresh: bool = False) -> Tuple[List[str], str]:
+        """获取 key 对应上游的模型列表；fetch() 返回 (模型列表, 实际使用的上游)，失败时抛出异常
+
+        refresh 为 True 时忽略有效期，立即请求服务商（失败时仍返回旧列表）。
+        """
+        settings = self.settings
+        with self._lock:
+            entry = self._entries.get(key)
+            age = time.time() - entry.fetched_at if entry is not None else None
+            if settings['enabled'] and entry is not None and not refresh:
+                if age < float(settings['ttl_seconds']):
+                    self.hits += 1
+                    return entry.models, 'HIT'
+                if age < float(settings['ttl_seconds']) + float(settings['stale_seconds']):
+                    self.stale_hits += 1
+                    stale_models = entry.models
+                else:
+                    stale_models = None
+            else:
+                stale_models = None
+
+        if stale_models is not None:
+            self._refresh_in_background(key, fetch)
+            return stale_models, 'STALE'
+
+        try:
+            models, _shared = self._flights.do(key, lambda: self._fetch(key, fetch))
+        except Exception:
+            if entry is None:
+                raise
+            with self._lock:
+                self.fallbacks += 1
+            return entry.models, 'FALLBACK'
+        with self._lock:
+            self.misses += 1
+        return models, 'MISS'
+
+    def _fetch(self, key: str, fetch: Callable[[], Tuple[List[str], str]]) -> List[str]:
+        try:
+            models, upstream = fetch()
+        except Exception as exc:
+            with self._lock:
+                self.refresh_failures += 1
+                entry = self._entries.get(key)
+                if entry is not None:
+                    entry.last_error = str(exc)
+            raise
+        with self._lock:
+            self._entries[key] = _Entry(models, upstream)
+        return models
+
+    def _refresh_in_background(self, key: str, fetch: Callable[[], Tuple[List[str], str]]) -> None:
+        # 同一上游已经在后台刷新时不再启动新的刷新
+        with self._lock:
+            if key in self._refreshing:
+                return
+            self._refreshing.add(key)
+
+        def run():
+            try:
+                self._flights.do(key, lambda: self._fetch(key, fetch))
+            except Exception as exc:
+                print(f"[模型列表] 后台刷新失败，继续使用旧列表: {exc}")
+            finally:
+                with self._lock:
+                    self._refreshing.discard(key)
+
+        threading.Thread(target=run, name='model-catalog-refresh', daemon=True).start()
+
+    def invalidate(self, key: Optional[str] = None) -> None:
+        """删除指定上游（或全部）的缓存"""
+        with self._lock:
+            if key is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(key, None)
+
+    def stats(self) -> dict:
+        now = time.time()
+        with self._lock:
+            return {
+                'settings': dict(self.settings),
+                'hits': self.hits,
+                'stale_hits': self.stale_hits,
+                'misses': self.misses,
+                'fallbacks': self.fallbacks,
+                'refresh_failures': self.refresh_failures,
+                'entries': [
+                    {
+                        'upstream': entry.upstream,
+                        'models': len(entry.models),
+                        'age_seconds': round(now - entry.fetched_at, 1),
+                        'last_error': entry.last_error,
+                    }
+                    for entry in self._entries.values()
+                ],
+            }
@@ -0,0 +1,177 @@
+"""采样分析器 - 在运行中的服务里按固定间隔采集线程调用栈，输出 collapsed stack 格式
+
+输出每行为 "外层函数;...;内层函数 次数"，可直接交给 flamegraph.pl、speedscope 等工具生成火焰图。
+采样由一个临时线程通过 sys._current_frames() 完成，只在分析期间存在；没有分析任务时不增加任何开销。
+"""
+
+from __future__ import annotations
+
+import hmac
+import os
+import sys
+import threading
+import time
+import uuid
+from collections import Counter, OrderedDict
+from typing import Iterable, Optional, Tuple
+
+# config.json 中 "profiler" 段的默认值
+DEFAULT_SETTINGS = {
+    'enabled': False,
+    'admin_token': '',       # 请求头 X-Admin-Token 需与此一致；为空时只允许本机访问
+    'interval_ms': 5,        # 采样间隔
+    'max_seconds': 60,       # 单次整体分析的最长时间
+    'max_results': 20,       # 保留最近多少个单请求分析结果
+}
+
+LOCAL_ADDRESSES = ('127.0.0.1', '::1', 'localhost')
+
+
+def _frame_label(frame) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+def collapse_stack(frame) -> str:
+    """把一个线程的调用栈转换为 "外层;...;内层" 形式"""
+    labels = []
+    while frame is not None:
+        labels.append(_frame_label(frame))
+        frame = frame.f_back
+    labels.reverse()
+    return ';'.join(labels)
+
+
+class StackSampler:
+    """后台线程每隔 interval 秒采集一次调用栈；thread_ids 为空时采集除自身外的所有线程"""
+
+    def __init__(self, interval: float, thread_ids: Optional[Iterable[int]] = None,
+                 exclude: Iterable[int] = ()) -> None:
+        self.interval = interval
+        self.thread_ids = set(thread_ids) if thread_ids is not None else None
+        self.exclude = set(exclude)
+        self.profile_id = uuid.uuid4().hex[:16]
+        self.counts: Counter = Counter()
+        self.samples = 0
+        self.started_at = 0.0
+        self.duration = 0.0
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> 'StackSampler':
+        self.started_at = time.perf_counter()
+        self._thread = threading.Thread(target=self._run, name='stack-sampler', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> 'StackSampler':
+        self._stop.set()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join()
+        self.duration = time.perf_counter() - self.started_at
+        return self
+
+    def _run(self) -> None:
+        own_id = threading.get_ident()
+        names = {}
+        while not self._stop.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id or thread_id in self.exclude:
+                    continue
+                if self.thread_ids is not None and thread_id not in self.thread_ids:
+                    continue
+                if thread_id not in names:
+                    names = {thread.ident: thread.name for thread in threading.enumerate()}
+                # 最外层为线程名，便于在火焰图中区分请求线程和后台线程
+                self.counts[f"{names.get(thread_id, thread_id)};{collapse_stack(frame)}"] += 1
+            self.samples += 1
+
+    def collapsed(self) -> str:
+        return ''.join(f"{stack} {count}\n" for stack, count in self.counts.most_common())
+
+
+class Profiler:
+    """整体分析（同一时间只允许一个）与按请求头触发的单请求分析"""
+
+    def __init__(self, settings: Optional[dict] = None) -> None:
+        self._lock = threading.Lock()
+        self._running = False
+        self._results: "OrderedDict[str, Tuple[str, dict]]" = OrderedDict()
+        self.runs = 0
+        self.request_profiles = 0
+        self.settings = dict(DEFAULT_SETTINGS)
+        self.configure(settings)
+
+    def configure(self, settings: Optional[dict] = None) -> None:
+        merged = dict(DEFAULT_SETTINGS)
+        merged.update({k: v for k, v in (settings or {}).items() if k in DEFAULT_SETTINGS})
+        with self._lock:
+            self.settings = merged
+
+    def is_admin(self, token: Optional[str], remote_addr: Optional[str]) -> bool:
+        """管理员校验：设置了 admin_token 时比较令牌，否则只允许本机访问（其他管理接口共用）"""
+        admin_token = self.settings['admin_token']
+        if admin_token:
+            # 定长比较，避免按响应时间逐字节猜出令牌
+            return hmac.compare_digest((token or '').encode('utf-8'), admin_token.encode('utf-8'))
+        return remote_addr in LOCAL_ADDRESSES
+
+    def authorized(self, token: Optional[str], remote_addr: Optional[str]) -> bool:
+        """只有开启分析器且通过管理员校验的请求可以使用"""
+        return bool(self.settings['enabled']) and self.is_admin(token, remote_addr)
+
+    def interval(self, interval_ms: Optional[float] = None) -> float:
+        value = float(interval_ms if interval_ms is not None else self.settings['interval_ms'])
+        return max(value, 1.0) / 1000.0
+
+    def run(self, seconds: float, interval_ms: Optional[float] = None) -> StackSampler:
+        """阻塞 seconds 秒采集整个进程（不含调用线程），已有分析在进行时抛出 RuntimeError"""
+        seconds = min(max(float(seconds), 0.1), float(self.settings['max_seconds']))
+        with self._lock:
+            if self._running:
+                raise RuntimeError("已有分析正在进行")
+            self._running = True
+            self.runs += 1
+        try:
+            sampler = StackSampler(self.interval(interval_ms), exclude=[threading.get_ident()]).start()
+            time.sleep(seconds)
+            return sampler.stop()
+        finally:
+            with self._lock:
+                self._running = False
+
+    def begin_request(self, thread_id: int) -> StackSampler:
+        """单请求分析：只采集处理该请求的线程"""
+        return StackSampler(self.interval(), thread_ids=[thread_id]).start()
+
+    def finish_request(self, sampler: StackSampler, name: str) -> str:
+        """停止单请求分析并保存结果，返回结果编号"""
+        sampler.stop()
+        profile_id = sampler.profile_id
+        info = {
+            'id': profile_id,
+            'name': name,
+            'timestamp': time.time(),
+            'duration_seconds': round(sampler.duration, 3),
+            'samples': sampler.samples,
+        }
+        with self._lock:
+            self.request_profiles += 1
+            self._results[profile_id] = (sampler.collapsed(), info)
+            while len(self._results) > int(self.settings['max_results']):
+                self._results.popitem(last=False)
+        return profile_id
+
+    def result(self, profile_id: str) -> Optional[Tuple[str, dict]]:
+        with self._lock:
+            return self._results.get(profile_id)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'settings': {k: v for k, v in self.settings.items() if k != 'admin_token'},
+                'running': self._running,
+                'runs': self.runs,
+                'request_profiles': self.request_profiles,
+                'results': [info for _collapsed, info in reversed(self._results.values())],
+            }
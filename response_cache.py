@@ -0,0 +1,266 @@
+"""非流式对话响应缓存 - 内存 LRU + 可选磁盘层"""
+
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import List, Optional, Tuple
+
+# config.json 中 "response_cache" 段的默认值
+DEFAULT_SETTINGS = {
+    'enabled': False,
+    'force': False,                        # 为 True 时 temperature 不为 0 也缓存
+    'max_memory_bytes': 64 * 1024 * 1024,  # 内存层容量（按响应体字节数计算）
+    'disk': False,                         # 是否启用 data/response_cache 磁盘层
+    'max_disk_bytes': 256 * 1024 * 1024,   # 磁盘层容量，超出时先删除最早写入的文件
+    'ttl_seconds': 3600,
+    'model_ttls': {},                      # 按模型覆盖 TTL，0 表示该模型不缓存
+}
+
+DISK_SWEEP_INTERVAL = 60  # 写入磁盘时最多每隔多少秒清理一次过期文件
+
+
+def cache_key(api_url: str, request_data: dict) -> str:
+    """对发往服务商的请求做规范化哈希（键排序、紧凑分隔符）"""
+    canonical = json.dumps(
+        {'api_url': api_url, 'request': request_data},
+        sort_keys=True, ensure_ascii=False, separators=(',', ':')
+    )
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+
+class ResponseCache:
+    """线程安全的响应缓存，存储序列化后的响应体，命中时无需再次编码
+
+    磁盘层在内存中保存按写入顺序排列的文件索引（启动后第一次使用时扫描目录建立），
+    写入时顺带清理过期文件，并按 max_disk_bytes 删除最早写入的文件。
+    """
+
+    def __init__(self, cache_dir: str, settings: Optional[dict] = None) -> None:
+        self.cache_dir = cache_dir
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[str, Tuple[float, bytes]]" = OrderedDict()
+        self._memory_bytes = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+        # 磁盘索引：键 -> (过期时间, 文件字节数)，按写入顺序排列；None 表示还没有扫描目录
+        self._disk_index: "Optional[OrderedDict[str, Tuple[float, int]]]" = None
+        self._disk_bytes = 0
+        self._disk_swept_at = 0.0
+        self.disk_evictions = 0
+        self.disk_expired = 0
+        self.settings = dict(DEFAULT_SETTINGS)
+        self.configure(settings)
+
+    def configure(self, settings: Optional[dict] = None) -> None:
+        merged = dict(DEFAULT_SETTINGS)
+        merged.update({k: v for k, v in (settings or {}).items() if k in DEFAULT_SETTINGS})
+        with self._lock:
+            self.settings = merged
+            self._evict_locked()
+        if merged['disk']:
+            self._disk_trim()
+
+    def ttl_for(self, model: str) -> float:
+        return float(self.settings['model_ttls'].get(model, self.settings['ttl_seconds']))
+
+    def should_cache(self, request_data: dict, force: bool = False) -> bool:
+        """只有开启缓存、该模型 TTL 大于 0，且 temperature 为 0 或被强制时才缓存"""
+        if not self.settings['enabled'] or request_data.get('stream'):
+            return False
+        if self.ttl_for(request_data.get('model', '')) <= 0:
+            return False
+        return force or self.settings['force'] or request_data.get('temperature') == 0
+
+    def get(self, key: str) -> Optional[bytes]:
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                expires_at, body = entry
+                if expires_at > now:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return body
+                self._remove_locked(key)
+        body = self._disk_get(key, now)
+        with self._lock:
+            if body is None:
+                self.misses += 1
+            else:
+                self.disk_hits += 1
+        return body
+
+    def put(self, key: str, model: str, body: bytes) -> None:
+        expires_at = time.time() + self.ttl_for(model)
+        with self._lock:
+            if key in self._entries:
+                self._remove_locked(key)
+            if len(body) <= self.settings['max_memory_bytes']:
+                self._entries[key] = (expires_at, body)
+                self._memory_bytes += len(body)
+                self._evict_locked()
+            self.stores += 1
+        self._disk_put(key, expires_at, body)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._memory_bytes = 0
+            if self._disk_index is not None:
+                self._disk_index = OrderedDict()
+            self._disk_bytes = 0
+        if os.path.isdir(self.cache_dir):
+            for root, _dirs, files in os.walk(self.cache_dir):
+                for name in files:
+                    if name.endswith('.cache'):
+                        os.remove(os.path.join(root, name))
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.disk_hits + self.misses
+            return {
+                'settings': dict(self.settings),
+                'entries': len(self._entries),
+                'memory_bytes': self._memory_bytes,
+                'hits': self.hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'hit_ratio': round((self.hits + self.disk_hits) / lookups, 4) if lookups else 0.0,
+                'stores': self.stores,
+                'evictions': self.evictions,
+                'disk_entries': len(self._disk_index) if self._disk_index is not None else 0,
+                'disk_bytes': self._disk_bytes,
+                'disk_evictions': self.disk_evictions,
+                'disk_expired': self.disk_expired,
+            }
+
+    def _remove_locked(self, key: str) -> None:
+        _expires_at, body = self._entries.pop(key)
+        self._memory_bytes -= len(body)
+
+    def _evict_locked(self) -> None:
+        while self._entries and self._memory_bytes > self.settings['max_memory_bytes']:
+            key = next(iter(self._entries))
+            self._remove_locked(key)
+            self.evictions += 1
+
+    def _disk_path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key[:2], f"{key}.cache")
+
+    def _disk_get(self, key: str, now: float) -> Optional[bytes]:
+        """磁盘层格式：第一行为过期时间戳，其余为响应体"""
+        if not self.settings['disk']:
+            return None
+        path = self._disk_path(key)
+        try:
+            with open(path, 'rb') as f:
+                expires_at = float(f.readline())
+                body = f.read()
+        except (OSError, ValueError):
+            return None
+        if expires_at <= now:
+            with self._lock:
+                self._disk_forget_locked(key)
+                self.disk_expired += 1
+            _remove_files([path])
+            return None
+        # 回填内存层
+        with self._lock:
+            if key not in self._entries and len(body) <= self.settings['max_memory_bytes']:
+                self._entries[key] = (expires_at, body)
+                self._memory_bytes += len(body)
+                self._evict_locked()
+        return body
+
+    def _disk_put(self, key: str, expires_at: float, body: bytes) -> None:
+        if not self.settings['disk']:
+            return
+        path = self._disk_path(key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.{threading.get_ident()}.tmp"
+            with open(tmp_path, 'wb') as f:
+                f.write(f"{expires_at}\n".encode('ascii'))
+                f.write(body)
+            os.replace(tmp_path, path)
+        except OSError as exc:
+            print(f"[响应缓存] 写入磁盘失败: {exc}")
+            return
+        with self._lock:
+            if self._disk_index is not None:
+                self._disk_forget_locked(key)
+                size = len(f"{expires_at}\n") + len(body)
+                self._disk_index[key] = (expires_at, size)
+                self._disk_bytes += size
+        self._disk_trim()
+
+    def _disk_forget_locked(self, key: str) -> None:
+        if self._disk_index is None:
+            return
+        entry = self._disk_index.pop(key, None)
+        if entry is not None:
+            self._disk_bytes -= entry[1]
+
+    def _disk_trim(self) -> None:
+        """清理过期文件（最多每 DISK_SWEEP_INTERVAL 秒一次），再按容量删除最早写入的文件"""
+        if self._disk_index is None:
+            self._disk_scan()
+        now = time.time()
+        doomed: List[str] = []
+        with self._lock:
+            if self._disk_index is None:
+                return
+            if now - self._disk_swept_at >= DISK_SWEEP_INTERVAL:
+                self._disk_swept_at = now
+                for key, (expires_at, _size) in list(self._disk_index.items()):
+                    if expires_at <= now:
+                        self._disk_forget_locked(key)
+                        self.disk_expired += 1
+                        doomed.append(self._disk_path(key))
+            limit = int(self.settings['max_disk_bytes'])
+            while self._disk_index and self._disk_bytes > limit:
+                key = next(iter(self._disk_index))
+                self._disk_forget_locked(key)
+                self.disk_evictions += 1
+                doomed.append(self._disk_path(key))
+        _remove_files(doomed)
+
+    def _disk_scan(self) -> None:
+        """扫描缓存目录建立磁盘索引（按文件修改时间排序），只读取每个文件的第一行"""
+        found = []
+        if os.path.isdir(self.cache_dir):
+            for root, _dirs, files in os.walk(self.cache_dir):
+                for name in files:
+                    if not name.endswith('.cache'):
+                        continue
+                    path = os.path.join(root, name)
+                    try:
+                        with open(path, 'rb') as f:
+                            expires_at = float(f.readline())
+                        stat = os.stat(path)
+                    except (OSError, ValueError):
+                        continue
+                    found.append((stat.st_mtime, name[:-len('.cache')], expires_at, stat.st_size))
+        found.sort()
+        with self._lock:
+            if self._disk_index is not None:
+                return
+            self._disk_index = OrderedDict((key, (expires_at, size)) for _mtime, key, expires_at, size in found)
+            self._disk_bytes = sum(size for _mtime, _key, _expires_at, size in found)
+            self._disk_swept_at = 0.0
+
+
+def _remove_files(paths: List[str]) -> None:
+    for path in paths:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
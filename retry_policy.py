@@ -0,0 +1,205 @@
+"""重试策略 - 指数退避 + 抖动、Retry-After、重试预算和幂等性规则，对话和识图共用"""
+
+from __future__ import annotations
+
+import email.utils
+import random
+import threading
+import time
+from typing import Callable, Optional
+
+import requests
+from urllib3.exceptions import NewConnectionError
+
+# config.json 中 "retry" 段的默认值
+DEFAULT_SETTINGS = {
+    'enabled': True,
+    'max_attempts': 3,           # 包括第一次在内的最多尝试次数
+    'base_delay': 0.5,           # 第 n 次重试的退避上限为 base_delay * 2^(n-1)，实际等待在 0 到上限之间随机
+    'max_delay': 20,
+    'max_retry_after': 60,       # 服务商要求等待超过该秒数时不再重试
+    'retry_on_status': [429, 500, 502, 503, 504],
+    'budget_ratio': 0.2,         # 每个请求为预算存入 0.2 次重试机会
+    'budget_burst': 10,          # 预算上限（也是初始值）
+    'idempotent_completions': False,  # 为 True 时对话/识图请求超时或 5xx 也重试（服务商可能已计费）
+}
+
+# 非幂等请求只在确定服务商没有处理时重试：连接没建立，或明确拒绝（429/503）
+NON_IDEMPOTENT_SAFE_STATUS = (429, 503)
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """解析 Retry-After 头，支持秒数和 HTTP 日期两种格式"""
+    if not value:
+        return None
+    value = value.strip()
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if retry_at is None:
+        return None
+    return max(0.0, retry_at.timestamp() - time.time())
+
+
+def classify_error(error: BaseException) -> Optional[str]:
+    """把异常归类为 connect（请求未发出）、timeout、io；无法重试的返回 None"""
+    if isinstance(error, requests.ConnectTimeout):
+        return 'connect'
+    if isinstance(error, requests.Timeout):
+        return 'timeout'
+    if isinstance(error, requests.ConnectionError):
+        reason = getattr(error.args[0], 'reason', None) if error.args else None
+        return 'connect' if isinstance(reason, NewConnectionError) else 'io'
+    # aiohttp / asyncio 的异常按类名判断，避免本模块依赖 aiohttp
+    name = type(error).__name__
+    if name in ('ClientConnectorError', 'ClientConnectorDNSError', 'ConnectionTimeoutError'):
+        return 'connect'
+    if name in ('TimeoutError', 'ServerTimeoutError', 'SocketTimeoutError'):
+        return 'timeout'
+    if name in ('ClientOSError', 'ServerDisconnectedError', 'ClientPayloadError'):
+        return 'io'
+    return None
+
+
+class RetryPolicy:
+    """线程安全的重试决策与统计；同步请求用 call()，异步引擎直接使用 next_delay()"""
+
+    def __init__(self, settings: Optional[dict] = None) -> None:
+        self._lock = threading.Lock()
+        self.settings = dict(DEFAULT_SETTINGS)
+        self._budget = float(DEFAULT_SETTINGS['budget_burst'])
+        self.calls = 0
+        self.retries = 0
+        self.retry_successes = 0
+        self.gave_up = 0
+        self.budget_exhausted = 0
+        self.retry_after_honored = 0
+        self.configure(settings)
+
+    def configure(self, settings: Optional[dict] = None) -> None:
+        merged = dict(DEFAULT_SETTINGS)
+        merged.update({k: v for k, v in (settings or {}).items() if k in DEFAULT_SETTINGS})
+        with self._lock:
+            self.settings = merged
+            self._budget = min(self._budget, float(merged['budget_burst']))
+
+    @property
+    def completions_idempotent(self) -> bool:
+        return bool(self.settings['idempotent_completions'])
+
+    def begin(self) -> None:
+        """开始一次调用：计数并为重试预算存入额度"""
+        with self._lock:
+            self.calls += 1
+            self._budget = min(float(self.settings['budget_burst']), self._budget + float(self.settings['budget_ratio']))
+
+    def finish(self, attempts: int, ok: bool) -> None:
+        """结束一次调用，统计重试是否最终成功"""
+        if attempts <= 1:
+            return
+        with self._lock:
+            if ok:
+                self.retry_successes += 1
+            else:
+                self.gave_up += 1
+
+    def backoff(self, attempt: int) -> float:
+        """第 attempt 次失败后的等待时间（full jitter）"""
+        cap = min(float(self.settings['max_delay']), float(self.settings['base_delay']) * (2 ** (attempt - 1)))
+        return random.uniform(0, cap)
+
+    def next_delay(self, attempt: int, status: Optional[int] = None, headers=None,
+                   error: Optional[BaseException] = None, idempotent: bool = True) -> Optional[float]:
+        """第 attempt 次尝试失败后是否重试：返回等待秒数，不重试时返回 None"""
+        settings = self.settings
+        if not settings['enabled'] or attempt >= int(settings['max_attempts']):
+            return None
+        if error is not None:
+            kind = classify_error(error)
+            if kind is None or (not idempotent and kind != 'connect'):
+                return None
+        elif status is not None:
+            if status not in settings['retry_on_status']:
+                return None
+            if not idempotent and status not in NON_IDEMPOTENT_SAFE_STATUS:
+                return None
+        else:
+            return None
+
+        delay = self.backoff(attempt)
+        retry_after = parse_retry_after((headers or {}).get('Retry-After')) if error is None else None
+        with self._lock:
+            if retry_after is not None and retry_after > float(settings['max_retry_after']):
+                return None
+            if self._budget < 1:
+                self.budget_exhausted += 1
+                return None
+            if retry_after is not None:
+                delay = max(delay, retry_after)
+                self.retry_after_honored += 1
+            self._budget -= 1
+            self.retries += 1
+        return delay
+
+    def call(self, send: Callable[[], requests.Response], idempotent: bool = True,
+             on_retry: Optional[Callable[[int, float, str], None]] = None) -> requests.Response:
+        """调用 send() 直到成功或不再重试，返回最后一次的响应（或抛出最后一次的异常）
+
+        流式请求的 send() 拿到响应头即返回，因此重试只会发生在向客户端输出第一个字节之前。
+        on_retry(已失败次数, 等待秒数, 原因) 在每次等待前调用。
+        """
+        self.begin()
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                response = send()
+            except Exception as exc:
+                delay = self.next_delay(attempt, error=exc, idempotent=idempotent)
+                if delay is None:
+                    self.finish(attempt, False)
+                    raise
+                reason = f"{type(exc).__name__}: {exc}"
+            else:
+                delay = self.next_delay(attempt, status=response.status_code, headers=response.headers,
+                                        idempotent=idempotent)
+                if delay is None:
+                    self.finish(attempt, response.status_code < 400)
+                    return response
+                reason = f"HTTP {response.status_code}"
+                response.close()
+            print(f"[重试] 第 {attempt} 次请求失败（{reason}），{delay:.1f} 秒后重试")
+            if on_retry:
+                on_retry(attempt, delay, reason)
+            time.sleep(delay)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'settings': dict(self.settings),
+                'calls': self.calls,
+                'retries': self.retries,
+                'retry_successes': self.retry_successes,
+                'gave_up': self.gave_up,
+                'budget_exhausted': self.budget_exhausted,
+                'retry_after_honored': self.retry_after_honored,
+                'budget_remaining': round(self._budget, 2),
+            }
+
+
+_policy = RetryPolicy()
+
+
+def get_policy() -> RetryPolicy:
+    """获取进程内共享的重试策略"""
+    return _policy
+
+
+def configure(settings: Optional[dict] = None) -> None:
+    """用 config.json 的 "retry" 段更新共享策略"""
+    _policy.configure(settings)
@@ -36,6 +36,14 @@ let currentChatTitle = '新对话';
 // 历史对话管理
 let chatHistory = [];  // 存储所有历史对话
 
+// 服务器上当前对话已保存的消息（序列化后的字符串），自动保存时只发送变化的部分；
+// base 为尚未加载的较早消息条数，contextMessages 只包含第 base 条之后的消息
+let savedChatState = { key: null, character: null, chat: null, lines: [], base: 0 };
+
+// 打开对话时只加载最后 CHAT_PAGE_SIZE 条消息，滚动到顶部时每次再加载同样多的较早消息
+const CHAT_PAGE_SIZE = 50;
+let earlierMessagesRequest = null;
+
 // DOM元素
 let chatContainer = null;
 let chatInput = null;
@@ -221,6 +229,13 @@ document.addEventListener('DOMContentLoaded', async function() {
         newChatBtn.addEventListener('click', startNewChat);
     }
     
+    // 消息区域滚动到顶部时加载较早的消息（消息容器会被重新创建，因此在 document 上捕获滚动事件）
+    document.addEventListener('scroll', function(e) {
+        if (e.target.classList && e.target.classList.contains('messages-container') && e.target.scrollTop < 100) {
+            loadEarlierMessages();
+        }
+    }, true);
+    
     // 点击聊天容器的空白区域收缩侧边栏
     if (chatContainer) {
         chatContainer.addEventListener('click', function(e) {
@@ -329,6 +344,7 @@ async function loadConfig() {
                 config.frontend_max_history = data.frontend_max_history || config.frontend_max_history;
                 config.frontend_max_response = data.frontend_max_response || config.frontend_max_response;
                 config.top_p = data.top_p !== undefined ? data.top_p : config.top_p;
+                config.candidates = data.candidates || config.candidates;
                 config.frequency_penalty = data.frequency_penalty !== undefined ? data.frequency_penalty : config.frequency_penalty;
                 config.presence_penalty = data.presence_penalty !== undefined ? data.presence_penalty : config.presence_penalty;
                 config.currentPresetName = data.currentPresetName || config.currentPresetName;
@@ -626,6 +642,13 @@ async function sendMessage() {
     chatInput.value = '';
     chatInput.style.height = 'auto';
     
+    // 提示词需要完整的历史（世界书、工具书也会扫描较早的消息），先加载尚未加载的较早消息
+    if (!(await loadEarlierMessages(true))) {
+        chatInput.value = message;
+        showToast('加载较早的消息失败', 'error');
+        return;
+    }
+    
     // 添加用户消息到界面
     addMessageToChat('user', message);
 
@@ -743,7 +766,9 @@ async function sendMessage() {
             repetition_penalty: config.repetition_penalty,
             min_p: config.min_p,
             top_a: config.top_a,
-            typical_p: config.typical_p
+            typical_p: config.typical_p,
+            // 多候选：一次请求并发生成多个回复，作为可左右切换的候选
+            candidates: config.candidates || 1
         };
         
         // 创建中止控制器
@@ -787,9 +812,50 @@ async function sendMessage() {
                 signal: abortController.signal
             });
             
-            const reader = response.body.getReader();
+            let reader = response.body.getReader();
             const decoder = new TextDecoder();
             let assistantMessage = '';
+            let candidateMessages = [];  // 多候选时序号 1 之后的候选（序号 0 即 assistantMessage）
+            let buffer = '';  // 跨数据块的不完整行（透传模式下数据块不按行对齐）
+            
+            // 断线重连：服务端开启 stream_replay 时会下发 "id: <流ID>:<序号>"，
+            // 网络中断后带上 Last-Event-ID 重新请求即可从断点继续，服务端不会重新请求AI
+            const streamId = response.headers.get('X-Stream-Id');
+            let lastEventId = null;
+            let messageAtLastId = '';
+            let candidatesAtLastId = [];
+            let resumeAttempts = 0;
+            const readChunk = async () => {
+                while (true) {
+                    try {
+                        return await reader.read();
+                    } catch (error) {
+                        if (error.name === 'AbortError' || !lastEventId || resumeAttempts >= 3) {
+                            throw error;
+                        }
+                        resumeAttempts++;
+                        console.log(`[断线重连] 连接中断，第${resumeAttempts}次尝试从 ${lastEventId} 续传`);
+                        await new Promise(resolve => setTimeout(resolve, 1000 * resumeAttempts));
+                        const resumed = await fetch('/api/chat/completions', {
+                            method: 'POST',
+                            headers: {
+                                'Content-Type': 'application/json',
+                                'Last-Event-ID': lastEventId
+                            },
+                            body: JSON.stringify(requestData),
+                            signal: abortController.signal
+                        });
+                        if (!resumed.ok) {
+                            throw error;
+                        }
+                        // 从最后一个事件ID之后重新接收，丢弃断点之后已显示的部分
+                        reader = resumed.body.getReader();
+                        buffer = '';
+                        assistantMessage = messageAtLastId;
+                        candidateMessages = candidatesAtLastId.slice();
+                    }
+                }
+            };
             
             // 移除加载动画，准备显示实际内容
             loadingDiv.remove();
@@ -807,19 +873,33 @@ async function sendMessage() {
             
             try {
                 while (true) {
-                    const { done, value } = await reader.read();
+                    const { done, value } = await readChunk();
                     if (done) break;
                 
-                const chunk = decoder.decode(value);
-                const lines = chunk.split('\n');
+                buffer += decoder.decode(value, { stream: true });
+                const lines = buffer.split('\n');
+                buffer = lines.pop();
                 
                 for (const line of lines) {
-                    if (line.startsWith('data: ')) {
+                    if (line.startsWith('id: ')) {
+                        lastEventId = line.slice(4);
+                        messageAtLastId = assistantMessage;
+                        candidatesAtLastId = candidateMessages.slice();
+                    } else if (line.startsWith('data: ')) {
                         const data = line.slice(6);
                         if (data === '[DONE]') continue;
                         
                         try {
                             const parsed = JSON.parse(data);
+                            // 其他候选只在后台累积，界面显示序号 0 的候选
+                            const choiceIndex = parsed.choices && parsed.choices[0] ? (parsed.choices[0].index || 0) : 0;
+                            if (choiceIndex > 0) {
+                                const delta = parsed.choices[0].delta;
+                                if (delta && delta.content) {
+                                    candidateMessages[choiceIndex] = (candidateMessages[choiceIndex] || '') + delta.content;
+                                }
+                                continue;
+                            }
                             if (parsed.choices && parsed.choices[0].delta && parsed.choices[0].delta.content) {
                                 assistantMessage += parsed.choices[0].delta.content;
                                 
@@ -843,6 +923,13 @@ async function sendMessage() {
                                     }
                                     console.log(`[回复截断] AI回复已达到${config.frontend_max_response}字符限制，已截断`);
                                     reader.cancel(); // 取消读取流
+                                    if (streamId) {
+                                        fetch('/api/chat/completions/cancel', {
+                                            method: 'POST',
+                                            headers: { 'Content-Type': 'application/json' },
+                                            body: JSON.stringify({ stream_id: streamId })
+                                        }).catch(() => {});
+                                    }
                                     break;
                                 } else {
                                     // 处理流式内容
@@ -875,6 +962,14 @@ async function sendMessage() {
                 }
             } catch (error) {
                 if (error.name === 'AbortError') {
+                    if (streamId) {
+                        // 用户主动停止：通知服务端不必等待重连，立即取消上游生成
+                        fetch('/api/chat/completions/cancel', {
+                            method: 'POST',
+                            headers: { 'Content-Type': 'application/json' },
+                            body: JSON.stringify({ stream_id: streamId })
+                        }).catch(() => {});
+                    }
                     const abortedMsg = assistantMessage + '\n\n[生成已被用户中止]';
                     if (window.textDecorator) {
                         // 设置变量值
@@ -906,7 +1001,14 @@ async function sendMessage() {
             
             // 添加到上下文
             if (assistantMessage) {
-                window.contextMessages.push({ role: 'assistant', content: assistantMessage });
+                const swipes = [assistantMessage, ...candidateMessages.slice(1).filter(Boolean)];
+                if (swipes.length > 1) {
+                    // 多候选：保存全部候选，刷新显示以出现左右切换按钮
+                    window.contextMessages.push({ role: 'assistant', content: assistantMessage, swipes: swipes, swipe_id: 0 });
+                    refreshChatDisplay();
+                } else {
+                    window.contextMessages.push({ role: 'assistant', content: assistantMessage });
+                }
                 updateHistoryDisplay();
                 
                 // 流式响应完成后，重新处理所有消息以确保深度正确
@@ -944,8 +1046,15 @@ async function sendMessage() {
                     addMessageToChat('assistant', assistantMessage);
                 }
                 
-                // 添加到上下文
-                window.contextMessages.push({ role: 'assistant', content: assistantMessage });
+                // 添加到上下文（多候选时保存全部候选，可左右切换）
+                const swipes = data.choices.map(choice => choice.message && choice.message.content).filter(Boolean);
+                if (swipes.length > 1) {
+                    swipes[0] = assistantMessage;
+                    window.contextMessages.push({ role: 'assistant', content: assistantMessage, swipes: swipes, swipe_id: 0 });
+                    refreshChatDisplay();
+                } else {
+                    window.contextMessages.push({ role: 'assistant', content: assistantMessage });
+                }
                 updateHistoryDisplay();
             }
             
@@ -1336,6 +1445,8 @@ function updateHistoryDisplay() {
 // 清空上下文
 window.clearContext = async function() {
     window.contextMessages = [];
+    // 清空后下一次保存只写入新的消息，不再补齐较早的消息
+    savedChatState = { key: null, character: null, chat: null, lines: [], base: 0 };
     updateHistoryDisplay();
     
     try {
@@ -1394,22 +1505,7 @@ async function autoSaveChat() {
     }
     
     try {
-        const response = await fetch('/api/chats/save', {
-            method: 'POST',
-            headers: {
-                'Content-Type': 'application/json'
-            },
-            body: JSON.stringify({
-                character_name: charName,
-                chat_name: currentChatId,
-                messages: window.contextMessages,
-                metadata: {
-                    user_name: userName,
-                    title: currentChatTitle || window.contextMessages[0]?.content?.substring(0, 30) || '新对话',
-                    create_date: new Date().toISOString()
-                }
-            })
-        });
+        const response = await persistChat(charName, userName);
         
         if (response.ok) {
             const data = await response.json();
@@ -1422,9 +1518,10 @@ async function autoSaveChat() {
                 chat.chatId === currentChatId || chat.name === currentChatId
             );
             if (chatIndex !== -1) {
-                chatHistory[chatIndex].message_count = window.contextMessages.length;
-                chatHistory[chatIndex].messageCount = window.contextMessages.length;
-                console.log('[自动保存] 对话消息数已更新:', currentChatId, '消息数:', window.contextMessages.length);
+                const messageCount = savedChatState.base + window.contextMessages.length;
+                chatHistory[chatIndex].message_count = messageCount;
+                chatHistory[chatIndex].messageCount = messageCount;
+                console.log('[自动保存] 对话消息数已更新:', currentChatId, '消息数:', messageCount);
                 // 立即更新显示
                 updateHistoryDisplay();
             } else {
@@ -1438,6 +1535,135 @@ async function autoSaveChat() {
     }
 }
 
+// 序列化需要保存的字段，用于和上次保存的内容比较
+function serializeSavedMessage(msg) {
+    return JSON.stringify([msg.role, msg.content, msg.name, msg.swipes, msg.swipe_id]);
+}
+
+// 对比上次保存的消息：末尾新增、修改一条、删除一条时返回对应的增量操作，其他情况返回 null（完整保存）
+function diffSavedMessages(savedLines, lines) {
+    let common = 0;
+    while (common < savedLines.length && common < lines.length && savedLines[common] === lines[common]) {
+        common++;
+    }
+    if (common === savedLines.length) {
+        return { type: 'append', start: common };
+    }
+    const sameTail = (offset) => lines.slice(common + 1).every((line, i) => line === savedLines[common + 1 + i + offset]);
+    if (lines.length === savedLines.length && sameTail(0)) {
+        return { type: 'edit', index: common };
+    }
+    if (lines.length === savedLines.length - 1 && lines.slice(common).every((line, i) => line === savedLines[common + 1 + i])) {
+        return { type: 'delete', index: common };
+    }
+    return null;
+}
+
+// 保存当前对话：能用追加/修改/删除表示时只发送变化的消息，否则（或服务器内容不一致时）重写整个对话
+async function persistChat(charName, userName) {
+    let messages = window.contextMessages.filter(msg => msg.role !== 'system');
+    let lines = messages.map(serializeSavedMessage);
+    const key = `${charName}/${currentChatId}`;
+    const metadata = {
+        user_name: userName,
+        title: currentChatTitle || window.contextMessages[0]?.content?.substring(0, 30) || '新对话',
+        create_date: new Date().toISOString()
+    };
+    const post = (url, body) => fetch(url, {
+        method: 'POST',
+        headers: { 'Content-Type': 'application/json' },
+        body: JSON.stringify({ character_name: charName, chat_name: currentChatId, ...body })
+    });
+    
+    const change = savedChatState.key === key ? diffSavedMessages(savedChatState.lines, lines) : null;
+    // 只加载了末尾部分时，本地序号加上 base 才是服务器上的序号
+    let base = savedChatState.key === key ? savedChatState.base : 0;
+    let response = null;
+    if (change && change.type === 'append') {
+        if (change.start === messages.length) {
+            return new Response(JSON.stringify({ chat_name: currentChatId }));  // 没有变化
+        }
+        response = await post('/api/chats/append', {
+            messages: messages.slice(change.start),
+            expected_count: base + change.start,
+            metadata
+        });
+    } else if (change && change.type === 'edit') {
+        response = await post('/api/chats/edit', { index: base + change.index, message: messages[change.index] });
+    } else if (change && change.type === 'delete') {
+        response = await post('/api/chats/delete-message', { index: base + change.index });
+    }
+    
+    if (!response || !response.ok) {
+        // 首次保存、复杂修改或服务器内容与本地记录不一致（409）时重写整个对话，
+        // 此前先加载尚未加载的较早消息，避免只写回末尾部分
+        if (base > 0) {
+            if (!(await loadEarlierMessages(true))) {
+                throw new Error('加载较早的消息失败');
+            }
+            messages = window.contextMessages.filter(msg => msg.role !== 'system');
+            lines = messages.map(serializeSavedMessage);
+            base = 0;
+        }
+        response = await post('/api/chats/save', { messages: window.contextMessages, metadata });
+    }
+    if (response.ok) {
+        savedChatState = { key, character: charName, chat: currentChatId, lines, base };
+    }
+    return response;
+}
+
+// 从服务器打开对话：只加载最后一页消息，并记为已保存的状态。失败时返回 null
+async function fetchChatTail(character, chatName) {
+    const response = await fetch(`/api/chats/get?character=${encodeURIComponent(character)}&chat_name=${encodeURIComponent(chatName)}&tail=${CHAT_PAGE_SIZE}`);
+    if (!response.ok) return null;
+    
+    const data = await response.json();
+    const messages = data.messages || [];
+    savedChatState = {
+        key: `${character}/${chatName}`,
+        character,
+        chat: chatName,
+        lines: messages.map(serializeSavedMessage),
+        base: data.offset || 0
+    };
+    return messages;
+}
+
+// 加载当前对话中较早的一页消息（all 为 true 时加载全部），插入到 contextMessages 开头并保持滚动位置
+async function loadEarlierMessages(all = false) {
+    if (earlierMessagesRequest) {
+        await earlierMessagesRequest.catch(() => null);
+        if (!all) return true;
+    }
+    const state = savedChatState;
+    if (!state.base || state.chat !== currentChatId) return true;
+    
+    const start = all ? 0 : Math.max(state.base - CHAT_PAGE_SIZE, 0);
+    earlierMessagesRequest = fetch(`/api/chats/get?character=${encodeURIComponent(state.character)}&chat_name=${encodeURIComponent(state.chat)}&offset=${start}&limit=${state.base - start}`)
+        .then(response => response.ok ? response.json() : Promise.reject(new Error('服务器响应错误')));
+    try {
+        const data = await earlierMessagesRequest;
+        if (savedChatState.key !== state.key || savedChatState.base !== state.base) {
+            return false;  // 加载期间切换了对话
+        }
+        const messages = data.messages || [];
+        window.contextMessages = [...messages, ...window.contextMessages];
+        savedChatState = {
+            ...savedChatState,
+            lines: [...messages.map(serializeSavedMessage), ...savedChatState.lines],
+            base: start
+        };
+        refreshChatDisplay(true);
+        return true;
+    } catch (error) {
+        console.error('加载较早的消息失败:', error);
+        return false;
+    } finally {
+        earlierMessagesRequest = null;
+    }
+}
+
 // 创建模态框
 function createModal(title, content) {
     const modal = document.createElement('div');
@@ -1480,12 +1706,18 @@ function escapeHtml(text) {
 }
 
 // 导出当前对话为JSONL（SillyTavern格式）
-window.exportCurrentChat = function() {
+window.exportCurrentChat = async function() {
     if (window.contextMessages.length === 0) {
         showToast('当前没有对话内容', 'warning');
         return;
     }
     
+    // 导出完整对话，先加载尚未加载的较早消息
+    if (!(await loadEarlierMessages(true))) {
+        showToast('加载较早的消息失败', 'error');
+        return;
+    }
+    
     // 获取用户和角色名称
     const userName = window.getCurrentUserPersona ? window.getCurrentUserPersona().name : 'User';
     const charName = window.currentCharacter ? window.currentCharacter.name : 'Assistant';
@@ -1513,8 +1745,8 @@ window.exportCurrentChat = function() {
             is_system: false,
             send_date: new Date().toISOString(),
             mes: msg.content,
-            swipes: [msg.content],
-            swipe_id: 0,
+            swipes: msg.swipes || [msg.content],
+            swipe_id: msg.swipe_id || 0,
             gen_started: new Date().toISOString(),
             gen_finished: new Date().toISOString()
         };
@@ -1562,8 +1794,8 @@ window.exportCurrentChat = function() {
                 is_system: msg.role === 'system',
                 send_date: chat.timestamp || new Date().toISOString(),
                 mes: msg.content,
-                swipes: [msg.content],
-                swipe_id: 0,
+                swipes: msg.swipes || [msg.content],
+                swipe_id: msg.swipe_id || 0,
                 gen_started: chat.timestamp || new Date().toISOString(),
                 gen_finished: chat.timestamp || new Date().toISOString()
             };
@@ -1691,6 +1923,9 @@ window.importChat = function(file) {
 function saveChatToHistory() {
     if (window.contextMessages.length === 0) return;
     
+    // 只加载了末尾部分的服务器对话不缓存，再次打开时从服务器读取
+    if (savedChatState.chat === currentChatId && savedChatState.base > 0) return;
+    
     // 检查是否已经存在相同ID的对话
     const existingIndex = chatHistory.findIndex(chat => chat.chatId === currentChatId);
     
@@ -1732,13 +1967,11 @@ async function loadLatestChatForCharacter(characterName) {
             if (chats.length > 0) {
                 // 加载最新的对话
                 const latestChat = chats[0]; // 已按时间排序，第一个是最新的
-                const chatResponse = await fetch(`/api/chats/get?character=${encodeURIComponent(characterName)}&chat_name=${encodeURIComponent(latestChat.name)}`);
+                const messages = await fetchChatTail(characterName, latestChat.name);
                 
-                if (chatResponse.ok) {
-                    const chatData = await chatResponse.json();
-                    
-                    // 恢复对话内容
-                    window.contextMessages = chatData.messages || [];
+                if (messages) {
+                    // 恢复对话内容（较早的消息在滚动到顶部时加载）
+                    window.contextMessages = messages;
                     currentChatId = latestChat.name;
                     currentChatTitle = latestChat.title || latestChat.name;
                     
@@ -1836,18 +2069,18 @@ async function loadHistoryChat(index) {
     if (chat.name && chat.character && !chat.messages) {
         try {
             showToast('正在加载对话...', 'info');
-            const response = await fetch(`/api/chats/get?character=${encodeURIComponent(chat.character)}&chat_name=${encodeURIComponent(chat.name)}`);
+            const messages = await fetchChatTail(chat.character, chat.name);
             
-            if (response.ok) {
-                const data = await response.json();
-                
-                // 更新window.contextMessages为服务器返回的消息
-                window.contextMessages = data.messages || [];
+            if (messages) {
+                // 更新window.contextMessages为服务器返回的最后一页消息，较早的消息在滚动到顶部时加载
+                window.contextMessages = messages;
                 currentChatId = chat.name;
                 currentChatTitle = chat.title || chat.name;
                 
-                // 更新缓存中的对话数据
-                chatHistory[index].messages = window.contextMessages;
+                // 更新缓存中的对话数据（只缓存完整加载的对话）
+                if (savedChatState.base === 0) {
+                    chatHistory[index].messages = window.contextMessages;
+                }
                 chatHistory[index].chatId = currentChatId;
                 
             } else {
@@ -2050,6 +2283,14 @@ window.regenerateMessage = async function(index) {
         return;
     }
     
+    // 提示词需要完整的历史，先加载尚未加载的较早消息（插入到开头，index 随之后移）
+    const loadedCount = window.contextMessages.length;
+    if (!(await loadEarlierMessages(true))) {
+        showToast('加载较早的消息失败', 'error');
+        return;
+    }
+    index += window.contextMessages.length - loadedCount;
+    
     // 删除当前AI回复及之后的所有消息
     window.contextMessages.splice(index);
     
@@ -2320,10 +2561,11 @@ window.regenerateMessage = async function(index) {
     }
 };
 
-// 刷新聊天显示
-function refreshChatDisplay() {
+// 刷新聊天显示；keepScrollPosition 为 true 时（在顶部插入了较早的消息）保持当前看到的位置，否则滚动到底部
+function refreshChatDisplay(keepScrollPosition = false) {
     const messagesContainer = document.querySelector('.messages-container');
     if (!messagesContainer) return;
+    const distanceFromBottom = messagesContainer.scrollHeight - messagesContainer.scrollTop;
 
     // 清空消息（但不清空容器，因为输入框可能在里面）
     const allMessages = messagesContainer.querySelectorAll('.message');
@@ -2403,8 +2645,12 @@ function refreshChatDisplay() {
         messagesContainer.appendChild(messageDiv);
     });
     
-    // 滚动到底部
-    scrollToBottom();
+    if (keepScrollPosition) {
+        messagesContainer.scrollTop = messagesContainer.scrollHeight - distanceFromBottom;
+    } else {
+        // 滚动到底部
+        scrollToBottom();
+    }
     
     // 触发HTML渲染器处理所有消息
     if (window.htmlRenderer && window.htmlRenderer.config.enabled) {
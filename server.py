@@ -1,19 +1,37 @@
-﻿from flask import Flask, request, jsonify, Response, stream_with_context, send_from_directory, render_template_string
+﻿from flask import Flask, request, jsonify, Response, stream_with_context, send_from_directory, render_template_string, g, has_request_context
 from flask_cors import CORS
 import json
-import requests
 import time
 from datetime import datetime
 import os
 import uuid
 import logging
+import threading
 import shutil
 import tempfile
 from logging.handlers import RotatingFileHandler
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
 from werkzeug.utils import secure_filename
 from document_parser import UniversalDocumentParser
 from docx_extract import extract_from_docx
+import upstream_client
+import upstream_router
+import retry_policy
+import sse_stream
+import response_cache
+import admission
+import singleflight
+import stream_replay
+import model_catalog
+import ai_log
+import metrics
+import tracing
+import profiler
+import memory_monitor
+import chat_store
+import chat_search
+import storage
 
 app = Flask(__name__, static_folder='.', static_url_path='')
 CORS(app)
@@ -44,9 +62,16 @@ def ensure_toolbook_storage():
 
 ensure_toolbook_storage()
 
-# 工具书导入进度跟踪
+# 工具书导入进度跟踪（按开始顺序保存，超过上限时淘汰最早的已结束任务）
 toolbook_import_progress = {}
 
+
+def prune_import_progress(max_entries):
+    finished = [key for key, progress in toolbook_import_progress.items()
+                if progress.get('status') in ('completed', 'error')]
+    for key in finished[:max(len(toolbook_import_progress) - max_entries, 0)]:
+        del toolbook_import_progress[key]
+
 # 初始化文档解析器
 doc_parser = UniversalDocumentParser(max_file_size=20*1024*1024)  # 20MB限制
 
@@ -86,75 +111,64 @@ ai_logger.setLevel(logging.INFO)
 ai_logger.addHandler(file_handler)
 ai_logger.addHandler(console_handler)
 
-def log_ai_request(endpoint, request_data, response_data=None, error=None):
-    """记录AI请求和响应的完整信息（最新的在最上面）"""
-    log_entry = {
-        'timestamp': datetime.now().isoformat(),
-        'endpoint': endpoint,
-        'request': request_data,
-        'response': response_data,
-        'error': str(error) if error else None
-    }
-    
-    # 构建日志内容
+def write_ai_log_text(log_entry):
+    """把一条AI日志以易读格式输出到控制台和 logs/ai_chat.log（由日志写入线程调用）"""
     log_lines = []
     log_lines.append("\n" + "="*80)
-    log_lines.append(f"AI请求 - 端点: {endpoint}")
+    log_lines.append(f"AI请求 - 端点: {log_entry['endpoint']}")
     log_lines.append(f"时间: {log_entry['timestamp']}")
     log_lines.append("-"*40)
     log_lines.append("请求体:")
-    log_lines.append(json.dumps(request_data, ensure_ascii=False, indent=2))
+    log_lines.append(json.dumps(log_entry['request'], ensure_ascii=False, indent=2))
     
-    if response_data:
+    if log_entry['response']:
         log_lines.append("-"*40)
         log_lines.append("响应体:")
         # 如果响应太长，可以截断
-        response_str = json.dumps(response_data, ensure_ascii=False, indent=2)
+        response_str = json.dumps(log_entry['response'], ensure_ascii=False, indent=2)
         if len(response_str) > 5000:  # 如果响应超过5000字符
             log_lines.append(response_str[:5000] + "\n... [响应已截断]")
         else:
             log_lines.append(response_str)
     
-    if error:
+    if log_entry['error']:
         log_lines.append("-"*40)
-        log_lines.append(f"错误: {error}")
+        log_lines.append(f"错误: {log_entry['error']}")
     
     log_lines.append("="*80)
     
-    # 将新日志内容写入到文件开头
-    log_file_path = 'logs/ai_chat.log'
-    new_content = "\n".join(log_lines) + "\n\n"
-    
-    # 读取现有内容
-    existing_content = ""
-    if os.path.exists(log_file_path):
-        try:
-            with open(log_file_path, 'r', encoding='utf-8') as f:
-                existing_content = f.read()
-        except:
-            existing_content = ""
-    
-    # 将新内容写在最前面
-    try:
-        with open(log_file_path, 'w', encoding='utf-8') as f:
-            f.write(new_content + existing_content)
-            
-        # 限制文件大小，如果超过10MB，只保留最近的5MB
-        if len(new_content + existing_content) > 10 * 1024 * 1024:
-            with open(log_file_path, 'r', encoding='utf-8') as f:
-                content = f.read(5 * 1024 * 1024)  # 只保留前5MB
-            with open(log_file_path, 'w', encoding='utf-8') as f:
-                f.write(content)
-    except Exception as e:
-        print(f"写入日志文件失败: {e}")
-    
-    # 同时输出到控制台（保持原有功能）
     for line in log_lines:
-        if error and "错误" in line:
+        if log_entry['error'] and "错误" in line:
             ai_logger.error(line)
         else:
             ai_logger.info(line)
 
+# AI请求日志：logs/ai_requests/ 下只追加的 JSONL 分段，由后台线程批量写入
+ai_log_writer = ai_log.AILogWriter(os.path.join(LOGS_DIR, 'ai_requests'), mirror=write_ai_log_text)
+ai_log.register_shutdown(ai_log_writer)
+
+# 请求分阶段追踪：Server-Timing 响应头，可选导出到 logs/traces.jsonl
+tracer = tracing.Tracer(LOGS_DIR)
+
+
+def current_trace():
+    """当前请求的追踪；请求上下文之外或未被采样时为空追踪"""
+    if not has_request_context():
+        return tracing.NULL_TRACE
+    return g.get('trace', tracing.NULL_TRACE)
+
+def log_ai_request(endpoint, request_data, response_data=None, error=None):
+    """记录AI请求和响应的完整信息（放入后台写入队列，不阻塞请求线程）"""
+    log_entry = {
+        'timestamp': datetime.now().isoformat(),
+        'endpoint': endpoint,
+        'request': request_data,
+        'response': response_data,
+        'error': str(error) if error else None
+    }
+    with current_trace().span('log'):
+        return ai_log_writer.submit(log_entry)
+
 
 
 def slugify_toolbook_keyword(keyword: str) -> str:
@@ -304,22 +318,282 @@ def save_config(new_config):
         json.dump(new_config, f, ensure_ascii=False, indent=2)
     return new_config
 
+# 仅由服务端维护的配置段（前端保存配置时不会携带，需要保留）
+SERVER_CONFIG_KEYS = ('upstream', 'upstreams', 'stream', 'response_cache', 'single_flight', 'admission', 'retry', 'stream_replay',
+                      'candidate_generation', 'model_cache', 'ai_log', 'tracing', 'metrics', 'profiler', 'memory', 'storage')
+
 # 初始加载配置
 config = load_config()
+upstream_client.configure(config.get('upstream'))
+upstream = upstream_client.get_client()
+upstream_router.configure(config)
+router = upstream_router.get_router()
+retry_policy.configure(config.get('retry'))
+retry = retry_policy.get_policy()
+completion_cache = response_cache.ResponseCache(os.path.join(DATA_DIR, 'response_cache'), config.get('response_cache'))
+
+# 相同的进行中请求合并为一次上游调用
+completion_flights = singleflight.SingleFlight()
+stream_flights = singleflight.StreamFlights()
+
+# 流式断线重连的重放缓冲区
+replay_store = stream_replay.ReplayStore(config.get('stream_replay'))
+
+# 发往服务商的并发上限与公平排队
+admission_controller = admission.AdmissionController(config.get('admission'))
+
+# 模型列表缓存（过期后先返回旧列表，后台刷新）
+models_cache = model_catalog.ModelCatalog(config.get('model_cache'))
+
+ai_log_writer.configure(config.get('ai_log'))
+tracer.configure(config.get('tracing'))
+metrics.configure(config.get('metrics'))
+
+# 采样分析器（默认关闭，仅管理员可用）
+sampling_profiler = profiler.Profiler(config.get('profiler'))
+
+# 进程内各结构的内存统计与上限
+memory_tracker = memory_monitor.MemoryMonitor(config.get('memory'))
+
+
+def collect_component_metrics():
+    """/metrics 输出时读取各组件的当前状态"""
+    admission_stats = admission_controller.stats()
+    cache_stats = completion_cache.stats()
+    retry_stats = retry.stats()
+    log_stats = ai_log_writer.stats()
+    lines = []
+    lines += metrics.gauge_lines('chat_proxy_admission_active', '已获准入、正在请求服务商的数量', admission_stats['active'])
+    lines += metrics.gauge_lines('chat_proxy_admission_queued', '排队等待准入的请求数', admission_stats['queued'])
+    lines += metrics.gauge_lines('chat_proxy_admission_rejected_total', '因队列已满或超时被拒绝的请求数',
+                                 admission_stats['rejected_queue_full'] + admission_stats['rejected_deadline'], 'counter')
+    lines += metrics.gauge_lines('chat_proxy_response_cache_hits_total', '响应缓存命中次数', cache_stats['hits'], 'counter')
+    lines += metrics.gauge_lines('chat_proxy_response_cache_misses_total', '响应缓存未命中次数', cache_stats['misses'], 'counter')
+    lines += metrics.gauge_lines('chat_proxy_response_cache_disk_bytes', '响应缓存磁盘层占用的字节数', cache_stats['disk_bytes'])
+    lines += metrics.gauge_lines('chat_proxy_retries_total', '重试次数', retry_stats['retries'], 'counter')
+    lines += metrics.gauge_lines('chat_proxy_ai_log_dropped_total', '写入队列已满而丢弃的AI日志条数', log_stats['dropped'], 'counter')
+    return lines
+
+
+metrics.registry.register_collector(collect_component_metrics)
 
 # 聊天历史存储
 chats = {}
 current_chat_id = None
 
-# 上下文窗口
+# 上下文窗口（只保留最近 memory.context_window_max_messages 条）
 context_window = []
 
+
+def add_to_context(messages):
+    context_window.extend(messages)
+    excess = len(context_window) - int(memory_tracker.settings['context_window_max_messages'])
+    if excess > 0:
+        del context_window[:excess]
+
+
+def apply_memory_limits():
+    """按 memory 配置调整各结构的上限，并立即淘汰超出的部分"""
+    settings = memory_tracker.settings
+    add_to_context([])
+    doc_parser.configure_cache(int(settings['document_cache_max_entries']), int(settings['document_cache_max_chars']))
+    prune_import_progress(int(settings['import_progress_max_entries']))
+
+
+def context_window_usage():
+    return {
+        'items': len(context_window),
+        'bytes': memory_monitor.deep_sizeof(context_window),
+        'limit': memory_tracker.settings['context_window_max_messages'],
+    }
+
+
+def document_cache_usage():
+    stats = doc_parser.cache_stats()
+    stats['items'] = stats.pop('entries')
+    stats['bytes'] = memory_monitor.deep_sizeof(doc_parser.cache)
+    return stats
+
+
+def import_progress_usage():
+    return {
+        'items': len(toolbook_import_progress),
+        'bytes': memory_monitor.deep_sizeof(toolbook_import_progress),
+        'limit': memory_tracker.settings['import_progress_max_entries'],
+    }
+
+
+def response_cache_usage():
+    stats = completion_cache.stats()
+    return {'items': stats['entries'], 'bytes': stats['memory_bytes'], 'evictions': stats['evictions']}
+
+
+def replay_buffer_usage():
+    stats = replay_store.stats()
+    return {'items': stats['streams'], 'bytes': stats['bytes'], 'evictions': stats['evicted']}
+
+
+memory_tracker.register('context_window', context_window_usage)
+memory_tracker.register('document_cache', document_cache_usage)
+memory_tracker.register('toolbook_import_progress', import_progress_usage)
+memory_tracker.register('response_cache', response_cache_usage)
+memory_tracker.register('stream_replay', replay_buffer_usage)
+memory_tracker.register('ai_log_queue', lambda: {'items': ai_log_writer.stats()['queued']})
+memory_tracker.register('model_cache', lambda: {'items': len(models_cache.stats()['entries'])})
+apply_memory_limits()
+
 # 确保数据目录存在
 os.makedirs(os.path.join(DATA_DIR, 'chats'), exist_ok=True)
 os.makedirs(os.path.join(DATA_DIR, 'characters'), exist_ok=True)
 os.makedirs(os.path.join(DATA_DIR, 'worlds'), exist_ok=True)
 os.makedirs(os.path.join(DATA_DIR, 'presets'), exist_ok=True)
 
+# 直接运行 server.py 时开启 Werkzeug 重载器：监视进程只负责在代码修改后重启服务进程（设置了 WERKZEUG_RUN_MAIN），
+# 不处理请求，因此不核对对话目录、不建立搜索索引，避免两个进程重复读取全部对话并同时写入 .catalog.jsonl
+USE_RELOADER = True
+RELOADER_WATCHER = __name__ == '__main__' and USE_RELOADER and os.environ.get('WERKZEUG_RUN_MAIN') != 'true'
+
+# 数据存储层：角色卡、世界书、预设、用户身份、正则脚本和聊天记录都通过它读写
+# （config.json 的 "storage" 段选择文件或 SQLite 后端，修改后重启生效）
+data_store = storage.open_storage(DATA_DIR, config.get('storage'), reconcile=not RELOADER_WATCHER)
+
+# 对话全文搜索：启动时在后台建立倒排索引，之后随保存/追加/修改/删除增量更新
+chat_search_index = chat_search.ChatSearchIndex(data_store)
+if not RELOADER_WATCHER:
+    chat_search_index.start()
+memory_tracker.register('chat_search', chat_search_index.stats)
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.monotonic()
+    if request.path.startswith('/api/'):
+        g.trace = tracer.start(request.endpoint or request.path, force=request.headers.get('X-Trace') == '1')
+    if request.headers.get('X-Profile') == '1' and profiler_authorized():
+        # 单请求分析：只采集处理本请求的线程，响应关闭（流式输出结束）时停止
+        g.profile_sampler = sampling_profiler.begin_request(threading.get_ident())
+
+@app.after_request
+def record_request_metrics(response):
+    # 按路由规则（而不是实际路径）计数，避免标签数量无限增长
+    endpoint = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+    metrics.http_requests.labels(endpoint, request.method, response.status_code).inc()
+    started = g.get('request_started')
+    if started is not None:
+        metrics.http_duration.labels(endpoint).observe(time.monotonic() - started)
+    return response
+
+@app.after_request
+def finish_request_trace(response):
+    trace = g.get('trace', tracing.NULL_TRACE)
+    if trace.sampled:
+        response.headers['Server-Timing'] = trace.server_timing()
+        response.headers['X-Trace-Id'] = trace.trace_id
+        trace.set('status', response.status_code)
+        if not trace.deferred:
+            trace.finish()
+    return response
+
+@app.after_request
+def attach_request_profile(response):
+    sampler = g.get('profile_sampler')
+    if sampler is not None:
+        response.headers['X-Profile-Id'] = sampler.profile_id
+        endpoint = request.endpoint or request.path
+        response.call_on_close(lambda: sampling_profiler.finish_request(sampler, endpoint))
+    return response
+
+def profiler_authorized():
+    return sampling_profiler.authorized(request.headers.get('X-Admin-Token'), request.remote_addr)
+
+@app.route('/api/profiler/sample', methods=['GET', 'POST'])
+def profile_process():
+    """对整个进程采样 seconds 秒，返回 collapsed stack 格式（可用于生成火焰图）"""
+    if not profiler_authorized():
+        return jsonify({"error": "未开启分析器或没有权限"}), 403
+    try:
+        seconds = float(request.args.get('seconds', 10))
+        interval_ms = request.args.get('interval_ms')
+        sampler = sampling_profiler.run(seconds, float(interval_ms) if interval_ms else None)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except RuntimeError as e:
+        return jsonify({"error": str(e)}), 409
+    return Response(sampler.collapsed(), mimetype='text/plain', headers={
+        'Content-Disposition': f'attachment; filename="profile-{sampler.profile_id}.folded"',
+        'X-Profile-Samples': str(sampler.samples),
+    })
+
+@app.route('/api/profiler/results/<profile_id>', methods=['GET'])
+def get_request_profile(profile_id):
+    """获取单请求分析（请求头 X-Profile: 1）的结果"""
+    if not profiler_authorized():
+        return jsonify({"error": "未开启分析器或没有权限"}), 403
+    result = sampling_profiler.result(profile_id)
+    if result is None:
+        return jsonify({"error": "分析结果不存在或已过期"}), 404
+    collapsed, info = result
+    return Response(collapsed, mimetype='text/plain', headers={
+        'Content-Disposition': f'attachment; filename="profile-{profile_id}.folded"',
+        'X-Profile-Samples': str(info['samples']),
+    })
+
+@app.route('/api/profiler/stats', methods=['GET'])
+def get_profiler_stats():
+    """分析器状态和最近的单请求分析结果"""
+    if not profiler_authorized():
+        return jsonify({"error": "未开启分析器或没有权限"}), 403
+    return jsonify(sampling_profiler.stats())
+
+def admin_authorized():
+    return sampling_profiler.is_admin(request.headers.get('X-Admin-Token'), request.remote_addr)
+
+@app.route('/api/memory', methods=['GET'])
+def get_memory_report():
+    """进程内存与各结构的大小（仅管理员）"""
+    if not admin_authorized():
+        return jsonify({"error": "没有权限"}), 403
+    return jsonify(memory_tracker.report())
+
+@app.route('/api/memory/snapshot', methods=['POST'])
+def take_memory_snapshot():
+    """tracemalloc 快照：返回占用最多的位置和与上一次快照的差异（未开启时自动开启）"""
+    if not admin_authorized():
+        return jsonify({"error": "没有权限"}), 403
+    try:
+        limit = int(request.args.get('limit', 20))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    group_by = request.args.get('group_by', 'lineno')
+    if group_by not in ('lineno', 'filename', 'traceback'):
+        return jsonify({"error": "group_by 只能是 lineno、filename 或 traceback"}), 400
+    return jsonify(memory_tracker.snapshot(limit, group_by))
+
+@app.route('/api/memory/tracemalloc', methods=['POST'])
+def toggle_tracemalloc():
+    """开启或关闭 tracemalloc：{"enabled": true, "frames": 10}"""
+    if not admin_authorized():
+        return jsonify({"error": "没有权限"}), 403
+    data = request.json or {}
+    if data.get('enabled', True):
+        memory_tracker.start_tracing(data.get('frames'))
+    else:
+        memory_tracker.stop_tracing()
+    return jsonify(memory_tracker.tracing_status())
+
+@app.route('/api/trace/stats', methods=['GET'])
+def get_trace_stats():
+    """请求追踪的采样与导出统计（仅管理员）"""
+    if not admin_authorized():
+        return jsonify({"error": "没有权限"}), 403
+    return jsonify(tracer.stats())
+
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    """Prometheus 文本格式的运行指标（metrics.public 为 false 时仅管理员）"""
+    if not (metrics.settings['public'] or admin_authorized()):
+        return jsonify({"error": "没有权限"}), 403
+    return Response(metrics.registry.render(), mimetype='text/plain; version=0.0.4')
+
 @app.route('/')
 def home():
     """返回主页面"""
@@ -344,6 +618,15 @@ def api_info():
         "endpoints": [
             "/api/config - 配置管理",
             "/api/models - 获取模型列表",
+            "/api/upstream/stats - 上游连接池统计",
+            "/api/stream/stats - 流式请求统计",
+            "/api/cache/stats - 响应缓存统计",
+            "/api/singleflight/stats - 请求合并统计",
+            "/api/admission/stats - 准入控制与排队统计",
+            "/api/retry/stats - 重试统计",
+            "/api/stream/replay/stats - 断线重连缓冲区统计",
+            "/api/trace/stats - 请求追踪统计",
+            "/metrics - Prometheus 格式的运行指标",
             "/api/chat/completions - 聊天接口",
             "/api/context - 上下文管理",
             "/api/chat/save - 保存聊天",
@@ -356,8 +639,25 @@ def handle_config():
     """处理配置的获取和更新"""
     global config
     if request.method == 'POST':
-        # 前端发来完整的配置，直接替换
-        config = request.json
+        # 前端发来完整的配置，直接替换（保留服务端专用的配置段）
+        new_config = request.json
+        for key in SERVER_CONFIG_KEYS:
+            if key in config and key not in new_config:
+                new_config[key] = config[key]
+        config = new_config
+        upstream_client.configure(config.get('upstream'))
+        upstream_router.configure(config)
+        completion_cache.configure(config.get('response_cache'))
+        admission_controller.configure(config.get('admission'))
+        retry_policy.configure(config.get('retry'))
+        replay_store.configure(config.get('stream_replay'))
+        models_cache.configure(config.get('model_cache'))
+        ai_log_writer.configure(config.get('ai_log'))
+        tracer.configure(config.get('tracing'))
+        metrics.configure(config.get('metrics'))
+        sampling_profiler.configure(config.get('profiler'))
+        memory_tracker.configure(config.get('memory'))
+        apply_memory_limits()
         print(f"[服务器] 收到前端配置更新:")
         print(f"  API URL: {config.get('api_url')}")
         print(f"  Model: {config.get('model')}")
@@ -402,58 +702,156 @@ def handle_frontend_decorator_config():
             }
         return jsonify(decorator_config)
 
+def fetch_model_list():
+    """向服务商请求模型列表（OpenAI兼容格式），返回 (模型列表, 实际使用的上游地址)，失败时抛出异常"""
+    endpoint = f"{config.get('api_url')}/models"
+    request_info = {"endpoint": endpoint, "method": "GET"}
+    
+    # 当前上游失败时自动切换
+    chosen = {}
+    
+    def send():
+        response, chosen['target'] = router.get('/models', timeout=upstream.timeout(read=10))
+        return response
+    
+    try:
+        response = retry.call(send)
+    except Exception as e:
+        log_ai_request(endpoint, request_info, error=e)
+        raise
+    endpoint = chosen['target'].url('/models')
+    request_info["endpoint"] = endpoint
+    
+    if response.status_code != 200:
+        error_msg = f"Status: {response.status_code}, Body: {response.text}"
+        log_ai_request(endpoint, request_info, error=error_msg)
+        raise Exception("无法获取模型列表")
+    
+    data = response.json()
+    # 记录成功响应（只有实际请求服务商时才记录，命中缓存不记录）
+    log_ai_request(endpoint, request_info, data)
+    
+    # 提取模型列表
+    if 'data' in data:
+        models = [model['id'] for model in data['data']]
+    else:
+        models = []
+    return models, endpoint
+
+def upstream_scope():
+    """对话缓存和请求合并的键所区分的上游：配置了 upstreams 时为各上游地址，否则为 api_url"""
+    upstreams = config.get('upstreams')
+    if upstreams:
+        return ','.join(item.get('api_url', '') for item in upstreams)
+    return config.get('api_url', '')
+
+def default_completion_endpoint():
+    """还没有选定上游（或所有上游都失败）时日志中记录的端点：api_url，只配置了 upstreams 时为第一个上游"""
+    api_url = config.get('api_url') or next(
+        (item['api_url'] for item in config.get('upstreams') or [] if item.get('api_url')), ''
+    )
+    return f"{api_url}/chat/completions"
+
+def model_cache_key():
+    """模型列表按上游配置分别缓存：更换 API 地址、密钥或 upstreams 后使用新的缓存"""
+    upstreams = config.get('upstreams') or [{'api_url': config.get('api_url'), 'api_key': config.get('api_key', '')}]
+    return response_cache.cache_key('models', {'upstreams': upstreams})
+
 @app.route('/api/models', methods=['GET'])
 def get_models():
-    """获取可用的模型列表"""
-    if not config.get('api_url') or not config.get('api_key'):
+    """获取可用的模型列表（带缓存，?refresh=1 强制向服务商重新获取）"""
+    if not config.get('upstreams') and (not config.get('api_url') or not config.get('api_key')):
         return jsonify({"error": "API未配置"}), 400
     
-    endpoint = f"{config['api_url']}/models"
-    request_info = {"endpoint": endpoint, "method": "GET"}
-    
     try:
-        # OpenAI兼容格式
-        headers = {
-            "Authorization": f"Bearer {config['api_key']}",
-            "Content-Type": "application/json"
-        }
-        
-        # 尝试获取模型列表
-        response = requests.get(
-            endpoint,
-            headers=headers,
-            timeout=10
-        )
-        
-        if response.status_code == 200:
-            data = response.json()
-            # 记录成功响应
-            log_ai_request(endpoint, request_info, data)
-            
-            # 提取模型列表
-            if 'data' in data:
-                models = [model['id'] for model in data['data']]
-            else:
-                models = []
-            return jsonify({"models": models})
-        else:
-            error_msg = f"Status: {response.status_code}, Body: {response.text}"
-            log_ai_request(endpoint, request_info, error=error_msg)
-            return jsonify({"models": [], "error": "无法获取模型列表"})
+        models, state = models_cache.get(model_cache_key(), fetch_model_list,
+                                         refresh=request.args.get('refresh') == '1')
+        json_response = jsonify({"models": models})
+        json_response.headers['X-Model-Cache'] = state
+        return json_response
     except Exception as e:
-        log_ai_request(endpoint, request_info, error=e)
         return jsonify({"models": [], "error": str(e)})
 
-@app.route('/api/chat/completions', methods=['POST'])
-def chat_completions():
-    """处理聊天完成请求（OpenAI兼容格式）"""
-    data = request.json
-    original_request = data.copy()  # 保存原始请求用于日志记录
+@app.route('/api/logs/stats', methods=['GET'])
+def get_ai_log_stats():
+    """AI日志写入统计（已写入/丢弃条数、队列长度、分段数和占用空间，仅管理员）"""
+    if not admin_authorized():
+        return jsonify({"error": "没有权限"}), 403
+    return jsonify(ai_log_writer.stats())
+
+def parse_log_time(value):
+    """查询参数中的时间：支持 Unix 时间戳（秒）或 ISO 格式"""
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        return datetime.fromisoformat(value).timestamp()
+
+@app.route('/api/logs', methods=['GET'])
+def query_ai_logs():
+    """查询AI请求日志（最新的在前），只返回摘要，完整内容通过 /api/logs/<id> 获取
+
+    参数：since/until（时间范围）、endpoint（端点包含该字符串）、model、errors=1（只看失败的请求）、offset、limit
+    日志包含完整的对话内容，仅管理员可查询。
+    """
+    if not admin_authorized():
+        return jsonify({"error": "没有权限"}), 403
+    try:
+        limit = max(1, min(int(request.args.get('limit', 50)), 500))
+        offset = max(0, int(request.args.get('offset', 0)))
+        records, has_more = ai_log_writer.query(
+            since=parse_log_time(request.args.get('since')),
+            until=parse_log_time(request.args.get('until')),
+            endpoint=request.args.get('endpoint'),
+            model=request.args.get('model'),
+            errors_only=request.args.get('errors') == '1',
+            offset=offset,
+            limit=limit
+        )
+        entries = [{
+            'id': record['id'],
+            'timestamp': datetime.fromtimestamp(record['timestamp']).isoformat(),
+            'endpoint': record['endpoint'],
+            'model': record['model'],
+            'error': record['error'],
+            'size': record['length']
+        } for record in records]
+        return jsonify({'entries': entries, 'offset': offset, 'limit': limit, 'has_more': has_more})
+    except ValueError as e:
+        return jsonify({"error": f"参数错误: {e}"}), 400
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/logs/<entry_id>', methods=['GET'])
+def get_ai_log_entry(entry_id):
+    """按 ID 获取一条完整的AI日志（包括请求和响应体，仅管理员），?raw=1 时不还原按哈希保存的消息"""
+    if not admin_authorized():
+        return jsonify({"error": "没有权限"}), 403
+    entry = ai_log_writer.get_entry(entry_id, expand=request.args.get('raw') != '1')
+    if entry is None:
+        return jsonify({"error": "日志不存在或已被轮转删除"}), 404
+    return jsonify(entry)
+
+@app.route('/api/models/stats', methods=['GET'])
+def get_models_cache_stats():
+    """模型列表缓存统计（命中、后台刷新、服务商故障时返回旧列表的次数）"""
+    return jsonify(models_cache.stats())
+
+@app.route('/api/upstream/stats', methods=['GET'])
+def get_upstream_stats():
+    """上游连接池统计（复用率、打开的连接数）以及各上游的健康评分"""
+    stats = upstream.stats()
+    stats['routing'] = router.stats()
+    return jsonify(stats)
+
+def build_chat_request(data):
+    """根据前端请求构建发往服务商的请求体（同步与异步流式引擎共用）"""
     messages = data.get('messages', [])
     
     # 添加到上下文窗口
     if messages:
-        context_window.extend(messages)
+        add_to_context(messages)
     
     # 构建请求（不发送max_tokens，让服务商自己决定）
     request_data = {
@@ -468,97 +866,506 @@ def chat_completions():
     if 'max_tokens' in data:
         request_data['max_tokens'] = data['max_tokens']
     
-    # 不在这里记录请求，改为在实际响应时记录，避免重复
+    # 多候选：服务商支持 n 参数时一次请求生成全部候选，否则由 chat_completions 并发请求
+    candidates = requested_candidates(data)
+    if candidates > 1 and supports_native_n(request_data['model']):
+        request_data['n'] = candidates
     
-    headers = {
-        "Authorization": f"Bearer {config['api_key']}",
+    return request_data
+
+def candidate_settings():
+    """config.json 中 "candidate_generation" 段：max 为单次请求的候选数上限，
+    native_n_models 为支持 n 参数的模型（"*" 表示全部）"""
+    settings = config.get('candidate_generation') or {}
+    return {
+        'max': int(settings.get('max', 4)),
+        'native_n_models': list(settings.get('native_n_models', [])),
+    }
+
+def requested_candidates(data):
+    """前端请求的候选数（candidates 字段），限制在 1 到上限之间"""
+    try:
+        count = int(data.get('candidates') or 1)
+    except (TypeError, ValueError):
+        count = 1
+    return max(1, min(count, candidate_settings()['max']))
+
+def supports_native_n(model):
+    native_models = candidate_settings()['native_n_models']
+    return '*' in native_models or model in native_models
+
+def fetch_candidate_completions(request_data, headers, count):
+    """非流式多候选：并发发送 count 个请求，把成功的回复合并为一个带多个 choices 的响应
+
+    返回 (状态码, 响应或错误, 实际使用的上游地址)；全部失败时返回最后一个错误。
+    """
+    def fetch_one(_index):
+        try:
+            response, target = post_completion(request_data, headers)
+        except Exception as e:
+            return 500, {"error": str(e)}, default_completion_endpoint()
+        endpoint = target.url('/chat/completions')
+        if response.status_code == 200:
+            return 200, response.json(), endpoint
+        return response.status_code, {"error": response.text}, endpoint
+    
+    with ThreadPoolExecutor(max_workers=count) as pool:
+        outcomes = list(pool.map(fetch_one, range(count)))
+    
+    succeeded = [(result, endpoint) for status_code, result, endpoint in outcomes if status_code == 200]
+    if not succeeded:
+        return outcomes[-1]
+    merged = dict(succeeded[0][0])
+    merged['choices'] = []
+    for result, _endpoint in succeeded:
+        for choice in result.get('choices', [])[:1]:
+            merged['choices'].append(dict(choice, index=len(merged['choices'])))
+    usages = [result['usage'] for result, _endpoint in succeeded if isinstance(result.get('usage'), dict)]
+    if usages:
+        merged['usage'] = {
+            key: sum(usage.get(key, 0) for usage in usages)
+            for key in ('prompt_tokens', 'completion_tokens', 'total_tokens')
+        }
+    return 200, merged, succeeded[0][1]
+
+def post_completion(request_data, headers, stream=False):
+    """经路由和重试策略发送对话请求，返回 (响应, 实际使用的上游)
+
+    流式请求拿到响应头即返回，重试只会发生在向前端输出任何内容之前。
+    """
+    chosen = {}
+    
+    def send():
+        response, chosen['target'] = router.post(
+            '/chat/completions',
+            model=request_data['model'],
+            headers=headers,
+            json=request_data,
+            stream=stream,
+            idempotent=retry.completions_idempotent
+        )
+        return response
+    
+    response = retry.call(send, idempotent=retry.completions_idempotent)
+    return response, chosen['target']
+
+@app.route('/api/retry/stats', methods=['GET'])
+def get_retry_stats():
+    """重试统计（重试次数、重试后成功/放弃的请求数、剩余预算）"""
+    return jsonify(retry.stats())
+
+def upstream_headers():
+    """发往服务商的请求头"""
+    return {
+        "Authorization": f"Bearer {config.get('api_key', '')}",
         "Content-Type": "application/json"
     }
+
+def stream_settings():
+    """config.json 中 "stream" 段：passthrough 开启零解码透传，coalesce 开启增量合并（优先）"""
+    settings = config.get('stream') or {}
+    return {
+        'passthrough': bool(settings.get('passthrough', False)),
+        'chunk_size': int(settings.get('chunk_size', sse_stream.DEFAULT_CHUNK_SIZE)),
+        'coalesce': bool(settings.get('coalesce', False)),
+        'coalesce_window_ms': float(settings.get('coalesce_window_ms', 50)),
+        'coalesce_max_bytes': int(settings.get('coalesce_max_bytes', 2048)),
+    }
+
+def build_stream_log_response(accumulated_content):
+    """流式响应完成后用于日志记录的完整响应"""
+    return {
+        "choices": [{
+            "message": {
+                "content": "".join(accumulated_content)
+            }
+        }],
+        "stream": True
+    }
+
+def build_candidates_log_response(candidate_contents):
+    """多候选流式响应完成后用于日志记录的完整响应"""
+    return {
+        "choices": [
+            {"index": index, "message": {"content": "".join(parts)}}
+            for index, parts in enumerate(candidate_contents)
+        ],
+        "stream": True
+    }
+
+def append_assistant_to_context(result):
+    """把非流式响应中的回复添加到上下文窗口"""
+    if 'choices' in result and result['choices']:
+        assistant_message = {
+            "role": "assistant",
+            "content": result['choices'][0]['message']['content']
+        }
+        add_to_context([assistant_message])
+
+def log_cancelled_stream(endpoint, original_request, request_data, get_content_parts, candidate_contents=None):
+    """记录被客户端中止的流：统计节省的 token，并在旁路线程中记录已生成的部分内容"""
+    def task():
+        content_parts = get_content_parts()
+        saved = sse_stream.stream_stats.record_cancelled(
+            request_data['model'], len(content_parts), request_data.get('max_tokens')
+        )
+        if candidate_contents is not None:
+            partial_response = build_candidates_log_response(candidate_contents)
+        else:
+            partial_response = build_stream_log_response(content_parts)
+        partial_response['cancelled'] = True
+        partial_response['tokens_saved_estimate'] = saved
+        log_ai_request(endpoint, original_request, partial_response)
+    
+    sse_stream.sidecar.submit(task)
+
+@app.route('/api/stream/stats', methods=['GET'])
+def get_stream_stats():
+    """流式请求统计（完成数、取消数、节省的 token 估算）"""
+    return jsonify(sse_stream.stream_stats.snapshot())
+
+@app.route('/api/cache/stats', methods=['GET'])
+def get_cache_stats():
+    """非流式响应缓存统计"""
+    return jsonify(completion_cache.stats())
+
+@app.route('/api/cache/clear', methods=['POST'])
+def clear_response_cache():
+    """清空非流式响应缓存（内存和磁盘）"""
+    completion_cache.clear()
+    return jsonify({"status": "success"})
+
+# 由 async_server.py 置为 True：流式对话改由异步引擎转发，那些流不经过 stream_flights，不参与请求合并
+ASYNC_STREAMING = False
+
+def single_flight_enabled():
+    """config.json 中 "single_flight" 段：enabled 为 False 时关闭请求合并"""
+    return bool((config.get('single_flight') or {}).get('enabled', True))
+
+@app.route('/api/singleflight/stats', methods=['GET'])
+def get_singleflight_stats():
+    """请求合并统计（实际上游调用数、被合并的请求数）
+
+    stream_coalescing 为 False 表示流式对话由异步引擎转发（开启 stream_replay 时除外），
+    这些流不参与合并，stream 中只统计交给 Flask 的流（多候选等）。
+    """
+    return jsonify({
+        "enabled": single_flight_enabled(),
+        "stream_coalescing": single_flight_enabled() and (not ASYNC_STREAMING or replay_store.enabled),
+        "non_stream": completion_flights.stats.snapshot(),
+        "stream": stream_flights.stats.snapshot(),
+        "in_flight": completion_flights.in_flight() + stream_flights.in_flight()
+    })
+
+def admission_client_id():
+    """准入控制按来源地址计数（不使用客户端自报的请求头，避免伪造不同的 ID 绕过单客户端上限）"""
+    return request.remote_addr or 'anonymous'
+
+def admission_rejected_response(e):
+    """未获准入时快速返回 503，并告知建议的重试时间"""
+    return jsonify({"error": str(e)}), 503, {"Retry-After": str(e.retry_after)}
+
+@app.route('/api/admission/stats', methods=['GET'])
+def get_admission_stats():
+    """准入控制统计（进行中/排队数量、等待时间和队列深度直方图）"""
+    return jsonify(admission_controller.stats())
+
+@app.route('/api/stream/replay/stats', methods=['GET'])
+def get_replay_stats():
+    """断线重连缓冲区统计（保留的生成数、占用字节、续传次数）"""
+    return jsonify(replay_store.stats())
+
+@app.route('/api/chat/completions/cancel', methods=['POST'])
+def cancel_chat_completion():
+    """前端点击停止：不再等待断线重连，立即取消该生成的上游请求"""
+    stream_id = (request.json or {}).get('stream_id', '')
+    return jsonify({"status": "success" if replay_store.cancel(stream_id) else "not_found"})
+
+def resume_stream(last_event_id):
+    """断线重连：从重放缓冲区中 Last-Event-ID 之后的位置继续输出，不会再次请求服务商"""
+    reader = replay_store.resume(last_event_id)
+    if reader is None:
+        return jsonify({"error": "无法续传：该生成已过期或断点已被覆盖，请重新生成"}), 410
+    return Response(reader, content_type='text/event-stream', headers={'X-Stream-Id': reader.buffer.stream_id})
+
+@app.route('/api/chat/completions', methods=['POST'])
+def chat_completions():
+    """处理聊天完成请求（OpenAI兼容格式）"""
+    last_event_id = request.headers.get('Last-Event-ID')
+    if last_event_id:
+        # 续传不重新构建请求，避免上下文窗口重复添加消息
+        return resume_stream(last_event_id)
+    
+    trace = current_trace()
+    with trace.span('parse'):
+        data = request.json
+        original_request = data.copy()  # 保存原始请求用于日志记录
+        request_data = build_chat_request(data)
+    trace.set('model', request_data['model'])
+    request_started = time.monotonic()
+    metrics.chat_requests.labels(request_data['model'], 'true' if request_data['stream'] else 'false').inc()
+    
+    # 不在这里记录请求，改为在实际响应时记录，避免重复
+    
+    headers = upstream_headers()
+    client_id = admission_client_id()
+    
+    # 多候选：服务商原生支持 n 时 request_data 已带 n，否则需要并发请求 fan_out 次
+    candidates = requested_candidates(data)
+    fan_out = 1 if 'n' in request_data else candidates
+    # 合并/缓存的键需要区分候选数
+    key_data = dict(request_data, n=candidates) if fan_out > 1 else request_data
     
     try:
         if request_data['stream']:
             # 流式响应
             accumulated_content = []  # 累积响应内容用于日志
+            candidate_contents = [[] for _ in range(candidates)]  # 多候选时按序号分别累积
+            settings = stream_settings()
+            endpoint = default_completion_endpoint()
+            # 广播缓冲区在所有读者离开后从其他线程调用 abort_upstream，
+            # 关闭已打开的上游连接，使卡住的上游不再占用连接和准入许可
+            aborted = threading.Event()
+            upstream_responses = []
             
-            def generate():
+            def opened(upstream_response):
+                upstream_responses.append(upstream_response)
+                if aborted.is_set():
+                    upstream_client.abort_response(upstream_response)
+                return upstream_response
+            
+            def abort_upstream():
+                aborted.set()
+                for upstream_response in list(upstream_responses):
+                    upstream_client.abort_response(upstream_response)
+            
+            def check_aborted():
+                # 上游被中止后读取可能正常结束，不能当作完整的响应记录
+                if aborted.is_set():
+                    raise singleflight.StreamAbandoned("所有读者都已断开，上游生成已中止")
+            
+            def generate(ticket):
+                nonlocal endpoint
+                response = None
+                collector = None
                 try:
-                    response = requests.post(
-                        f"{config['api_url']}/chat/completions",
-                        headers=headers,
-                        json=request_data,
-                        stream=True,
-                        timeout=60
-                    )
+                    with trace.span('upstream'):
+                        response, target = post_completion(request_data, headers, stream=True)
+                    opened(response)
+                    endpoint = target.url('/chat/completions')
                     
-                    for line in response.iter_lines():
-                        if line:
-                            line_str = line.decode('utf-8')
-                            if line_str.startswith('data: '):
-                                yield line_str + '\n\n'
-                                
-                                # 解析并累积响应内容
-                                if line_str != 'data: [DONE]':
-                                    try:
-                                        chunk_data = json.loads(line_str[6:])
-                                        if 'choices' in chunk_data and chunk_data['choices']:
-                                            delta = chunk_data['choices'][0].get('delta', {})
-                                            if 'content' in delta:
-                                                accumulated_content.append(delta['content'])
-                                    except:
-                                        pass
+                    if settings['coalesce']:
+                        # 合并模式：按时间窗口/字节阈值把连续的增量帧合并成一帧
+                        coalescer = sse_stream.DeltaCoalescer(settings['coalesce_window_ms'], settings['coalesce_max_bytes'])
+                        yield from sse_stream.relay_coalesced(response, accumulated_content, coalescer)
+                    elif settings['passthrough']:
+                        # 透传模式：原样转发字节块，流结束后由旁路线程解析内容并记录日志
+                        collector = sse_stream.SSEContentCollector()
+                        yield from sse_stream.relay_passthrough(response, collector, settings['chunk_size'])
+                        check_aborted()
+                        
+                        def log_passthrough():
+                            content_parts = collector.content_parts()
+                            sse_stream.stream_stats.record_completed(request_data['model'], len(content_parts))
+                            metrics.record_stream_done(request_data['model'], request_started, sum(map(len, content_parts)))
+                            log_ai_request(endpoint, original_request, build_stream_log_response(content_parts))
+                        
+                        sse_stream.sidecar.submit(log_passthrough)
+                        return
+                    else:
+                        yield from sse_stream.relay_lines(response, accumulated_content)
+                    check_aborted()
                     
                     # 流式响应完成后记录
-                    complete_response = {
-                        "choices": [{
-                            "message": {
-                                "content": "".join(accumulated_content)
-                            }
-                        }],
-                        "stream": True
-                    }
-                    log_ai_request(f"{config['api_url']}/chat/completions", original_request, complete_response)
+                    sse_stream.stream_stats.record_completed(request_data['model'], len(accumulated_content))
+                    metrics.record_stream_done(request_data['model'], request_started, sum(map(len, accumulated_content)))
+                    complete_response = build_stream_log_response(accumulated_content)
+                    log_ai_request(endpoint, original_request, complete_response)
+                    
+                except GeneratorExit:
+                    # 客户端断开（前端点击停止）：finally 中立即关闭上游连接，部分输出记为已取消
+                    log_cancelled_stream(endpoint, original_request, request_data,
+                                         collector.content_parts if collector else lambda: accumulated_content)
+                    raise
+                except Exception as e:
+                    if aborted.is_set():
+                        log_cancelled_stream(endpoint, original_request, request_data,
+                                             collector.content_parts if collector else lambda: accumulated_content)
+                    else:
+                        log_ai_request(endpoint, original_request, error=e)
+                    raise
+                finally:
+                    if response is not None:
+                        response.close()
+                    ticket.release()
+            
+            def generate_candidates(ticket):
+                # 多候选流：各候选的帧按 choices[].index 交错输出（不使用透传/合并模式）
+                nonlocal endpoint
+                response = None
+                try:
+                    if fan_out > 1:
+                        def open_candidate(_index):
+                            nonlocal endpoint
+                            candidate_response, target = post_completion(request_data, headers, stream=True)
+                            opened(candidate_response)
+                            endpoint = target.url('/chat/completions')
+                            if candidate_response.status_code != 200:
+                                body = candidate_response.text
+                                candidate_response.close()
+                                raise Exception(f"Status: {candidate_response.status_code}, Body: {body}")
+                            return candidate_response
+                        
+                        yield from sse_stream.relay_candidates(open_candidate, candidate_contents)
+                    else:
+                        with trace.span('upstream'):
+                            response, target = post_completion(request_data, headers, stream=True)
+                        opened(response)
+                        endpoint = target.url('/chat/completions')
+                        yield from sse_stream.relay_indexed(response, candidate_contents)
+                    check_aborted()
+                    
+                    sse_stream.stream_stats.record_completed(
+                        request_data['model'], sum(len(parts) for parts in candidate_contents) // candidates
+                    )
+                    metrics.record_stream_done(request_data['model'], request_started,
+                                               sum(len(part) for parts in candidate_contents for part in parts))
+                    log_ai_request(endpoint, original_request, build_candidates_log_response(candidate_contents))
                     
+                except GeneratorExit:
+                    log_cancelled_stream(endpoint, original_request, request_data,
+                                         lambda: [part for parts in candidate_contents for part in parts],
+                                         candidate_contents)
+                    raise
                 except Exception as e:
-                    log_ai_request(f"{config['api_url']}/chat/completions", original_request, error=e)
+                    if aborted.is_set():
+                        log_cancelled_stream(endpoint, original_request, request_data,
+                                             lambda: [part for parts in candidate_contents for part in parts],
+                                             candidate_contents)
+                    else:
+                        log_ai_request(endpoint, original_request, error=e)
                     raise
+                finally:
+                    if response is not None:
+                        response.close()
+                    ticket.release()
+            
+            if candidates > 1:
+                generate = generate_candidates
+            
+            def tracked(ticket):
+                # 首个数据块时间、转发量和进行中的流数量（合并的流只在领头请求处统计一次）
+                return metrics.track_stream(trace.wrap_stream(generate(ticket)), request_data['model'], request_started)
             
-            return Response(
-                stream_with_context(generate()),
+            if single_flight_enabled() or replay_store.enabled:
+                # 由后台线程把上游数据写入广播缓冲区：
+                # 相同的流正在进行时直接订阅，只有领头请求会连接服务商；开启断线重连时缓冲区同时用于续传
+                if single_flight_enabled():
+                    flight_key = response_cache.cache_key(upstream_scope(), key_data)
+                else:
+                    flight_key = uuid.uuid4().hex
+                reader, is_leader = stream_flights.join(flight_key, **replay_store.buffer_options())
+                if is_leader:
+                    try:
+                        with trace.span('admission'):
+                            ticket = admission_controller.acquire(client_id)
+                    except admission.AdmissionRejected as e:
+                        reader.close()
+                        stream_flights.fail(flight_key, reader.buffer, e)
+                        raise
+                    if replay_store.enabled:
+                        replay_store.register(reader.buffer)
+                    trace.defer()
+                    stream_flights.start_pump(flight_key, reader.buffer, tracked(ticket), abort_upstream)
+                else:
+                    # 等领头请求获准入后再返回 200；领头请求被拒绝时跟随者同样返回 503，而不是在流中途出错
+                    with trace.span('admission'):
+                        error = reader.buffer.wait_started()
+                    if error is not None:
+                        reader.close()
+                        raise error
+                headers = {}
+                if single_flight_enabled():
+                    headers['X-Single-Flight'] = 'leader' if is_leader else 'follower'
+                if reader.buffer.stream_id:
+                    headers['X-Stream-Id'] = reader.buffer.stream_id
+                return Response(reader, content_type='text/event-stream', headers=headers)
+            
+            with trace.span('admission'):
+                ticket = admission_controller.acquire(client_id)
+            # 请求在流结束时才算完成，Server-Timing 只包含返回响应头之前的阶段
+            trace.defer()
+            stream_response = Response(
+                stream_with_context(tracked(ticket)),
                 content_type='text/event-stream'
             )
+            # 客户端在开始读取前就断开时生成器不会执行，需要在响应关闭时归还许可
+            stream_response.call_on_close(ticket.release)
+            return stream_response
         else:
-            # 非流式响应
-            response = requests.post(
-                f"{config['api_url']}/chat/completions",
-                headers=headers,
-                json=request_data,
-                timeout=60
-            )
+            # 非流式响应：相同请求（temperature 为 0 或强制缓存）直接返回缓存结果
+            cache_key = None
+            if completion_cache.should_cache(request_data, force=request.headers.get('X-Cache-Force') == '1'):
+                cache_key = response_cache.cache_key(upstream_scope(), key_data)
+                with trace.span('cache'):
+                    cached_body = completion_cache.get(cache_key)
+                if cached_body is not None:
+                    # 命中缓存时没有请求服务商，因此不记录AI日志
+                    append_assistant_to_context(json.loads(cached_body))
+                    return Response(cached_body, mimetype='application/json', headers={'X-Response-Cache': 'HIT'})
             
-            if response.status_code == 200:
-                result = response.json()
-                
-                # 记录成功的响应
-                log_ai_request(f"{config['api_url']}/chat/completions", original_request, result)
-                
-                # 添加响应到上下文窗口
-                if 'choices' in result and result['choices']:
-                    assistant_message = {
-                        "role": "assistant",
-                        "content": result['choices'][0]['message']['content']
-                    }
-                    context_window.append(assistant_message)
+            def fetch_completion():
+                # 多候选并发请求共用一个准入许可
+                with trace.span('admission'):
+                    ticket = admission_controller.acquire(client_id)
+                with ticket, trace.span('upstream'):
+                    if fan_out > 1:
+                        status_code, result, endpoint = fetch_candidate_completions(request_data, headers, fan_out)
+                    else:
+                        response, target = post_completion(request_data, headers)
+                        endpoint = target.url('/chat/completions')
+                        status_code = response.status_code
+                        result = response.json() if status_code == 200 else {"error": response.text}
                 
-                return jsonify(result)
+                if status_code == 200:
+                    
+                    # 记录成功的响应
+                    log_ai_request(endpoint, original_request, result)
+                else:
+                    # 记录错误响应
+                    error_msg = f"Status: {status_code}, Body: {result['error']}"
+                    log_ai_request(endpoint, original_request, error=error_msg)
+                return status_code, result
+            
+            shared = False
+            if single_flight_enabled():
+                # 相同请求正在进行时等待并复用其结果（跟随者不再记录AI日志）
+                flight_key = cache_key or response_cache.cache_key(upstream_scope(), key_data)
+                (status_code, result), shared = completion_flights.do(flight_key, fetch_completion)
             else:
-                # 记录错误响应
-                error_msg = f"Status: {response.status_code}, Body: {response.text}"
-                log_ai_request(f"{config['api_url']}/chat/completions", original_request, error=error_msg)
-                return jsonify({"error": response.text}), response.status_code
+                status_code, result = fetch_completion()
+            
+            if status_code != 200:
+                return jsonify(result), status_code
+            
+            # 添加响应到上下文窗口
+            append_assistant_to_context(result)
+            
+            json_response = jsonify(result)
+            if shared:
+                json_response.headers['X-Single-Flight'] = 'follower'
+            if cache_key is not None:
+                if not shared:
+                    completion_cache.put(cache_key, request_data['model'], json_response.get_data())
+                json_response.headers['X-Response-Cache'] = 'MISS'
+            return json_response
                 
+    except admission.AdmissionRejected as e:
+        # 未获准入时没有请求服务商，不记录AI日志
+        return admission_rejected_response(e)
     except Exception as e:
         # 记录异常
-        log_ai_request(f"{config['api_url']}/chat/completions", original_request, error=e)
+        log_ai_request(default_completion_endpoint(), original_request, error=e)
         return jsonify({"error": str(e)}), 500
 
 @app.route('/api/context', methods=['GET'])
@@ -576,9 +1383,10 @@ def update_context():
     data = request.json
     
     if 'messages' in data:
-        context_window = data['messages']
+        context_window = []
+        add_to_context(data['messages'])
     elif 'message' in data:
-        context_window.append(data['message'])
+        add_to_context([data['message']])
     
     return jsonify({
         "status": "success",
@@ -845,8 +1653,10 @@ def delete_toolbook_resource():
 
 
 @app.route('/api/toolbook/import', methods=['POST'])
+@metrics.timed(metrics.import_duration, 'toolbook')
 def import_toolbook():
     import_id = f"import_{uuid.uuid4().hex[:8]}"
+    prune_import_progress(int(memory_tracker.settings['import_progress_max_entries']) - 1)
     toolbook_import_progress[import_id] = {
         'status': 'starting',
         'current': 0,
@@ -905,21 +1715,24 @@ def import_toolbook():
         toolbook_import_progress[import_id]['status'] = 'extracting'
         toolbook_import_progress[import_id]['message'] = '正在提取文档内容'
 
+        trace = current_trace()
         with tempfile.TemporaryDirectory() as tmp_dir:
             docx_path = os.path.join(tmp_dir, secure_filename(uploaded_file.filename) or 'toolbook.docx')
-            uploaded_file.save(docx_path)
+            with trace.span('upload'):
+                uploaded_file.save(docx_path)
             output_dir = Path(tmp_dir) / 'extracted'
 
             # 传递进度回调
             from docx_extract import extract_from_docx
-            extract_from_docx(
-                Path(docx_path),
-                output_dir,
-                keep_temp=False,
-                vision_config=vision_config,
-                enable_vision=enable_vision,
-                progress_callback=progress_callback if enable_vision else None
-            )
+            with trace.span('extract'):
+                extract_from_docx(
+                    Path(docx_path),
+                    output_dir,
+                    keep_temp=False,
+                    vision_config=vision_config,
+                    enable_vision=enable_vision,
+                    progress_callback=progress_callback if enable_vision else None
+                )
 
             text_path = output_dir / 'document.txt'
             content = text_path.read_text(encoding='utf-8') if text_path.exists() else ''
@@ -927,6 +1740,7 @@ def import_toolbook():
             placeholder_map = {}
             destination_dir = get_toolbook_resource_dir(safe_keyword)
             os.makedirs(destination_dir, exist_ok=True)
+            copy_started = time.perf_counter()
             if media_dir.exists() and media_dir.is_dir():
                 for media in media_dir.iterdir():
                     if media.is_file():
@@ -936,9 +1750,10 @@ def import_toolbook():
                             placeholder_map[media.name] = unique_name
             for original, new_name in placeholder_map.items():
                 content = content.replace(f"[[{original}]]", f"[[{new_name}]]")
+            trace.add('media', time.perf_counter() - copy_started, copy_started)
 
         txt_path = get_toolbook_txt_path(safe_keyword)
-        with open(txt_path, 'w', encoding='utf-8') as f:
+        with trace.span('write'), open(txt_path, 'w', encoding='utf-8') as f:
             f.write(content)
 
         now_iso = datetime.now().isoformat()
@@ -992,7 +1807,7 @@ def get_import_progress(import_id):
     if import_id == 'latest':
         # 返回最新的进度
         if toolbook_import_progress:
-            latest_key = max(toolbook_import_progress.keys())
+            latest_key = next(reversed(toolbook_import_progress))
             progress = toolbook_import_progress[latest_key]
         else:
             progress = {
@@ -1051,14 +1866,12 @@ def save_world_book():
         metadata = data.get('_metadata', {})
         book_id = metadata.get('id') or f"wb_{uuid.uuid4().hex[:8]}"
         
-        # 使用安全的文件名
+        # 使用安全的id
         safe_id = book_id.replace('/', '_').replace('\\', '_').replace(':', '_')
-        filename = f"{safe_id}.json"
-        filepath = os.path.join(DATA_DIR, 'worlds', filename)
         
         # 直接保存SillyTavern格式
-        with open(filepath, 'w', encoding='utf-8') as f:
-            json.dump(data, f, ensure_ascii=False, indent=2)
+        with current_trace().span('write'):
+            data_store.put('worlds', safe_id, data)
         
         return jsonify({
             "status": "success",
@@ -1075,13 +1888,11 @@ def save_active_world_books():
         data = request.json
         active_books = data.get('activeWorldBooks', [])
         
-        # 保存到配置文件
-        active_file = os.path.join(DATA_DIR, 'active_world_books.json')
-        with open(active_file, 'w', encoding='utf-8') as f:
-            json.dump({
-                'activeWorldBooks': active_books,
-                'timestamp': data.get('timestamp', '')
-            }, f, ensure_ascii=False, indent=2)
+        # 保存激活状态
+        data_store.put_document('active_world_books', {
+            'activeWorldBooks': active_books,
+            'timestamp': data.get('timestamp', '')
+        })
         
         return jsonify({
             "status": "success",
@@ -1094,11 +1905,9 @@ def save_active_world_books():
 def get_active_world_books():
     """获取激活的世界书状态"""
     try:
-        active_file = os.path.join(DATA_DIR, 'active_world_books.json')
-        if os.path.exists(active_file):
-            with open(active_file, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-                return jsonify(data)
+        data = data_store.get_document('active_world_books')
+        if data is not None:
+            return jsonify(data)
         else:
             return jsonify({'activeWorldBooks': []})
     except Exception as e:
@@ -1109,68 +1918,62 @@ def get_world_list():
     """获取所有世界书"""
     try:
         world_books = []
-        worlds_dir = os.path.join(DATA_DIR, 'worlds')
-        if os.path.exists(worlds_dir):
-            for filename in os.listdir(worlds_dir):
-                if filename.endswith('.json'):
-                    filepath = os.path.join(DATA_DIR, 'worlds', filename)
-                    try:
-                        with open(filepath, 'r', encoding='utf-8') as f:
-                            data = json.load(f)
-                            
-                            # 处理SillyTavern格式
-                            if 'entries' in data:
-                                # 转换为内部格式
-                                world_book = {
-                                    'id': filename.replace('.json', ''),
-                                    'name': data.get('_metadata', {}).get('name', filename.replace('.json', '')),
-                                    'description': data.get('_metadata', {}).get('description', ''),
-                                    'createDate': data.get('_metadata', {}).get('createDate', ''),
-                                    'active': data.get('_metadata', {}).get('active', False),
-                                    'entries': [],
-                                    'originalFormat': data  # 保存原始格式
-                                }
-                                
-                                # 转换entries
-                                if isinstance(data['entries'], dict):
-                                    for key, entry in data['entries'].items():
-                                        world_book['entries'].append({
-                                            'id': f"entry_{entry.get('uid', key)}",
-                                            'keys': entry.get('key', []),
-                                            'secondary_keys': entry.get('keysecondary', []),
-                                            'content': entry.get('content', ''),
-                                            'title': entry.get('comment', ''),
-                                            'order': entry.get('order', 100),
-                                            'position': 'before' if entry.get('position', 0) == 0 else 'after',
-                                            'enabled': not entry.get('disable', False),
-                                            'probability': entry.get('probability', 100),
-                                            'use_probability': entry.get('useProbability', True),
-                                            'depth': entry.get('depth', 4),
-                                            'constant': entry.get('constant', False),
-                                            'selective': entry.get('selective', True),
-                                            'case_sensitive': entry.get('caseSensitive'),
-                                            'match_whole_words': entry.get('matchWholeWords'),
-                                            'exclude_recursion': entry.get('excludeRecursion', False),
-                                            'prevent_recursion': entry.get('preventRecursion', False),
-                                            'delay_until_recursion': entry.get('delayUntilRecursion', False),
-                                            'group': entry.get('group', ''),
-                                            'automation_id': entry.get('automationId', ''),
-                                            'role': entry.get('role'),
-                                            'sticky': entry.get('sticky', 0),
-                                            'cooldown': entry.get('cooldown', 0),
-                                            'delay': entry.get('delay', 0)
-                                        })
-                                
-                                world_books.append(world_book)
-                    except Exception as e:
-                        print(f"Error loading {filename}: {e}")
-                        continue
+        for book_id, data in data_store.list('worlds'):
+            try:
+                # 处理SillyTavern格式
+                if 'entries' in data:
+                    # 转换为内部格式
+                    world_book = {
+                        'id': book_id,
+                        'name': data.get('_metadata', {}).get('name', book_id),
+                        'description': data.get('_metadata', {}).get('description', ''),
+                        'createDate': data.get('_metadata', {}).get('createDate', ''),
+                        'active': data.get('_metadata', {}).get('active', False),
+                        'entries': [],
+                        'originalFormat': data  # 保存原始格式
+                    }
+                    
+                    # 转换entries
+                    if isinstance(data['entries'], dict):
+                        for key, entry in data['entries'].items():
+                            world_book['entries'].append({
+                                'id': f"entry_{entry.get('uid', key)}",
+                                'keys': entry.get('key', []),
+                                'secondary_keys': entry.get('keysecondary', []),
+                                'content': entry.get('content', ''),
+                                'title': entry.get('comment', ''),
+                                'order': entry.get('order', 100),
+                                'position': 'before' if entry.get('position', 0) == 0 else 'after',
+                                'enabled': not entry.get('disable', False),
+                                'probability': entry.get('probability', 100),
+                                'use_probability': entry.get('useProbability', True),
+                                'depth': entry.get('depth', 4),
+                                'constant': entry.get('constant', False),
+                                'selective': entry.get('selective', True),
+                                'case_sensitive': entry.get('caseSensitive'),
+                                'match_whole_words': entry.get('matchWholeWords'),
+                                'exclude_recursion': entry.get('excludeRecursion', False),
+                                'prevent_recursion': entry.get('preventRecursion', False),
+                                'delay_until_recursion': entry.get('delayUntilRecursion', False),
+                                'group': entry.get('group', ''),
+                                'automation_id': entry.get('automationId', ''),
+                                'role': entry.get('role'),
+                                'sticky': entry.get('sticky', 0),
+                                'cooldown': entry.get('cooldown', 0),
+                                'delay': entry.get('delay', 0)
+                            })
+                    
+                    world_books.append(world_book)
+            except Exception as e:
+                print(f"Error loading {book_id}: {e}")
+                continue
         
         return jsonify({"worldBooks": world_books})
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
 @app.route('/api/world/import', methods=['POST'])
+@metrics.timed(metrics.import_duration, 'world')
 def import_world_book():
     """导入世界书"""
     try:
@@ -1181,9 +1984,8 @@ def import_world_book():
         safe_id = book_id.replace('/', '_').replace('\\', '_').replace(':', '_')
         
         # 保存完整的世界书数据
-        world_file = os.path.join(DATA_DIR, 'worlds', f"{safe_id}.json")
-        with open(world_file, 'w', encoding='utf-8') as f:
-            json.dump(world_book, f, ensure_ascii=False, indent=2)
+        with current_trace().span('write'):
+            data_store.put('worlds', safe_id, world_book)
         
         return jsonify({
             "status": "success",
@@ -1197,20 +1999,16 @@ def import_world_book():
 def delete_world_book(world_book_id):
     """删除世界书"""
     try:
-        # 使用安全的文件名
+        # 使用安全的id
         safe_id = world_book_id.replace('/', '_').replace('\\', '_').replace(':', '_')
         
-        # 直接删除世界书文件
-        filepath = os.path.join('data/worlds', f"{safe_id}.json")
-        
-        if os.path.exists(filepath):
-            os.remove(filepath)
+        if data_store.delete('worlds', safe_id):
             return jsonify({
                 "status": "success",
                 "message": "世界书已删除"
             })
         else:
-            # 文件不存在，可能已被删除
+            # 不存在，可能已被删除
             return jsonify({
                 "status": "success",
                 "message": "世界书已删除（或不存在）"
@@ -1230,12 +2028,9 @@ def save_character():
         if not character.get('id'):
             character['id'] = f"char_{uuid.uuid4().hex[:8]}"
         
-        # 保存到文件
-        filename = f"{character['id']}.json"
-        filepath = os.path.join(DATA_DIR, 'characters', filename)
-        
-        with open(filepath, 'w', encoding='utf-8') as f:
-            json.dump(character, f, ensure_ascii=False, indent=2)
+        # 保存
+        with current_trace().span('write'):
+            data_store.put('characters', character['id'], character)
         
         return jsonify({
             "status": "success",
@@ -1249,15 +2044,7 @@ def save_character():
 def get_character_list():
     """获取角色卡列表"""
     try:
-        characters = []
-        chars_dir = os.path.join(DATA_DIR, 'characters')
-        if os.path.exists(chars_dir):
-            for filename in os.listdir(chars_dir):
-                if filename.endswith('.json'):
-                    filepath = os.path.join(DATA_DIR, 'characters', filename)
-                    with open(filepath, 'r', encoding='utf-8') as f:
-                        character = json.load(f)
-                        characters.append(character)
+        characters = [character for _character_id, character in data_store.list('characters')]
         
         return jsonify({"characters": characters})
     except Exception as e:
@@ -1267,10 +2054,8 @@ def get_character_list():
 def get_character(character_id):
     """获取单个角色卡"""
     try:
-        filepath = os.path.join(DATA_DIR, 'characters', f"{character_id}.json")
-        if os.path.exists(filepath):
-            with open(filepath, 'r', encoding='utf-8') as f:
-                character = json.load(f)
+        character = data_store.get('characters', character_id)
+        if character is not None:
             return jsonify(character)
         else:
             return jsonify({"error": "角色不存在"}), 404
@@ -1281,9 +2066,7 @@ def get_character(character_id):
 def delete_character(character_id):
     """删除角色卡"""
     try:
-        filepath = os.path.join(DATA_DIR, 'characters', f"{character_id}.json")
-        if os.path.exists(filepath):
-            os.remove(filepath)
+        if data_store.delete('characters', character_id):
             return jsonify({
                 "status": "success",
                 "message": "角色已删除"
@@ -1300,10 +2083,8 @@ def save_persona():
     try:
         persona_data = request.json
         
-        # 保存到文件
-        filepath = os.path.join(DATA_DIR, 'user_persona.json')
-        with open(filepath, 'w', encoding='utf-8') as f:
-            json.dump(persona_data, f, ensure_ascii=False, indent=2)
+        # 保存
+        data_store.put_document('user_persona', persona_data)
         
         return jsonify({
             "status": "success",
@@ -1316,10 +2097,8 @@ def save_persona():
 def get_persona():
     """获取用户身份信息"""
     try:
-        filepath = os.path.join(DATA_DIR, 'user_persona.json')
-        if os.path.exists(filepath):
-            with open(filepath, 'r', encoding='utf-8') as f:
-                persona_data = json.load(f)
+        persona_data = data_store.get_document('user_persona')
+        if persona_data is not None:
             return jsonify(persona_data)
         else:
             # 返回默认身份
@@ -1380,19 +2159,17 @@ def get_persona_avatar(filename):
 # ========== 预设管理接口 ==========
 @app.route('/api/preset/save', methods=['POST'])
 def save_preset():
-    """保存预设到文件"""
+    """保存预设"""
     try:
         preset = request.json
         preset_name = preset.get('name', 'unnamed')
         
-        # 生成文件名（使用预设名称，替换特殊字符）
+        # 生成id（使用预设名称，替换特殊字符）；filename 沿用文件存储时的文件名，前端以此获取和删除
         safe_name = "".join(c if c.isalnum() or c in (' ', '-', '_') else '_' for c in preset_name)
         filename = f"{safe_name}.json"
-        filepath = os.path.join(DATA_DIR, 'presets', filename)
         
         # 保存预设
-        with open(filepath, 'w', encoding='utf-8') as f:
-            json.dump(preset, f, ensure_ascii=False, indent=2)
+        data_store.put('presets', safe_name, preset)
         
         return jsonify({
             "status": "success",
@@ -1407,19 +2184,9 @@ def get_preset_list():
     """获取预设列表"""
     try:
         presets = []
-        presets_dir = os.path.join(DATA_DIR, 'presets')
-        if os.path.exists(presets_dir):
-            for filename in os.listdir(presets_dir):
-                if filename.endswith('.json'):
-                    filepath = os.path.join(DATA_DIR, 'presets', filename)
-                    try:
-                        with open(filepath, 'r', encoding='utf-8') as f:
-                            preset = json.load(f)
-                            preset['filename'] = filename
-                            presets.append(preset)
-                    except json.JSONDecodeError:
-                        print(f"无法解析预设文件: {filename}")
-                        continue
+        for preset_id, preset in data_store.list('presets'):
+            preset['filename'] = f"{preset_id}.json"
+            presets.append(preset)
         
         return jsonify({"presets": presets})
     except Exception as e:
@@ -1429,14 +2196,12 @@ def get_preset_list():
 def get_preset(preset_name):
     """获取单个预设"""
     try:
-        # 添加.json扩展名如果没有
-        if not preset_name.endswith('.json'):
-            preset_name += '.json'
+        # 去掉.json扩展名（前端传入的是文件名）
+        if preset_name.endswith('.json'):
+            preset_name = preset_name[:-len('.json')]
             
-        filepath = os.path.join(DATA_DIR, 'presets', preset_name)
-        if os.path.exists(filepath):
-            with open(filepath, 'r', encoding='utf-8') as f:
-                preset = json.load(f)
+        preset = data_store.get('presets', preset_name)
+        if preset is not None:
             return jsonify(preset)
         else:
             return jsonify({"error": "预设不存在"}), 404
@@ -1445,123 +2210,238 @@ def get_preset(preset_name):
 
 # ========== 对话管理API ==========
 
+def chat_metadata_line(character_name, chat_name, metadata):
+    """JSONL 第一行：元数据（SillyTavern兼容）"""
+    return {
+        'user_name': metadata.get('user_name', 'User'),
+        'character_name': character_name,
+        'create_date': metadata.get('create_date', datetime.now().isoformat()),
+        'chat_metadata': {
+            'note': metadata.get('note', ''),
+            'title': metadata.get('title', chat_name)
+        }
+    }
+
+def chat_message_line(msg, character_name):
+    """前端消息转换为 JSONL 中的一行"""
+    return {
+        'name': msg.get('name', 'User' if msg['role'] == 'user' else character_name),
+        'is_user': msg['role'] == 'user',
+        'is_system': False,
+        'send_date': msg.get('send_date', datetime.now().isoformat()),
+        'mes': msg['content'],
+        # 多候选生成的回复保存全部候选，mes 为当前选中的候选
+        'swipes': msg.get('swipes') or [msg['content']],
+        'swipe_id': msg.get('swipe_id', 0)
+    }
+
+def chat_message_from_line(data):
+    """JSONL 中的一行转换为前端消息"""
+    message = {
+        'role': 'user' if data.get('is_user') else 'assistant',
+        'content': data.get('mes', ''),
+        'name': data.get('name'),
+        'send_date': data.get('send_date')
+    }
+    if len(data.get('swipes') or []) > 1:
+        message['swipes'] = data['swipes']
+        message['swipe_id'] = data.get('swipe_id', 0)
+    return message
+
 @app.route('/api/chats/save', methods=['POST'])
 def save_chat_to_file():
-    """保存对话到服务器文件系统"""
+    """保存对话（重写整个对话；逐条保存请使用 /api/chats/append）"""
     try:
-        data = request.json
+        with current_trace().span('parse'):
+            data = request.json
         character_name = data.get('character_name', 'default')
         chat_name = data.get('chat_name', f'chat_{datetime.now().strftime("%Y%m%d_%H%M%S")}')
         messages = data.get('messages', [])
         metadata = data.get('metadata', {})
         
-        # 创建角色目录
-        char_dir = os.path.join(DATA_DIR, 'chats', character_name.replace('/', '_'))
-        os.makedirs(char_dir, exist_ok=True)
-        
-        # 保存为JSONL格式（SillyTavern兼容）
-        filepath = os.path.join(char_dir, f'{chat_name}.jsonl')
-        
-        with open(filepath, 'w', encoding='utf-8') as f:
-            # 第一行：元数据
-            meta_line = {
-                'user_name': metadata.get('user_name', 'User'),
-                'character_name': character_name,
-                'create_date': metadata.get('create_date', datetime.now().isoformat()),
-                'chat_metadata': {
-                    'note': metadata.get('note', ''),
-                    'title': metadata.get('title', chat_name)
-                }
-            }
-            f.write(json.dumps(meta_line, ensure_ascii=False) + '\n')
-            
-            # 后续行：消息
-            for msg in messages:
-                if msg.get('role') != 'system':  # 过滤系统消息
-                    entry = {
-                        'name': msg.get('name', 'User' if msg['role'] == 'user' else character_name),
-                        'is_user': msg['role'] == 'user',
-                        'is_system': False,
-                        'send_date': msg.get('send_date', datetime.now().isoformat()),
-                        'mes': msg['content'],
-                        'swipes': [msg['content']],
-                        'swipe_id': 0
-                    }
-                    f.write(json.dumps(entry, ensure_ascii=False) + '\n')
+        # 保存为SillyTavern兼容的格式（文件存储时为JSONL），过滤系统消息
+        chat_log = data_store.chat(character_name, chat_name)
+        entries = [chat_message_line(msg, character_name) for msg in messages if msg.get('role') != 'system']
+        metadata_line = chat_metadata_line(character_name, chat_name, metadata)
+        with current_trace().span('write'):
+            message_count = chat_log.write_all(metadata_line, entries)
+        with current_trace().span('index'):
+            chat_search_index.replace_chat(chat_log, metadata_line, entries)
         
         return jsonify({
             'status': 'success',
             'chat_name': chat_name,
-            'filepath': filepath
+            'filepath': chat_log.path,
+            'message_count': message_count
         })
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/chats/append', methods=['POST'])
+def append_chat_messages():
+    """在对话末尾追加新消息（对话不存在时创建）
+
+    expected_count 为前端认为服务器上已有的消息条数，不一致时返回 409，前端应改用 /api/chats/save。
+    """
+    try:
+        with current_trace().span('parse'):
+            data = request.json
+        character_name = data.get('character_name', 'default')
+        chat_name = data.get('chat_name')
+        if not chat_name:
+            return jsonify({'error': '缺少参数'}), 400
+        entries = [chat_message_line(msg, character_name) for msg in data.get('messages', [])
+                   if msg.get('role') != 'system']
+        chat_log = data_store.chat(character_name, chat_name)
+        try:
+            with current_trace().span('write'):
+                message_count = chat_log.append(
+                    entries,
+                    metadata=chat_metadata_line(character_name, chat_name, data.get('metadata', {})),
+                    expected_count=data.get('expected_count')
+                )
+        except chat_store.ChatConflict as e:
+            return jsonify({'error': str(e), 'message_count': e.count}), 409
+        chat_search_index.append(chat_log, message_count - len(entries), entries)
+        return jsonify({'status': 'success', 'chat_name': chat_name, 'message_count': message_count})
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/chats/edit', methods=['POST'])
+def edit_chat_message():
+    """修改对话中第 index 条消息（不含系统消息，从 0 开始）"""
+    try:
+        data = request.json
+        character_name = data.get('character_name', 'default')
+        chat_name = data.get('chat_name')
+        index = data.get('index')
+        message = data.get('message')
+        if not chat_name or not isinstance(index, int) or not message:
+            return jsonify({'error': '缺少参数'}), 400
+        chat_log = data_store.chat(character_name, chat_name)
+        if not chat_log.exists():
+            return jsonify({'error': '对话不存在'}), 404
+        entry = chat_message_line(message, character_name)
+        try:
+            with current_trace().span('write'):
+                chat_log.replace(index, entry)
+        except IndexError as e:
+            return jsonify({'error': str(e), 'message_count': chat_log.message_count()}), 409
+        chat_search_index.replace_message(chat_log, index, entry)
+        return jsonify({'status': 'success', 'message_count': chat_log.message_count()})
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/chats/delete-message', methods=['POST'])
+def delete_chat_message():
+    """删除对话中第 index 条消息"""
+    try:
+        data = request.json
+        character_name = data.get('character_name', 'default')
+        chat_name = data.get('chat_name')
+        index = data.get('index')
+        if not chat_name or not isinstance(index, int):
+            return jsonify({'error': '缺少参数'}), 400
+        chat_log = data_store.chat(character_name, chat_name)
+        if not chat_log.exists():
+            return jsonify({'error': '对话不存在'}), 404
+        try:
+            with current_trace().span('write'):
+                chat_log.remove(index)
+        except IndexError as e:
+            return jsonify({'error': str(e), 'message_count': chat_log.message_count()}), 409
+        chat_search_index.remove_message(chat_log, index)
+        return jsonify({'status': 'success', 'message_count': chat_log.message_count()})
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/chats/compact', methods=['POST'])
+def compact_chat_file():
+    """整理对话文件：去掉原地修改留下的行尾空格"""
+    try:
+        data = request.json
+        chat_log = data_store.chat(data.get('character_name', 'default'), data.get('chat_name', ''))
+        if not chat_log.exists():
+            return jsonify({'error': '对话不存在'}), 404
+        message_count = chat_log.compact()
+        return jsonify({'status': 'success', 'message_count': message_count})
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
 @app.route('/api/chats/list', methods=['GET'])
 def list_chats_from_file():
-    """从文件系统获取对话列表"""
+    """获取对话列表（读取对话目录索引或数据库，不打开对话文件）
+
+    参数：character 只看某个角色；sort 为 create_date（默认）/modified/title/message_count/size/name，
+    order 为 desc（默认）/asc；offset、limit 分页（不传 limit 时返回全部）；refresh=1 先与磁盘重新核对。
+    """
     try:
         character_name = request.args.get('character', None)
-        all_chats = []
-        
-        chats_dir = os.path.join(DATA_DIR, 'chats')
-        if not os.path.exists(chats_dir):
-            return jsonify({'chats': []})
-        
-        # 如果指定角色，只返回该角色的对话
-        if character_name:
-            char_dir = os.path.join(chats_dir, character_name.replace('/', '_'))
-            if os.path.exists(char_dir):
-                for filename in os.listdir(char_dir):
-                    if filename.endswith('.jsonl'):
-                        filepath = os.path.join(char_dir, filename)
-                        # 读取文件获取元数据和消息数量
-                        with open(filepath, 'r', encoding='utf-8') as f:
-                            lines = f.readlines()
-                            if lines:
-                                metadata = json.loads(lines[0])
-                                # 计算消息数量（排除第一行元数据）
-                                message_count = len(lines) - 1
-                                all_chats.append({
-                                    'name': filename[:-6],  # 去掉.jsonl
-                                    'character': character_name,
-                                    'create_date': metadata.get('create_date'),
-                                    'title': metadata.get('chat_metadata', {}).get('title'),
-                                    'filepath': filepath,
-                                    'message_count': message_count
-                                })
-        else:
-            # 返回所有角色的对话
-            for char_name in os.listdir(chats_dir):
-                char_dir = os.path.join(chats_dir, char_name)
-                if os.path.isdir(char_dir):
-                    for filename in os.listdir(char_dir):
-                        if filename.endswith('.jsonl'):
-                            filepath = os.path.join(char_dir, filename)
-                            with open(filepath, 'r', encoding='utf-8') as f:
-                                lines = f.readlines()
-                                if lines:
-                                    metadata = json.loads(lines[0])
-                                    # 计算消息数量（排除第一行元数据）
-                                    message_count = len(lines) - 1
-                                    all_chats.append({
-                                        'name': filename[:-6],
-                                        'character': char_name,
-                                        'create_date': metadata.get('create_date'),
-                                        'title': metadata.get('chat_metadata', {}).get('title'),
-                                        'filepath': filepath,
-                                        'message_count': message_count
-                                    })
+        if request.args.get('refresh') == '1':
+            data_store.reconcile()
+        try:
+            offset = int(request.args.get('offset', 0))
+            limit = int(request.args['limit']) if request.args.get('limit') else None
+            with current_trace().span('scan'):
+                page, total = data_store.list_chats(
+                    character=character_name,
+                    sort=request.args.get('sort', 'create_date'),
+                    descending=request.args.get('order', 'desc') != 'asc',
+                    offset=max(offset, 0),
+                    limit=limit
+                )
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
         
-        # 按创建时间排序
-        all_chats.sort(key=lambda x: x.get('create_date', ''), reverse=True)
-        return jsonify({'chats': all_chats})
+        all_chats = []
+        for chat in page:
+            chat['filepath'] = data_store.chat(chat['character'], chat['name']).path
+            if character_name:
+                chat['character'] = character_name
+            all_chats.append(chat)
+        return jsonify({'chats': all_chats, 'total': total})
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/chats/search', methods=['GET'])
+def search_chats():
+    """全文搜索所有对话中的消息
+
+    参数：q 为查询内容（空格分隔的词都必须出现，引号中的内容按短语匹配）；character 只搜某个角色；
+    date_from、date_to 按消息发送时间过滤（如 2024-05 或 2024-05-01，包含两端，格式无效时返回 400）；
+    offset、limit 分页（limit 最大 100）。
+    结果按相关度排序，snippet 为命中位置附近的文字，highlights 为其中命中部分的 [起, 止) 位置；
+    候选过多时只在最新的一部分消息中搜索，truncated 为 true。
+    """
+    try:
+        character_name = request.args.get('character')
+        try:
+            offset = max(int(request.args.get('offset', 0)), 0)
+            limit = min(max(int(request.args.get('limit', 20)), 1), 100)
+            with current_trace().span('search'):
+                results, total, truncated = chat_search_index.search(
+                    request.args.get('q', ''),
+                    character=character_name.replace('/', '_') if character_name else None,
+                    date_from=request.args.get('date_from') or None,
+                    date_to=request.args.get('date_to') or None,
+                    offset=offset,
+                    limit=limit
+                )
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        except chat_search.IndexNotReady as e:
+            return jsonify({'error': str(e), 'indexed': e.indexed}), 503, {'Retry-After': '5'}
+        return jsonify({'results': results, 'total': total, 'offset': offset, 'truncated': truncated})
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
 @app.route('/api/chats/get', methods=['GET'])
 def get_chat_from_file():
-    """从文件系统获取指定对话内容"""
+    """获取指定对话内容
+
+    参数 offset、limit 读取一段消息，tail=N 读取最后 N 条；都不传时返回全部消息。
+    只读取需要的消息（文件存储借助 .idx 行偏移索引定位），返回值中的 total 为消息总数，offset 为第一条返回消息的序号。
+    """
     try:
         character_name = request.args.get('character')
         chat_name = request.args.get('chat_name')
@@ -1569,39 +2449,40 @@ def get_chat_from_file():
         if not character_name or not chat_name:
             return jsonify({'error': '缺少参数'}), 400
         
-        filepath = os.path.join(DATA_DIR, 'chats', character_name.replace('/', '_'), f'{chat_name}.jsonl')
+        try:
+            offset = max(int(request.args.get('offset', 0)), 0)
+            limit = int(request.args['limit']) if request.args.get('limit') else None
+            tail = int(request.args['tail']) if request.args.get('tail') else None
+        except ValueError:
+            return jsonify({'error': 'offset、limit、tail 必须是整数'}), 400
+        
+        chat_log = data_store.chat(character_name, chat_name)
         
-        if not os.path.exists(filepath):
+        if not chat_log.exists():
             return jsonify({'error': '对话不存在'}), 404
         
-        messages = []
-        metadata = {}
-        
-        with open(filepath, 'r', encoding='utf-8') as f:
-            for i, line in enumerate(f):
-                data = json.loads(line)
-                if i == 0 and 'user_name' in data:
-                    # 第一行是元数据
-                    metadata = data
-                else:
-                    # 消息行
-                    messages.append({
-                        'role': 'user' if data.get('is_user') else 'assistant',
-                        'content': data.get('mes', ''),
-                        'name': data.get('name'),
-                        'send_date': data.get('send_date')
-                    })
+        with current_trace().span('read'):
+            metadata = chat_log.read_metadata()
+            if not metadata:
+                # 没有元数据行的旧文件：整份读取，第一行也是消息
+                messages = [chat_message_from_line(entry) for entry in chat_log.read_lines()]
+                return jsonify({'metadata': {}, 'messages': messages, 'total': len(messages), 'offset': 0})
+            total = chat_log.message_count()
+            start, stop = chat_store.window(total, offset, limit, tail)
+            entries = chat_log.read_range(start, stop)
         
         return jsonify({
             'metadata': metadata,
-            'messages': messages
+            'messages': [chat_message_from_line(entry) for entry in entries],
+            'total': total,
+            'offset': start
         })
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
 @app.route('/api/chats/delete', methods=['DELETE'])
 def delete_chat_file():
-    """从文件系统删除对话"""
+    """删除对话"""
     try:
         character_name = request.args.get('character')
         chat_name = request.args.get('chat_name')
@@ -1609,10 +2490,11 @@ def delete_chat_file():
         if not character_name or not chat_name:
             return jsonify({'error': '缺少参数'}), 400
         
-        filepath = os.path.join(DATA_DIR, 'chats', character_name.replace('/', '_'), f'{chat_name}.jsonl')
+        chat_log = data_store.chat(character_name, chat_name)
         
-        if os.path.exists(filepath):
-            os.remove(filepath)
+        if chat_log.exists():
+            chat_log.delete()
+            chat_search_index.remove(chat_log)
             return jsonify({'status': 'success', 'message': '对话已删除'})
         else:
             return jsonify({'error': '对话不存在'}), 404
@@ -1621,7 +2503,7 @@ def delete_chat_file():
 
 @app.route('/api/chats/rename', methods=['POST'])
 def rename_chat_file():
-    """重命名文件系统中的对话"""
+    """重命名对话"""
     try:
         data = request.json
         character_name = data.get('character')
@@ -1631,17 +2513,17 @@ def rename_chat_file():
         if not all([character_name, old_name, new_name]):
             return jsonify({'error': '缺少参数'}), 400
         
-        char_dir = os.path.join(DATA_DIR, 'chats', character_name.replace('/', '_'))
-        old_path = os.path.join(char_dir, f'{old_name}.jsonl')
-        new_path = os.path.join(char_dir, f'{new_name}.jsonl')
+        old_chat = data_store.chat(character_name, old_name)
+        new_chat = data_store.chat(character_name, new_name)
         
-        if not os.path.exists(old_path):
+        if not old_chat.exists():
             return jsonify({'error': '原对话不存在'}), 404
         
-        if os.path.exists(new_path):
+        if new_chat.exists():
             return jsonify({'error': '新名称已存在'}), 400
         
-        os.rename(old_path, new_path)
+        data_store.rename_chat(character_name, old_name, new_name)
+        chat_search_index.rename(old_chat.key, new_chat.key)
         return jsonify({'status': 'success', 'message': '对话已重命名'})
     except Exception as e:
         return jsonify({'error': str(e)}), 500
@@ -1650,13 +2532,11 @@ def rename_chat_file():
 def delete_preset(preset_name):
     """删除预设"""
     try:
-        # 添加.json扩展名如果没有
-        if not preset_name.endswith('.json'):
-            preset_name += '.json'
+        # 去掉.json扩展名（前端传入的是文件名）
+        if preset_name.endswith('.json'):
+            preset_name = preset_name[:-len('.json')]
             
-        filepath = os.path.join(DATA_DIR, 'presets', preset_name)
-        if os.path.exists(filepath):
-            os.remove(filepath)
+        if data_store.delete('presets', preset_name):
             return jsonify({
                 "status": "success",
                 "message": "预设已删除"
@@ -1672,12 +2552,10 @@ def delete_preset(preset_name):
 def load_regex_scripts():
     """加载正则表达式脚本"""
     try:
-        filepath = os.path.join(DATA_DIR, 'regex_scripts.json')
+        data = data_store.get_document('regex_scripts')
         
-        if os.path.exists(filepath):
-            with open(filepath, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-                return jsonify(data)
+        if data is not None:
+            return jsonify(data)
         else:
             # 返回默认空结构
             return jsonify({
@@ -1698,10 +2576,8 @@ def save_regex_scripts():
         if not isinstance(data, dict):
             return jsonify({"error": "无效的数据格式"}), 400
             
-        # 保存到文件
-        filepath = os.path.join(DATA_DIR, 'regex_scripts.json')
-        with open(filepath, 'w', encoding='utf-8') as f:
-            json.dump(data, f, ensure_ascii=False, indent=2)
+        # 保存
+        data_store.put_document('regex_scripts', data)
         
         return jsonify({
             "status": "success",
@@ -1744,11 +2620,19 @@ def parse_document():
         filepath = os.path.join(UPLOAD_DIR, unique_filename)
         
         # 保存文件
-        file.save(filepath)
+        trace = current_trace()
+        with trace.span('upload'):
+            file.save(filepath)
         
         try:
             # 解析文档
-            result = doc_parser.parse(filepath)
+            parse_started = time.monotonic()
+            with trace.span('parse'):
+                result = doc_parser.parse(filepath)
+            metrics.document_parse_duration.labels(
+                Path(filename).suffix.lower().lstrip('.') or 'unknown',
+                'success' if result['success'] else 'error'
+            ).observe(time.monotonic() - parse_started)
             
             if result['success']:
                 # 记录日志
@@ -1815,9 +2699,9 @@ if __name__ == '__main__':
     print("可以通过以下地址访问：")
     print("- http://localhost:5000")
     print("- http://你的IP地址:5000")
-    print("日志文件位置: logs/ai_chat.log")
+    print("日志文件位置: logs/ai_requests/（JSONL），logs/ai_chat.log（文本）")
     # host='0.0.0.0' 允许外部访问
-    app.run(host='0.0.0.0', debug=True, port=5000)
+    app.run(host='0.0.0.0', debug=True, port=5000, use_reloader=USE_RELOADER)
 
 # ========== 重要提醒 ==========
 # 添加新的AI相关接口时，请务必使用 log_ai_request() 函数记录请求和响应
@@ -1825,7 +2709,7 @@ if __name__ == '__main__':
 # log_ai_request(endpoint_url, request_data, response_data, error)
 # 
 # 这将帮助调试和监控AI服务的使用情况
-# 日志文件位置：logs/ai_chat.log
+# 日志文件位置：logs/ai_requests/（JSONL 分段），logs/ai_chat.log（文本）
 # ============================
 
 
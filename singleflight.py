@@ -0,0 +1,320 @@
+"""单飞请求合并 - 相同的进行中请求只向服务商发起一次
+
+非流式请求：后到的请求（跟随者）等待领头请求的结果并直接复用。
+流式请求：领头请求的上游数据由后台线程写入广播缓冲区，所有请求各自从头读取；
+全部读者断开后才取消上游生成：立即调用登记的中止回调关闭上游连接，不等下一个数据块到达。
+广播缓冲区同时是断线重连的重放缓冲区（见 stream_replay.py）。
+"""
+
+from __future__ import annotations
+
+import threading
+import time
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+FRAME_ENDINGS = ('\n\n', '\r\n\r\n', '\r\r')
+FRAME_ENDINGS_BYTES = tuple(ending.encode('ascii') for ending in FRAME_ENDINGS)
+
+
+class _Call:
+    def __init__(self) -> None:
+        self.event = threading.Event()
+        self.result = None
+        self.error: Optional[BaseException] = None
+
+
+class FlightStats:
+    """统计实际发起的上游调用数和被合并掉的调用数"""
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self.upstream_calls = 0
+        self.coalesced = 0
+
+    def record(self, leader: bool) -> None:
+        with self._lock:
+            if leader:
+                self.upstream_calls += 1
+            else:
+                self.coalesced += 1
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            total = self.upstream_calls + self.coalesced
+            return {
+                'upstream_calls': self.upstream_calls,
+                'coalesced': self.coalesced,
+                'avoided_ratio': round(self.coalesced / total, 4) if total else 0.0,
+            }
+
+
+class SingleFlight:
+    """非流式请求合并"""
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._calls: Dict[str, _Call] = {}
+        self.stats = FlightStats()
+
+    def do(self, key: str, fn: Callable[[], object]) -> Tuple[object, bool]:
+        """执行 fn 或等待相同 key 的进行中调用，返回 (结果, 是否复用了他人的结果)"""
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+        self.stats.record(leader)
+
+        if not leader:
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+
+        try:
+            call.result = fn()
+        except BaseException as exc:
+            call.error = exc
+            raise
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+            call.event.set()
+        return call.result, False
+
+    def in_flight(self) -> int:
+        with self._lock:
+            return len(self._calls)
+
+
+class ReplayGap(Exception):
+    """请求的位置已经被移出环形缓冲区"""
+
+
+class StreamAbandoned(Exception):
+    """所有读者都已断开，上游生成已被中止"""
+
+
+class BroadcastBuffer:
+    """流式广播缓冲区：按序号保存数据块，读者按各自的进度读取
+
+    max_bytes 不为 None 时是环形缓冲区，超出后丢弃最早的数据块（字符串按字符数近似）。
+    grace 秒内所有读者都断开也继续接收上游数据，等待客户端断线重连。
+    超过等待时间（或客户端主动停止）后调用 on_abort 中止上游，上游卡住不再输出时也能及时释放连接。
+    """
+
+    def __init__(self, max_bytes: Optional[int] = None, grace: float = 0.0) -> None:
+        self._cond = threading.Condition()
+        self._chunks: List = []
+        self._base = 0  # _chunks[0] 的序号
+        self._readers = 0
+        self._orphaned_at: Optional[float] = None
+        self._cancel_requested = False
+        self.max_bytes = max_bytes
+        self.grace = grace
+        self.size = 0
+        self.stream_id: Optional[str] = None  # 开启断线重连时由 ReplayStore 分配
+        self.done = False
+        self.started = False  # 领头请求已获准入并开始读取上游
+        self.closed = False  # 已完成或因没有读者而取消，不再接受新读者
+        self.finished_at: Optional[float] = None
+        self.error: Optional[BaseException] = None
+        self.on_abort: Optional[Callable[[], None]] = None
+        self._aborted = False
+
+    def attach(self, start: int = 0) -> "BroadcastReader":
+        """新增读者，从序号 start 开始读取；该位置已被环形缓冲区丢弃时抛出 ReplayGap"""
+        with self._cond:
+            if start < self._base:
+                raise ReplayGap(f"序号 {start} 之前的数据已被丢弃")
+            self._readers += 1
+            self._orphaned_at = None
+        return BroadcastReader(self, start)
+
+    def _detach(self) -> None:
+        with self._cond:
+            self._readers -= 1
+            if self._readers <= 0:
+                self._orphaned_at = time.monotonic()
+                if not self._cancel_requested and self.grace > 0 and not self.done:
+                    # 等待重连期满后再检查一次，期间有读者重新加入则不中止
+                    timer = threading.Timer(self.grace, self._abort_if_orphaned, args=(self._orphaned_at,))
+                    timer.daemon = True
+                    timer.start()
+        self._abort_if_orphaned()
+
+    def request_cancel(self) -> None:
+        """客户端主动停止：没有其他读者时不再等待重连，立即中止上游"""
+        with self._cond:
+            self._cancel_requested = True
+        self._abort_if_orphaned()
+
+    def set_abort(self, on_abort: Callable[[], None]) -> None:
+        """登记中止上游的回调；登记时读者已经全部离开则立即调用"""
+        with self._cond:
+            self.on_abort = on_abort
+        self._abort_if_orphaned()
+
+    def _abort_if_orphaned(self, orphaned_at: Optional[float] = None) -> None:
+        """没有读者且已请求停止或超过重连等待时间时关闭缓冲区，并在锁外调用 on_abort（只调用一次）"""
+        with self._cond:
+            if self._readers > 0 or self._orphaned_at is None or self.done or self._aborted:
+                return
+            if orphaned_at is not None and orphaned_at != self._orphaned_at:
+                return
+            orphaned_for = time.monotonic() - self._orphaned_at
+            if not (self._cancel_requested or orphaned_for >= self.grace):
+                return
+            self.closed = True
+            on_abort = self.on_abort
+            if on_abort is None:
+                return
+            self._aborted = True
+        on_abort()
+
+    def publish(self, chunk) -> bool:
+        """追加数据块；返回 False 表示所有读者都已断开（且超过重连等待时间），应取消上游"""
+        with self._cond:
+            if self._readers <= 0:
+                orphaned_for = time.monotonic() - (self._orphaned_at or 0.0)
+                if self._cancel_requested or orphaned_for >= self.grace:
+                    self.closed = True
+                    return False
+            self._chunks.append(chunk)
+            self.size += len(chunk)
+            if self.max_bytes is not None:
+                while self.size > self.max_bytes and len(self._chunks) > 1:
+                    self.size -= len(self._chunks.pop(0))
+                    self._base += 1
+            self._cond.notify_all()
+            return True
+
+    def mark_started(self) -> None:
+        with self._cond:
+            self.started = True
+            self._cond.notify_all()
+
+    def wait_started(self) -> Optional[BaseException]:
+        """阻塞直到领头请求开始读取上游；领头请求未能开始（如未获准入）时返回其错误"""
+        with self._cond:
+            while not self.started and not self.done:
+                self._cond.wait()
+            return None if self.started else self.error
+
+    def finish(self, error: Optional[BaseException] = None) -> None:
+        with self._cond:
+            self.done = True
+            self.closed = True
+            self.finished_at = time.time()
+            self.error = error
+            self._cond.notify_all()
+
+    def read_from(self, index: int):
+        """阻塞直到有序号 index 及之后的数据或流结束，返回 (数据块列表, 是否结束)"""
+        with self._cond:
+            while index >= self._base + len(self._chunks) and not self.done:
+                self._cond.wait()
+            if index < self._base:
+                raise ReplayGap(f"序号 {index} 之前的数据已被丢弃")
+            return self._chunks[index - self._base:], self.done
+
+
+class BroadcastReader:
+    """单个客户端的读取迭代器；Werkzeug 在连接结束或断开时调用 close()
+
+    缓冲区分配了 stream_id 时，在每个以完整 SSE 帧结尾的数据块后追加一个只含
+    "id: <stream_id>:<序号>" 的帧，客户端据此用 Last-Event-ID 断点续传。
+    """
+
+    def __init__(self, buffer: BroadcastBuffer, start: int = 0) -> None:
+        self.buffer = buffer
+        self._index = start
+        self._pending: List = []
+        self._closed = False
+
+    def __iter__(self) -> Iterator:
+        return self
+
+    def __next__(self):
+        while not self._pending:
+            start = self._index
+            chunks, done = self.buffer.read_from(start)
+            self._index += len(chunks)
+            self._pending = [(start + offset, chunk) for offset, chunk in enumerate(chunks)]
+            if not chunks and done:
+                if self.buffer.error is not None:
+                    raise self.buffer.error
+                raise StopIteration
+        seq, chunk = self._pending.pop(0)
+        stream_id = self.buffer.stream_id
+        if stream_id is None:
+            return chunk
+        # SSE 帧可以用 \n、\r\n 或 \r 换行，三种结尾都视为完整的帧
+        if isinstance(chunk, bytes):
+            return chunk + f"id: {stream_id}:{seq}\n\n".encode('ascii') if chunk.endswith(FRAME_ENDINGS_BYTES) else chunk
+        return chunk + f"id: {stream_id}:{seq}\n\n" if chunk.endswith(FRAME_ENDINGS) else chunk
+
+    def close(self) -> None:
+        if not self._closed:
+            self._closed = True
+            self.buffer._detach()
+
+
+class StreamFlights:
+    """流式请求合并：相同 key 的进行中流共享一个广播缓冲区"""
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._buffers: Dict[str, BroadcastBuffer] = {}
+        self.stats = FlightStats()
+
+    def join(self, key: str, max_bytes: Optional[int] = None, grace: float = 0.0) -> Tuple[BroadcastReader, bool]:
+        """加入相同 key 的进行中流，返回 (读者, 是否为领头请求)；新建缓冲区时使用 max_bytes 和 grace"""
+        with self._lock:
+            buffer = self._buffers.get(key)
+            leader = buffer is None or buffer.closed
+            if leader:
+                buffer = self._buffers[key] = BroadcastBuffer(max_bytes, grace)
+            reader = buffer.attach()
+        self.stats.record(leader)
+        return reader, leader
+
+    def fail(self, key: str, buffer: BroadcastBuffer, error: BaseException) -> None:
+        """领头请求未能开始（如未获准入）：结束缓冲区，wait_started 的跟随者和已加入的读者都会收到该错误"""
+        with self._lock:
+            if self._buffers.get(key) is buffer:
+                del self._buffers[key]
+        buffer.finish(error)
+
+    def start_pump(self, key: str, buffer: BroadcastBuffer, source: Iterator,
+                   on_abort: Optional[Callable[[], None]] = None) -> None:
+        """在后台线程中把 source 的数据写入广播缓冲区
+
+        on_abort 在所有读者离开（且超过重连等待时间）时从其他线程调用，应让阻塞在读取上游的
+        source 尽快返回或抛出异常，例如关闭上游连接的套接字。
+        """
+        if on_abort is not None:
+            buffer.set_abort(on_abort)
+        buffer.mark_started()
+        thread = threading.Thread(target=self._pump, args=(key, buffer, source), name='stream-flight', daemon=True)
+        thread.start()
+
+    def _pump(self, key: str, buffer: BroadcastBuffer, source: Iterator) -> None:
+        error = None
+        try:
+            for chunk in source:
+                if not buffer.publish(chunk):
+                    # 所有读者都已断开：关闭生成器，由其取消上游并记录部分输出
+                    source.close()
+                    break
+        except Exception as exc:
+            error = exc
+        finally:
+            with self._lock:
+                if self._buffers.get(key) is buffer:
+                    del self._buffers[key]
+            buffer.finish(error)
+
+    def in_flight(self) -> int:
+        with self._lock:
+            return len(self._buffers)
@@ -0,0 +1,345 @@
+"""SSE 流处理 - 逐行转发、零解码透传、增量合并、多候选交错转发以及旁路内容解析"""
+
+from __future__ import annotations
+
+import json
+import queue
+import threading
+import time
+from collections import deque
+from typing import Callable, Deque, Dict, Iterator, List, Optional
+
+DONE_LINE = 'data: [DONE]'
+DEFAULT_CHUNK_SIZE = 64 * 1024
+
+
+def accumulate_stream_line(line_str: str, accumulated_content: List[str]) -> None:
+    """解析一行 SSE 数据，把 delta.content 累积到列表中用于日志"""
+    parse_stream_line(line_str, accumulated_content)
+
+
+def parse_stream_line(line_str: str, accumulated_content: List[str]):
+    """解析一行 SSE 数据并累积 delta.content，返回解析结果（[DONE] 或无法解析时为 None）"""
+    if line_str != DONE_LINE:
+        try:
+            chunk_data = json.loads(line_str[6:])
+            if 'choices' in chunk_data and chunk_data['choices']:
+                delta = chunk_data['choices'][0].get('delta', {})
+                if 'content' in delta:
+                    accumulated_content.append(delta['content'])
+            return chunk_data
+        except:
+            pass
+    return None
+
+
+def relay_lines(response, accumulated_content: List[str]) -> Iterator[str]:
+    """逐行转发：每行解码、重新分帧，并在热路径上解析内容"""
+    for line in response.iter_lines():
+        if line:
+            line_str = line.decode('utf-8')
+            if line_str.startswith('data: '):
+                yield line_str + '\n\n'
+
+                # 解析并累积响应内容
+                accumulate_stream_line(line_str, accumulated_content)
+
+
+def accumulate_indexed_line(line_str: str, candidate_contents: List[List[str]]):
+    """解析一行 SSE 数据，按 choices[].index 把 delta.content 分别累积到各候选的列表中"""
+    if line_str == DONE_LINE:
+        return None
+    try:
+        chunk_data = json.loads(line_str[6:])
+    except ValueError:
+        return None
+    for choice in chunk_data.get('choices') or []:
+        index = choice.get('index', 0)
+        content = (choice.get('delta') or {}).get('content')
+        if content and 0 <= index < len(candidate_contents):
+            candidate_contents[index].append(content)
+    return chunk_data
+
+
+def relay_indexed(response, candidate_contents: List[List[str]]) -> Iterator[str]:
+    """逐行转发服务商原生 n 参数生成的多候选流，按候选序号分别累积内容"""
+    for line in response.iter_lines():
+        if line:
+            line_str = line.decode('utf-8')
+            if line_str.startswith('data: '):
+                yield line_str + '\n\n'
+                accumulate_indexed_line(line_str, candidate_contents)
+
+
+def relay_candidates(open_candidate: Callable[[int], object], candidate_contents: List[List[str]]) -> Iterator[str]:
+    """并发请求多个候选并交错转发
+
+    每个候选由一个工作线程调用 open_candidate(序号) 打开上游流，帧中的 choices[].index
+    改写为候选序号后放入同一个队列，由生成器按到达顺序输出，前端按 index 区分候选。
+    单个候选失败时输出一帧带 index 的 error，其余候选继续；全部结束后只输出一次 [DONE]。
+    生成器被关闭（客户端断开）时通知所有工作线程停止并关闭上游连接。
+    """
+    count = len(candidate_contents)
+    frames: "queue.Queue[Optional[dict]]" = queue.Queue()
+    stop = threading.Event()
+    responses: List[object] = [None] * count
+
+    def worker(index: int) -> None:
+        try:
+            response = open_candidate(index)
+            responses[index] = response
+            if stop.is_set():
+                response.close()
+                return
+            for line in response.iter_lines():
+                if stop.is_set():
+                    break
+                if not line:
+                    continue
+                line_str = line.decode('utf-8')
+                if not line_str.startswith('data: ') or line_str == DONE_LINE:
+                    continue
+                try:
+                    chunk_data = json.loads(line_str[6:])
+                except ValueError:
+                    continue
+                for choice in chunk_data.get('choices') or []:
+                    choice['index'] = index
+                frames.put(chunk_data)
+        except Exception as exc:
+            if not stop.is_set():
+                print(f"[多候选] 候选 {index} 生成失败: {exc}")
+                frames.put({
+                    'error': {'message': str(exc), 'candidate': index},
+                    'choices': [{'index': index, 'delta': {}, 'finish_reason': 'error'}],
+                })
+        finally:
+            frames.put(None)
+
+    for index in range(count):
+        threading.Thread(target=worker, args=(index,), name=f'candidate-{index}', daemon=True).start()
+
+    remaining = count
+    try:
+        while remaining:
+            chunk_data = frames.get()
+            if chunk_data is None:
+                remaining -= 1
+                continue
+            for choice in chunk_data['choices']:
+                content = (choice.get('delta') or {}).get('content')
+                if content:
+                    candidate_contents[choice['index']].append(content)
+            yield 'data: ' + json.dumps(chunk_data, ensure_ascii=False) + '\n\n'
+        yield DONE_LINE + '\n\n'
+    finally:
+        stop.set()
+        for response in responses:
+            if response is not None:
+                response.close()
+
+
+def iter_raw_chunks(response, max_chunk_size: int = DEFAULT_CHUNK_SIZE) -> Iterator[bytes]:
+    """按到达的大小读取上游原始字节块（不等待凑满 max_chunk_size）"""
+    read1 = getattr(response.raw, 'read1', None)
+    if read1 is None:
+        # urllib3 1.x 没有 read1，分块传输时 chunk_size=None 同样按到达的块返回
+        yield from response.iter_content(chunk_size=None)
+        return
+    while True:
+        chunk = read1(max_chunk_size, decode_content=True)
+        if not chunk:
+            break
+        yield chunk
+
+
+def relay_passthrough(response, collector: "SSEContentCollector",
+                      max_chunk_size: int = DEFAULT_CHUNK_SIZE) -> Iterator[bytes]:
+    """零解码透传：上游字节块原样转发，内容解析交给旁路解析器"""
+    for chunk in iter_raw_chunks(response, max_chunk_size):
+        yield chunk
+        collector.feed(chunk)
+
+
+class DeltaCoalescer:
+    """增量合并：把连续的纯文本 delta 帧合并成一帧
+
+    只有 choices 仅一项、delta 只含 content、且没有 finish_reason 的帧才会被合并；
+    其他帧（角色帧、工具调用、finish_reason、[DONE] 等）到达时先输出已合并的内容，
+    再原样输出该帧，因此结束语义和帧顺序保持不变。
+    时间窗口在下一帧到达时检查，上游停顿期间已收到的内容不会额外等待超过一个帧间隔。
+    """
+
+    def __init__(self, window_ms: float = 50, max_bytes: int = 2048) -> None:
+        self.window = window_ms / 1000.0
+        self.max_bytes = max_bytes
+        self._template: Optional[dict] = None
+        self._parts: List[str] = []
+        self._size = 0
+        self._started = 0.0
+
+    @staticmethod
+    def _mergeable(chunk_data) -> bool:
+        if not isinstance(chunk_data, dict):
+            return False
+        choices = chunk_data.get('choices')
+        if not isinstance(choices, list) or len(choices) != 1:
+            return False
+        choice = choices[0]
+        if not isinstance(choice, dict) or choice.get('finish_reason') is not None:
+            return False
+        delta = choice.get('delta')
+        if not isinstance(delta, dict) or set(delta) != {'content'} or not isinstance(delta['content'], str):
+            return False
+        if not set(choice) <= {'index', 'delta', 'finish_reason', 'logprobs'} or choice.get('logprobs') is not None:
+            return False
+        return chunk_data.get('usage') is None
+
+    def feed(self, line_str: str, chunk_data, now: Optional[float] = None) -> List[str]:
+        """输入一行 SSE 数据及其解析结果，返回需要立即输出的帧"""
+        now = time.monotonic() if now is None else now
+        if not self._mergeable(chunk_data):
+            frames = self.flush()
+            frames.append(line_str + '\n\n')
+            return frames
+
+        choice_index = chunk_data['choices'][0].get('index', 0)
+        frames: List[str] = []
+        if self._template is not None and self._template['choices'][0].get('index', 0) != choice_index:
+            frames = self.flush()
+        content = chunk_data['choices'][0]['delta']['content']
+        if self._template is None:
+            self._template = chunk_data
+            self._started = now
+        self._parts.append(content)
+        self._size += len(content.encode('utf-8'))
+        if self._size >= self.max_bytes or now - self._started >= self.window:
+            frames.extend(self.flush())
+        return frames
+
+    def flush(self) -> List[str]:
+        """输出已合并的内容帧"""
+        if self._template is None:
+            return []
+        merged = self._template
+        merged['choices'][0]['delta'] = {'content': ''.join(self._parts)}
+        self._template = None
+        self._parts = []
+        self._size = 0
+        return ['data: ' + json.dumps(merged, ensure_ascii=False) + '\n\n']
+
+
+def relay_coalesced(response, accumulated_content: List[str], coalescer: DeltaCoalescer) -> Iterator[str]:
+    """逐行读取并合并增量帧；合并需要解析每一帧，内容累积复用同一次解析结果"""
+    for line in response.iter_lines():
+        if line:
+            line_str = line.decode('utf-8')
+            if line_str.startswith('data: '):
+                chunk_data = parse_stream_line(line_str, accumulated_content)
+                yield from coalescer.feed(line_str, chunk_data)
+    yield from coalescer.flush()
+
+
+class SSEContentCollector:
+    """旁路解析器
+
+    热路径上只保存数据块的引用（bytes 不可变，相当于缓冲区的零拷贝副本），
+    流结束后再一次性按行切分、解码并提取 delta.content。
+    """
+
+    def __init__(self) -> None:
+        self._chunks: List[bytes] = []
+
+    def feed(self, chunk: bytes) -> None:
+        self._chunks.append(chunk)
+
+    @property
+    def size(self) -> int:
+        return sum(len(chunk) for chunk in self._chunks)
+
+    def content_parts(self) -> List[str]:
+        accumulated_content: List[str] = []
+        text = b''.join(self._chunks).decode('utf-8', errors='replace')
+        # 只按 \n 切分：str.splitlines() 还会在 U+2028、\x85 等字符处切分，而它们可以原样出现在 JSON 字符串中
+        for line in text.split('\n'):
+            if line.endswith('\r'):
+                line = line[:-1]
+            if line.startswith('data: '):
+                accumulate_stream_line(line, accumulated_content)
+        return accumulated_content
+
+
+class StreamStats:
+    """流式请求统计：完成/取消的流数量，以及提前取消节省的 token 估算
+
+    token 数按 delta.content 帧数近似（服务商通常每个 token 发送一帧）。
+    节省量 = 该模型最近完成的流的平均长度（有 max_tokens 时取较小值）减去取消前已生成的长度。
+    """
+
+    def __init__(self, window: int = 50) -> None:
+        self._lock = threading.Lock()
+        self._window = window
+        self._recent: Dict[str, Deque[int]] = {}
+        self.completed = 0
+        self.cancelled = 0
+        self.tokens_delivered_before_cancel = 0
+        self.tokens_saved = 0
+
+    def record_completed(self, model: str, tokens: int) -> None:
+        with self._lock:
+            self.completed += 1
+            recent = self._recent.get(model)
+            if recent is None:
+                recent = self._recent[model] = deque(maxlen=self._window)
+            recent.append(tokens)
+
+    def record_cancelled(self, model: str, tokens: int, max_tokens: Optional[int] = None) -> int:
+        """记录一次取消，返回估算节省的 token 数"""
+        with self._lock:
+            recent = self._recent.get(model)
+            expected = sum(recent) / len(recent) if recent else 0
+            if max_tokens:
+                expected = min(expected, max_tokens) if expected else max_tokens
+            saved = max(0, int(expected - tokens))
+            self.cancelled += 1
+            self.tokens_delivered_before_cancel += tokens
+            self.tokens_saved += saved
+            return saved
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                'completed': self.completed,
+                'cancelled': self.cancelled,
+                'tokens_delivered_before_cancel': self.tokens_delivered_before_cancel,
+                'tokens_saved_estimate': self.tokens_saved,
+            }
+
+
+class Sidecar:
+    """单个后台线程，按顺序执行流结束后的解析和日志任务"""
+
+    def __init__(self, name: str = 'sse-sidecar') -> None:
+        self._name = name
+        self._queue: "queue.Queue[Callable[[], None]]" = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def submit(self, task: Callable[[], None]) -> None:
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name=self._name, daemon=True)
+                self._thread.start()
+        self._queue.put(task)
+
+    def _run(self) -> None:
+        while True:
+            task = self._queue.get()
+            try:
+                task()
+            except Exception as exc:
+                print(f"[旁路解析] 任务执行失败: {exc}")
+
+
+sidecar = Sidecar()
+stream_stats = StreamStats()
@@ -0,0 +1,606 @@
+"""数据存储层 - 角色卡、世界书、预设、用户身份、正则脚本和聊天记录的统一读写接口
+
+两种后端：
+- FileStorage：原有的目录结构（data/characters/*.json、data/chats/<角色>/<对话>.jsonl 等），默认使用
+- SqliteStorage：单个 SQLite 数据库（data/storage.db），WAL 模式，文档以 JSON 文本保存，按 id、名称、角色、日期建立索引
+
+集合（characters / worlds / presets）中的每一项是一个 JSON 文档，用 id 存取；
+user_persona、regex_scripts 等只有一份的配置保存为单个文档。
+对话通过 chat(character, name) 取得句柄，两种后端的句柄接口都与 chat_store.ChatLog 相同。
+
+后端在 config.json 的 "storage" 段中选择，修改后重启生效。两种后端之间用以下命令互相迁移（迁移前先停止服务）：
+    python storage.py migrate --to sqlite
+    python storage.py migrate --to file
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import sqlite3
+import sys
+import threading
+import time
+from abc import ABC, abstractmethod
+from typing import Iterator, List, Optional, Tuple
+
+import chat_catalog
+from chat_store import ChatConflict, ChatLog, encode_line
+
+# config.json 中 "storage" 段的默认值
+DEFAULT_SETTINGS = {
+    'backend': 'file',            # file：原有目录结构；sqlite：单个数据库文件
+    'sqlite_file': 'storage.db',  # 相对路径放在 data 目录下
+}
+
+COLLECTIONS = ('characters', 'worlds', 'presets')
+
+# 单个文档在文件后端中的位置（相对 data 目录）
+DOCUMENTS = {
+    'user_persona': 'user_persona.json',
+    'active_world_books': 'active_world_books.json',
+    'regex_scripts': 'regex_scripts.json',
+}
+
+PREVIEW_CHARS = chat_catalog.PREVIEW_CHARS
+
+
+def write_json_atomic(path: str, data) -> None:
+    """先写临时文件再替换，写入中途失败不会留下不完整的文件"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False, indent=2)
+        os.replace(temp_path, path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+
+def document_name(data: dict) -> Optional[str]:
+    """文档的显示名称（角色卡、预设为 name，世界书为 _metadata.name）"""
+    name = data.get('name') or (data.get('_metadata') or {}).get('name')
+    return name if isinstance(name, str) else None
+
+
+def safe_character(character: str) -> str:
+    return character.replace('/', '_')
+
+
+class Storage(ABC):
+    """存储后端接口（缺少任何一个抽象方法的后端在创建时即报错）"""
+
+    backend = ''
+
+    # ---- 集合 ----
+
+    @abstractmethod
+    def list(self, collection: str) -> List[Tuple[str, dict]]:
+        """返回集合中全部的 (id, 文档)"""
+
+    @abstractmethod
+    def get(self, collection: str, doc_id: str) -> Optional[dict]:
+        """不存在时返回 None"""
+
+    @abstractmethod
+    def put(self, collection: str, doc_id: str, data: dict) -> None:
+        """保存文档（同 id 的覆盖）"""
+
+    @abstractmethod
+    def delete(self, collection: str, doc_id: str) -> bool:
+        """删除文档，返回是否存在"""
+
+    # ---- 单个文档 ----
+
+    @abstractmethod
+    def get_document(self, name: str) -> Optional[dict]:
+        """读取 DOCUMENTS 中的单个文档，不存在时返回 None"""
+
+    @abstractmethod
+    def put_document(self, name: str, data: dict) -> None:
+        """保存单个文档"""
+
+    # ---- 对话 ----
+
+    @abstractmethod
+    def chat(self, character: str, name: str):
+        """对话句柄（接口与 chat_store.ChatLog 相同，另有 character、name、key 属性）"""
+
+    @abstractmethod
+    def iter_chats(self) -> Iterator[Tuple[str, str]]:
+        """遍历全部对话的 (角色, 对话名)"""
+
+    @abstractmethod
+    def list_chats(self, character: Optional[str] = None, sort: str = 'create_date', descending: bool = True,
+                   offset: int = 0, limit: Optional[int] = None) -> Tuple[List[dict], int]:
+        """返回 (当前页的对话摘要, 符合条件的总数)，排序字段见 chat_catalog.SORT_KEYS"""
+
+    @abstractmethod
+    def rename_chat(self, character: str, old_name: str, new_name: str) -> None:
+        """重命名对话"""
+
+    def reconcile(self) -> None:
+        """与外部修改同步（只有文件后端需要）"""
+
+    def close(self) -> None:
+        pass
+
+
+# ==================== 文件后端 ====================
+
+class FileChat(ChatLog):
+    """文件后端的对话句柄：写入后同步更新对话目录索引"""
+
+    def __init__(self, storage: 'FileStorage', character: str, name: str) -> None:
+        super().__init__(os.path.join(storage.chats_dir, character, f'{name}.jsonl'))
+        self.character = character
+        self.name = name
+        self.key = f'{character}/{name}'
+        self._catalog = storage.catalog
+
+    def write_all(self, metadata, entries) -> int:
+        count = super().write_all(metadata, entries)
+        self._catalog.refresh(self.path)
+        return count
+
+    def append(self, entries, metadata=None, expected_count=None) -> int:
+        count = super().append(entries, metadata, expected_count)
+        self._catalog.refresh(self.path)
+        return count
+
+    def replace(self, index, entry) -> None:
+        super().replace(index, entry)
+        self._catalog.refresh(self.path)
+
+    def remove(self, index) -> None:
+        super().remove(index)
+        self._catalog.refresh(self.path)
+
+    def delete(self) -> None:
+        super().delete()
+        self._catalog.remove(self.path)
+
+
+class FileStorage(Storage):
+    backend = 'file'
+
+    def __init__(self, data_dir: str, reconcile: bool = True) -> None:
+        self.data_dir = data_dir
+        self.chats_dir = os.path.join(data_dir, 'chats')
+        for directory in (*COLLECTIONS, 'chats'):
+            os.makedirs(os.path.join(data_dir, directory), exist_ok=True)
+        # 对话目录索引：list_chats 只读索引，启动时按修改时间与磁盘核对（reconcile 为 False 时跳过）
+        self.catalog = chat_catalog.ChatCatalog(self.chats_dir)
+        self.catalog.start(reconcile)
+
+    def _path(self, collection: str, doc_id: str) -> str:
+        return os.path.join(self.data_dir, collection, f'{doc_id}.json')
+
+    def list(self, collection: str) -> List[Tuple[str, dict]]:
+        directory = os.path.join(self.data_dir, collection)
+        items = []
+        for filename in sorted(os.listdir(directory)):
+            if not filename.endswith('.json'):
+                continue
+            path = os.path.join(directory, filename)
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    items.append((filename[:-len('.json')], json.load(f)))
+            except (OSError, ValueError) as exc:
+                print(f"[存储] 无法读取 {path}: {exc}")
+        return items
+
+    def get(self, collection: str, doc_id: str) -> Optional[dict]:
+        try:
+            with open(self._path(collection, doc_id), 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def put(self, collection: str, doc_id: str, data: dict) -> None:
+        write_json_atomic(self._path(collection, doc_id), data)
+
+    def delete(self, collection: str, doc_id: str) -> bool:
+        try:
+            os.remove(self._path(collection, doc_id))
+            return True
+        except FileNotFoundError:
+            return False
+
+    def get_document(self, name: str) -> Optional[dict]:
+        try:
+            with open(os.path.join(self.data_dir, DOCUMENTS[name]), 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def put_document(self, name: str, data: dict) -> None:
+        write_json_atomic(os.path.join(self.data_dir, DOCUMENTS[name]), data)
+
+    def chat(self, character: str, name: str) -> FileChat:
+        return FileChat(self, safe_character(character), name)
+
+    def iter_chats(self) -> Iterator[Tuple[str, str]]:
+        for char_entry in os.scandir(self.chats_dir):
+            if not char_entry.is_dir():
+                continue
+            for file_entry in os.scandir(char_entry.path):
+                if file_entry.name.endswith('.jsonl') and file_entry.is_file():
+                    yield char_entry.name, file_entry.name[:-len('.jsonl')]
+
+    def list_chats(self, character=None, sort='create_date', descending=True, offset=0, limit=None):
+        page, total = self.catalog.list(character=safe_character(character) if character else None,
+                                        sort=sort, descending=descending, offset=offset, limit=limit)
+        return [{key: value for key, value in entry.items() if key != 'mtime_ns'} for entry in page], total
+
+    def rename_chat(self, character: str, old_name: str, new_name: str) -> None:
+        old_chat, new_chat = self.chat(character, old_name), self.chat(character, new_name)
+        old_chat.rename(new_chat.path)
+        self.catalog.rename(old_chat.path, new_chat.path)
+
+    def reconcile(self) -> None:
+        self.catalog.reconcile()
+
+
+# ==================== SQLite 后端 ====================
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS documents (
+    collection TEXT NOT NULL,
+    id TEXT NOT NULL,
+    name TEXT,
+    data TEXT NOT NULL,
+    updated_at REAL NOT NULL,
+    PRIMARY KEY (collection, id)
+);
+CREATE INDEX IF NOT EXISTS documents_name ON documents (collection, name);
+
+CREATE TABLE IF NOT EXISTS chats (
+    id INTEGER PRIMARY KEY,
+    character TEXT NOT NULL,
+    name TEXT NOT NULL,
+    title TEXT,
+    create_date TEXT,
+    metadata TEXT NOT NULL,
+    message_count INTEGER NOT NULL DEFAULT 0,
+    size INTEGER NOT NULL DEFAULT 0,
+    preview TEXT NOT NULL DEFAULT '',
+    modified REAL NOT NULL,
+    UNIQUE (character, name)
+);
+CREATE INDEX IF NOT EXISTS chats_create_date ON chats (character, create_date);
+CREATE INDEX IF NOT EXISTS chats_modified ON chats (modified);
+
+CREATE TABLE IF NOT EXISTS messages (
+    chat_id INTEGER NOT NULL REFERENCES chats (id) ON DELETE CASCADE,
+    position INTEGER NOT NULL,
+    data TEXT NOT NULL,
+    PRIMARY KEY (chat_id, position)
+) WITHOUT ROWID;
+"""
+
+# 单个文档保存在 documents 表的这个集合中
+DOCUMENTS_COLLECTION = '_documents'
+
+# list_chats 的排序字段对应的 SQL 表达式（空值按空字符串/0 排序，与文件后端一致）
+CHAT_SORT_COLUMNS = {
+    'create_date': "COALESCE(create_date, '')",
+    'modified': 'modified',
+    'title': "COALESCE(title, '')",
+    'message_count': 'message_count',
+    'size': 'size',
+    'name': 'name',
+}
+
+
+def _dumps(data) -> str:
+    return json.dumps(data, ensure_ascii=False)
+
+
+def _preview(entry: Optional[dict]) -> str:
+    return (entry.get('mes') or '')[:PREVIEW_CHARS] if entry else ''
+
+
+def _line_size(entry: dict) -> int:
+    """该条在 JSONL 文件中占用的字节数，用作两种后端一致的 size"""
+    return len(encode_line(entry))
+
+
+class SqliteChat:
+    """SQLite 后端的对话句柄，接口与 chat_store.ChatLog 相同（每个方法是一个事务）"""
+
+    def __init__(self, storage: 'SqliteStorage', character: str, name: str) -> None:
+        self.storage = storage
+        self.character = character
+        self.name = name
+        self.key = f'{character}/{name}'
+        self.path = f'{storage.db_path}#{self.key}'
+        self.lock = storage.lock
+
+    def _row(self, conn: sqlite3.Connection):
+        return conn.execute('SELECT id, message_count, size FROM chats WHERE character = ? AND name = ?',
+                            (self.character, self.name)).fetchone()
+
+    def _require_row(self, conn: sqlite3.Connection, index: int):
+        row = self._row(conn)
+        count = row['message_count'] if row else 0
+        if not 0 <= index < count:
+            raise IndexError(f"消息序号超出范围: {index}（共 {count} 条）")
+        return row
+
+    def _message(self, conn: sqlite3.Connection, chat_id: int, position: int) -> Optional[dict]:
+        row = conn.execute('SELECT data FROM messages WHERE chat_id = ? AND position = ?',
+                           (chat_id, position)).fetchone()
+        return json.loads(row['data']) if row else None
+
+    def _update_summary(self, conn: sqlite3.Connection, chat_id: int, count_delta: int, size_delta: int,
+                        preview_changed: bool) -> None:
+        if preview_changed:
+            conn.execute('UPDATE chats SET preview = ? WHERE id = ?',
+                         (_preview(self._message(conn, chat_id, 0)), chat_id))
+        conn.execute('UPDATE chats SET message_count = message_count + ?, size = size + ?, modified = ? WHERE id = ?',
+                     (count_delta, size_delta, time.time(), chat_id))
+
+    # ---- 读取 ----
+
+    def exists(self) -> bool:
+        with self.lock:
+            return self._row(self.storage.conn) is not None
+
+    def read_metadata(self) -> dict:
+        with self.lock:
+            row = self.storage.conn.execute('SELECT metadata FROM chats WHERE character = ? AND name = ?',
+                                            (self.character, self.name)).fetchone()
+        if row is None:
+            raise FileNotFoundError(self.path)
+        return json.loads(row['metadata'])
+
+    def message_count(self) -> int:
+        with self.lock:
+            row = self._row(self.storage.conn)
+        if row is None:
+            raise FileNotFoundError(self.path)
+        return row['message_count']
+
+    def read_range(self, start: int, stop: int) -> List[dict]:
+        with self.lock:
+            rows = self.storage.conn.execute(
+                'SELECT m.data FROM messages m JOIN chats c ON m.chat_id = c.id '
+                'WHERE c.character = ? AND c.name = ? AND m.position >= ? AND m.position < ? ORDER BY m.position',
+                (self.character, self.name, max(start, 0), stop)
+            ).fetchall()
+        return [json.loads(row['data']) for row in rows]
+
+    def read_lines(self) -> List[dict]:
+        with self.lock:
+            return [self.read_metadata(), *self.read_range(0, self.message_count())]
+
+    # ---- 写入 ----
+
+    def _write_all(self, conn: sqlite3.Connection, metadata: dict, entries: List[dict]) -> int:
+        row = self._row(conn)
+        size = _line_size(metadata) + sum(_line_size(entry) for entry in entries)
+        values = ((metadata.get('chat_metadata') or {}).get('title'), metadata.get('create_date'),
+                  _dumps(metadata), len(entries), size, _preview(entries[0] if entries else None), time.time())
+        if row is None:
+            chat_id = conn.execute(
+                'INSERT INTO chats (character, name, title, create_date, metadata, message_count, size, preview, modified) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', (self.character, self.name, *values)
+            ).lastrowid
+        else:
+            chat_id = row['id']
+            conn.execute('UPDATE chats SET title = ?, create_date = ?, metadata = ?, message_count = ?, size = ?, '
+                         'preview = ?, modified = ? WHERE id = ?', (*values, chat_id))
+            conn.execute('DELETE FROM messages WHERE chat_id = ?', (chat_id,))
+        conn.executemany('INSERT INTO messages (chat_id, position, data) VALUES (?, ?, ?)',
+                         ((chat_id, position, _dumps(entry)) for position, entry in enumerate(entries)))
+        return len(entries)
+
+    def write_all(self, metadata: dict, entries) -> int:
+        entries = list(entries)
+        with self.lock, self.storage.conn as conn:
+            return self._write_all(conn, metadata, entries)
+
+    def append(self, entries: List[dict], metadata: Optional[dict] = None,
+               expected_count: Optional[int] = None) -> int:
+        with self.lock, self.storage.conn as conn:
+            row = self._row(conn)
+            if row is None:
+                if expected_count:
+                    raise ChatConflict(0)
+                return self._write_all(conn, metadata or {}, list(entries))
+            count = row['message_count']
+            if expected_count is not None and expected_count != count:
+                raise ChatConflict(count)
+            conn.executemany('INSERT INTO messages (chat_id, position, data) VALUES (?, ?, ?)',
+                             ((row['id'], count + i, _dumps(entry)) for i, entry in enumerate(entries)))
+            self._update_summary(conn, row['id'], len(entries), sum(_line_size(entry) for entry in entries),
+                                 preview_changed=count == 0)
+            return count + len(entries)
+
+    def replace(self, index: int, entry: dict) -> None:
+        with self.lock, self.storage.conn as conn:
+            row = self._require_row(conn, index)
+            old_entry = self._message(conn, row['id'], index)
+            conn.execute('UPDATE messages SET data = ? WHERE chat_id = ? AND position = ?',
+                         (_dumps(entry), row['id'], index))
+            self._update_summary(conn, row['id'], 0, _line_size(entry) - _line_size(old_entry),
+                                 preview_changed=index == 0)
+
+    def remove(self, index: int) -> None:
+        with self.lock, self.storage.conn as conn:
+            row = self._require_row(conn, index)
+            old_entry = self._message(conn, row['id'], index)
+            conn.execute('DELETE FROM messages WHERE chat_id = ? AND position = ?', (row['id'], index))
+            # 分两步移动后面的消息，避免中途与主键冲突
+            conn.execute('UPDATE messages SET position = -position WHERE chat_id = ? AND position > ?',
+                         (row['id'], index))
+            conn.execute('UPDATE messages SET position = -position - 1 WHERE chat_id = ? AND position < 0',
+                         (row['id'],))
+            self._update_summary(conn, row['id'], -1, -_line_size(old_entry), preview_changed=index == 0)
+
+    def compact(self) -> int:
+        """SQLite 后端没有行尾补齐，无需整理"""
+        return self.message_count()
+
+    def delete(self) -> None:
+        with self.lock, self.storage.conn as conn:
+            row = self._row(conn)
+            if row is not None:
+                conn.execute('DELETE FROM messages WHERE chat_id = ?', (row['id'],))
+                conn.execute('DELETE FROM chats WHERE id = ?', (row['id'],))
+
+
+class SqliteStorage(Storage):
+    """所有数据保存在一个 SQLite 数据库中；进程内共用一个连接，读写由同一把锁串行化"""
+
+    backend = 'sqlite'
+
+    def __init__(self, db_path: str) -> None:
+        self.db_path = db_path
+        self.lock = threading.RLock()
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        self.conn = sqlite3.connect(db_path, timeout=30, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute('PRAGMA journal_mode = WAL')
+        self.conn.execute('PRAGMA synchronous = NORMAL')
+        self.conn.execute('PRAGMA foreign_keys = ON')
+        with self.conn:
+            self.conn.executescript(SCHEMA)
+
+    def list(self, collection: str) -> List[Tuple[str, dict]]:
+        with self.lock:
+            rows = self.conn.execute('SELECT id, data FROM documents WHERE collection = ? ORDER BY id',
+                                     (collection,)).fetchall()
+        return [(row['id'], json.loads(row['data'])) for row in rows]
+
+    def get(self, collection: str, doc_id: str) -> Optional[dict]:
+        with self.lock:
+            row = self.conn.execute('SELECT data FROM documents WHERE collection = ? AND id = ?',
+                                    (collection, doc_id)).fetchone()
+        return json.loads(row['data']) if row else None
+
+    def put(self, collection: str, doc_id: str, data: dict) -> None:
+        with self.lock, self.conn:
+            self.conn.execute(
+                'INSERT OR REPLACE INTO documents (collection, id, name, data, updated_at) VALUES (?, ?, ?, ?, ?)',
+                (collection, doc_id, document_name(data), _dumps(data), time.time())
+            )
+
+    def delete(self, collection: str, doc_id: str) -> bool:
+        with self.lock, self.conn:
+            return self.conn.execute('DELETE FROM documents WHERE collection = ? AND id = ?',
+                                     (collection, doc_id)).rowcount > 0
+
+    def get_document(self, name: str) -> Optional[dict]:
+        return self.get(DOCUMENTS_COLLECTION, name)
+
+    def put_document(self, name: str, data: dict) -> None:
+        self.put(DOCUMENTS_COLLECTION, name, data)
+
+    def chat(self, character: str, name: str) -> SqliteChat:
+        return SqliteChat(self, safe_character(character), name)
+
+    def iter_chats(self) -> Iterator[Tuple[str, str]]:
+        with self.lock:
+            rows = self.conn.execute('SELECT character, name FROM chats ORDER BY id').fetchall()
+        return iter([(row['character'], row['name']) for row in rows])
+
+    def list_chats(self, character=None, sort='create_date', descending=True, offset=0, limit=None):
+        if sort not in CHAT_SORT_COLUMNS:
+            raise ValueError(f"sort 只能是 {', '.join(chat_catalog.SORT_KEYS)}")
+        where, params = ('WHERE character = ?', [safe_character(character)]) if character else ('', [])
+        with self.lock:
+            total = self.conn.execute(f'SELECT COUNT(*) FROM chats {where}', params).fetchone()[0]
+            rows = self.conn.execute(
+                'SELECT name, character, create_date, title, message_count, modified, size, preview FROM chats '
+                f'{where} ORDER BY {CHAT_SORT_COLUMNS[sort]} {"DESC" if descending else "ASC"}, id '
+                'LIMIT ? OFFSET ?', (*params, -1 if limit is None else limit, offset)
+            ).fetchall()
+        return [dict(row) for row in rows], total
+
+    def rename_chat(self, character: str, old_name: str, new_name: str) -> None:
+        with self.lock, self.conn:
+            self.conn.execute('UPDATE chats SET name = ?, modified = ? WHERE character = ? AND name = ?',
+                              (new_name, time.time(), safe_character(character), old_name))
+
+    def close(self) -> None:
+        with self.lock:
+            self.conn.close()
+
+
+# ==================== 创建与迁移 ====================
+
+def open_storage(data_dir: str, settings: Optional[dict] = None, backend: Optional[str] = None,
+                 reconcile: bool = True) -> Storage:
+    """按 config.json 的 "storage" 段创建后端；backend 参数优先，reconcile 为 False 时文件后端不在后台核对对话目录"""
+    merged = dict(DEFAULT_SETTINGS)
+    merged.update({k: v for k, v in (settings or {}).items() if k in DEFAULT_SETTINGS})
+    backend = backend or merged['backend']
+    if backend == 'sqlite':
+        return SqliteStorage(os.path.join(data_dir, merged['sqlite_file']))
+    if backend != 'file':
+        print(f"[存储] 未知的存储后端 {backend}，使用文件存储")
+    return FileStorage(data_dir, reconcile)
+
+
+def migrate(source: Storage, target: Storage) -> dict:
+    """把 source 中的全部数据复制到 target（同 id 的数据被覆盖，target 中其余数据保留），返回各类数据的条数"""
+    counts = {}
+    for collection in COLLECTIONS:
+        items = source.list(collection)
+        for doc_id, data in items:
+            target.put(collection, doc_id, data)
+        counts[collection] = len(items)
+    counts['documents'] = 0
+    for name in DOCUMENTS:
+        data = source.get_document(name)
+        if data is not None:
+            target.put_document(name, data)
+            counts['documents'] += 1
+    counts['chats'] = counts['messages'] = 0
+    for character, name in list(source.iter_chats()):
+        chat = source.chat(character, name)
+        metadata = chat.read_metadata()
+        if metadata:
+            entries = chat.read_range(0, chat.message_count())
+        else:
+            # 没有元数据行的旧文件：第一行也是消息，迁移时补上元数据
+            entries = chat.read_lines()
+            metadata = {'user_name': 'User', 'character_name': character, 'create_date': '',
+                        'chat_metadata': {'note': '', 'title': name}}
+        target.chat(character, name).write_all(metadata, entries)
+        counts['chats'] += 1
+        counts['messages'] += len(entries)
+    return counts
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description='数据存储工具')
+    commands = parser.add_subparsers(dest='command', required=True)
+    migrate_parser = commands.add_parser('migrate', help='在文件存储和 SQLite 存储之间迁移全部数据')
+    migrate_parser.add_argument('--to', choices=('sqlite', 'file'), required=True, help='迁移到的后端')
+    migrate_parser.add_argument('--data-dir', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data'))
+    args = parser.parse_args(argv)
+
+    settings = {}
+    config_file = os.path.join(args.data_dir, 'config.json')
+    if os.path.exists(config_file):
+        with open(config_file, 'r', encoding='utf-8') as f:
+            settings = json.load(f).get('storage') or {}
+    # 迁移只逐个读写对话，不需要在后台核对对话目录（服务下次启动时会核对）
+    source = open_storage(args.data_dir, settings, backend='file' if args.to == 'sqlite' else 'sqlite', reconcile=False)
+    target = open_storage(args.data_dir, settings, backend=args.to, reconcile=False)
+    started = time.perf_counter()
+    counts = migrate(source, target)
+    source.close()
+    target.close()
+    print(f"迁移完成（{time.perf_counter() - started:.1f} 秒）: " + ', '.join(f"{k} {v}" for k, v in counts.items()))
+    print(f"在 config.json 中设置 \"storage\": {{\"backend\": \"{args.to}\"}} 并重启服务后生效")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
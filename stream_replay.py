@@ -0,0 +1,128 @@
+"""流式断线重连 - 为进行中和最近完成的生成保留重放缓冲区，按 Last-Event-ID 断点续传"""
+
+from __future__ import annotations
+
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from typing import Optional, Tuple
+
+from singleflight import BroadcastBuffer, BroadcastReader, ReplayGap
+
+# config.json 中 "stream_replay" 段的默认值
+DEFAULT_SETTINGS = {
+    'enabled': False,
+    'max_total_bytes': 32 * 1024 * 1024,  # 所有重放缓冲区的总容量
+    'max_stream_bytes': 2 * 1024 * 1024,  # 单个生成的环形缓冲区容量
+    'retain_seconds': 300,                # 生成结束后保留多久
+    'resume_grace_seconds': 30,           # 客户端全部断开后继续生成、等待重连的时间
+}
+
+
+def parse_last_event_id(value: Optional[str]) -> Optional[Tuple[str, int]]:
+    """解析 "<stream_id>:<序号>" 格式的 Last-Event-ID"""
+    if not value or ':' not in value:
+        return None
+    stream_id, _, seq = value.strip().rpartition(':')
+    try:
+        return stream_id, int(seq)
+    except ValueError:
+        return None
+
+
+class ReplayStore:
+    """按 stream_id 保存广播缓冲区，超过保留时间或总容量时淘汰最早结束的生成"""
+
+    def __init__(self, settings: Optional[dict] = None) -> None:
+        self._lock = threading.Lock()
+        self._buffers: "OrderedDict[str, BroadcastBuffer]" = OrderedDict()
+        self.resumed = 0
+        self.resume_misses = 0
+        self.evicted = 0
+        self.settings = dict(DEFAULT_SETTINGS)
+        self.configure(settings)
+
+    def configure(self, settings: Optional[dict] = None) -> None:
+        merged = dict(DEFAULT_SETTINGS)
+        merged.update({k: v for k, v in (settings or {}).items() if k in DEFAULT_SETTINGS})
+        with self._lock:
+            self.settings = merged
+            self._evict_locked()
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.settings['enabled'])
+
+    def buffer_options(self) -> dict:
+        """新建广播缓冲区时使用的参数（未开启时不限容量、不等待重连）"""
+        if not self.enabled:
+            return {'max_bytes': None, 'grace': 0.0}
+        return {
+            'max_bytes': int(self.settings['max_stream_bytes']),
+            'grace': float(self.settings['resume_grace_seconds']),
+        }
+
+    def register(self, buffer: BroadcastBuffer) -> str:
+        """为缓冲区分配 stream_id 并登记"""
+        stream_id = uuid.uuid4().hex[:16]
+        buffer.stream_id = stream_id
+        with self._lock:
+            self._buffers[stream_id] = buffer
+            self._evict_locked()
+        return stream_id
+
+    def resume(self, last_event_id: Optional[str]) -> Optional[BroadcastReader]:
+        """返回从 Last-Event-ID 之后继续读取的读者；缓冲区已淘汰或位置已被覆盖时返回 None"""
+        parsed = parse_last_event_id(last_event_id)
+        with self._lock:
+            self._evict_locked()
+            buffer = self._buffers.get(parsed[0]) if parsed else None
+            if buffer is None:
+                self.resume_misses += 1
+                return None
+        try:
+            reader = buffer.attach(parsed[1] + 1)
+        except ReplayGap:
+            with self._lock:
+                self.resume_misses += 1
+            return None
+        with self._lock:
+            self.resumed += 1
+        return reader
+
+    def cancel(self, stream_id: str) -> bool:
+        with self._lock:
+            buffer = self._buffers.get(stream_id)
+        if buffer is None:
+            return False
+        buffer.request_cancel()
+        return True
+
+    def _evict_locked(self) -> None:
+        now = time.time()
+        retain = float(self.settings['retain_seconds'])
+        finished = sorted(
+            (buffer.finished_at, stream_id) for stream_id, buffer in self._buffers.items()
+            if buffer.finished_at is not None
+        )
+        total = sum(buffer.size for buffer in self._buffers.values())
+        for finished_at, stream_id in finished:
+            if finished_at + retain > now and total <= int(self.settings['max_total_bytes']):
+                break
+            total -= self._buffers.pop(stream_id).size
+            self.evicted += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            self._evict_locked()
+            live = sum(1 for buffer in self._buffers.values() if buffer.finished_at is None)
+            return {
+                'settings': dict(self.settings),
+                'streams': len(self._buffers),
+                'live': live,
+                'bytes': sum(buffer.size for buffer in self._buffers.values()),
+                'resumed': self.resumed,
+                'resume_misses': self.resume_misses,
+                'evicted': self.evicted,
+            }
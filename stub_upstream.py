@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+本地模拟上游 - OpenAI 兼容的假服务商，用于离线测试多上游路由和故障切换
+
+用法:
+    python stub_upstream.py --port 5101 --name A                     # 正常上游
+    python stub_upstream.py --port 5102 --name B --fail-status 503   # 总是返回 503
+    python stub_upstream.py --port 5103 --name C --fail-rate 0.5 --latency 0.8
+    python stub_upstream.py --port 5104 --name D --fail-rate 0.5 --retry-after 1   # 测试重试
+
+然后在 data/config.json 中配置:
+    "upstreams": [
+        {"name": "A", "api_url": "http://127.0.0.1:5101/v1", "api_key": "test"},
+        {"name": "B", "api_url": "http://127.0.0.1:5102/v1", "api_key": "test"}
+    ]
+
+回复内容以 [--name] 开头，可以看出实际由哪个上游应答；
+访问 /stats 可以查看该上游收到的请求数。
+"""
+
+import argparse
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class StubState:
+    def __init__(self, args):
+        self.args = args
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.failures = 0
+
+    def next_failure(self):
+        """决定本次请求是否模拟失败，返回状态码或 None"""
+        with self.lock:
+            self.requests += 1
+            if self.args.fail_status or random.random() < self.args.fail_rate:
+                self.failures += 1
+                return self.args.fail_status or 503
+        return None
+
+
+def make_handler(state):
+    args = state.args
+
+    class StubHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def _send_json(self, status, data):
+            body = json.dumps(data, ensure_ascii=False).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            if status in (429, 503) and args.retry_after is not None:
+                self.send_header('Retry-After', str(args.retry_after))
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _write_chunk(self, data):
+            self.wfile.write(b'%x\r\n%s\r\n' % (len(data), data))
+            self.wfile.flush()
+
+        def do_GET(self):
+            if self.path.endswith('/stats'):
+                self._send_json(200, {'name': args.name, 'requests': state.requests, 'failures': state.failures})
+                return
+            if self.path.endswith('/models'):
+                status = state.next_failure()
+                if status:
+                    self._send_json(status, {'error': {'message': f'stub {args.name} failure'}})
+                    return
+                self._send_json(200, {'object': 'list', 'data': [{'id': model, 'object': 'model'} for model in args.models]})
+                return
+            self._send_json(404, {'error': {'message': 'not found'}})
+
+        def do_POST(self):
+            length = int(self.headers.get('Content-Length', 0))
+            try:
+                payload = json.loads(self.rfile.read(length) or b'{}')
+            except json.JSONDecodeError:
+                self._send_json(400, {'error': {'message': 'invalid json'}})
+                return
+            if not self.path.endswith('/chat/completions'):
+                self._send_json(404, {'error': {'message': 'not found'}})
+                return
+
+            time.sleep(args.latency)
+            status = state.next_failure()
+            if status:
+                self._send_json(status, {'error': {'message': f'stub {args.name} failure'}})
+                return
+
+            model = payload.get('model', args.models[0])
+            words = [f'[{args.name}]'] + [f'token{i}' for i in range(args.tokens)]
+            if not payload.get('stream'):
+                time.sleep(args.token_delay * args.tokens)
+                self._send_json(200, {
+                    'id': f'chatcmpl-stub-{args.name}',
+                    'object': 'chat.completion',
+                    'model': model,
+                    'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': ' '.join(words)}, 'finish_reason': 'stop'}],
+                })
+                return
+
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/event-stream')
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+            try:
+                for index, word in enumerate(words):
+                    chunk = {
+                        'id': f'chatcmpl-stub-{args.name}',
+                        'object': 'chat.completion.chunk',
+                        'model': model,
+                        'choices': [{'index': 0, 'delta': {'content': word if index == 0 else ' ' + word}, 'finish_reason': None}],
+                    }
+                    self._write_chunk(b'data: ' + json.dumps(chunk).encode('utf-8') + b'\n\n')
+                    time.sleep(args.token_delay)
+                finish = {'id': f'chatcmpl-stub-{args.name}', 'choices': [{'index': 0, 'delta': {}, 'finish_reason': 'stop'}]}
+                self._write_chunk(b'data: ' + json.dumps(finish).encode('utf-8') + b'\n\n')
+                self._write_chunk(b'data: [DONE]\n\n')
+                self._write_chunk(b'')
+            except (BrokenPipeError, ConnectionResetError):
+                print(f"[{args.name}] 客户端已断开")
+
+        def log_message(self, format, *log_args):
+            if args.verbose:
+                super().log_message(format, *log_args)
+
+    return StubHandler
+
+
+def main():
+    parser = argparse.ArgumentParser(description="OpenAI 兼容的本地模拟上游")
+    parser.add_argument('--port', type=int, default=5101, help='监听端口')
+    parser.add_argument('--name', default='stub', help='上游名称，会出现在回复内容开头')
+    parser.add_argument('--models', nargs='+', default=['stub-model'], help='/models 返回的模型列表')
+    parser.add_argument('--tokens', type=int, default=20, help='每次回复的 token 数')
+    parser.add_argument('--token-delay', type=float, default=0.02, help='每个 token 的间隔秒数')
+    parser.add_argument('--latency', type=float, default=0.0, help='返回响应头之前的延迟秒数')
+    parser.add_argument('--fail-status', type=int, default=0, help='总是返回该状态码（如 503、429）')
+    parser.add_argument('--fail-rate', type=float, default=0.0, help='随机失败的概率（返回 503）')
+    parser.add_argument('--retry-after', type=int, default=None, help='失败（429/503）时附带的 Retry-After 秒数')
+    parser.add_argument('--verbose', action='store_true', help='打印每个请求')
+    args = parser.parse_args()
+
+    state = StubState(args)
+    server = ThreadingHTTPServer(('127.0.0.1', args.port), make_handler(state))
+    print(f"模拟上游 {args.name} 已启动: http://127.0.0.1:{args.port}/v1")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("\n已停止")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,185 @@
+"""admission.AdmissionController：全局与单客户端上限、按客户端轮转的公平出队、排队上限和超时"""
+
+import asyncio
+import threading
+import time
+
+import pytest
+
+from admission import AdmissionController, AdmissionRejected
+
+
+def controller(**settings):
+    return AdmissionController(dict({'enabled': True, 'max_concurrent': 2, 'per_client': 2, 'max_queue': 10,
+                                     'max_wait_seconds': 5}, **settings))
+
+
+def queue_in_background(admission, client, granted):
+    """在后台线程中排队，获得许可后记录客户端并持有许可，返回 (线程, 许可列表)"""
+    tickets = []
+
+    def run():
+        ticket = admission.acquire(client)
+        granted.append(client)
+        tickets.append(ticket)
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    return thread, tickets
+
+
+def wait_until(condition, timeout=2.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, '等待超时'
+        time.sleep(0.005)
+
+
+def test_disabled_admits_everything():
+    admission = AdmissionController({'enabled': False, 'max_concurrent': 1})
+    tickets = [admission.acquire('a') for _ in range(5)]
+    assert admission.stats()['active'] == 0
+    for ticket in tickets:
+        ticket.release()
+
+
+def test_release_is_idempotent():
+    admission = controller()
+    with admission.acquire('a') as ticket:
+        assert admission.stats()['active_by_client'] == {'a': 1}
+    ticket.release()
+    assert admission.stats()['active'] == 0
+
+
+def test_per_client_limit_queues_only_that_client():
+    admission = controller(max_concurrent=4, per_client=1)
+    first = admission.acquire('a')
+    granted = []
+    thread, tickets = queue_in_background(admission, 'a', granted)
+    wait_until(lambda: admission.stats()['queued'] == 1)
+    # 其他客户端不受 a 的上限影响
+    admission.acquire('b').release()
+    assert granted == []
+    first.release()
+    thread.join(2)
+    assert granted == ['a']
+    tickets[0].release()
+
+
+def test_queued_clients_are_served_round_robin():
+    admission = controller(max_concurrent=1, per_client=5)
+    holder = admission.acquire('a')
+    granted = []
+    workers = []
+    # a 先排 3 个，b、c 随后各排 1 个
+    for client in ('a', 'a', 'a', 'b', 'c'):
+        workers.append(queue_in_background(admission, client, granted))
+        wait_until(lambda: admission.stats()['queued'] == len(workers))
+    holder.release()
+    for index in range(len(workers)):
+        wait_until(lambda: len(granted) == index + 1)
+        for _thread, tickets in workers:
+            if tickets and not tickets[0].released:
+                tickets[0].release()
+                break
+    assert granted == ['a', 'b', 'c', 'a', 'a']
+
+
+def test_full_queue_rejects_immediately():
+    admission = controller(max_concurrent=1, max_queue=1)
+    holder = admission.acquire('a')
+    granted = []
+    thread, tickets = queue_in_background(admission, 'b', granted)
+    wait_until(lambda: admission.stats()['queued'] == 1)
+    with pytest.raises(AdmissionRejected) as excinfo:
+        admission.acquire('c')
+    assert excinfo.value.retry_after >= 1
+    assert admission.stats()['rejected_queue_full'] == 1
+    holder.release()
+    thread.join(2)
+    tickets[0].release()
+
+
+def test_queue_timeout_rejects_and_removes_waiter():
+    admission = controller(max_concurrent=1, max_wait_seconds=0.05)
+    holder = admission.acquire('a')
+    with pytest.raises(AdmissionRejected):
+        admission.acquire('b')
+    stats = admission.stats()
+    assert stats['timed_out'] == 1
+    assert stats['queued'] == 0
+    assert stats['queued_by_client'] == {}
+    holder.release()
+    admission.acquire('b').release()
+
+
+def test_long_estimated_wait_rejects_without_queueing():
+    admission = controller(max_concurrent=1, max_wait_seconds=0.5)
+    ticket = admission.acquire('a')
+    time.sleep(0.6)
+    ticket.release()  # 平均占用约 0.6 秒，超过 max_wait_seconds
+    holder = admission.acquire('a')
+    with pytest.raises(AdmissionRejected):
+        admission.acquire('b')
+    assert admission.stats()['rejected_deadline'] == 1
+    holder.release()
+
+
+def test_raising_limit_releases_queued_requests():
+    admission = controller(max_concurrent=1)
+    holder = admission.acquire('a')
+    granted = []
+    thread, tickets = queue_in_background(admission, 'b', granted)
+    wait_until(lambda: admission.stats()['queued'] == 1)
+    admission.configure({'enabled': True, 'max_concurrent': 2})
+    thread.join(2)
+    assert granted == ['b']
+    holder.release()
+    tickets[0].release()
+
+
+def test_stats_include_wait_and_depth_buckets():
+    admission = controller(max_concurrent=1, max_wait_seconds=0.05)
+    holder = admission.acquire('a')
+    with pytest.raises(AdmissionRejected):
+        admission.acquire('b')
+    holder.release()
+    stats = admission.stats()
+    assert stats['wait_ms']['count'] == 1
+    assert stats['queue_depth']['buckets']['0'] == 1
+
+
+def test_acquire_async_waits_without_a_thread():
+    admission = controller(max_concurrent=1)
+    holder = admission.acquire('a')
+
+    async def scenario():
+        waiting = asyncio.ensure_future(admission.acquire_async('b'))
+        await asyncio.sleep(0.05)
+        assert not waiting.done()
+        # 在其他线程中释放，异步等待者随之被放行
+        threading.Thread(target=holder.release).start()
+        return await asyncio.wait_for(waiting, 2)
+
+    ticket = asyncio.run(scenario())
+    assert admission.stats()['active_by_client'] == {'b': 1}
+    ticket.release()
+
+
+def test_cancelled_async_waiter_leaves_the_queue():
+    admission = controller(max_concurrent=1)
+    holder = admission.acquire('a')
+
+    async def scenario():
+        waiting = asyncio.ensure_future(admission.acquire_async('b'))
+        await asyncio.sleep(0.05)
+        assert admission.stats()['queued'] == 1
+        waiting.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiting
+
+    asyncio.run(scenario())
+    stats = admission.stats()
+    assert (stats['queued'], stats['abandoned']) == (0, 1)
+    holder.release()
+    assert admission.stats()['active'] == 0
@@ -0,0 +1,169 @@
+"""ai_log.AILogWriter：后台批量追加、按大小轮转和丢弃"""
+
+import json
+
+import pytest
+
+from ai_log import AILogWriter
+
+
+def entry(number, **extra):
+    return dict({'timestamp': f'2024-05-01T10:00:{number % 60:02d}', 'endpoint': 'https://api.example.com/v1',
+                 'request': {'model': 'gpt-test', 'messages': [{'role': 'user', 'content': f'问题 {number}'}]},
+                 'response': {'content': f'回答 {number}'}}, **extra)
+
+
+@pytest.fixture
+def writer(tmp_path):
+    log_writer = AILogWriter(str(tmp_path / 'logs'), {'text_log': False, 'flush_interval': 0.01})
+    yield log_writer
+    log_writer.close()
+
+
+def test_entries_are_appended_and_read_newest_first(writer):
+    ids = [writer.submit(entry(i)) for i in range(5)]
+    writer.flush()
+    entries = list(writer.iter_entries())
+    assert [item['id'] for item in entries] == ids[::-1]
+    assert entries[0]['request']['messages'] == [{'role': 'user', 'content': '问题 4'}]
+    _number, path = writer.segments()[0]
+    with open(path, encoding='utf-8') as f:
+        assert [json.loads(line)['id'] for line in f] == ids
+
+
+def test_segments_rotate_and_expire(tmp_path):
+    writer = AILogWriter(str(tmp_path / 'logs'), {'text_log': False, 'segment_bytes': 600, 'max_segments': 3,
+                                                  'batch_size': 1})
+    ids = []
+    for i in range(12):
+        ids.append(writer.submit(entry(i)))
+        writer.flush()
+    segments = writer.segments()
+    assert len(segments) == 3
+    assert segments[-1][0] > 3
+    kept = [item['id'] for item in writer.iter_entries()]
+    # 删除的是最早的分段，留下的是最新的一段连续日志
+    assert kept == ids[::-1][:len(kept)]
+    assert 0 < len(kept) < 12
+    writer.close()
+
+
+def test_full_queue_drops_new_entries(tmp_path):
+    writer = AILogWriter(str(tmp_path / 'logs'), {'text_log': False, 'max_queue': 0})
+    assert writer.submit(entry(1)) is None
+    assert writer.stats()['dropped'] == 1
+    writer.close()
+
+
+def test_mirror_is_off_by_default(tmp_path):
+    mirrored = []
+    writer = AILogWriter(str(tmp_path / 'logs'), {'flush_interval': 0.01}, mirror=mirrored.append)
+    writer.submit(entry(1))
+    writer.flush()
+    assert mirrored == []
+    writer.close()
+
+
+def test_mirror_receives_expanded_entries(tmp_path):
+    mirrored = []
+    writer = AILogWriter(str(tmp_path / 'logs'), {'flush_interval': 0.01, 'text_log': True, 'dedup_min_bytes': 0},
+                         mirror=mirrored.append)
+    messages = [{'role': 'user', 'content': '很长的问题 ' + 'x' * 300}]
+    writer.submit({'request': {'messages': messages}})
+    writer.flush()
+    writer.submit({'request': {'messages': messages * 2}, 'response': {'content': '回答'}})
+    writer.flush()
+    # 日志中保存的是前缀引用，文本日志收到的是完整的消息
+    assert [item['request']['messages'] for item in mirrored] == [messages, messages * 2]
+    writer.close()
+
+
+def test_restart_continues_last_segment(tmp_path):
+    first = AILogWriter(str(tmp_path / 'logs'), {'text_log': False})
+    first.submit(entry(1))
+    first.close()
+    second = AILogWriter(str(tmp_path / 'logs'), {'text_log': False})
+    second.submit(entry(2))
+    second.close()
+    assert len(second.segments()) == 1
+    assert [item['response']['content'] for item in second.iter_entries()] == ['回答 2', '回答 1']
+
+
+# ---- 索引与查询 ----
+
+def test_index_records_match_entries(writer):
+    long_endpoint = 'https://' + 'a' * 200 + '.example.com/v1/chat/completions'
+    writer.submit(entry(1, endpoint=long_endpoint))
+    entry_id = writer.submit(entry(2, error='timeout'))
+    writer.flush()
+    records = [record for _path, record in writer.iter_records()]
+    assert records[0]['id'] == entry_id
+    assert records[0]['error'] is True
+    assert records[0]['model'] == 'gpt-test'
+    # 过长的端点保留末尾
+    assert records[1]['endpoint'].endswith('/v1/chat/completions')
+    assert records[1]['error'] is False
+    path, _record = next(writer.iter_records())
+    with open(path, 'rb') as f:
+        f.seek(records[0]['offset'])
+        assert json.loads(f.read(records[0]['length']))['id'] == entry_id
+
+
+def test_query_filters_newest_first_and_pages(writer):
+    for i in range(10):
+        writer.submit(entry(i, error='失败' if i % 3 == 0 else None,
+                            endpoint='https://b.example.com' if i % 2 else 'https://a.example.com'))
+    writer.flush()
+    ids = [record['id'] for _path, record in writer.iter_records()]
+
+    results, more = writer.query(limit=3)
+    assert [record['id'] for record in results] == ids[:3]
+    assert more is True
+    results, more = writer.query(offset=8, limit=3)
+    assert [record['id'] for record in results] == ids[8:]
+    assert more is False
+
+    errors, _more = writer.query(errors_only=True)
+    assert len(errors) == 4
+    on_b, _more = writer.query(endpoint='b.example')
+    assert len(on_b) == 5
+    assert writer.query(model='other')[0] == []
+
+
+def test_query_time_range(writer):
+    writer.submit(entry(1))
+    writer.flush()
+    now = next(writer.iter_records())[1]['timestamp']
+    assert len(writer.query(since=now - 60)[0]) == 1
+    assert writer.query(since=now + 60)[0] == []
+    assert writer.query(until=now - 60)[0] == []
+
+
+def test_get_entry_expands_messages(writer):
+    messages = [{'role': 'user', 'content': '很长的问题 ' + 'x' * 300}]
+    writer.submit({'request': {'model': 'm', 'messages': messages}})
+    writer.flush()
+    entry_id = writer.submit({'request': {'model': 'm', 'messages': messages * 2}})
+    writer.flush()
+    assert writer.get_entry(entry_id)['request']['messages'] == messages * 2
+    assert writer.get_entry(entry_id, expand=False)['request']['messages'][0]['count'] == 1
+    assert writer.get_entry('0' * 16) is None
+
+
+def test_missing_or_stale_index_is_rebuilt(tmp_path):
+    log_dir = tmp_path / 'logs'
+    writer = AILogWriter(str(log_dir), {'text_log': False})
+    for i in range(3):
+        writer.submit(entry(i))
+    writer.close()
+    _number, path = writer.segments()[0]
+    # 索引丢失，数据末尾还有写入中断留下的半行
+    (log_dir / 'ai_requests-000001.idx').unlink()
+    with open(path, 'ab') as f:
+        f.write(b'{"id": "trunc')
+
+    restarted = AILogWriter(str(log_dir), {'text_log': False})
+    records = [record for _path, record in restarted.iter_records()]
+    assert [record['model'] for record in records] == ['gpt-test'] * 3
+    assert restarted.get_entry(records[0]['id'])['response'] == {'content': '回答 2'}
+    restarted.close()
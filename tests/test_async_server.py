@@ -0,0 +1,193 @@
+"""async_server：Flask 桥接的线程池与错误响应、流式转发中途出错、排队期间断开时退出准入队列
+
+server.py 导入时会在程序目录下建立数据目录并启动后台任务，这里换成只提供所需接口的替身模块。
+"""
+
+import asyncio
+import importlib
+import json
+import sys
+import threading
+import types
+
+import pytest
+
+import admission
+import tracing
+
+
+class FakeUpstream:
+    """按行输出的上游响应，error 不为 None 时在输出完 lines 后抛出"""
+
+    def __init__(self, lines, error=None):
+        self.content = self._iterate(lines, error)
+
+    async def _iterate(self, lines, error):
+        for line in lines:
+            yield line
+        if error is not None:
+            raise error
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        return False
+
+
+@pytest.fixture
+def fake_server(monkeypatch):
+    logged = []
+    fake = types.ModuleType('server')
+    fake.app = None
+    fake.config = {}
+    fake.replay_store = types.SimpleNamespace(enabled=False)
+    fake.tracer = types.SimpleNamespace(start=lambda *args, **kwargs: tracing.NULL_TRACE)
+    fake.requested_candidates = lambda data: 1
+    fake.build_chat_request = lambda data: {'model': data.get('model', 'test-model'), 'stream': True}
+    fake.upstream_headers = lambda: {}
+    fake.default_completion_endpoint = lambda: 'http://upstream/chat/completions'
+    fake.stream_settings = lambda: {'coalesce': False, 'passthrough': False}
+    fake.admission_controller = admission.AdmissionController({'enabled': True, 'max_concurrent': 1})
+    fake.build_stream_log_response = lambda parts: {'content': ''.join(parts)}
+    fake.log_ai_request = lambda endpoint, request, response=None, error=None: logged.append((response, error))
+    fake.log_cancelled_stream = lambda *args, **kwargs: logged.append(('cancelled', None))
+    fake.logged = logged
+    monkeypatch.setitem(sys.modules, 'server', fake)
+    sys.modules.pop('async_server', None)
+    yield fake
+    sys.modules.pop('async_server', None)
+
+
+@pytest.fixture
+def async_server(fake_server):
+    return importlib.import_module('async_server')
+
+
+def http_scope(path, method='POST'):
+    return {
+        'type': 'http', 'method': method, 'path': path, 'query_string': b'',
+        'headers': [(b'content-type', b'application/json')],
+        'client': ('10.0.0.5', 40000), 'server': ('testserver', 80),
+    }
+
+
+def run_app(app, scope, body=b'', disconnect=None):
+    """驱动 ASGI 应用，返回发送的全部消息；disconnect 是 threading.Event，置位后客户端断开"""
+    messages = []
+
+    async def scenario():
+        delivered = False
+
+        async def receive():
+            nonlocal delivered
+            if not delivered:
+                delivered = True
+                return {'type': 'http.request', 'body': body, 'more_body': False}
+            while disconnect is None or not disconnect.is_set():
+                await asyncio.sleep(0.01)
+            return {'type': 'http.disconnect'}
+
+        async def send(message):
+            messages.append(message)
+
+        await asyncio.wait_for(app(scope, receive, send), 5)
+
+    asyncio.run(scenario())
+    return messages
+
+
+def test_wsgi_without_start_response_returns_500(async_server):
+    app = async_server.AsyncStreamingApp(lambda environ, start_response: [b'orphan body'])
+    messages = run_app(app, http_scope('/api/config', 'GET'))
+    assert messages[0]['type'] == 'http.response.start'
+    assert messages[0]['status'] == 500
+    assert b'orphan body' not in b''.join(message.get('body', b'') for message in messages)
+
+
+def test_chat_requests_use_a_separate_pool(async_server):
+    threads = []
+
+    def wsgi_app(environ, start_response):
+        threads.append(threading.current_thread().name)
+        start_response('200 OK', [('Content-Type', 'application/json')])
+        return [b'{}']
+
+    app = async_server.AsyncStreamingApp(wsgi_app)
+    run_app(app, http_scope('/api/config', 'GET'))
+    # 非流式对话交给 Flask 处理，使用对话专用的线程池
+    run_app(app, http_scope('/api/chat/completions'), json.dumps({'stream': False}).encode())
+    assert threads[0].startswith('flask_')
+    assert threads[1].startswith('flask-chat_')
+
+
+def test_wsgi_error_after_headers_ends_the_body(async_server):
+    def wsgi_app(environ, start_response):
+        start_response('200 OK', [('Content-Type', 'text/event-stream')])
+
+        def body():
+            yield b'data: 1\n\n'
+            raise RuntimeError('生成中断')
+        return body()
+
+    messages = run_app(async_server.AsyncStreamingApp(wsgi_app), http_scope('/api/other', 'GET'))
+    assert messages[0]['status'] == 200
+    assert messages[-1] == {'type': 'http.response.body', 'body': b'', 'more_body': False}
+
+
+@pytest.fixture
+def streaming_app(async_server, monkeypatch):
+    if not async_server.AIOHTTP_AVAILABLE:
+        pytest.skip('需要 aiohttp')
+    app = async_server.AsyncStreamingApp(None)
+
+    def use_upstream(upstream):
+        async def open_upstream(request_data, headers, attempted=None):
+            return upstream, types.SimpleNamespace(url=lambda path: 'http://upstream' + path)
+        monkeypatch.setattr(app, '_open_upstream', open_upstream)
+
+    app.use_upstream = use_upstream
+    return app
+
+
+def stream_body():
+    return json.dumps({'model': 'test-model', 'stream': True, 'messages': []}).encode()
+
+
+def test_upstream_error_mid_stream_sends_error_frame(streaming_app, fake_server):
+    chunk = b'data: {"choices": [{"index": 0, "delta": {"content": "hi"}}]}\n'
+    streaming_app.use_upstream(FakeUpstream([chunk], RuntimeError('上游断开')))
+    messages = run_app(streaming_app, http_scope('/api/chat/completions'), stream_body())
+    assert messages[0]['status'] == 200
+    last = messages[-1]
+    assert last['more_body'] is False
+    frame = json.loads(last['body'].decode('utf-8')[len('data: '):])
+    assert frame['error']['message'] == '上游断开'
+    assert frame['choices'][0]['finish_reason'] == 'error'
+    assert isinstance(fake_server.logged[-1][1], RuntimeError)
+    assert fake_server.admission_controller.stats()['active'] == 0
+
+
+def test_upstream_error_before_first_chunk_returns_500(streaming_app):
+    streaming_app.use_upstream(FakeUpstream([], RuntimeError('连接失败')))
+    messages = run_app(streaming_app, http_scope('/api/chat/completions'), stream_body())
+    assert messages[0]['status'] == 500
+    assert json.loads(messages[1]['body']) == {'error': '连接失败'}
+
+
+def test_disconnect_while_queued_leaves_admission_queue(streaming_app, fake_server):
+    controller = fake_server.admission_controller
+    holder = controller.acquire('someone-else')
+    disconnect = threading.Event()
+    threading.Timer(0.1, disconnect.set).start()
+    messages = run_app(streaming_app, http_scope('/api/chat/completions'), stream_body(), disconnect)
+    assert messages == []
+    stats = controller.stats()
+    assert (stats['queued'], stats['abandoned']) == (0, 1)
+    holder.release()
+    assert controller.stats()['active'] == 0
+
+
+def test_engine_marks_streams_as_not_coalesced(async_server, fake_server):
+    # 事件循环转发的流不经过 stream_flights，/api/singleflight/stats 据此报告 stream_coalescing
+    assert fake_server.ASYNC_STREAMING is async_server.AIOHTTP_AVAILABLE
@@ -0,0 +1,139 @@
+"""blob_store.BlobStore：最长已存储前缀的查找、引用还原、标记-清除，以及写入失败后不引用未保存的对象"""
+
+import json
+import os
+import time
+
+import pytest
+
+from ai_log import AILogWriter
+from blob_store import PREFIX_KEY, RECENT_SECONDS, REF_KEY, BlobStore
+
+
+def history(count, start=0):
+    return [{'role': 'user' if i % 2 == 0 else 'assistant', 'content': f'第 {i} 条消息 ' + 'x' * 200}
+            for i in range(start, start + count)]
+
+
+def store_messages(blobs, messages, min_bytes=0):
+    """模拟日志写入线程：prepare 后保存并记住新对象"""
+    stored, new_objects = blobs.prepare(messages, min_bytes)
+    blobs.write(new_objects)
+    blobs.remember(new_objects)
+    return stored
+
+
+def age_all(root, seconds):
+    past = time.time() - seconds
+    for directory, _dirs, files in os.walk(root):
+        for name in files:
+            os.utime(os.path.join(directory, name), (past, past))
+
+
+@pytest.fixture
+def blobs(tmp_path):
+    return BlobStore(str(tmp_path / 'blobs'))
+
+
+def test_first_request_keeps_messages_inline(blobs):
+    messages = history(3)
+    stored = store_messages(blobs, messages)
+    assert stored == messages
+    assert blobs.stats()['stored'] == 6  # 3 条消息 + 3 个前缀节点
+
+
+def test_growing_history_references_longest_prefix(blobs):
+    store_messages(blobs, history(4))
+    stored = store_messages(blobs, history(6))
+    assert stored[0] == {PREFIX_KEY: stored[0][PREFIX_KEY], 'count': 4}
+    assert stored[1:] == history(2, start=4)
+    assert blobs.expand(stored) == history(6)
+
+
+def test_edited_history_matches_common_prefix(blobs):
+    store_messages(blobs, history(8))
+    edited = history(8)
+    edited[5] = {'role': 'assistant', 'content': '改写过的回复'}
+    stored = store_messages(blobs, edited)
+    assert stored[0]['count'] == 5
+    # 改写之后的消息内容已存储过，写成引用
+    assert stored[2:] == [{REF_KEY: stored[2][REF_KEY]}, {REF_KEY: stored[3][REF_KEY]}]
+    assert blobs.expand(stored) == edited
+
+
+def test_short_messages_stay_inline(blobs):
+    messages = [{'role': 'user', 'content': 'hi'}] * 2 + history(1)
+    stored, _new_objects = blobs.prepare(messages, min_bytes=128)
+    assert stored[1] == {'role': 'user', 'content': 'hi'}
+
+
+def test_prefix_not_referenced_before_write(blobs):
+    blobs.prepare(history(3))
+    stored, _new_objects = blobs.prepare(history(4))
+    assert PREFIX_KEY not in stored[0]
+
+
+def test_restarted_store_finds_prefix_on_disk(blobs):
+    store_messages(blobs, history(3))
+    restarted = BlobStore(blobs.root)
+    stored, new_objects = restarted.prepare(history(4))
+    assert stored[0]['count'] == 3
+    assert len(new_objects) == 2
+
+
+def test_expand_marks_missing_objects(blobs):
+    stored = store_messages(blobs, history(3))
+    stored = store_messages(blobs, history(4))
+    os.remove(blobs.path(stored[0][PREFIX_KEY]))
+    expanded = blobs.expand(stored)
+    assert expanded[0] == {PREFIX_KEY: stored[0][PREFIX_KEY], 'count': 3, 'missing': True}
+
+
+def test_collect_keeps_objects_referenced_by_logs(blobs, tmp_path):
+    kept = store_messages(blobs, history(4))
+    kept = store_messages(blobs, history(5))
+    store_messages(blobs, history(3, start=100))
+    log_path = tmp_path / 'ai_requests-000001.jsonl'
+    log_path.write_text(json.dumps({'request': {'messages': kept}}, ensure_ascii=False) + '\n', encoding='utf-8')
+    age_all(blobs.root, RECENT_SECONDS + 10)
+
+    restarted = BlobStore(blobs.root)
+    removed = restarted.collect([str(log_path)])
+    # 另一段对话的 3 条消息和 3 个前缀节点，以及日志中原样保存的第 5 条消息和它的前缀节点
+    assert removed == 8
+    assert restarted.expand(kept) == history(5)
+
+
+def test_collect_keeps_recent_objects(blobs, tmp_path):
+    store_messages(blobs, history(3))
+    assert blobs.collect([]) == 0
+    age_all(blobs.root, RECENT_SECONDS + 10)
+    # 最近引用过的对象仍视为在使用
+    assert blobs.collect([]) == 0
+    assert BlobStore(blobs.root).collect([]) == 6
+
+
+def test_failed_blob_write_is_not_referenced(tmp_path):
+    writer = AILogWriter(str(tmp_path / 'logs'), {'text_log': False, 'dedup_min_bytes': 0})
+    original_write = writer.blobs.write
+
+    def failing_write(new_objects):
+        raise OSError('磁盘已满')
+
+    writer.blobs.write = failing_write
+    writer.submit({'request': {'messages': history(3)}})
+    writer.flush()
+    assert writer.stats()['write_errors'] == 1
+
+    writer.blobs.write = original_write
+    first_id = writer.submit({'request': {'messages': history(4)}})
+    writer.flush()
+    first = writer.get_entry(first_id, expand=False)
+    assert first['request']['messages'] == history(4)
+
+    second_id = writer.submit({'request': {'messages': history(5)}})
+    writer.flush()
+    second = writer.get_entry(second_id, expand=False)
+    assert second['request']['messages'][0]['count'] == 4
+    assert writer.get_entry(second_id)['request']['messages'] == history(5)
+    writer.close()
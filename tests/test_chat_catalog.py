@@ -0,0 +1,134 @@
+"""chat_catalog.ChatCatalog：日志重放、与磁盘核对、日志整理和列表排序"""
+
+import json
+import os
+
+import pytest
+
+from chat_catalog import CATALOG_FILE, ChatCatalog
+from chat_store import ChatLog
+
+
+def write_chat(chats_dir, character, name, title, create_date, count=2):
+    path = os.path.join(chats_dir, character, f'{name}.jsonl')
+    metadata = {'user_name': 'User', 'character_name': character, 'create_date': create_date,
+                'chat_metadata': {'title': title}}
+    ChatLog(path).write_all(metadata, [{'name': character, 'is_user': False, 'mes': f'{title} 第 {i} 条'}
+                                       for i in range(count)])
+    return path
+
+
+def started(chats_dir):
+    catalog = ChatCatalog(chats_dir)
+    catalog.start()
+    catalog.list()  # 等待后台核对完成
+    return catalog
+
+
+def journal_records(chats_dir):
+    with open(os.path.join(chats_dir, CATALOG_FILE), encoding='utf-8') as f:
+        return [json.loads(line) for line in f]
+
+
+@pytest.fixture
+def chats_dir(tmp_path):
+    directory = str(tmp_path / 'chats')
+    write_chat(directory, 'Alice', 'a1', '第一次', '2024-01-01', count=3)
+    write_chat(directory, 'Alice', 'a2', '第二次', '2024-03-01')
+    write_chat(directory, 'Bob', 'b1', '冒险', '2024-02-01', count=1)
+    return directory
+
+
+def test_initial_scan_builds_entries(chats_dir):
+    catalog = started(chats_dir)
+    chats, total = catalog.list()
+    assert total == 3
+    assert [chat['name'] for chat in chats] == ['a2', 'b1', 'a1']
+    first = next(chat for chat in chats if chat['name'] == 'a1')
+    assert first['character'] == 'Alice'
+    assert first['title'] == '第一次'
+    assert first['message_count'] == 3
+    assert first['preview'] == '第一次 第 0 条'
+
+
+def test_list_filters_sorts_and_pages(chats_dir):
+    catalog = started(chats_dir)
+    chats, total = catalog.list(character='Alice', sort='message_count', descending=False)
+    assert total == 2
+    assert [chat['name'] for chat in chats] == ['a2', 'a1']
+    page, total = catalog.list(sort='title', descending=False, offset=1, limit=1)
+    assert total == 3
+    assert len(page) == 1
+    with pytest.raises(ValueError):
+        catalog.list(sort='mes')
+
+
+def test_restart_replays_journal_without_reading_chats(chats_dir):
+    started(chats_dir)
+    catalog = started(chats_dir)
+    # 文件没有变化，重放日志后核对时不应重新读取任何对话
+    assert catalog.stats()['reconciled'] == 0
+    assert catalog.list()[1] == 3
+
+
+def test_restart_picks_up_external_changes(chats_dir):
+    started(chats_dir)
+    write_chat(chats_dir, 'Bob', 'b1', '冒险（续）', '2024-02-01', count=4)
+    os.remove(os.path.join(chats_dir, 'Alice', 'a2.jsonl'))
+    write_chat(chats_dir, 'Carol', 'c1', '新对话', '2024-04-01')
+    catalog = started(chats_dir)
+    chats = {chat['name']: chat for chat in catalog.list()[0]}
+    assert sorted(chats) == ['a1', 'b1', 'c1']
+    assert chats['b1']['title'] == '冒险（续）'
+    assert chats['b1']['message_count'] == 4
+    assert catalog.stats()['reconciled'] == 3
+
+
+def test_refresh_remove_and_rename_are_journaled(chats_dir):
+    catalog = started(chats_dir)
+    path = os.path.join(chats_dir, 'Alice', 'a1.jsonl')
+    ChatLog(path).append([{'name': 'User', 'is_user': True, 'mes': '追加'}])
+    catalog.refresh(path)
+    new_path = os.path.join(chats_dir, 'Alice', 'renamed.jsonl')
+    ChatLog(path).rename(new_path)
+    catalog.rename(path, new_path)
+    catalog.remove(os.path.join(chats_dir, 'Bob', 'b1.jsonl'))
+
+    records = journal_records(chats_dir)
+    assert records[-1] == {'op': 'del', 'key': 'Bob/b1'}
+    assert {'op': 'del', 'key': 'Alice/a1'} in records
+
+    replayed = ChatCatalog(chats_dir)
+    replayed._load_journal()
+    chats = {chat['name']: chat for chat in replayed._entries.values()}
+    assert sorted(chats) == ['a2', 'renamed']
+    assert chats['renamed']['message_count'] == 4
+
+
+def test_journal_ignores_torn_last_line(chats_dir):
+    started(chats_dir)
+    with open(os.path.join(chats_dir, CATALOG_FILE), 'a', encoding='utf-8') as f:
+        f.write('{"op": "put", "key": "Alice/x", "ent')
+    catalog = started(chats_dir)
+    assert catalog.list()[1] == 3
+
+
+def test_journal_compacts_to_snapshot(chats_dir):
+    catalog = started(chats_dir)
+    path = os.path.join(chats_dir, 'Alice', 'a1.jsonl')
+    for _ in range(120):
+        catalog.refresh(path)
+    # 过时的记录超过 2 × 条目数 + 100 后整理为每个对话一行
+    records = journal_records(chats_dir)
+    assert len(records) < 2 * 3 + 100
+    assert catalog.stats()['journal_lines'] == len(records)
+    assert started(chats_dir).list()[1] == 3
+
+
+def test_start_without_reconcile_only_replays_journal(chats_dir):
+    started(chats_dir)
+    write_chat(chats_dir, 'Carol', 'c1', '新对话', '2024-04-01')
+    catalog = ChatCatalog(chats_dir)
+    catalog.start(reconcile=False)
+    assert catalog.list()[1] == 3
+    assert catalog.stats()['reconciled'] == 0
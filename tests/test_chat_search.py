@@ -0,0 +1,189 @@
+"""chat_search：分词、BM25 排序、短语与单字查询、过滤、增量更新和候选上限"""
+
+import pytest
+
+import chat_search
+import storage
+from chat_search import ChatSearchIndex, check_date, parse_query, tokenize
+
+
+def message(text, is_user=False, send_date='2024-05-01T10:00:00'):
+    return {'name': 'User' if is_user else 'Alice', 'is_user': is_user, 'mes': text, 'send_date': send_date}
+
+
+def metadata(title, character='Alice'):
+    return {'user_name': 'User', 'character_name': character, 'create_date': '2024-05-01',
+            'chat_metadata': {'title': title}}
+
+
+@pytest.fixture
+def store(tmp_path):
+    backend = storage.open_storage(str(tmp_path), backend='sqlite')
+    yield backend
+    backend.close()
+
+
+def build(store):
+    index = ChatSearchIndex(store)
+    index.start()
+    return index
+
+
+def texts(results):
+    return [result['snippet'] for result in results]
+
+
+def test_tokenize_and_parse_query():
+    assert tokenize('今天天气 Hello World_2') == ['今天', '天天', '天气', 'hello', 'world_2']
+    assert tokenize('好 ok') == ['好', 'ok']
+    assert parse_query('dragon "Hello   World" dragon') == ['dragon', 'hello world']
+
+
+@pytest.mark.parametrize('value', ['2024', '2024-05', '2024-05-01', '2024-05-01T12:30', '2024-05-01 12:30:15'])
+def test_check_date_accepts_iso_prefixes(value):
+    assert check_date(value, 'date_from') == value
+
+
+@pytest.mark.parametrize('value', ['2024-13', '2024-02-30', 'abc', '24-05', '2024/05/01', '2024-05-01T25:00'])
+def test_check_date_rejects_invalid(value):
+    with pytest.raises(ValueError):
+        check_date(value, 'date_from')
+
+
+def test_bm25_prefers_frequent_term_in_short_message(store):
+    store.chat('Alice', 'c1').write_all(metadata('一'), [
+        message('dragon'),
+        message('dragon ' + ' '.join(f'filler{i}' for i in range(30))),
+        message('dragon dragon dragon castle'),
+        message('nothing here'),
+    ])
+    results, total, truncated = build(store).search('dragon')
+    assert total == 3
+    assert truncated is False
+    assert [result['index'] for result in results] == [2, 0, 1]
+    assert results[0]['score'] > results[1]['score'] > results[2]['score']
+
+
+def test_rare_term_weighs_more_than_common_term(store):
+    store.chat('Alice', 'c1').write_all(metadata('一'), [
+        message('sword sword magic'),
+        message('sword magic magic'),
+    ] + [message(f'sword filler{i}') for i in range(10)])
+    results, _total, _truncated = build(store).search('sword magic')
+    # magic 只出现在两条消息中，出现两次 magic 的排在前面
+    assert [result['index'] for result in results] == [1, 0]
+
+
+def test_cjk_phrase_and_highlights(store):
+    store.chat('Alice', 'c1').write_all(metadata('一'), [
+        message('樱花飘落的季节到了'),
+        message('飘落的樱花'),
+        message('季节更替'),
+    ])
+    index = build(store)
+    results, total, _truncated = index.search('樱花飘落')
+    assert total == 1
+    assert results[0]['snippet'] == '樱花飘落的季节到了'
+    assert results[0]['highlights'] == [[0, 4]]
+    assert index.search('"飘落的樱花"')[1] == 1
+    # 两个词都必须出现
+    assert index.search('樱花 季节')[1] == 1
+
+
+def test_single_character_queries(store):
+    store.chat('Alice', 'c1').write_all(metadata('一'), [
+        message('好'),
+        message('你好吗'),
+        message('好的 ok'),
+        message('不行'),
+    ])
+    index = build(store)
+    assert sorted(result['index'] for result in index.search('好')[0]) == [0, 1, 2]
+    # 单字与其他词组合时在其他词的候选中核对
+    assert [result['index'] for result in index.search('好 ok')[0]] == [2]
+    assert index.search('喵')[1] == 0
+
+
+def test_character_and_date_filters(store):
+    store.chat('Alice', 'c1').write_all(metadata('一'), [
+        message('dragon', send_date='2024-04-30T23:00:00'),
+        message('dragon', send_date='2024-05-15T10:00:00'),
+    ])
+    store.chat('Bob', 'c2').write_all(metadata('二', 'Bob'), [message('dragon', send_date='2024-05-20T10:00:00')])
+    index = build(store)
+    assert index.search('dragon')[1] == 3
+    results, total, _truncated = index.search('dragon', character='Bob')
+    assert total == 1
+    assert (results[0]['character'], results[0]['chat_name'], results[0]['title']) == ('Bob', 'c2', '二')
+    assert index.search('dragon', date_from='2024-05')[1] == 2
+    assert index.search('dragon', date_to='2024-05-15')[1] == 2
+    assert index.search('dragon', date_from='2024-05-16', date_to='2024-05')[1] == 1
+    with pytest.raises(ValueError):
+        index.search('dragon', date_from='2024-13')
+    with pytest.raises(ValueError):
+        index.search('   ')
+
+
+def test_paging(store):
+    store.chat('Alice', 'c1').write_all(metadata('一'), [message(f'magic {i}') for i in range(7)])
+    index = build(store)
+    first, total, _truncated = index.search('magic', limit=3)
+    second, _total, _truncated = index.search('magic', offset=3, limit=3)
+    assert total == 7
+    assert len(first) == len(second) == 3
+    assert not {result['index'] for result in first} & {result['index'] for result in second}
+
+
+def test_incremental_updates(store):
+    chat = store.chat('Alice', 'c1')
+    chat.write_all(metadata('一'), [message('dragon'), message('castle')])
+    index = build(store)
+    assert index.search('dragon')[1] == 1
+
+    chat.append([message('dragon again')])
+    index.append(chat, 2, [message('dragon again')])
+    assert sorted(result['index'] for result in index.search('dragon')[0]) == [0, 2]
+
+    chat.replace(0, message('sword'))
+    index.replace_message(chat, 0, message('sword'))
+    chat.remove(1)
+    index.remove_message(chat, 1)
+    results, total, _truncated = index.search('dragon')
+    assert total == 1
+    assert results[0]['index'] == 1  # 删除第 1 条后原来的第 2 条前移
+
+    store.rename_chat('Alice', 'c1', 'renamed')
+    index.rename('Alice/c1', 'Alice/renamed')
+    assert index.search('sword')[0][0]['chat_name'] == 'renamed'
+    index.remove(store.chat('Alice', 'renamed'))
+    assert index.search('sword')[1] == 0
+    assert index.stats()['items'] == 0
+
+
+def test_append_with_wrong_start_rereads_chat(store):
+    chat = store.chat('Alice', 'c1')
+    chat.write_all(metadata('一'), [message('dragon')])
+    index = build(store)
+    chat.append([message('dragon two'), message('dragon three')])
+    index.append(chat, 5, [message('dragon three')])
+    assert index.search('dragon')[1] == 3
+
+
+def test_candidates_are_capped_newest_first(store, monkeypatch):
+    monkeypatch.setattr(chat_search, 'MAX_CANDIDATES', 5)
+    store.chat('Alice', 'c1').write_all(metadata('一'), [message(f'dragon {i}') for i in range(12)])
+    index = build(store)
+    results, total, truncated = index.search('dragon', limit=20)
+    assert truncated is True
+    assert total == 5
+    assert sorted(result['index'] for result in results) == [7, 8, 9, 10, 11]
+    # 过滤掉的候选不占用上限
+    assert index.search('dragon', character='Bob') == ([], 0, False)
+
+
+def test_single_character_candidates_are_capped(store, monkeypatch):
+    monkeypatch.setattr(chat_search, 'MAX_CANDIDATES', 3)
+    store.chat('Alice', 'c1').write_all(metadata('一'), [message(f'好{i}') for i in range(6)])
+    _results, total, truncated = build(store).search('好')
+    assert total == 3
+    assert truncated is True
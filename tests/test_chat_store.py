@@ -0,0 +1,188 @@
+"""chat_store.ChatLog：偏移索引、原地覆盖、尾部重写、外部修改后重建索引和追加冲突，以及分页范围换算"""
+
+import json
+import os
+import time
+
+import pytest
+
+from chat_store import INDEX_HEADER, ChatConflict, ChatLog, window
+
+METADATA = {'user_name': 'User', 'character_name': 'Alice', 'create_date': '2024-05-01'}
+
+
+def message(text, is_user=False):
+    return {'name': 'User' if is_user else 'Alice', 'is_user': is_user, 'mes': text}
+
+
+def scanned_offsets(path):
+    """直接按行计算每行的起始偏移，用于核对索引"""
+    offsets, position = [], 0
+    with open(path, 'rb') as f:
+        for line in f:
+            offsets.append(position)
+            position += len(line)
+    return offsets
+
+
+def file_lines(path):
+    with open(path, 'rb') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+@pytest.fixture
+def chat(tmp_path):
+    chat_log = ChatLog(str(tmp_path / 'Alice' / 'chat.jsonl'))
+    chat_log.write_all(METADATA, [message(f'消息 {i}', i % 2 == 0) for i in range(5)])
+    return chat_log
+
+
+def test_write_all_and_read_range(chat):
+    assert chat.message_count() == 5
+    assert chat.read_metadata() == METADATA
+    assert [entry['mes'] for entry in chat.read_range(1, 3)] == ['消息 1', '消息 2']
+    assert [entry['mes'] for entry in chat.read_range(3, 100)] == ['消息 3', '消息 4']
+    assert chat.read_range(5, 10) == []
+    offsets, padding = chat.load_index()
+    assert list(offsets) == scanned_offsets(chat.path)
+    assert padding == 0
+
+
+def test_append_writes_only_new_lines(chat):
+    assert chat.append([message('新的'), message('再一条')], expected_count=5) == 7
+    offsets, _padding = chat.load_index()
+    assert list(offsets) == scanned_offsets(chat.path)
+    assert [entry['mes'] for entry in chat.read_range(5, 7)] == ['新的', '再一条']
+
+
+def test_append_with_wrong_expected_count_conflicts(chat):
+    with pytest.raises(ChatConflict) as excinfo:
+        chat.append([message('过期的')], expected_count=3)
+    assert excinfo.value.count == 5
+    assert chat.message_count() == 5
+
+
+def test_append_to_missing_file_with_expected_count_conflicts(tmp_path):
+    chat_log = ChatLog(str(tmp_path / 'Alice' / 'new.jsonl'))
+    with pytest.raises(ChatConflict):
+        chat_log.append([message('x')], metadata=METADATA, expected_count=2)
+    assert chat_log.append([message('x')], metadata=METADATA, expected_count=0) == 1
+    assert chat_log.read_metadata() == METADATA
+
+
+def test_shorter_replace_pads_in_place(chat):
+    size = os.path.getsize(chat.path)
+    offsets_before, _padding = chat.load_index()
+    chat.replace(2, message('短'))
+    assert os.path.getsize(chat.path) == size
+    offsets, padding = chat.load_index()
+    assert list(offsets) == list(offsets_before)
+    assert padding == len(json.dumps(message('消息 2', True), ensure_ascii=False).encode()) \
+        - len(json.dumps(message('短'), ensure_ascii=False).encode())
+    assert chat.read_range(2, 3) == [message('短')]
+    # 补齐的空格不影响解析，也不影响其他消息
+    assert [entry['mes'] for entry in file_lines(chat.path)[1:]] == ['消息 0', '消息 1', '短', '消息 3', '消息 4']
+
+
+def test_replace_again_reuses_padding(chat):
+    chat.replace(2, message('短'))
+    chat.replace(2, message('消息 2', True))
+    _offsets, padding = chat.load_index()
+    assert padding == 0
+    assert chat.read_range(2, 3) == [message('消息 2', True)]
+
+
+def test_longer_replace_rewrites_tail_and_shifts_offsets(chat):
+    chat.replace(1, message('长' * 50))
+    offsets, _padding = chat.load_index()
+    assert list(offsets) == scanned_offsets(chat.path)
+    assert [entry['mes'] for entry in chat.read_range(0, 5)] == ['消息 0', '长' * 50, '消息 2', '消息 3', '消息 4']
+
+
+def test_remove_middle_and_last(chat):
+    chat.remove(1)
+    chat.remove(3)
+    offsets, _padding = chat.load_index()
+    assert list(offsets) == scanned_offsets(chat.path)
+    assert [entry['mes'] for entry in chat.read_range(0, 10)] == ['消息 0', '消息 2', '消息 3']
+    with pytest.raises(IndexError):
+        chat.remove(3)
+
+
+def test_remove_padded_line_drops_its_padding(chat):
+    chat.replace(2, message('短'))
+    chat.remove(2)
+    _offsets, padding = chat.load_index()
+    assert padding == 0
+
+
+def test_index_rebuilt_after_external_edit(chat):
+    chat.load_index()
+    # 外部程序重写文件：大小和修改时间都与索引头部不一致
+    time.sleep(0.01)
+    with open(chat.path, 'ab') as f:
+        f.write(json.dumps(message('外部追加'), ensure_ascii=False).encode() + b'\n')
+    assert chat.message_count() == 6
+    assert chat.read_range(5, 6) == [message('外部追加')]
+    with open(chat.index_path, 'rb') as f:
+        _magic, size, mtime_ns, _padding = INDEX_HEADER.unpack(f.read(INDEX_HEADER.size))
+    stat = os.stat(chat.path)
+    assert (size, mtime_ns) == (stat.st_size, stat.st_mtime_ns)
+
+
+def test_index_rebuilt_when_missing_or_corrupt(chat):
+    os.remove(chat.index_path)
+    assert chat.message_count() == 5
+    with open(chat.index_path, 'wb') as f:
+        f.write(b'garbage')
+    assert chat.message_count() == 5
+    assert list(chat.load_index()[0]) == scanned_offsets(chat.path)
+
+
+def test_append_after_file_without_trailing_newline(chat):
+    with open(chat.path, 'rb+') as f:
+        f.seek(-1, os.SEEK_END)
+        f.truncate()
+    assert chat.append([message('补上换行')]) == 6
+    assert [entry['mes'] for entry in file_lines(chat.path)[-2:]] == ['消息 4', '补上换行']
+
+
+def test_compact_removes_padding(tmp_path):
+    chat_log = ChatLog(str(tmp_path / 'Alice' / 'big.jsonl'))
+    chat_log.write_all(METADATA, [message('x' * 2000) for _ in range(4)])
+    chat_log.replace(0, message('y'))
+    assert chat_log.load_index()[1] > 0
+    chat_log.replace(1, message('y'))
+    chat_log.replace(2, message('y'))
+    # 补齐超过 4096 字节且超过文件的 1/4 后自动整理
+    offsets, padding = chat_log.load_index()
+    assert padding == 0
+    assert os.path.getsize(chat_log.path) < 2 * 2000
+    assert list(offsets) == scanned_offsets(chat_log.path)
+    assert [entry['mes'] for entry in chat_log.read_range(0, 4)] == ['y', 'y', 'y', 'x' * 2000]
+
+
+def test_rename_and_delete_move_index(chat, tmp_path):
+    new_path = str(tmp_path / 'Alice' / 'renamed.jsonl')
+    chat.rename(new_path)
+    assert os.path.exists(new_path + '.idx')
+    assert not os.path.exists(chat.index_path)
+    renamed = ChatLog(new_path)
+    assert renamed.message_count() == 5
+    renamed.delete()
+    assert not os.path.exists(new_path) and not os.path.exists(new_path + '.idx')
+
+
+@pytest.mark.parametrize('params, expected', [
+    ({}, (0, 10)),
+    ({'tail': 3}, (7, 10)),
+    ({'tail': 50}, (0, 10)),
+    ({'tail': 0}, (10, 10)),
+    ({'offset': 2, 'limit': 3}, (2, 5)),
+    ({'offset': 8, 'limit': 5}, (8, 10)),
+    ({'offset': 20, 'limit': 5}, (10, 10)),
+    ({'offset': -4, 'limit': -1}, (0, 0)),
+    ({'offset': 4, 'tail': 2}, (8, 10)),  # tail 优先
+])
+def test_window_bounds(params, expected):
+    assert window(10, **params) == expected
@@ -0,0 +1,62 @@
+"""metrics：Prometheus 文本格式输出和直方图分桶"""
+
+import pytest
+
+import metrics
+
+
+def test_counter_and_histogram_render():
+    registry = metrics.Registry()
+    requests = registry.register(metrics.Counter('demo_requests_total', '请求数', ('route',)))
+    latency = registry.register(metrics.Histogram('demo_seconds', '耗时', buckets=(0.1, 1)))
+    requests.labels('/a"b').inc()
+    requests.labels('/a"b').inc(2)
+    latency.labels().observe(0.05)
+    latency.labels().observe(5)
+    lines = registry.render().splitlines()
+    assert 'demo_requests_total{route="/a\\"b"} 3' in lines
+    assert 'demo_seconds_bucket{le="0.1"} 1' in lines
+    assert 'demo_seconds_bucket{le="1"} 1' in lines
+    assert 'demo_seconds_bucket{le="+Inf"} 2' in lines
+    assert 'demo_seconds_count 2' in lines
+
+
+def test_bucket_counts_are_cumulative():
+    counts = metrics.BucketCounts((1, 5))
+    for value in (0.5, 3, 3, 9):
+        counts.observe(value)
+    assert counts.snapshot() == {'buckets': {'1': 1, '5': 3, '+Inf': 4}, 'sum': 15.5, 'count': 4}
+
+
+def test_metric_without_child_type_cannot_be_created():
+    class Broken(metrics._Metric):
+        kind = 'gauge'
+
+    with pytest.raises(TypeError):
+        Broken('broken', '')
+
+
+def test_collector_errors_are_reported_inline():
+    def broken_collector():
+        raise RuntimeError('boom')
+
+    registry = metrics.Registry()
+    registry.register_collector(broken_collector)
+    assert registry.render() == '# collector error: boom\n'
+
+
+def test_track_stream_closes_inner_generator():
+    closed = []
+
+    def source():
+        try:
+            yield 'a'
+            yield 'b'
+        finally:
+            closed.append(1)
+
+    wrapped = metrics.track_stream(source(), 'test-model', 0.0)
+    assert next(wrapped) == 'a'
+    wrapped.close()
+    assert closed == [1]
+    assert metrics.active_streams.labels('test-model').value == 0
@@ -0,0 +1,110 @@
+"""model_catalog.ModelCatalog：有效期内命中、过期后先返回旧列表并在后台刷新、失败时回退、并发请求合并"""
+
+import threading
+import time
+
+import pytest
+
+from model_catalog import ModelCatalog
+
+
+class Upstream:
+    """记录调用次数的 fetch，可切换返回的模型列表或让它失败"""
+
+    def __init__(self, models=('m1',)):
+        self.models = list(models)
+        self.calls = 0
+        self.error = None
+        self.delay = 0.0
+
+    def __call__(self):
+        self.calls += 1
+        if self.delay:
+            time.sleep(self.delay)
+        if self.error is not None:
+            raise self.error
+        return list(self.models), 'http://upstream'
+
+
+def age(catalog, key, seconds):
+    """把缓存条目的获取时间往前拨"""
+    catalog._entries[key].fetched_at -= seconds
+
+
+def wait_until(condition, timeout=2):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def test_fresh_entry_is_served_from_cache():
+    catalog = ModelCatalog({'ttl_seconds': 60})
+    upstream = Upstream()
+    assert catalog.get('k', upstream) == (['m1'], 'MISS')
+    assert catalog.get('k', upstream) == (['m1'], 'HIT')
+    assert upstream.calls == 1
+
+
+def test_stale_entry_is_returned_while_refreshing():
+    catalog = ModelCatalog({'ttl_seconds': 60, 'stale_seconds': 600})
+    upstream = Upstream()
+    catalog.get('k', upstream)
+    age(catalog, 'k', 120)
+    upstream.models = ['m1', 'm2']
+    upstream.delay = 0.1
+    started = time.monotonic()
+    assert catalog.get('k', upstream) == (['m1'], 'STALE')
+    assert time.monotonic() - started < 0.1  # 不等待服务商
+    # 刷新进行中再次请求不会重复刷新
+    assert catalog.get('k', upstream) == (['m1'], 'STALE')
+    wait_until(lambda: not catalog._refreshing)
+    assert catalog.get('k', upstream) == (['m1', 'm2'], 'HIT')
+    assert upstream.calls == 2
+    assert catalog.stats()['stale_hits'] == 2
+
+
+def test_failed_background_refresh_keeps_old_list():
+    catalog = ModelCatalog({'ttl_seconds': 60, 'stale_seconds': 600})
+    upstream = Upstream()
+    catalog.get('k', upstream)
+    age(catalog, 'k', 120)
+    upstream.error = RuntimeError('服务商不可用')
+    assert catalog.get('k', upstream) == (['m1'], 'STALE')
+    wait_until(lambda: catalog.stats()['refresh_failures'] == 1)
+    assert catalog.stats()['entries'][0]['last_error'] == '服务商不可用'
+    wait_until(lambda: not catalog._refreshing)
+    assert catalog.get('k', upstream) == (['m1'], 'STALE')
+
+
+def test_expired_beyond_stale_window_fetches_and_falls_back():
+    catalog = ModelCatalog({'ttl_seconds': 60, 'stale_seconds': 60})
+    upstream = Upstream()
+    catalog.get('k', upstream)
+    age(catalog, 'k', 200)
+    upstream.error = RuntimeError('超时')
+    assert catalog.get('k', upstream) == (['m1'], 'FALLBACK')
+    with pytest.raises(RuntimeError):
+        catalog.get('other', upstream)
+
+
+def test_refresh_bypasses_ttl():
+    catalog = ModelCatalog()
+    upstream = Upstream()
+    catalog.get('k', upstream)
+    upstream.models = ['m3']
+    assert catalog.get('k', upstream, refresh=True) == (['m3'], 'MISS')
+
+
+def test_concurrent_misses_share_one_fetch():
+    catalog = ModelCatalog()
+    upstream = Upstream()
+    upstream.delay = 0.1
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(catalog.get('k', upstream))) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(2)
+    assert upstream.calls == 1
+    assert results == [(['m1'], 'MISS')] * 4
@@ -0,0 +1,21 @@
+"""profiler.Profiler：管理员校验"""
+
+from profiler import Profiler
+
+
+def test_admin_token_is_required_when_set():
+    profiler = Profiler({'admin_token': '令牌-1'})
+    assert profiler.is_admin('令牌-1', '8.8.8.8')
+    assert not profiler.is_admin('令牌-2', '127.0.0.1')
+    assert not profiler.is_admin(None, '127.0.0.1')
+
+
+def test_without_token_only_local_requests_are_admin():
+    profiler = Profiler()
+    assert profiler.is_admin(None, '127.0.0.1')
+    assert not profiler.is_admin(None, '192.168.1.20')
+
+
+def test_authorized_requires_enabled_profiler():
+    assert not Profiler({'admin_token': 't'}).authorized('t', None)
+    assert Profiler({'admin_token': 't', 'enabled': True}).authorized('t', None)
@@ -0,0 +1,123 @@
+"""response_cache：键规范化、内存层 LRU 与 TTL、磁盘层回填、容量上限、过期文件清理和统计"""
+
+import os
+import time
+
+import response_cache
+from response_cache import ResponseCache
+
+
+def memory_cache(tmp_path, **settings):
+    return ResponseCache(str(tmp_path / 'cache'), {'enabled': True, **settings})
+
+
+def disk_cache(tmp_path, **settings):
+    return ResponseCache(str(tmp_path / 'cache'), {'enabled': True, 'disk': True, **settings})
+
+
+def cache_files(tmp_path):
+    return sorted(name for _root, _dirs, files in os.walk(tmp_path / 'cache') for name in files)
+
+
+def test_cache_key_ignores_key_order_and_separates_upstreams():
+    first = response_cache.cache_key('http://a', {'model': 'm', 'messages': [{'role': 'user', 'content': '你好'}]})
+    reordered = response_cache.cache_key('http://a', {'messages': [{'content': '你好', 'role': 'user'}], 'model': 'm'})
+    assert first == reordered
+    assert response_cache.cache_key('http://b', {'model': 'm', 'messages': [{'role': 'user', 'content': '你好'}]}) != first
+    assert response_cache.cache_key('http://a', {'model': 'm', 'messages': [], 'n': 2}) != \
+        response_cache.cache_key('http://a', {'model': 'm', 'messages': []})
+
+
+def test_should_cache_rules(tmp_path):
+    cache = memory_cache(tmp_path, model_ttls={'nocache': 0})
+    assert cache.should_cache({'model': 'm', 'temperature': 0})
+    assert not cache.should_cache({'model': 'm', 'temperature': 0.7})
+    assert cache.should_cache({'model': 'm', 'temperature': 0.7}, force=True)
+    assert not cache.should_cache({'model': 'm', 'temperature': 0, 'stream': True})
+    assert not cache.should_cache({'model': 'nocache', 'temperature': 0})
+    assert not ResponseCache(str(tmp_path)).should_cache({'model': 'm', 'temperature': 0})
+
+
+def test_memory_lru_evicts_least_recently_used(tmp_path):
+    cache = memory_cache(tmp_path, max_memory_bytes=10)
+    cache.put('a', 'm', b'aaaa')
+    cache.put('b', 'm', b'bbbb')
+    assert cache.get('a') == b'aaaa'  # a 变为最近使用
+    cache.put('c', 'm', b'cccc')
+    assert cache.get('b') is None
+    assert cache.get('a') == b'aaaa'
+    stats = cache.stats()
+    assert (stats['entries'], stats['memory_bytes'], stats['evictions']) == (2, 8, 1)
+    cache.put('huge', 'm', b'x' * 11)  # 超过内存层容量的响应不进入内存层
+    assert cache.get('huge') is None
+
+
+def test_entries_expire_after_model_ttl(tmp_path):
+    cache = memory_cache(tmp_path, model_ttls={'short': 0.05})
+    cache.put('k', 'short', b'body')
+    cache.put('other', 'm', b'body')
+    assert cache.get('k') == b'body'
+    time.sleep(0.1)
+    assert cache.get('k') is None
+    assert cache.get('other') == b'body'
+    stats = cache.stats()
+    assert (stats['hits'], stats['misses'], stats['hit_ratio']) == (2, 1, round(2 / 3, 4))
+
+
+def test_disk_hit_refills_memory(tmp_path):
+    disk_cache(tmp_path).put('a' * 64, 'm', b'body')
+    # 新的缓存实例（相当于重启）内存层为空，从磁盘读取后回填
+    cache = disk_cache(tmp_path)
+    assert cache.get('a' * 64) == b'body'
+    assert cache.get('a' * 64) == b'body'
+    stats = cache.stats()
+    assert (stats['disk_hits'], stats['hits'], stats['entries']) == (1, 1, 1)
+
+
+def test_expired_disk_entries_are_not_served(tmp_path):
+    cache = disk_cache(tmp_path, model_ttls={'short': 0.05})
+    cache.put('a' * 64, 'short', b'body')
+    time.sleep(0.1)
+    assert disk_cache(tmp_path).get('a' * 64) is None
+    assert cache_files(tmp_path) == []
+
+
+def test_disk_cap_removes_oldest_files(tmp_path):
+    cache = disk_cache(tmp_path, max_disk_bytes=250)
+    for number in range(4):
+        cache.put(f'{number:02d}' + 'k' * 62, 'm', b'x' * 100)
+    stats = cache.stats()
+    assert stats['disk_entries'] == 2
+    assert stats['disk_bytes'] <= 250
+    assert stats['disk_evictions'] == 2
+    assert [name[:2] for name in cache_files(tmp_path)] == ['02', '03']
+
+
+def test_expired_files_are_swept_on_write(tmp_path, monkeypatch):
+    monkeypatch.setattr(response_cache, 'DISK_SWEEP_INTERVAL', 0)
+    cache = disk_cache(tmp_path, model_ttls={'short': 0.05})
+    cache.put('a' * 64, 'short', b'old')
+    time.sleep(0.1)
+    cache.put('b' * 64, 'm', b'new')
+    assert cache_files(tmp_path) == ['b' * 64 + '.cache']
+    stats = cache.stats()
+    assert (stats['disk_entries'], stats['disk_expired']) == (1, 1)
+
+
+def test_disk_index_is_rebuilt_from_existing_files(tmp_path):
+    first = disk_cache(tmp_path)
+    first.put('a' * 64, 'm', b'body')
+    first.put('b' * 64, 'm', b'body')
+    # 重启后扫描目录建立索引，容量调小时删除最早写入的文件
+    second = disk_cache(tmp_path, max_disk_bytes=30)
+    assert second.stats()['disk_entries'] == 1
+    assert cache_files(tmp_path) == ['b' * 64 + '.cache']
+    assert second.get('b' * 64) == b'body'
+
+
+def test_clear_resets_disk_usage(tmp_path):
+    cache = disk_cache(tmp_path)
+    cache.put('a' * 64, 'm', b'body')
+    cache.clear()
+    assert cache_files(tmp_path) == []
+    assert (cache.stats()['disk_entries'], cache.stats()['disk_bytes']) == (0, 0)
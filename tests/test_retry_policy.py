@@ -0,0 +1,132 @@
+"""retry_policy：重试决策（状态码、异常类型、幂等性、Retry-After、预算）和 call() 的重试循环"""
+
+import io
+
+import pytest
+import requests
+from urllib3.exceptions import MaxRetryError, NewConnectionError
+
+import retry_policy
+from retry_policy import RetryPolicy, classify_error, parse_retry_after
+
+
+def connect_error():
+    """与 requests 在连接被拒绝时抛出的异常结构相同"""
+    reason = NewConnectionError(None, '连接被拒绝')
+    return requests.ConnectionError(MaxRetryError(None, 'http://upstream/v1', reason=reason))
+
+
+def response(status, headers=None):
+    resp = requests.Response()
+    resp.status_code = status
+    resp.raw = io.BytesIO(b'')
+    resp.headers.update(headers or {})
+    return resp
+
+
+@pytest.fixture
+def policy():
+    return RetryPolicy({'base_delay': 0.5, 'max_delay': 4})
+
+
+def test_classify_error():
+    assert classify_error(requests.ConnectTimeout()) == 'connect'
+    assert classify_error(connect_error()) == 'connect'
+    assert classify_error(requests.ReadTimeout()) == 'timeout'
+    assert classify_error(requests.ConnectionError('连接被重置')) == 'io'
+    assert classify_error(ValueError('bad json')) is None
+
+
+def test_parse_retry_after():
+    assert parse_retry_after('3') == 3.0
+    assert parse_retry_after(' -5 ') == 0.0
+    assert parse_retry_after('Wed, 21 Oct 2015 07:28:00 GMT') == 0.0
+    assert parse_retry_after('soon') is None
+    assert parse_retry_after(None) is None
+
+
+def test_backoff_is_capped_full_jitter(policy):
+    for attempt, cap in ((1, 0.5), (2, 1.0), (3, 2.0), (6, 4.0)):
+        delays = [policy.backoff(attempt) for _ in range(200)]
+        assert all(0 <= delay <= cap for delay in delays)
+        assert max(delays) > cap / 2
+
+
+@pytest.mark.parametrize('status, idempotent, retried', [
+    (429, True, True), (503, True, True), (500, True, True), (400, True, False), (404, True, False),
+    (429, False, True), (503, False, True), (500, False, False), (502, False, False),
+])
+def test_status_decisions(policy, status, idempotent, retried):
+    assert (policy.next_delay(1, status=status, idempotent=idempotent) is not None) is retried
+
+
+@pytest.mark.parametrize('error, idempotent, retried', [
+    (requests.ConnectTimeout(), False, True),
+    (connect_error(), False, True),
+    (requests.ReadTimeout(), False, False),
+    (requests.ReadTimeout(), True, True),
+    (requests.ConnectionError('连接被重置'), True, True),
+    (ValueError('bad json'), True, False),
+])
+def test_error_decisions(policy, error, idempotent, retried):
+    assert (policy.next_delay(1, error=error, idempotent=idempotent) is not None) is retried
+
+
+def test_stops_after_max_attempts(policy):
+    assert policy.next_delay(2, status=503) is not None
+    assert policy.next_delay(3, status=503) is None
+    assert RetryPolicy({'enabled': False}).next_delay(1, status=503) is None
+
+
+def test_retry_after_is_honored_or_gives_up(policy):
+    assert policy.next_delay(1, status=429, headers={'Retry-After': '7'}) == 7.0
+    assert policy.next_delay(1, status=429, headers={'Retry-After': '120'}) is None
+    assert policy.stats()['retry_after_honored'] == 1
+
+
+def test_budget_limits_retries():
+    policy = RetryPolicy({'budget_burst': 2, 'budget_ratio': 0.5, 'base_delay': 0})
+    assert policy.next_delay(1, status=503) is not None
+    assert policy.next_delay(1, status=503) is not None
+    assert policy.next_delay(1, status=503) is None
+    assert policy.stats()['budget_exhausted'] == 1
+    # 每次调用存入 0.5 次重试机会
+    policy.begin()
+    policy.begin()
+    assert policy.next_delay(1, status=503) is not None
+
+
+def test_call_retries_until_success(policy, monkeypatch):
+    slept = []
+    monkeypatch.setattr(retry_policy.time, 'sleep', slept.append)
+    replies = [requests.ConnectTimeout(), response(503, {'Retry-After': '1'}), response(200)]
+
+    def send():
+        reply = replies.pop(0)
+        if isinstance(reply, Exception):
+            raise reply
+        return reply
+
+    assert policy.call(send, idempotent=False).status_code == 200
+    assert len(slept) == 2
+    assert slept[1] >= 1
+    assert policy.stats()['retry_successes'] == 1
+
+
+def test_call_does_not_retry_non_idempotent_timeout(policy, monkeypatch):
+    monkeypatch.setattr(retry_policy.time, 'sleep', lambda _delay: pytest.fail('不应重试'))
+    calls = []
+
+    def send():
+        calls.append(1)
+        raise requests.ReadTimeout()
+
+    with pytest.raises(requests.ReadTimeout):
+        policy.call(send, idempotent=False)
+    assert len(calls) == 1
+
+
+def test_call_returns_last_error_response(policy, monkeypatch):
+    monkeypatch.setattr(retry_policy.time, 'sleep', lambda _delay: None)
+    assert policy.call(lambda: response(502)).status_code == 502
+    assert policy.stats()['gave_up'] == 1
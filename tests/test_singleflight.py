@@ -0,0 +1,229 @@
+"""singleflight：非流式合并、广播缓冲区的多读者读取，以及全部读者断开后取消上游"""
+
+import threading
+import time
+
+import pytest
+
+from singleflight import BroadcastBuffer, ReplayGap, SingleFlight, StreamAbandoned, StreamFlights
+
+
+def test_concurrent_calls_share_one_result():
+    flights = SingleFlight()
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+    results = []
+
+    def slow():
+        calls.append(1)
+        started.set()
+        release.wait(2)
+        return 'answer'
+
+    leader = threading.Thread(target=lambda: results.append(flights.do('k', slow)))
+    leader.start()
+    started.wait(2)
+    followers = [threading.Thread(target=lambda: results.append(flights.do('k', slow))) for _ in range(3)]
+    for thread in followers:
+        thread.start()
+    time.sleep(0.05)
+    release.set()
+    for thread in [leader, *followers]:
+        thread.join(2)
+    assert len(calls) == 1
+    assert sorted(results) == [('answer', False)] + [('answer', True)] * 3
+    assert flights.stats.snapshot()['coalesced'] == 3
+    assert flights.in_flight() == 0
+
+
+def test_leader_error_is_shared():
+    flights = SingleFlight()
+
+    def failing():
+        raise RuntimeError('上游错误')
+
+    with pytest.raises(RuntimeError):
+        flights.do('k', failing)
+    # 失败的调用不会留下，下一次重新执行
+    assert flights.do('k', lambda: 'ok') == ('ok', False)
+
+
+def test_readers_each_get_the_whole_stream():
+    buffer = BroadcastBuffer()
+    first = buffer.attach()
+    buffer.publish('a')
+    second = buffer.attach()
+    buffer.publish('b')
+    buffer.finish()
+    assert list(first) == ['a', 'b']
+    assert list(second) == ['a', 'b']
+
+
+def test_reader_raises_pump_error():
+    buffer = BroadcastBuffer()
+    reader = buffer.attach()
+    buffer.publish('a')
+    buffer.finish(RuntimeError('上游断开'))
+    assert next(reader) == 'a'
+    with pytest.raises(RuntimeError):
+        next(reader)
+
+
+def test_publish_cancels_after_all_readers_close():
+    buffer = BroadcastBuffer()
+    first, second = buffer.attach(), buffer.attach()
+    assert buffer.publish('a') is True
+    first.close()
+    first.close()  # 重复关闭不影响计数
+    assert buffer.publish('b') is True
+    second.close()
+    assert buffer.publish('c') is False
+    assert buffer.closed
+
+
+def test_grace_keeps_stream_for_reconnect():
+    buffer = BroadcastBuffer(grace=0.2)
+    buffer.attach().close()
+    assert buffer.publish('a') is True
+    time.sleep(0.25)
+    assert buffer.publish('b') is False
+
+
+def test_request_cancel_skips_grace():
+    buffer = BroadcastBuffer(grace=60)
+    reader = buffer.attach()
+    buffer.request_cancel()
+    assert buffer.publish('a') is True  # 还有读者时不取消
+    reader.close()
+    assert buffer.publish('b') is False
+
+
+def test_ring_buffer_drops_oldest_chunks():
+    buffer = BroadcastBuffer(max_bytes=4)
+    reader = buffer.attach()
+    for chunk in ('ab', 'cd', 'ef'):
+        buffer.publish(chunk)
+    buffer.finish()
+    with pytest.raises(ReplayGap):
+        list(reader)
+    assert list(buffer.attach(1)) == ['cd', 'ef']
+    with pytest.raises(ReplayGap):
+        buffer.attach(0)
+
+
+def test_stream_flights_pump_and_cancel_source():
+    flights = StreamFlights()
+    closed = threading.Event()
+    produced = []
+
+    def source():
+        try:
+            for number in range(1000):
+                produced.append(number)
+                yield f'data: {number}\n\n'
+                time.sleep(0.005)
+        finally:
+            closed.set()
+
+    reader, leader = flights.join('k')
+    follower, follower_leader = flights.join('k')
+    assert (leader, follower_leader) == (True, False)
+    flights.start_pump('k', reader.buffer, source())
+    assert next(reader) == 'data: 0\n\n'
+    assert next(follower) == 'data: 0\n\n'
+    reader.close()
+    follower.close()
+    # 全部读者断开后关闭生成器，由它取消上游
+    assert closed.wait(2)
+    assert len(produced) < 1000
+    time.sleep(0.05)
+    assert flights.in_flight() == 0
+    assert flights.join('k')[1] is True
+
+
+def test_stream_flights_fail_reaches_joined_readers():
+    flights = StreamFlights()
+    reader, _leader = flights.join('k')
+    follower, _leader = flights.join('k')
+    flights.fail('k', reader.buffer, RuntimeError('未获准入'))
+    with pytest.raises(RuntimeError):
+        next(follower)
+    assert flights.in_flight() == 0
+
+
+def test_stalled_upstream_is_aborted_when_last_reader_leaves():
+    flights = StreamFlights()
+    aborted = threading.Event()
+    closed = threading.Event()
+
+    def stalled_source():
+        try:
+            yield 'data: 0\n\n'
+            # 上游卡住不再输出，只有中止回调能让读取返回
+            aborted.wait(5)
+            raise StreamAbandoned('上游已中止')
+        finally:
+            closed.set()
+
+    reader, _leader = flights.join('k')
+    flights.start_pump('k', reader.buffer, stalled_source(), aborted.set)
+    assert next(reader) == 'data: 0\n\n'
+    started = time.monotonic()
+    reader.close()
+    assert aborted.wait(1)
+    assert closed.wait(1)
+    assert time.monotonic() - started < 1
+    time.sleep(0.05)
+    assert flights.in_flight() == 0
+
+
+def test_abort_waits_for_grace_and_reconnect_keeps_stream():
+    aborts = []
+    buffer = BroadcastBuffer(grace=0.2)
+    buffer.set_abort(lambda: aborts.append(1))
+    buffer.attach().close()
+    time.sleep(0.1)
+    reader = buffer.attach()  # 等待期内重连
+    time.sleep(0.2)
+    assert aborts == []
+    reader.close()
+    time.sleep(0.3)
+    assert aborts == [1]
+    assert buffer.closed
+
+
+def test_request_cancel_aborts_without_readers():
+    aborts = []
+    buffer = BroadcastBuffer(grace=60)
+    buffer.set_abort(lambda: aborts.append(1))
+    reader = buffer.attach()
+    buffer.request_cancel()
+    assert aborts == []  # 还有读者时不中止
+    reader.close()
+    buffer.request_cancel()
+    assert aborts == [1]  # 只调用一次
+
+
+def test_follower_waits_for_leader_admission():
+    flights = StreamFlights()
+    reader, _leader = flights.join('k')
+    follower, _leader = flights.join('k')
+    results = []
+    waiter = threading.Thread(target=lambda: results.append(follower.buffer.wait_started()))
+    waiter.start()
+    time.sleep(0.05)
+    assert results == []  # 领头请求还在排队
+    flights.start_pump('k', reader.buffer, iter(['data: 0\n\n']))
+    waiter.join(1)
+    assert results == [None]
+    assert list(follower) == ['data: 0\n\n']
+
+
+def test_follower_gets_leader_rejection_before_reading():
+    flights = StreamFlights()
+    reader, _leader = flights.join('k')
+    follower, _leader = flights.join('k')
+    error = RuntimeError('未获准入')
+    flights.fail('k', reader.buffer, error)
+    assert follower.buffer.wait_started() is error
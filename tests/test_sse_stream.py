@@ -0,0 +1,175 @@
+"""sse_stream：零解码透传与旁路内容解析、增量合并、多候选流的交错转发"""
+
+import json
+import threading
+
+import sse_stream
+
+
+class FakeRaw:
+    def __init__(self, chunks):
+        self._chunks = list(chunks)
+        self.sizes = []
+
+    def read1(self, size, decode_content=True):
+        self.sizes.append(size)
+        return self._chunks.pop(0) if self._chunks else b''
+
+
+class FakeResponse:
+    """按给定字节块返回的上游响应，iter_lines 按 \\n 切分"""
+
+    def __init__(self, chunks):
+        self.raw = FakeRaw(chunks)
+        self._chunks = chunks
+
+    def iter_lines(self):
+        yield from b''.join(self._chunks).split(b'\n')
+
+
+def delta_line(content, index=0, finish_reason=None):
+    return 'data: ' + json.dumps({'choices': [{'index': index, 'delta': {'content': content} if content else {},
+                                               'finish_reason': finish_reason}]}, ensure_ascii=False)
+
+
+def test_passthrough_forwards_bytes_unchanged():
+    # 一帧被拆到两个字节块中，多字节字符也被拆开
+    frame = (delta_line('你好') + '\n\n').encode('utf-8')
+    chunks = [frame[:15], frame[15:], b'data: [DONE]\n\n']
+    collector = sse_stream.SSEContentCollector()
+    relayed = list(sse_stream.relay_passthrough(FakeResponse(chunks), collector, max_chunk_size=1024))
+    assert relayed == chunks
+    assert collector.size == sum(map(len, chunks))
+    assert collector.content_parts() == ['你好']
+
+
+def test_passthrough_reads_what_has_arrived():
+    response = FakeResponse([b'data: a\n\n'])
+    list(sse_stream.iter_raw_chunks(response, 4096))
+    assert response.raw.sizes == [4096, 4096]
+
+
+def test_collector_handles_crlf_and_line_separators_in_content():
+    collector = sse_stream.SSEContentCollector()
+    collector.feed((delta_line('一\u2028二') + '\r\n\r\n').encode('utf-8'))
+    collector.feed((delta_line('三') + '\n\n' + 'data: [DONE]\n\n').encode('utf-8'))
+    assert collector.content_parts() == ['一\u2028二', '三']
+
+
+def feed(coalescer, line, now):
+    return coalescer.feed(line, json.loads(line[6:]) if line != sse_stream.DONE_LINE else None, now=now)
+
+
+def frame_contents(frames):
+    return [json.loads(frame[6:])['choices'][0]['delta'].get('content') for frame in frames]
+
+
+def test_coalescer_flushes_when_window_elapses():
+    coalescer = sse_stream.DeltaCoalescer(window_ms=50, max_bytes=1024)
+    assert feed(coalescer, delta_line('a'), now=0.0) == []
+    assert feed(coalescer, delta_line('b'), now=0.02) == []
+    frames = feed(coalescer, delta_line('c'), now=0.06)
+    assert frame_contents(frames) == ['abc']
+    assert coalescer.flush() == []
+
+
+def test_coalescer_flushes_at_byte_limit():
+    coalescer = sse_stream.DeltaCoalescer(window_ms=1000, max_bytes=6)
+    assert feed(coalescer, delta_line('你'), now=0.0) == []
+    assert frame_contents(feed(coalescer, delta_line('好'), now=0.0)) == ['你好']
+
+
+def test_finish_reason_frame_flushes_pending_content_first():
+    coalescer = sse_stream.DeltaCoalescer(window_ms=1000)
+    feed(coalescer, delta_line('a'), now=0.0)
+    feed(coalescer, delta_line('b'), now=0.0)
+    finish = delta_line(None, finish_reason='stop')
+    frames = feed(coalescer, finish, now=0.0)
+    assert frame_contents(frames) == ['ab', None]
+    assert frames[1] == finish + '\n\n'  # 结束帧原样输出
+    assert feed(coalescer, sse_stream.DONE_LINE, now=0.0) == [sse_stream.DONE_LINE + '\n\n']
+
+
+def test_coalescer_does_not_merge_across_choice_index():
+    coalescer = sse_stream.DeltaCoalescer(window_ms=1000)
+    feed(coalescer, delta_line('a', index=0), now=0.0)
+    frames = feed(coalescer, delta_line('b', index=1), now=0.0)
+    assert frame_contents(frames) == ['a']
+    assert json.loads(coalescer.flush()[0][6:])['choices'][0]['index'] == 1
+
+
+def test_relay_coalesced_accumulates_and_flushes_at_end():
+    lines = [delta_line(text) for text in ('x', 'y', 'z')]
+    response = FakeResponse([('\n'.join(lines) + '\n').encode('utf-8')])
+    accumulated = []
+    frames = list(sse_stream.relay_coalesced(response, accumulated, sse_stream.DeltaCoalescer(window_ms=10_000)))
+    assert frame_contents(frames) == ['xyz']
+    assert accumulated == ['x', 'y', 'z']
+
+
+class ClosingResponse(FakeResponse):
+    def __init__(self, chunks):
+        super().__init__(chunks)
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+def candidate_stream(*contents):
+    lines = [delta_line(text) for text in contents] + [delta_line(None, finish_reason='stop'), sse_stream.DONE_LINE]
+    return [('\n'.join(lines) + '\n').encode('utf-8')]
+
+
+def test_relay_indexed_splits_native_n_candidates():
+    lines = [delta_line('a', index=0), delta_line('b', index=1), delta_line('c', index=0), sse_stream.DONE_LINE]
+    contents = [[], []]
+    frames = list(sse_stream.relay_indexed(FakeResponse([('\n'.join(lines) + '\n').encode('utf-8')]), contents))
+    assert len(frames) == 4
+    assert contents == [['a', 'c'], ['b']]
+
+
+def test_relay_candidates_interleaves_and_ends_once():
+    responses = [ClosingResponse(candidate_stream('一', '二')), ClosingResponse(candidate_stream('甲'))]
+    contents = [[], []]
+    frames = list(sse_stream.relay_candidates(lambda index: responses[index], contents))
+    assert contents == [['一', '二'], ['甲']]
+    assert frames.count(sse_stream.DONE_LINE + '\n\n') == 1
+    assert frames[-1] == sse_stream.DONE_LINE + '\n\n'
+    indexes = {json.loads(frame[6:])['choices'][0]['index'] for frame in frames[:-1]}
+    assert indexes == {0, 1}
+    assert all(response.closed for response in responses)
+
+
+def test_failed_candidate_reports_error_and_others_continue():
+    def open_candidate(index):
+        if index == 1:
+            raise RuntimeError('候选失败')
+        return ClosingResponse(candidate_stream('ok'))
+
+    contents = [[], []]
+    frames = list(sse_stream.relay_candidates(open_candidate, contents))
+    errors = [json.loads(frame[6:]) for frame in frames if '"error"' in frame]
+    assert len(errors) == 1
+    assert errors[0]['error']['candidate'] == 1
+    assert errors[0]['choices'][0] == {'index': 1, 'delta': {}, 'finish_reason': 'error'}
+    assert contents == [['ok'], []]
+    assert frames[-1] == sse_stream.DONE_LINE + '\n\n'
+
+
+def test_closing_candidate_relay_closes_upstreams():
+    release = threading.Event()
+
+    class BlockingResponse(ClosingResponse):
+        def iter_lines(self):
+            yield delta_line('first').encode('utf-8')
+            release.wait(2)
+            yield delta_line('late').encode('utf-8')
+
+    responses = [BlockingResponse([]), BlockingResponse([])]
+    relay = sse_stream.relay_candidates(lambda index: responses[index], [[], []])
+    next(relay)
+    next(relay)  # 两个候选都已打开
+    relay.close()
+    release.set()
+    assert all(response.closed for response in responses)
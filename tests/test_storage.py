@@ -0,0 +1,184 @@
+"""storage：文件后端与 SQLite 后端行为一致，以及两者之间的迁移"""
+
+import os
+
+import pytest
+
+import storage
+from chat_store import ChatConflict, window
+
+METADATA = {'user_name': 'User', 'character_name': 'Alice', 'create_date': '2024-05-01',
+            'chat_metadata': {'note': '', 'title': '初次见面'}}
+
+
+def message(text, is_user=False):
+    return {'name': 'User' if is_user else 'Alice', 'is_user': is_user, 'mes': text}
+
+
+@pytest.fixture(params=['file', 'sqlite'])
+def store(request, tmp_path):
+    backend = storage.open_storage(str(tmp_path), backend=request.param)
+    yield backend
+    backend.close()
+
+
+def exercise_chat(store):
+    """对两种后端执行同样的操作序列，返回每一步可观察到的结果"""
+    chat = store.chat('Alice', 'chat1')
+    observed = [chat.exists()]
+    observed.append(chat.append([message('你好', True)], metadata=METADATA, expected_count=0))
+    observed.append(chat.append([message('你好呀'), message('今天天气如何', True)], expected_count=1))
+    with pytest.raises(ChatConflict) as excinfo:
+        chat.append([message('过期')], expected_count=1)
+    observed.append(excinfo.value.count)
+    chat.replace(1, message('改短'))
+    chat.replace(2, message('改成一条更长的消息' * 5, True))
+    chat.remove(0)
+    with pytest.raises(IndexError):
+        chat.replace(5, message('x'))
+    observed.extend([chat.exists(), chat.message_count(), chat.read_metadata(),
+                     chat.read_range(0, 10), chat.read_range(1, 2), chat.read_lines()])
+    return observed
+
+
+def test_windowed_and_tail_reads(store):
+    chat = store.chat('Alice', 'long')
+    chat.write_all(METADATA, [message(f'消息 {number}') for number in range(50)])
+    total = chat.message_count()
+    start, stop = window(total, tail=5)
+    assert [entry['mes'] for entry in chat.read_range(start, stop)] == [f'消息 {number}' for number in range(45, 50)]
+    # 向上滚动时按 offset 加载更早的一段
+    start, stop = window(total, offset=40, limit=5)
+    assert [entry['mes'] for entry in chat.read_range(start, stop)] == [f'消息 {number}' for number in range(40, 45)]
+    assert chat.read_range(*window(total, offset=60, limit=5)) == []
+
+
+def test_chat_operations_match_across_backends(tmp_path):
+    results = []
+    for backend in ('file', 'sqlite'):
+        store = storage.open_storage(str(tmp_path / backend), backend=backend)
+        results.append(exercise_chat(store))
+        store.close()
+    assert results[0] == results[1]
+    assert results[0][-1] == [METADATA, message('改短'), message('改成一条更长的消息' * 5, True)]
+
+
+def test_collections_and_documents(store):
+    assert store.get('characters', 'c1') is None
+    store.put('characters', 'c2', {'name': '乙'})
+    store.put('characters', 'c1', {'name': '甲'})
+    store.put('characters', 'c1', {'name': '甲（新）'})
+    assert store.list('characters') == [('c1', {'name': '甲（新）'}), ('c2', {'name': '乙'})]
+    assert store.delete('characters', 'c2') is True
+    assert store.delete('characters', 'c2') is False
+    assert store.list('characters') == [('c1', {'name': '甲（新）'})]
+
+    assert store.get_document('user_persona') is None
+    store.put_document('user_persona', {'name': '旅人'})
+    assert store.get_document('user_persona') == {'name': '旅人'}
+
+
+def test_list_and_rename_chats(store):
+    for name, title, create_date, count in (('a', '第一', '2024-01-01', 3), ('b', '第二', '2024-02-01', 1)):
+        metadata = dict(METADATA, create_date=create_date, chat_metadata={'title': title})
+        store.chat('Alice', name).write_all(metadata, [message(f'{title} {i}') for i in range(count)])
+    store.chat('Bob', 'c').write_all(dict(METADATA, character_name='Bob'), [message('Bob 的对话')])
+    store.reconcile()
+
+    chats, total = store.list_chats(character='Alice')
+    assert total == 2
+    assert [chat['name'] for chat in chats] == ['b', 'a']
+    assert chats[1]['message_count'] == 3
+    assert chats[1]['preview'] == '第一 0'
+    chats, total = store.list_chats(sort='message_count', descending=False, offset=1, limit=1)
+    assert total == 3
+    assert len(chats) == 1
+    with pytest.raises(ValueError):
+        store.list_chats(sort='unknown')
+
+    store.rename_chat('Alice', 'a', 'renamed')
+    assert not store.chat('Alice', 'a').exists()
+    assert store.chat('Alice', 'renamed').message_count() == 3
+    assert sorted(store.iter_chats()) == [('Alice', 'b'), ('Alice', 'renamed'), ('Bob', 'c')]
+
+    store.chat('Bob', 'c').delete()
+    assert store.list_chats()[1] == 2
+
+
+def test_character_names_with_slash_are_kept_in_one_directory(store):
+    store.chat('A/B', 'x').write_all(METADATA, [message('1')])
+    assert list(store.iter_chats()) == [('A_B', 'x')]
+    assert store.list_chats(character='A/B')[1] == 1
+
+
+def populate(store):
+    store.put('characters', 'c1', {'name': '甲'})
+    store.put('worlds', 'w1', {'_metadata': {'name': '世界'}, 'entries': []})
+    store.put('presets', 'p1', {'name': '预设'})
+    store.put_document('regex_scripts', {'scripts': []})
+    store.chat('Alice', 'chat1').write_all(METADATA, [message('你好', True), message('你好呀')])
+
+
+@pytest.mark.parametrize('source_backend, target_backend', [('file', 'sqlite'), ('sqlite', 'file')])
+def test_migrate_copies_everything(tmp_path, source_backend, target_backend):
+    source = storage.open_storage(str(tmp_path), backend=source_backend)
+    populate(source)
+    target = storage.open_storage(str(tmp_path), backend=target_backend)
+    counts = storage.migrate(source, target)
+    assert counts == {'characters': 1, 'worlds': 1, 'presets': 1, 'documents': 1, 'chats': 1, 'messages': 2}
+    for collection in storage.COLLECTIONS:
+        assert target.list(collection) == source.list(collection)
+    assert target.get_document('regex_scripts') == {'scripts': []}
+    chat = target.chat('Alice', 'chat1')
+    assert chat.read_lines() == [METADATA, message('你好', True), message('你好呀')]
+    source.close()
+    target.close()
+
+
+def test_migrate_adds_metadata_to_legacy_chat(tmp_path):
+    source = storage.open_storage(str(tmp_path), backend='file')
+    path = os.path.join(str(tmp_path), 'chats', 'Alice', 'old.jsonl')
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write('{"name": "Alice", "is_user": false, "mes": "旧文件"}\n')
+    target = storage.open_storage(str(tmp_path), backend='sqlite')
+    counts = storage.migrate(source, target)
+    assert counts['messages'] == 1
+    chat = target.chat('Alice', 'old')
+    assert chat.read_metadata()['chat_metadata']['title'] == 'old'
+    assert chat.read_range(0, 1) == [message('旧文件')]
+    source.close()
+    target.close()
+
+
+def test_migrate_command_line(tmp_path, capsys):
+    source = storage.open_storage(str(tmp_path), backend='file')
+    populate(source)
+    source.close()
+    assert storage.main(['migrate', '--to', 'sqlite', '--data-dir', str(tmp_path)]) == 0
+    assert '迁移完成' in capsys.readouterr().out
+    target = storage.open_storage(str(tmp_path), backend='sqlite')
+    assert target.chat('Alice', 'chat1').message_count() == 2
+    target.close()
+
+
+def test_incomplete_backend_fails_at_construction():
+    class PartialStorage(storage.Storage):
+        def list(self, collection):
+            return []
+
+    with pytest.raises(TypeError):
+        PartialStorage()
+
+
+def test_migrate_command_does_not_reconcile_catalogue(tmp_path, monkeypatch):
+    source = storage.open_storage(str(tmp_path), backend='file')
+    populate(source)
+    source.close()
+
+    def fail(_catalog):
+        raise AssertionError('迁移时不应核对对话目录')
+
+    monkeypatch.setattr(storage.chat_catalog.ChatCatalog, 'reconcile', fail)
+    assert storage.main(['migrate', '--to', 'sqlite', '--data-dir', str(tmp_path)]) == 0
+    assert storage.main(['migrate', '--to', 'file', '--data-dir', str(tmp_path)]) == 0
@@ -0,0 +1,93 @@
+"""stream_replay：Last-Event-ID 解析、断点续传、resume id 帧和缓冲区淘汰"""
+
+import time
+
+import pytest
+
+from singleflight import BroadcastBuffer
+from stream_replay import ReplayStore, parse_last_event_id
+
+
+@pytest.fixture
+def store():
+    return ReplayStore({'enabled': True})
+
+
+def registered(store, chunks, finish=True):
+    buffer = BroadcastBuffer(**store.buffer_options())
+    stream_id = store.register(buffer)
+    buffer.attach()  # 领头请求的读者，没有读者时 publish 会取消上游
+    for chunk in chunks:
+        buffer.publish(chunk)
+    if finish:
+        buffer.finish()
+    return buffer, stream_id
+
+
+def test_parse_last_event_id():
+    assert parse_last_event_id('abc:3') == ('abc', 3)
+    assert parse_last_event_id(' abc:12 ') == ('abc', 12)
+    assert parse_last_event_id('abc') is None
+    assert parse_last_event_id('abc:x') is None
+    assert parse_last_event_id(None) is None
+
+
+def test_buffer_options_follow_settings():
+    assert ReplayStore().buffer_options() == {'max_bytes': None, 'grace': 0.0}
+    options = ReplayStore({'enabled': True, 'max_stream_bytes': 100, 'resume_grace_seconds': 5}).buffer_options()
+    assert options == {'max_bytes': 100, 'grace': 5.0}
+
+
+@pytest.mark.parametrize('frame', ['data: 1\n\n', 'data: 1\r\n\r\n', 'data: 1\r\r', b'data: 1\n\n'])
+def test_complete_frames_get_resume_ids(store, frame):
+    buffer, stream_id = registered(store, [frame])
+    chunk = next(buffer.attach())
+    suffix = f'id: {stream_id}:0\n\n'
+    assert chunk == frame + (suffix.encode('ascii') if isinstance(frame, bytes) else suffix)
+
+
+def test_partial_frames_get_no_id(store):
+    buffer, _stream_id = registered(store, ['data: 1\n'])
+    assert next(buffer.attach()) == 'data: 1\n'
+
+
+def test_resume_continues_after_last_event_id(store):
+    _buffer, stream_id = registered(store, ['data: 0\n\n', 'data: 1\n\n', 'data: 2\n\n'])
+    reader = store.resume(f'{stream_id}:0')
+    assert [chunk.split('\n')[0] for chunk in reader] == ['data: 1', 'data: 2']
+    assert store.stats()['resumed'] == 1
+
+
+def test_resume_misses(store):
+    assert store.resume('unknown:0') is None
+    assert store.resume('garbage') is None
+    ring = ReplayStore({'enabled': True, 'max_stream_bytes': 4})
+    _buffer, stream_id = registered(ring, ['ab', 'cd', 'ef'])
+    assert ring.resume(f'{stream_id}:-1') is None  # 第 0 块已被覆盖
+    assert ring.resume(f'{stream_id}:0') is not None
+    assert store.stats()['resume_misses'] == 2
+
+
+def test_cancel_requests_stop_without_grace(store):
+    buffer = BroadcastBuffer(**store.buffer_options())
+    stream_id = store.register(buffer)
+    buffer.attach().close()
+    assert buffer.publish('data: 0\n\n') is True  # 在重连等待时间内
+    assert store.cancel(stream_id) is True
+    assert buffer.publish('data: 1\n\n') is False
+    assert store.cancel('unknown') is False
+
+
+def test_finished_streams_are_evicted_by_age_and_size():
+    store = ReplayStore({'enabled': True, 'retain_seconds': 0.05, 'max_total_bytes': 10})
+    _live, live_id = registered(store, ['x' * 20], finish=False)
+    _old, old_id = registered(store, ['y' * 4])
+    assert store.stats()['streams'] == 1  # 超出总容量：淘汰最早结束的，进行中的保留
+    assert store.resume(f'{live_id}:-1') is not None
+    assert store.resume(f'{old_id}:-1') is None
+
+    store.configure({'enabled': True, 'retain_seconds': 0.05})
+    _recent, recent_id = registered(store, ['z'])
+    time.sleep(0.1)
+    assert store.resume(f'{recent_id}:-1') is None
+    assert store.stats()['evicted'] == 2
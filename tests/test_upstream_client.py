@@ -0,0 +1,127 @@
+"""upstream_client：连接池复用与统计、超时配置、从其他线程中止卡住的流式响应"""
+
+import http.server
+import socket
+import threading
+import time
+
+import pytest
+import requests
+
+import upstream_client
+
+
+class KeepAliveHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        body = b'{"ok": true}'
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def keep_alive_server():
+    httpd = http.server.ThreadingHTTPServer(('127.0.0.1', 0), KeepAliveHandler)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    yield f'http://127.0.0.1:{httpd.server_address[1]}'
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def test_requests_reuse_pooled_connection(keep_alive_server):
+    client = upstream_client.UpstreamClient()
+    for _ in range(3):
+        assert client.post(keep_alive_server + '/chat/completions', json={}).json() == {'ok': True}
+    stats = client.stats()
+    assert (stats['requests'], stats['connections']) == (3, 1)
+    assert stats['reuse_ratio'] == round(1 - 1 / 3, 4)
+    host = next(iter(stats['hosts'].values()))
+    assert (host['idle'], host['in_use']) == (1, 0)
+
+
+def test_keep_alive_off_opens_a_connection_per_request(keep_alive_server):
+    client = upstream_client.UpstreamClient({'keep_alive': False})
+    for _ in range(2):
+        client.post(keep_alive_server + '/chat/completions', json={})
+    assert client.stats()['connections'] == 2
+
+
+def test_timeouts_follow_settings():
+    client = upstream_client.UpstreamClient({'connect_timeout': 3, 'read_timeout': 90})
+    assert client.timeout() == (3.0, 90.0)
+    assert client.timeout(read=5) == (3.0, 5.0)
+    session = client._session
+    client.configure({'connect_timeout': 4, 'read_timeout': 30})
+    # 只改超时不重建连接池
+    assert client._session is session
+    assert client.timeout() == (4.0, 30.0)
+    client.configure({'pool_maxsize': 5})
+    assert client._session is not session
+
+
+def test_request_uses_configured_timeout(monkeypatch):
+    client = upstream_client.UpstreamClient({'connect_timeout': 2, 'read_timeout': 7})
+    seen = {}
+    monkeypatch.setattr(client._session, 'request', lambda method, url, **kwargs: seen.update(kwargs))
+    client.post('http://upstream/chat/completions')
+    assert seen['timeout'] == (2.0, 7.0)
+    client.get('http://upstream/models', timeout=1)
+    assert seen['timeout'] == 1
+
+
+@pytest.fixture
+def stalled_server():
+    """返回响应头和一个数据块后不再输出的服务端"""
+    listener = socket.socket()
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(1)
+    release = threading.Event()
+
+    def serve():
+        conn, _addr = listener.accept()
+        conn.recv(65536)
+        conn.sendall(b'HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nTransfer-Encoding: chunked\r\n\r\n'
+                     b'd\r\ndata: first\n\n\r\n')
+        release.wait(10)
+        conn.close()
+
+    thread = threading.Thread(target=serve, daemon=True)
+    thread.start()
+    yield f'http://127.0.0.1:{listener.getsockname()[1]}'
+    release.set()
+    listener.close()
+
+
+def test_abort_response_unblocks_reader(stalled_server):
+    client = upstream_client.UpstreamClient({'read_timeout': 30})
+    response = client.post(stalled_server + '/chat/completions', json={}, stream=True)
+    lines = response.iter_lines()
+    assert next(lines) == b'data: first'
+    finished = threading.Event()
+
+    def read_rest():
+        try:
+            list(lines)
+        except requests.RequestException:
+            pass
+        finished.set()
+
+    threading.Thread(target=read_rest, daemon=True).start()
+    time.sleep(0.1)
+    assert not finished.is_set()
+    upstream_client.abort_response(response)
+    assert finished.wait(2)
+    response.close()
+
+
+def test_abort_response_without_connection_is_noop():
+    response = requests.Response()
+    upstream_client.abort_response(response)
@@ -0,0 +1,133 @@
+"""upstream_router：故障切换是否遵守幂等性规则、冷却和候选顺序"""
+
+import io
+
+import pytest
+import requests
+from urllib3.exceptions import MaxRetryError, NewConnectionError
+
+from upstream_router import FAILURES_BEFORE_COOLDOWN, UpstreamRouter, can_fail_over
+
+
+def response(status):
+    resp = requests.Response()
+    resp.status_code = status
+    resp.raw = io.BytesIO(b'')
+    return resp
+
+
+def connect_error():
+    reason = NewConnectionError(None, '连接被拒绝')
+    return requests.ConnectionError(MaxRetryError(None, 'http://upstream/v1', reason=reason))
+
+
+class FakeClient:
+    """按上游地址返回预设的响应或异常，并记录请求顺序"""
+
+    def __init__(self, replies):
+        self.replies = replies
+        self.calls = []
+
+    def request(self, method, url, **kwargs):
+        host = url.split('/')[2]
+        self.calls.append(host)
+        reply = self.replies[host]
+        if isinstance(reply, Exception):
+            raise reply
+        return response(reply)
+
+
+def make_router(replies):
+    router = UpstreamRouter(FakeClient(replies))
+    router.configure({'upstreams': [{'name': host, 'api_url': f'http://{host}/v1'} for host in replies]})
+    return router
+
+
+@pytest.mark.parametrize('idempotent, status_code, error, expected', [
+    (True, 500, None, True),
+    (False, 500, None, False),
+    (False, 503, None, True),
+    (False, 429, None, True),
+    (True, 400, None, False),
+    (False, None, requests.ReadTimeout(), False),
+    (True, None, requests.ReadTimeout(), True),
+    (False, None, connect_error(), True),
+])
+def test_can_fail_over(idempotent, status_code, error, expected):
+    assert can_fail_over(idempotent, status_code=status_code, error=error) is expected
+
+
+def ordered(router, first):
+    """固定候选顺序：把 first 排在最前"""
+    upstreams = {upstream.name: upstream for upstream in router._upstreams}
+    rest = [upstream for name, upstream in upstreams.items() if name != first]
+    router.candidates = lambda model=None, primary=None: [upstreams[first], *rest]
+
+
+def test_non_idempotent_500_is_not_failed_over():
+    router = make_router({'a': 500, 'b': 200})
+    ordered(router, 'a')
+    resp, upstream = router.post('/chat/completions', idempotent=False)
+    assert (resp.status_code, upstream.name) == (500, 'a')
+    assert router.client.calls == ['a']
+
+
+def test_idempotent_500_fails_over():
+    router = make_router({'a': 500, 'b': 200})
+    ordered(router, 'a')
+    resp, upstream = router.get('/models')
+    assert (resp.status_code, upstream.name) == (200, 'b')
+    assert router.stats()['failovers'] == 1
+
+
+def test_non_idempotent_503_and_refused_connection_fail_over():
+    router = make_router({'a': 503, 'b': 200})
+    ordered(router, 'a')
+    assert router.post('/chat/completions', idempotent=False)[1].name == 'b'
+
+    router = make_router({'a': connect_error(), 'b': 200})
+    ordered(router, 'a')
+    assert router.post('/chat/completions', idempotent=False)[1].name == 'b'
+
+
+def test_non_idempotent_timeout_is_raised():
+    router = make_router({'a': requests.ReadTimeout(), 'b': 200})
+    ordered(router, 'a')
+    with pytest.raises(requests.ReadTimeout):
+        router.post('/chat/completions', idempotent=False)
+    assert router.client.calls == ['a']
+
+
+def test_all_failing_returns_last_response():
+    router = make_router({'a': 502, 'b': 503})
+    ordered(router, 'a')
+    resp, upstream = router.get('/models')
+    assert (resp.status_code, upstream.name) == (503, 'b')
+
+
+def test_failing_upstream_cools_down_and_goes_last():
+    router = make_router({'a': 200, 'b': 200})
+    upstream_a = router._upstreams[0]
+    for _ in range(FAILURES_BEFORE_COOLDOWN):
+        router.record(upstream_a, False)
+    for _ in range(20):
+        assert [upstream.name for upstream in router.candidates()] == ['b', 'a']
+    router.record(upstream_a, True, 0.1)
+    assert not router.stats()['upstreams'][0]['cooling_down']
+
+
+def test_models_restrict_candidates_and_primary_goes_first():
+    router = UpstreamRouter(FakeClient({}))
+    router.configure({'upstreams': [
+        {'name': 'a', 'api_url': 'http://a/v1', 'models': ['gpt-a']},
+        {'name': 'b', 'api_url': 'http://b/v1'},
+    ]})
+    assert [upstream.name for upstream in router.candidates('gpt-b')] == ['b']
+    primary = router._upstreams[1]
+    assert router.candidates('gpt-a', primary=primary)[0] is primary
+
+
+def test_legacy_single_upstream_config():
+    router = UpstreamRouter(FakeClient({}))
+    router.configure({'api_url': 'http://legacy/v1/', 'api_key': 'k'})
+    assert [(u.name, u.api_url) for u in router.candidates()] == [('default', 'http://legacy/v1')]
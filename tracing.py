@@ -0,0 +1,243 @@
+"""请求追踪 - 按阶段记录单个请求的耗时，输出 Server-Timing 响应头，并可导出到本地 JSONL 文件
+
+每个采样的请求对应一个 Trace，阶段（span）记录为 (名称, 相对请求开始的毫秒数, 耗时毫秒)。
+未采样的请求得到共享的 NULL_TRACE，所有操作都是空操作，不产生额外分配。
+"""
+
+from __future__ import annotations
+
+import json
+import os
+import queue
+import random
+import threading
+import time
+import uuid
+from typing import Iterator, List, Optional, Tuple
+
+# config.json 中 "tracing" 段的默认值
+DEFAULT_SETTINGS = {
+    'enabled': True,
+    'sample_rate': 1.0,                   # 采样比例（0~1）；请求头 X-Trace: 1 的请求总是采样
+    'export': False,                      # 把采样的请求写入 export_file（每行一个 JSON）
+    'export_file': 'traces.jsonl',        # 相对路径放在 logs 目录下
+    'max_file_bytes': 20 * 1024 * 1024,   # 超过后轮转为 .1（只保留一个旧文件）
+    'max_queue': 10000,                   # 等待写入的记录超过此数量时丢弃
+}
+
+
+class _Span:
+    __slots__ = ('trace', 'name', 'started')
+
+    def __init__(self, trace: 'Trace', name: str) -> None:
+        self.trace = trace
+        self.name = name
+        self.started = 0.0
+
+    def __enter__(self) -> '_Span':
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        self.trace.add(self.name, time.perf_counter() - self.started, self.started)
+
+
+class Trace:
+    """一个采样请求的全部阶段；add() 可以在其他线程（如流式输出线程）调用"""
+
+    sampled = True
+
+    def __init__(self, tracer: 'Tracer', name: str) -> None:
+        self.trace_id = uuid.uuid4().hex[:16]
+        self.name = name
+        self.started = time.perf_counter()
+        self.wall_started = time.time()
+        self.spans: List[Tuple[str, float, float]] = []
+        self.attributes: dict = {}
+        self.deferred = False
+        self._tracer = tracer
+        self._finished = False
+
+    def span(self, name: str) -> _Span:
+        """with trace.span('upstream'): ... 记录代码块的耗时"""
+        return _Span(self, name)
+
+    def add(self, name: str, duration: float, started: Optional[float] = None) -> None:
+        """记录一个已经结束的阶段（秒）；started 为 perf_counter 时间，缺省时按刚刚结束计算"""
+        if started is None:
+            started = time.perf_counter() - duration
+        self.spans.append((name, round((started - self.started) * 1000, 3), round(duration * 1000, 3)))
+
+    def set(self, key: str, value) -> None:
+        self.attributes[key] = value
+
+    def defer(self) -> None:
+        """流式响应返回时请求尚未结束，由生成器结束时调用 finish()"""
+        self.deferred = True
+
+    def wrap_stream(self, chunks) -> Iterator:
+        """包装流式输出：ttfb 为开始生成到第一个数据块（含连接服务商），stream 为之后到结束"""
+        started = time.perf_counter()
+        first_at = None
+        try:
+            for chunk in chunks:
+                if first_at is None:
+                    first_at = time.perf_counter()
+                    self.add('ttfb', first_at - started, started)
+                yield chunk
+        finally:
+            if hasattr(chunks, 'close'):
+                chunks.close()
+            if first_at is not None:
+                self.add('stream', time.perf_counter() - first_at, first_at)
+            self.finish()
+
+    def server_timing(self) -> str:
+        """Server-Timing 响应头：已结束的各阶段加上到目前为止的总耗时"""
+        parts = [f"{name};dur={duration}" for name, _offset, duration in list(self.spans)]
+        parts.append(f"total;dur={round((time.perf_counter() - self.started) * 1000, 3)}")
+        return ', '.join(parts)
+
+    def finish(self, status: Optional[int] = None) -> None:
+        if self._finished:
+            return
+        self._finished = True
+        if status is not None:
+            self.attributes['status'] = status
+        self._tracer.export(self)
+
+    def to_record(self) -> dict:
+        return {
+            'trace_id': self.trace_id,
+            'name': self.name,
+            'timestamp': self.wall_started,
+            'duration_ms': round((time.perf_counter() - self.started) * 1000, 3),
+            'spans': [{'name': name, 'start_ms': offset, 'duration_ms': duration}
+                      for name, offset, duration in list(self.spans)],
+            'attributes': self.attributes,
+        }
+
+
+class _NullSpan:
+    __slots__ = ()
+
+    def __enter__(self) -> '_NullSpan':
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        pass
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class _NullTrace:
+    """未采样请求使用的空追踪"""
+
+    sampled = False
+    trace_id = None
+    deferred = False
+
+    def span(self, name: str) -> _NullSpan:
+        return _NULL_SPAN
+
+    def add(self, name: str, duration: float, started: Optional[float] = None) -> None:
+        pass
+
+    def set(self, key: str, value) -> None:
+        pass
+
+    def defer(self) -> None:
+        pass
+
+    def wrap_stream(self, chunks):
+        return chunks
+
+    def finish(self, status: Optional[int] = None) -> None:
+        pass
+
+
+NULL_TRACE = _NullTrace()
+
+
+class Tracer:
+    """按采样率创建 Trace；开启导出时由后台线程批量追加到 JSONL 文件"""
+
+    def __init__(self, log_dir: str, settings: Optional[dict] = None) -> None:
+        self.log_dir = log_dir
+        self._lock = threading.Lock()
+        self._queue: Optional[queue.Queue] = None
+        self._thread: Optional[threading.Thread] = None
+        self.started = 0
+        self.exported = 0
+        self.dropped = 0
+        self.settings = dict(DEFAULT_SETTINGS)
+        self.configure(settings)
+
+    def configure(self, settings: Optional[dict] = None) -> None:
+        merged = dict(DEFAULT_SETTINGS)
+        merged.update({k: v for k, v in (settings or {}).items() if k in DEFAULT_SETTINGS})
+        with self._lock:
+            self.settings = merged
+
+    @property
+    def export_path(self) -> str:
+        return os.path.join(self.log_dir, self.settings['export_file'])
+
+    def start(self, name: str, force: bool = False):
+        """返回新的 Trace；未开启或未被采样时返回 NULL_TRACE"""
+        settings = self.settings
+        if not settings['enabled']:
+            return NULL_TRACE
+        if not force and random.random() >= float(settings['sample_rate']):
+            return NULL_TRACE
+        self.started += 1
+        return Trace(self, name)
+
+    def export(self, trace: Trace) -> None:
+        if not self.settings['export']:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._queue = queue.Queue(maxsize=int(self.settings['max_queue']))
+                self._thread = threading.Thread(target=self._run, name='trace-export', daemon=True)
+                self._thread.start()
+        try:
+            self._queue.put_nowait(trace.to_record())
+        except queue.Full:
+            self.dropped += 1
+
+    def _run(self) -> None:
+        while True:
+            records = [self._queue.get()]
+            while len(records) < 500:
+                try:
+                    records.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self._write(records)
+            except OSError as exc:
+                self.dropped += len(records)
+                print(f"[追踪] 写入失败: {exc}")
+
+    def _write(self, records: List[dict]) -> None:
+        path = self.export_path
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        try:
+            if os.path.getsize(path) >= int(self.settings['max_file_bytes']):
+                os.replace(path, f"{path}.1")
+        except OSError:
+            pass
+        with open(path, 'a', encoding='utf-8') as f:
+            f.write(''.join(json.dumps(record, ensure_ascii=False) + '\n' for record in records))
+        self.exported += len(records)
+
+    def stats(self) -> dict:
+        return {
+            'settings': dict(self.settings),
+            'sampled': self.started,
+            'exported': self.exported,
+            'dropped': self.dropped,
+            'pending': self._queue.qsize() if self._queue is not None else 0,
+        }
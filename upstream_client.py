@@ -0,0 +1,220 @@
+"""上游HTTP客户端 - 共享连接池，复用 TCP/TLS 连接"""
+
+from __future__ import annotations
+
+import socket
+import threading
+from typing import Dict, Optional, Tuple
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+# config.json 中 "upstream" 段的默认值
+DEFAULT_SETTINGS = {
+    'pool_connections': 10,  # 最多缓存多少个主机的连接池
+    'pool_maxsize': 20,      # 每个主机最多保持的连接数
+    'keep_alive': True,      # 关闭后每次请求都会发送 Connection: close
+    'connect_timeout': 10,
+    'read_timeout': 60,
+    'async_max_connections': 512,  # 异步流式引擎（async_server.py）的总连接上限
+}
+
+
+class _PoolStats:
+    """按主机统计请求数和实际建立的连接数（握手次数）"""
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self.hosts: Dict[str, Dict[str, int]] = {}
+
+    def _entry(self, host: str) -> Dict[str, int]:
+        entry = self.hosts.get(host)
+        if entry is None:
+            entry = self.hosts[host] = {'requests': 0, 'connections': 0}
+        return entry
+
+    def record_request(self, host: str) -> None:
+        with self._lock:
+            self._entry(host)['requests'] += 1
+
+    def record_connect(self, host: str) -> None:
+        with self._lock:
+            self._entry(host)['connections'] += 1
+
+    def snapshot(self) -> Dict[str, Dict[str, int]]:
+        with self._lock:
+            return {host: dict(entry) for host, entry in self.hosts.items()}
+
+
+def _counting_pool_classes(stats: _PoolStats):
+    """生成会在每次真正建立连接时计数的连接池类"""
+
+    class CountingHTTPConnection(HTTPConnection):
+        def connect(self):
+            stats.record_connect(f"{self.host}:{self.port}")
+            return super().connect()
+
+    class CountingHTTPSConnection(HTTPSConnection):
+        def connect(self):
+            stats.record_connect(f"{self.host}:{self.port}")
+            return super().connect()
+
+    class CountingHTTPConnectionPool(HTTPConnectionPool):
+        ConnectionCls = CountingHTTPConnection
+
+    class CountingHTTPSConnectionPool(HTTPSConnectionPool):
+        ConnectionCls = CountingHTTPSConnection
+
+    return {'http': CountingHTTPConnectionPool, 'https': CountingHTTPSConnectionPool}
+
+
+class PooledAdapter(HTTPAdapter):
+    """带统计的连接池适配器"""
+
+    def __init__(self, stats: _PoolStats, **kwargs) -> None:
+        self._stats = stats
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = _counting_pool_classes(self._stats)
+
+    def send(self, request, **kwargs):
+        parts = urlsplit(request.url)
+        port = parts.port or (443 if parts.scheme == 'https' else 80)
+        self._stats.record_request(f"{parts.hostname}:{port}")
+        return super().send(request, **kwargs)
+
+    def connection_counts(self) -> Dict[str, Dict[str, int]]:
+        """统计各主机当前空闲/借出的连接数"""
+        counts: Dict[str, Dict[str, int]] = {}
+        pools = self.poolmanager.pools
+        with pools.lock:
+            items = [(key, pools._container[key]) for key in list(pools._container.keys())]
+        for key, pool in items:
+            idle = 0
+            queue = pool.pool
+            if queue is None:
+                continue
+            with queue.mutex:
+                for conn in queue.queue:
+                    if conn is not None and getattr(conn, 'sock', None) is not None:
+                        idle += 1
+                in_use = pool.pool.maxsize - len(queue.queue)
+            counts[f"{key.key_host}:{key.key_port}"] = {'idle': idle, 'in_use': in_use}
+        return counts
+
+
+class UpstreamClient:
+    """线程安全的上游客户端，所有对AI服务商的调用共用同一组连接池"""
+
+    def __init__(self, settings: Optional[dict] = None) -> None:
+        self._lock = threading.Lock()
+        self._stats = _PoolStats()
+        self.settings = dict(DEFAULT_SETTINGS)
+        self._session: Optional[requests.Session] = None
+        self._adapter: Optional[PooledAdapter] = None
+        self.configure(settings)
+
+    def configure(self, settings: Optional[dict] = None) -> None:
+        """应用新配置；连接池参数变化时重建会话"""
+        merged = dict(DEFAULT_SETTINGS)
+        merged.update({k: v for k, v in (settings or {}).items() if k in DEFAULT_SETTINGS})
+        with self._lock:
+            pool_changed = (
+                self._session is None
+                or merged['pool_connections'] != self.settings['pool_connections']
+                or merged['pool_maxsize'] != self.settings['pool_maxsize']
+            )
+            self.settings = merged
+            if pool_changed:
+                old_session = self._session
+                self._session, self._adapter = self._build_session()
+                if old_session is not None:
+                    old_session.close()
+
+    def _build_session(self) -> Tuple[requests.Session, PooledAdapter]:
+        session = requests.Session()
+        adapter = PooledAdapter(
+            self._stats,
+            pool_connections=int(self.settings['pool_connections']),
+            pool_maxsize=int(self.settings['pool_maxsize']),
+        )
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session, adapter
+
+    def timeout(self, read: Optional[float] = None) -> Tuple[float, float]:
+        """返回 (连接超时, 读取超时)，read 可单独覆盖读取超时"""
+        return (
+            float(self.settings['connect_timeout']),
+            float(read if read is not None else self.settings['read_timeout']),
+        )
+
+    def request(self, method: str, url: str, **kwargs) -> requests.Response:
+        kwargs.setdefault('timeout', self.timeout())
+        if not self.settings['keep_alive']:
+            headers = dict(kwargs.get('headers') or {})
+            headers['Connection'] = 'close'
+            kwargs['headers'] = headers
+        return self._session.request(method, url, **kwargs)
+
+    def get(self, url: str, **kwargs) -> requests.Response:
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url: str, **kwargs) -> requests.Response:
+        return self.request('POST', url, **kwargs)
+
+    def stats(self) -> dict:
+        """连接池统计：请求数、握手数、复用率、当前打开的连接"""
+        hosts = self._stats.snapshot()
+        adapter = self._adapter
+        open_counts = adapter.connection_counts() if adapter else {}
+        total_requests = 0
+        total_connections = 0
+        for host, entry in hosts.items():
+            requests_count = entry['requests']
+            connections = entry['connections']
+            entry['reuse_ratio'] = round(1 - connections / requests_count, 4) if requests_count else 0.0
+            entry.update(open_counts.get(host, {'idle': 0, 'in_use': 0}))
+            total_requests += requests_count
+            total_connections += connections
+        return {
+            'settings': dict(self.settings),
+            'requests': total_requests,
+            'connections': total_connections,
+            'reuse_ratio': round(1 - total_connections / total_requests, 4) if total_requests else 0.0,
+            'open_connections': sum(c['idle'] + c['in_use'] for c in open_counts.values()),
+            'hosts': hosts,
+        }
+
+
+def abort_response(response: requests.Response) -> None:
+    """从其他线程中止流式响应：关闭底层套接字的读写，阻塞在读取上的线程会立即返回或抛出异常
+
+    不在这里调用 response.close()，响应仍由读取它的线程关闭，避免两个线程同时操作连接。
+    """
+    connection = getattr(getattr(response, 'raw', None), '_connection', None)
+    sock = getattr(connection, 'sock', None)
+    if sock is None:
+        return
+    try:
+        sock.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass
+
+
+_client = UpstreamClient()
+
+
+def get_client() -> UpstreamClient:
+    """获取进程内共享的上游客户端"""
+    return _client
+
+
+def configure(settings: Optional[dict] = None) -> None:
+    """用 config.json 的 "upstream" 段更新共享客户端"""
+    _client.configure(settings)
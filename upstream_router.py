@@ -0,0 +1,247 @@
+"""多上游路由 - 按权重和健康评分选择服务商，首字节前失败时自动切换到下一个"""
+
+from __future__ import annotations
+
+import random
+import threading
+import time
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import requests
+
+import metrics
+from retry_policy import NON_IDEMPOTENT_SAFE_STATUS, classify_error
+from upstream_client import UpstreamClient, get_client
+
+EWMA_ALPHA = 0.2               # 延迟/错误率滑动平均的权重
+FAILURES_BEFORE_COOLDOWN = 3   # 连续失败多少次后暂时跳过该上游
+COOLDOWN_SECONDS = 30
+DEFAULT_LATENCY = 1.0          # 还没有样本时按 1 秒估计
+
+
+def is_retryable_status(status_code: int) -> bool:
+    """429 和 5xx 视为服务商问题，可以换一个上游重试"""
+    return status_code == 429 or status_code >= 500
+
+
+def can_fail_over(idempotent: bool, status_code: Optional[int] = None,
+                  error: Optional[BaseException] = None) -> bool:
+    """失败后能否把同一个请求发给下一个上游
+
+    非幂等请求（对话、识图，服务商可能已经计费）与重试策略的规则相同：
+    只在连接没有建立或服务商明确拒绝（429/503）时切换。
+    """
+    if error is not None:
+        return idempotent or classify_error(error) == 'connect'
+    if not is_retryable_status(status_code):
+        return False
+    return idempotent or status_code in NON_IDEMPOTENT_SAFE_STATUS
+
+
+class Upstream:
+    """一个 OpenAI 兼容的服务商"""
+
+    def __init__(self, name: str, api_url: str, api_key: str, weight: float = 1.0,
+                 models: Optional[Iterable[str]] = None) -> None:
+        self.name = name
+        self.api_url = api_url.rstrip('/')
+        self.api_key = api_key
+        self.weight = max(float(weight), 0.0)
+        self.models = set(models) if models else None  # None 表示支持所有模型
+
+    def serves(self, model: Optional[str]) -> bool:
+        return model is None or self.models is None or model in self.models
+
+    def url(self, path: str) -> str:
+        return self.api_url + (path if path.startswith('/') else f"/{path}")
+
+    def headers(self, extra: Optional[dict] = None) -> dict:
+        headers = {
+            "Authorization": f"Bearer {self.api_key}",
+            "Content-Type": "application/json"
+        }
+        for key, value in (extra or {}).items():
+            if key.lower() != 'authorization':
+                headers[key] = value
+        return headers
+
+
+class _Health:
+    """单个上游的滑动健康统计"""
+
+    def __init__(self) -> None:
+        self.latency: Optional[float] = None
+        self.error_rate = 0.0
+        self.requests = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.cooldown_until = 0.0
+
+    def score(self) -> float:
+        """越小越好：延迟按错误率放大"""
+        latency = self.latency if self.latency is not None else DEFAULT_LATENCY
+        return (latency + 0.05) * (1 + 10 * self.error_rate)
+
+
+class UpstreamRouter:
+    """线程安全的上游选择与故障切换，底层共用 UpstreamClient 的连接池"""
+
+    def __init__(self, client: Optional[UpstreamClient] = None) -> None:
+        self.client = client or get_client()
+        self._lock = threading.Lock()
+        self._upstreams: List[Upstream] = []
+        self._health: Dict[str, _Health] = {}
+        self.failovers = 0
+
+    def configure(self, config: dict) -> None:
+        """从 config.json 构建上游列表；没有 "upstreams" 段时使用 api_url/api_key"""
+        upstreams = []
+        for index, item in enumerate(config.get('upstreams') or []):
+            if not item.get('api_url'):
+                continue
+            upstreams.append(Upstream(
+                item.get('name') or f"upstream-{index + 1}",
+                item['api_url'],
+                item.get('api_key', ''),
+                item.get('weight', 1.0),
+                item.get('models'),
+            ))
+        if not upstreams and config.get('api_url'):
+            upstreams.append(Upstream('default', config['api_url'], config.get('api_key', '')))
+        with self._lock:
+            self._upstreams = upstreams
+
+    def _health_for(self, upstream: Upstream) -> _Health:
+        # 按地址记录，配置更新或临时指定的上游（如识图）也能沿用历史统计
+        health = self._health.get(upstream.api_url)
+        if health is None:
+            health = self._health[upstream.api_url] = _Health()
+        return health
+
+    def candidates(self, model: Optional[str] = None, primary: Optional[Upstream] = None) -> List[Upstream]:
+        """按尝试顺序返回上游：首选按 权重/评分 加权随机，其余按评分排序，冷却中的排在最后
+
+        primary 不为 None 时它总是第一个，配置的上游只作为备用。
+        """
+        now = time.time()
+        with self._lock:
+            pool = [u for u in self._upstreams if u.serves(model) and u.weight > 0]
+            if primary is not None:
+                pool = [u for u in pool if u.api_url != primary.api_url.rstrip('/')]
+            scored = [(self._health_for(u), u) for u in pool]
+        healthy = sorted(((h.score(), u) for h, u in scored if h.cooldown_until <= now), key=lambda item: item[0])
+        cooling = sorted(((h.cooldown_until, u) for h, u in scored if h.cooldown_until > now), key=lambda item: item[0])
+
+        ordered = [u for _score, u in healthy]
+        if primary is None and len(healthy) > 1:
+            weights = [u.weight / score for score, u in healthy]
+            first = random.choices(range(len(healthy)), weights=weights)[0]
+            ordered.insert(0, ordered.pop(first))
+        ordered.extend(u for _until, u in cooling)
+        if primary is not None:
+            ordered.insert(0, primary)
+        return ordered
+
+    def record(self, upstream: Upstream, ok: bool, latency: Optional[float] = None) -> None:
+        with self._lock:
+            health = self._health_for(upstream)
+            health.requests += 1
+            health.error_rate = (1 - EWMA_ALPHA) * health.error_rate + EWMA_ALPHA * (0.0 if ok else 1.0)
+            if ok:
+                health.consecutive_failures = 0
+                health.cooldown_until = 0.0
+                if latency is not None:
+                    health.latency = latency if health.latency is None else (
+                        (1 - EWMA_ALPHA) * health.latency + EWMA_ALPHA * latency
+                    )
+            else:
+                health.failures += 1
+                health.consecutive_failures += 1
+                if health.consecutive_failures >= FAILURES_BEFORE_COOLDOWN:
+                    health.cooldown_until = time.time() + COOLDOWN_SECONDS
+
+    def record_failover(self) -> None:
+        with self._lock:
+            self.failovers += 1
+
+    def request(self, method: str, path: str, model: Optional[str] = None,
+                primary: Optional[Upstream] = None, idempotent: bool = True,
+                **kwargs) -> Tuple[requests.Response, Upstream]:
+        """依次尝试候选上游，返回 (响应, 实际使用的上游)
+
+        只在拿到响应体之前切换：连接错误、超时、429、5xx 换下一个上游；
+        idempotent 为 False 时只在连接失败和 429/503 时切换（见 can_fail_over）。
+        流式请求（stream=True）拿到响应头即返回，之后的错误不再切换。
+        全部失败时返回最后一个错误响应，或抛出最后一个连接异常。
+        """
+        targets = self.candidates(model, primary)
+        if not targets:
+            raise ValueError("没有可用的上游（请检查 api_url 或 upstreams 配置）")
+        extra_headers = kwargs.pop('headers', None)
+        last_error: Optional[Exception] = None
+        for attempt, target in enumerate(targets):
+            if attempt:
+                self.record_failover()
+            is_last = attempt == len(targets) - 1
+            started = time.monotonic()
+            try:
+                response = self.client.request(method, target.url(path), headers=target.headers(extra_headers), **kwargs)
+            except requests.RequestException as exc:
+                self.record(target, False)
+                metrics.upstream_responses.labels(target.name, path, 'error').inc()
+                last_error = exc
+                print(f"[上游路由] {target.name} 请求失败: {exc}")
+                if not can_fail_over(idempotent, error=exc):
+                    raise
+                continue
+            metrics.upstream_responses.labels(target.name, path, response.status_code).inc()
+            if is_retryable_status(response.status_code):
+                self.record(target, False)
+                if not is_last and can_fail_over(idempotent, status_code=response.status_code):
+                    print(f"[上游路由] {target.name} 返回 {response.status_code}，切换到下一个上游")
+                    response.close()
+                    continue
+                return response, target
+            self.record(target, True, time.monotonic() - started)
+            return response, target
+        raise last_error
+
+    def get(self, path: str, model: Optional[str] = None, **kwargs) -> Tuple[requests.Response, Upstream]:
+        return self.request('GET', path, model, **kwargs)
+
+    def post(self, path: str, model: Optional[str] = None, **kwargs) -> Tuple[requests.Response, Upstream]:
+        return self.request('POST', path, model, **kwargs)
+
+    def stats(self) -> dict:
+        """各上游的延迟、错误率和冷却状态"""
+        now = time.time()
+        with self._lock:
+            upstreams = []
+            for upstream in self._upstreams:
+                health = self._health_for(upstream)
+                upstreams.append({
+                    'name': upstream.name,
+                    'api_url': upstream.api_url,
+                    'weight': upstream.weight,
+                    'models': sorted(upstream.models) if upstream.models is not None else None,
+                    'latency_ms': round(health.latency * 1000, 1) if health.latency is not None else None,
+                    'error_rate': round(health.error_rate, 4),
+                    'requests': health.requests,
+                    'failures': health.failures,
+                    'cooling_down': health.cooldown_until > now,
+                    'score': round(health.score(), 4),
+                })
+            return {'failovers': self.failovers, 'upstreams': upstreams}
+
+
+_router = UpstreamRouter()
+
+
+def get_router() -> UpstreamRouter:
+    """获取进程内共享的上游路由"""
+    return _router
+
+
+def configure(config: dict) -> None:
+    """用完整的 config.json 更新共享路由"""
+    _router.configure(config)